@@ -0,0 +1,2 @@
+VERSION = "test"
+BUILD = "0"
@@ -5,9 +5,10 @@ import asm3.utils
 import asm3.movement
 
 from asm3.i18n import _, python2display
-from asm3.typehints import Database, PostedData, Results
+from asm3.typehints import Database, Dict, List, PostedData, Results
 
 import sys
+import time
 
 # Links
 ANIMAL = 0
@@ -82,6 +83,16 @@ PERSON_SPONSOR = 11
 PERSON_VET = 12
 PERSON_ADOPTIONCOORDINATOR = 13
 
+# The most link IDs to put in a single IN clause when loading values in bulk
+CHUNK_SIZE = 1000
+
+# How long to keep field definitions in memory for the bulk loader, in seconds.
+# Changes made through this module clear the cache straight away, this is 
+# for changes made by other processes.
+FIELD_DEFINITIONS_TTL = 60
+
+field_definitions = {} # (database name, linktype) : (time loaded, definitions)
+
 def clause_for_linktype(linktype: str) -> str:
     """ Returns the appropriate clause for a link type """
     inclause = ANIMAL_IN
@@ -147,17 +158,40 @@ def get_additional_fields_ids(dbo: Database, rows: Results, linktype: str = "ani
     fields for lists of animals
     """
     inclause = clause_for_linktype(linktype)
-    links = []
-    for r in rows:
-        links.append(str(r.id))
-    if len(links) == 0:
-        links.append("0")
-    return dbo.query("SELECT af.*, a.LinkID, a.Value, " \
-        "CASE WHEN af.FieldType = 8 AND a.Value <> '' AND a.Value <> '0' THEN (SELECT AnimalName FROM animal WHERE %s = a.Value) ELSE '' END AS AnimalName, " \
-        "CASE WHEN af.FieldType IN (9, 11, 12) AND a.Value <> '' AND a.Value <> '0' THEN (SELECT OwnerName FROM owner WHERE %s = a.Value) ELSE '' END AS OwnerName " \
-        "FROM additional a INNER JOIN additionalfield af ON af.ID = a.AdditionalFieldID " \
-        "WHERE a.LinkType IN (%s) AND a.LinkID IN (%s) " \
-        "ORDER BY af.DisplayIndex" % ( dbo.sql_cast_char("animal.ID"), dbo.sql_cast_char("owner.ID"), inclause, ",".join(links)))
+    rv = []
+    for links in _chunk_ids(r.id for r in rows):
+        rv += dbo.query("SELECT af.*, a.LinkID, a.Value, " \
+            "CASE WHEN af.FieldType = 8 AND a.Value <> '' AND a.Value <> '0' THEN (SELECT AnimalName FROM animal WHERE %s = a.Value) ELSE '' END AS AnimalName, " \
+            "CASE WHEN af.FieldType IN (9, 11, 12) AND a.Value <> '' AND a.Value <> '0' THEN (SELECT OwnerName FROM owner WHERE %s = a.Value) ELSE '' END AS OwnerName " \
+            "FROM additional a INNER JOIN additionalfield af ON af.ID = a.AdditionalFieldID " \
+            "WHERE a.LinkType IN (%s) AND a.LinkID IN (%s) " \
+            "ORDER BY af.DisplayIndex" % ( dbo.sql_cast_char("animal.ID"), dbo.sql_cast_char("owner.ID"), inclause, links))
+    if rv and len(rows) > CHUNK_SIZE:
+        rv.sort(key=lambda r: r.DISPLAYINDEX or 0)
+    return rv
+
+def get_additional_values_ids(dbo: Database, ids: List[int], linktype: str = "animal") -> Dict[int, Dict[int, str]]:
+    """
+    Returns the additional field values for the linktype and every id in ids,
+    as a dictionary of { linkid: { additionalfieldid: value } }.
+    Values are read with one query for every CHUNK_SIZE ids.
+    """
+    inclause = clause_for_linktype(linktype)
+    rv = {}
+    for links in _chunk_ids(ids):
+        for r in dbo.query_view("SELECT LinkID, AdditionalFieldID, Value FROM additional " \
+            "WHERE LinkType IN (%s) AND LinkID IN (%s)" % (inclause, links)):
+            rv.setdefault(r.LINKID, {})[r.ADDITIONALFIELDID] = r.VALUE
+    return rv
+
+def _chunk_ids(ids) -> List[str]:
+    """
+    Splits ids into comma separated lists of CHUNK_SIZE integers
+    for use in IN clauses. Always returns at least one list.
+    """
+    ids = [ str(int(i)) for i in ids ]
+    if len(ids) == 0: return [ "0" ]
+    return [ ",".join(ids[i:i+CHUNK_SIZE]) for i in range(0, len(ids), CHUNK_SIZE) ]
 
 def get_additional_fields_dict(dbo: Database, post: PostedData, linktype: str) -> dict:
     """
@@ -181,6 +215,26 @@ def get_field_definitions(dbo: Database, linktype: str = "animal") -> Results:
     inclause = clause_for_linktype(linktype)
     return dbo.query("SELECT * FROM additionalfield WHERE LinkType IN (%s) ORDER BY DisplayIndex" % inclause)
 
+def get_field_definitions_cached(dbo: Database, linktype: str = "animal") -> Results:
+    """
+    Returns the field definitions for the linktype given from an in memory
+    copy that lasts FIELD_DEFINITIONS_TTL seconds. The rows must not be changed.
+    """
+    key = (dbo.name(), linktype)
+    cached = field_definitions.get(key)
+    if cached is not None and time.time() - cached[0] < FIELD_DEFINITIONS_TTL:
+        return cached[1]
+    defs = get_field_definitions(dbo, linktype)
+    field_definitions[key] = (time.time(), defs)
+    return defs
+
+def invalidate_field_definitions(dbo: Database) -> None:
+    """
+    Clears the in memory copies of the field definitions for this database
+    """
+    for k in list(field_definitions.keys()):
+        if k[0] == dbo.name(): field_definitions.pop(k, None)
+
 def get_ids_for_fieldtype(dbo: Database, fieldtype: int) -> list:
     """
     Returns a list of ID numbers for additional field definitions of a particular field type 
@@ -212,19 +266,25 @@ def append_to_results(dbo: Database, rows: Results, linktype: str = "animal") ->
     Goes through each row in rows and adds any additional fields to the resultset.
     Requires an ID column in the rows.
     """
+    if len(rows) == 0: return rows
+    fields = get_field_definitions_cached(dbo, linktype)
+    if len(fields) == 0: return rows
+    values = get_additional_values_ids(dbo, [ r.ID for r in rows if r.ID is not None ], linktype)
+    novalues = {}
     for r in rows:
-        add = get_additional_fields(dbo, r.ID, linktype)
-        for af in add:
+        if r.ID is None: continue
+        v = values.get(r.ID, novalues)
+        for af in fields:
             tn = af.FIELDNAME.upper()
             if tn.find("&") != -1:
                 # We've got unicode chars for the tag name - not allowed
-                r["ADD" + str(af.id)] = af.VALUE
+                r["ADD" + str(af.ID)] = v.get(af.ID)
             elif tn in r:
                 # This key already exists - do not allow a collision. 
                 # This happened where a user named a field ID and it broke animal_view_adoptable_js
-                r["ADD%s" % tn] = af.VALUE
+                r["ADD%s" % tn] = v.get(af.ID)
             else:
-                r[tn] = af.VALUE
+                r[tn] = v.get(af.ID)
     return rows
 
 def sanitise_lookup_values(s):
@@ -241,7 +301,7 @@ def insert_field_from_form(dbo: Database, username: str, post: PostedData) -> in
     Creates an additional field
     """
     validate_field(dbo, post)
-    return dbo.insert("additionalfield", {
+    nid = dbo.insert("additionalfield", {
         "FieldName":        post["name"],
         "FieldLabel":       post["label"],
         "ToolTip":          post["tooltip"],
@@ -255,6 +315,8 @@ def insert_field_from_form(dbo: Database, username: str, post: PostedData) -> in
         "LinkType":         post.integer("link"),
         "DisplayIndex":     post.integer("displayindex")
     }, username, setRecordVersion=False, setCreated=False)
+    invalidate_field_definitions(dbo)
+    return nid
 
 def update_field_from_form(dbo: Database, username: str, post: PostedData) -> None:
     """
@@ -277,6 +339,7 @@ def update_field_from_form(dbo: Database, username: str, post: PostedData) -> No
         "LinkType":         post.integer("link"),
         "DisplayIndex":     post.integer("displayindex")
     }, username, setRecordVersion=False, setLastChanged=False)
+    invalidate_field_definitions(dbo)
 
 def validate_field(dbo: Database, post: PostedData) -> None:
     """
@@ -320,6 +383,7 @@ def delete_field(dbo: Database, username: str, fid: int) -> None:
     """
     dbo.delete("additionalfield", fid, username)
     dbo.delete("additional", "AdditionalFieldID=%d" % fid)
+    invalidate_field_definitions(dbo)
 
 def insert_additional(dbo: Database, linktype: int, linkid: int, additionalfieldid: int, value: str) -> int:
     """ Inserts an additional field record """
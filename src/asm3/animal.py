@@ -18,7 +18,9 @@ import asm3.users
 
 from asm3.i18n import _, date_diff, date_diff_days, format_diff, display2python, python2display, remove_time, subtract_years, subtract_months
 from asm3.i18n import add_days, subtract_days, monday_of_week, first_of_month, last_of_month, first_of_year
-from asm3.typehints import Database, List, PostedData, ResultRow, Results, Tuple
+from asm3.typehints import Any, Database, Dict, List, PostedData, ResultRow, Results, Tuple
+
+import bisect
 
 from datetime import datetime
 from random import choice
@@ -5102,6 +5104,150 @@ def get_number_animals_on_foster(dbo: Database, date: datetime, speciesid: int =
     sql += " AND (ReturnDate > %s OR ReturnDate Is Null))" % sdate
     return dbo.query_int(sql)
 
+class FiguresInventory(object):
+    """
+    Calculates the daily on shelter, on foster and litter counts used by the 
+    animal figures for a run of consecutive days. 
+    The animals, movements and litters for the period are loaded once and 
+    turned into ranges of day indexes, then the counts for every group are 
+    built in one sweep over them, rather than running a query per day per group.
+    The rules are the same as get_number_animals_on_shelter, 
+    get_number_animals_on_foster and get_number_litters_on_shelter.
+    """
+    dbo = None
+    days = 0
+    starts = None
+    ends = None
+    animals = None
+    movements = None
+    litters = None
+
+    def __init__(self, dbo: Database, fromdate: datetime, days: int) -> None:
+        """
+        fromdate: The first day to calculate figures for
+        days: The number of days from fromdate to calculate figures for
+        """
+        self.dbo = dbo
+        self.days = days
+        fromdate = datetime(fromdate.year, fromdate.month, fromdate.day)
+        # The instants each day is counted at, the start of the day for foster
+        # and litter counts and the end of the day for on shelter counts
+        self.starts = [ add_days(fromdate, i) for i in range(0, days) ]
+        self.ends = [ d.replace(hour=23, minute=59, second=59) for d in self.starts ]
+        self.animals = dbo.query_view("SELECT ID, SpeciesID, AnimalTypeID, ShelterLocation, " \
+            "DateOfBirth, DateBroughtIn, DeceasedDate FROM animal " \
+            "WHERE NonShelterAnimal = 0 AND DateBroughtIn <= ? " \
+            "AND (DeceasedDate Is Null OR DeceasedDate >= ?)", [ self.ends[-1], self.starts[0] ])
+        self.movements = {}
+        for m in dbo.query_view("SELECT AnimalID, MovementType, MovementDate, ReturnDate FROM adoption " \
+            "WHERE MovementType > 0 AND MovementDate Is Not Null AND MovementDate <= ? " \
+            "AND (ReturnDate Is Null OR ReturnDate >= ?)", [ self.ends[-1], self.starts[0] ]):
+            self.movements.setdefault(m.ANIMALID, []).append(m)
+        self.litters = dbo.query_view("SELECT SpeciesID, Date, InvalidDate FROM animallitter " \
+            "WHERE Date <= ? AND (InvalidDate Is Null OR InvalidDate > ?)", [ self.starts[-1], self.starts[0] ])
+
+    def _from(self, instants: List[datetime], d: datetime) -> int:
+        """ Returns the index of the first instant at or after d """
+        if d is None: return 0
+        return bisect.bisect_left(instants, d)
+
+    def _to(self, instants: List[datetime], d: datetime, inclusive: bool) -> int:
+        """ Returns the index after the last instant before d (or at d if inclusive) """
+        if d is None: return self.days
+        if inclusive: return bisect.bisect_right(instants, d)
+        return bisect.bisect_left(instants, d)
+
+    def _merge(self, ranges: List[Tuple[int, int]], lo: int, hi: int) -> List[Tuple[int, int]]:
+        """ Clips a list of day index ranges to lo-hi and merges any that overlap """
+        merged = []
+        for a, b in sorted(ranges):
+            a = max(a, lo)
+            b = min(b, hi)
+            if a >= b: continue
+            if merged and a <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(b, merged[-1][1]))
+            else:
+                merged.append((a, b))
+        return merged
+
+    def _sweep(self, spans: List[Tuple[Any, int, int, int]]) -> Dict[Any, List[int]]:
+        """ Turns a list of (group, start, end, +1/-1) spans into daily counts for each group """
+        diffs = {}
+        for group, a, b, v in spans:
+            if a >= b: continue
+            if group not in diffs: diffs[group] = [0] * (self.days + 1)
+            diffs[group][a] += v
+            diffs[group][b] -= v
+        counts = {}
+        for group, diff in diffs.items():
+            running = 0
+            c = []
+            for i in range(0, self.days):
+                running += diff[i]
+                c.append(running)
+            counts[group] = c
+        return counts
+
+    def _age_range(self, a: ResultRow, ageselection: int) -> Tuple[int, int]:
+        """ Returns the range of days an animal falls in the age selection 
+            (1 = under six months, 2 = over six months, 0 = all ages) """
+        if ageselection == 0: return (0, self.days)
+        if a.DATEOFBIRTH is None: return (0, 0)
+        sixmonths = self._to(self.starts, add_days(a.DATEOFBIRTH, 182), True)
+        if ageselection == 1: return (0, sixmonths)
+        return (sixmonths, self.days)
+
+    def on_shelter(self, groupby: str = "SPECIESID", ageselection: int = 0) -> Dict[int, List[int]]:
+        """
+        Returns a dictionary of the number of animals on shelter at the end of
+        each day, keyed by the value of the animal column groupby.
+        ageselection: 0 = all ages, 1 = under six months, 2 = over six months
+        """
+        spans = []
+        for a in self.animals:
+            lo, hi = self._age_range(a, ageselection)
+            lo = max(lo, self._from(self.ends, a.DATEBROUGHTIN))
+            hi = min(hi, self._to(self.ends, a.DECEASEDDATE, True))
+            if lo >= hi: continue
+            group = a[groupby]
+            spans.append((group, lo, hi, 1))
+            # Days the animal was off shelter on a movement do not count
+            moves = [ (self._from(self.ends, m.MOVEMENTDATE), self._to(self.ends, m.RETURNDATE, True)) for m in self.movements.get(a.ID, []) ]
+            for ma, mb in self._merge(moves, lo, hi):
+                spans.append((group, ma, mb, -1))
+        return self._sweep(spans)
+
+    def on_foster(self, groupby: str = "SPECIESID") -> Dict[int, List[int]]:
+        """
+        Returns a dictionary of the number of animals on foster at the start of
+        each day, keyed by the value of the animal column groupby.
+        """
+        spans = []
+        for a in self.animals:
+            if a.ID not in self.movements: continue
+            lo = self._from(self.starts, a.DATEBROUGHTIN)
+            hi = self._to(self.starts, a.DECEASEDDATE, False)
+            moves = [ (self._from(self.starts, m.MOVEMENTDATE), self._to(self.starts, m.RETURNDATE, False)) \
+                for m in self.movements[a.ID] if m.MOVEMENTTYPE == asm3.movement.FOSTER ]
+            for ma, mb in self._merge(moves, lo, hi):
+                spans.append((a[groupby], ma, mb, 1))
+        return self._sweep(spans)
+
+    def litters_on_shelter(self) -> Dict[int, List[int]]:
+        """
+        Returns a dictionary of the number of active litters at the start of 
+        each day, keyed by species.
+        """
+        spans = []
+        for l in self.litters:
+            spans.append((l.SPECIESID, self._from(self.starts, l.DATE), self._to(self.starts, l.INVALIDDATE, False), 1))
+        return self._sweep(spans)
+
+    def days_dict(self, counts: Dict[int, List[int]], group: int) -> Dict[str, int]:
+        """ Returns the daily counts for group as a dictionary of D1..Dn for add_row """
+        c = counts.get(group, [0] * self.days)
+        return { "D%d" % (i + 1): c[i] for i in range(0, self.days) }
+
 def update_animal_figures(dbo: Database, month: int = 0, year: int = 0) -> str:
     """
     Updates the animal figures table for the month and year given.
@@ -5251,7 +5397,14 @@ def update_animal_figures(dbo: Database, month: int = 0, year: int = 0) -> str:
     firstofmonth = dbo.sql_date(fom)
     lastofmonth = dbo.sql_date(lom)
     daysinmonth = lom.day
-    loopdays = daysinmonth + 1
+
+    # Calculate the daily inventory counts for every species and type in one go
+    inventory = FiguresInventory(dbo, fom, daysinmonth)
+    sponshelter = inventory.on_shelter("SPECIESID")
+    sponfoster = inventory.on_foster("SPECIESID")
+    splitters = inventory.litters_on_shelter()
+    atonshelter = inventory.on_shelter("ANIMALTYPEID")
+    atonfoster = inventory.on_foster("ANIMALTYPEID")
 
     # Species =====================================
     allspecies = asm3.lookups.get_species(dbo)
@@ -5264,19 +5417,11 @@ def update_animal_figures(dbo: Database, month: int = 0, year: int = 0) -> str:
             continue
 
         # On Shelter
-        onshelter = {}
-        for i in range(1, loopdays):
-            d = datetime(year, month, i)
-            dk = "D%d" % i
-            onshelter[dk] = get_number_animals_on_shelter(dbo, d, speciesid)
+        onshelter = inventory.days_dict(sponshelter, speciesid)
         add_row(1, "SP_ONSHELTER", 0, speciesid, daysinmonth, _("On Shelter", l), 0, False, onshelter)
 
         # On Foster
-        onfoster = {}
-        for i in range(1, loopdays):
-            d = datetime(year, month, i)
-            dk = "D%d" % i
-            onfoster[dk] = get_number_animals_on_foster(dbo, d, speciesid)
+        onfoster = inventory.days_dict(sponfoster, speciesid)
         add_row(2, "SP_ONFOSTER", 0, speciesid, daysinmonth, _("On Foster", l), 0, False, onfoster)
         # NOTE: On Foster counts are not added to the day counts deliberately.
         # Start/End of day counts only track on shelter animals.
@@ -5285,11 +5430,7 @@ def update_animal_figures(dbo: Database, month: int = 0, year: int = 0) -> str:
         sheltertotal = onshelter
 
         # Litters
-        litters = {}
-        for i in range(1, loopdays):
-            d = datetime(year, month, i)
-            dk = "D%d" % i
-            litters[dk] = get_number_litters_on_shelter(dbo, d, speciesid)
+        litters = inventory.days_dict(splitters, speciesid)
         add_row(3, "SP_LITTERS", 0, speciesid, daysinmonth, _("Litters", l), 0, False, litters)
 
         # Start of day total - handled at the end.
@@ -5463,19 +5604,11 @@ def update_animal_figures(dbo: Database, month: int = 0, year: int = 0) -> str:
             continue
 
         # On Shelter
-        onshelter = {}
-        for i in range(1, loopdays):
-            d = datetime(year, month, i)
-            dk = "D%d" % i
-            onshelter[dk] = get_number_animals_on_shelter(dbo, d, 0, typeid)
+        onshelter = inventory.days_dict(atonshelter, typeid)
         add_row(1, "AT_ONSHELTER", typeid, 0, daysinmonth, _("On Shelter", l), 0, False, onshelter)
 
         # On Foster
-        onfoster = {}
-        for i in range(1, loopdays):
-            d = datetime(year, month, i)
-            dk = "D%d" % i
-            onfoster[dk] = get_number_animals_on_foster(dbo, d, 0, typeid)
+        onfoster = inventory.days_dict(atonfoster, typeid)
         add_row(2, "AT_ONFOSTER", typeid, 0, daysinmonth, _("On Foster", l), 0, False, onfoster)
         #sheltertotal = add_days((onshelter, onfoster))
         sheltertotal = onshelter
@@ -6,16 +6,69 @@ Only allows one async task per database to be run at a time.
 For many tasks, it should be as simple as calling their function as
 an argument to function_task, and having the function code call 
 async.set_progress_value(>100) or async.increment_progress_value()
+
+The progress value and cancel flag of a task are kept in memory by the
+process running it (see Channel), so that tasks can update progress and
+check for cancellation for every row they process. They are written to
+and read from the shared store at most every FLUSH_INTERVAL seconds for
+other processes to see.
 """
 
 import asm3.cachedisk
+import asm3.cachemem
 
+from asm3.sitedefs import MEMCACHED_SERVER
 from asm3.typehints import Any, Callable, Database
 
 import threading
+import time
 
 lc = {}
 
+# The most often (seconds) a running task writes its progress to or reads
+# its cancel flag from the shared store
+FLUSH_INTERVAL = 0.25
+
+class Channel(object):
+    """ The progress value and cancel flag for a task running in this process """
+    def __init__(self, value: int, progressmax: int, cancel: bool) -> None:
+        self.lock = threading.Lock()
+        self.value = value
+        self.flushedvalue = value
+        self.max = progressmax
+        self.cancel = cancel
+        self.flushed = time.time() # when value was last written to the shared store
+        self.checked = time.time() # when cancel was last read from the shared store
+
+channels = {} # database name: Channel
+channels_lock = threading.Lock()
+
+def _channel(dbo: Database) -> Channel:
+    """ Returns the channel for the task running for this database in this process, creating it if necessary """
+    with channels_lock:
+        c = channels.get(dbo.name())
+        if c is None:
+            c = Channel(_get_value(dbo) or 0, get_progress_max(dbo) or 0, get(dbo, "taskcancel") or False)
+            channels[dbo.name()] = c
+        return c
+
+def _value_key(dbo: Database) -> str:
+    return "asynctask:%s:taskval" % dbo.name()
+
+def _get_value(dbo: Database) -> int:
+    """ Reads the progress value from the shared store (memcache if it is configured) """
+    if MEMCACHED_SERVER != "": return asm3.cachemem.get(_value_key(dbo))
+    return get(dbo, "taskval")
+
+def _put_value(dbo: Database, v: int, delta: int = 0) -> None:
+    """ Writes the progress value to the shared store. If delta is given and memcache
+        is configured, the stored value is incremented by delta instead. """
+    if MEMCACHED_SERVER != "": 
+        if delta == 0 or asm3.cachemem.increment(_value_key(dbo), delta) is None:
+            asm3.cachemem.put(_value_key(dbo), v, 3600)
+    else:
+        put(dbo, "taskval", v)
+
 def get(dbo: Database, k: str) -> Any:
     """ Retrieve a task value for this database """
     return asm3.cachedisk.get(k, dbo.name())
@@ -28,7 +81,7 @@ def is_task_running(dbo: Database) -> bool:
     """ Returns True if a task is running """
     name = get(dbo, "taskname")
     mx = get(dbo, "taskmax")
-    v = get(dbo, "taskval")
+    v = _get_value(dbo)
     if v is not None and v == mx:
         return False
     if name is not None and name != "":
@@ -37,9 +90,11 @@ def is_task_running(dbo: Database) -> bool:
 
 def reset(dbo: Database) -> None:
     """ Clear all task related values (except lasterror and returnvalue) """
+    with channels_lock:
+        channels.pop(dbo.name(), None)
     put(dbo, "taskname", "")
     put(dbo, "taskmax", 0)
-    put(dbo, "taskval", 0)
+    _put_value(dbo, 0)
     put(dbo, "taskcancel", False)
     # tasklasterror, taskreturnvalue deliberately not cleared
 
@@ -60,11 +115,12 @@ def get_progress_max(dbo: Database) -> int:
    
 def set_progress_max(dbo: Database, progressmax: int) -> None:
     """ Set a value for the maximum progress meter """
+    _channel(dbo).max = progressmax
     put(dbo, "taskmax", progressmax)
 
 def get_progress_value(dbo: Database) -> int:
     """ Get a value for the progress meter """
-    return get(dbo, "taskval")
+    return _get_value(dbo)
 
 def get_progress_percent(dbo: Database) -> int:
     m = get_progress_max(dbo)
@@ -75,23 +131,43 @@ def get_progress_percent(dbo: Database) -> int:
 
 def set_progress_value(dbo, v: int) -> None:
     """ Set a value for the progress meter """
-    return put(dbo, "taskval", v)
+    c = _channel(dbo)
+    with c.lock:
+        c.value = v
+        c.flushedvalue = v
+        c.flushed = time.time()
+    _put_value(dbo, v)
 
 def increment_progress_value(dbo: Database) -> None:
-    """ Adds one to the progress value """
-    v = get_progress_value(dbo)
-    if v is not None: 
-        v += 1
-        set_progress_value(dbo, v)
+    """ Adds one to the progress value. The new value is only written to the 
+        shared store if FLUSH_INTERVAL has passed since it was last written or
+        the value has reached the max. """
+    c = _channel(dbo)
+    with c.lock:
+        c.value += 1
+        v = c.value
+        if v < c.max and time.time() - c.flushed < FLUSH_INTERVAL: return
+        delta = v - c.flushedvalue
+        c.flushedvalue = v
+        c.flushed = time.time()
+    _put_value(dbo, v, delta)
 
 def get_cancel(dbo: Database) -> bool:
     """ Returns whether the running task should stop """
+    c = channels.get(dbo.name())
+    if c is not None and time.time() - c.checked < FLUSH_INTERVAL:
+        return c.cancel
     v = get(dbo, "taskcancel")
-    if v is None: return False
+    if v is None: v = False
+    if c is not None:
+        c.cancel = v
+        c.checked = time.time()
     return v
 
 def set_cancel(dbo, v: bool) -> None:
     """ Set to True to tell the running task to stop """
+    c = channels.get(dbo.name())
+    if c is not None: c.cancel = v
     put(dbo, "taskcancel", v)
 
 def get_return_value(dbo: Database) -> str:
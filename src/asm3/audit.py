@@ -76,12 +76,12 @@ def map_diff(row1: ResultRow, row2: ResultRow, ref: List[str] = []) -> str:
     is empty, an empty dict will be used for comparison.
     if ref is set, output those fields (if available) from row1
     """
-    if type(row1) is not dict:
+    if not isinstance(row1, dict):
         if len(row1) > 0: 
             row1 = row1[0]
         else:
             row1 = {}
-    if type(row2) is not dict:
+    if not isinstance(row2, dict):
         if len(row2) > 0:
             row2 = row2[0]
         else:
@@ -116,13 +116,16 @@ def edit(dbo: Database, username: str, tablename: str, linkid: int, parentlinks:
 def delete(dbo: Database, username: str, tablename: str, linkid: int, parentlinks: str, description: str) -> None:
     action(dbo, DELETE, username, tablename, linkid, parentlinks, description)
 
-def delete_rows(dbo: Database, username: str, tablename: str, condition: str) -> None:
-    rows = dbo.query("SELECT * FROM %s WHERE %s" % (tablename, condition))
+def delete_rows(dbo: Database, username: str, tablename: str, condition: str, rows: Results = None) -> None:
+    """ Writes audit records for the rows matching condition that are about to be deleted.
+        rows: The rows matching condition if the caller has already read them """
+    if rows is None:
+        rows = dbo.query("SELECT * FROM %s WHERE %s" % (tablename, condition))
     # If there's an ID column, log an audited delete for each row
     if len(rows) > 0 and "ID" in rows[0]:
-        for r in dbo.query("SELECT * FROM %s WHERE %s" % (tablename, condition)):
+        for r in rows:
             parentlinks = get_parent_links(r, tablename)
-            action(dbo, DELETE, username, tablename, r.ID, parentlinks, dump_row(dbo, tablename, r.ID))
+            action(dbo, DELETE, username, tablename, r.ID, parentlinks, str([r])) # same output as dump_row
     else:
         # otherwise, stuff all the deleted rows into one delete action
         action(dbo, DELETE, username, tablename, 0, "", str(rows))
@@ -143,10 +146,13 @@ def get_restoresql(dbo: Database, tablename: str, iid: int) -> str:
     """ Returns the restore SQL for a given table/ID combo """
     return dbo.query_string("SELECT RestoreSQL FROM deletion WHERE ID=? AND TableName=?", (iid, tablename))
 
-def insert_deletions(dbo: Database, username: str, tablename: str, condition: str) -> None:
-    rows = dbo.query("SELECT * FROM %s WHERE %s" % (tablename, condition))
+def insert_deletions(dbo: Database, username: str, tablename: str, condition: str, rows: Results = None) -> None:
+    """ Writes deletion records for the rows matching condition that are about to be deleted.
+        rows: The rows matching condition if the caller has already read them """
+    if rows is None:
+        rows = dbo.query("SELECT * FROM %s WHERE %s" % (tablename, condition))
     if len(rows) > 0 and "ID" in rows[0]:
-        for r in dbo.query("SELECT * FROM %s WHERE %s" % (tablename, condition)):
+        for r in rows:
             parentlinks = get_parent_links(r, tablename)
             insert_deletion(dbo, username, tablename, r.ID, parentlinks, dbo.row_to_insert_sql(tablename, r))
 
@@ -47,7 +47,7 @@ def _send_email_from_template(dbo: Database, to: str, subject: str, body: str,
     bcc = mt["BCC"] or ""
     subject = mt["SUBJECT"] or subject
     try:
-        asm3.utils.send_email(dbo, fromadd, to, cc, bcc, subject, body, "html")
+        asm3.utils.send_email(dbo, fromadd, to, cc, bcc, subject, body, "html", queue=True)
         if asm3.configuration.audit_on_send_email(dbo): 
             asm3.audit.email(dbo, user, fromadd, to, cc, bcc, subject, body)
         if logtypeid == -1: logtypeid = asm3.configuration.system_log_type(dbo)
@@ -315,7 +315,7 @@ def fosterer_weekly(dbo: Database, user = "system") -> None:
             if asm3.configuration.fosterer_email_skip_no_medical(dbo) and not hasmedicaldue: continue
             subject = asm3.i18n._("Fosterer Medical Report", l)
             body = "\n".join(lines)
-            asm3.utils.send_email(dbo, replyto, f.EMAILADDRESS, subject=subject, body=body, contenttype="html", exceptions=False)
+            asm3.utils.send_email(dbo, replyto, f.EMAILADDRESS, subject=subject, body=body, contenttype="html", exceptions=False, queue=True)
             if asm3.configuration.audit_on_send_email(dbo): 
                 asm3.audit.email(dbo, user, replyto, f.EMAILADDRESS, "", "", subject, body)
 
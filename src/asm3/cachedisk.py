@@ -1,22 +1,50 @@
-
 """
-Implements a python disk cache in a similar way to memcache,
-uses md5sums of the key as filenames.
+Implements a python disk cache in a similar way to memcache.
+
+Each path (usually a database name) has its own SQLite file in DISK_CACHE,
+holding a single table of entries indexed by the md5sum of the key.
+SQLite handles locking between processes and each thread keeps its own
+connection, so there is no global lock. Entries expire after their ttl and
+if the store grows past DISK_CACHE_MAX_SIZE, the least recently used
+entries are evicted.
 """
 
 import asm3.al
 
-import fcntl
 import hashlib
 import os
 import pickle
 import re
+import sqlite3
 import threading
 import time
 
-from asm3.sitedefs import DISK_CACHE
+from asm3.sitedefs import DISK_CACHE, DISK_CACHE_MAX_SIZE
 from asm3.typehints import Any
 
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS cache (Key TEXT PRIMARY KEY, Expires REAL NOT NULL, Accessed REAL NOT NULL, Size INTEGER NOT NULL, Value BLOB NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS cache_Accessed ON cache (Accessed)",
+    "CREATE INDEX IF NOT EXISTS cache_Expires ON cache (Expires)",
+    # The total size of all entries is maintained by triggers so that
+    # checking it against the limit does not need a table scan
+    "CREATE TABLE IF NOT EXISTS cachesize (Total INTEGER NOT NULL)",
+    "INSERT INTO cachesize (Total) SELECT 0 WHERE NOT EXISTS (SELECT Total FROM cachesize)",
+    "CREATE TRIGGER IF NOT EXISTS cache_insert AFTER INSERT ON cache BEGIN UPDATE cachesize SET Total = Total + new.Size; END",
+    "CREATE TRIGGER IF NOT EXISTS cache_delete AFTER DELETE ON cache BEGIN UPDATE cachesize SET Total = Total - old.Size; END",
+    "CREATE TRIGGER IF NOT EXISTS cache_update AFTER UPDATE OF Size ON cache BEGIN UPDATE cachesize SET Total = Total - old.Size + new.Size; END"
+)
+
+# Only record that an entry was accessed if the last recorded access was
+# longer ago than this (seconds), to save writing on every read
+ACCESS_RESOLUTION = 60
+
+# When the store is over DISK_CACHE_MAX_SIZE, evict entries until it is
+# down to this fraction of it so we are not evicting on every put
+EVICT_TO = 0.9
+
+connections = threading.local()
+
 def _sanitise_path(path: str) -> str:
     """
     Make sure the path we've been given is safe to use, it should only
@@ -31,56 +59,81 @@ def _is_hex(s: str) -> bool:
     except:
         return False
 
-threadlock = threading.Lock()
-
-def _lrunpickle(fname: str) -> None:
-    """ Reads a file and returns the unpickled contents, using flock to lock the file """
-    with threadlock:
-        with open(fname, "rb") as fd:
-            fcntl.flock(fd, fcntl.LOCK_EX)
-            return pickle.load(fd)
-
-def _lwpickle(fname: str, o: Any) -> None:
-    """ Pickles and writes o to fname, using flock to lock the file """
-    with threadlock:
-        with open(fname, "wb") as fd:
-            fcntl.flock(fd, fcntl.LOCK_EX)
-            pickle.dump(o, fd)
-
-def _getfilename(key: str, path: str, mkpath: bool = False) -> str:
+def _hashkey(key: str) -> str:
     """
-    Calculates the filename from the key
-    (md5 hash)
-    If mkpath is True, creates any missing path directories.
+    Calculates the index key for the cache key (md5 hash)
     """
     # Is the key already a hash? ie. 32 or 40 chars and hex?
     # If so, don't waste time hashing it again.
     if (len(key) == 32 or len(key) == 40) and _is_hex(key):
-        pass
-    else:
-        m = hashlib.md5()
-        if isinstance(key, str): key = key.encode("utf-8") # turn str keys into bytes
-        m.update(key)
-        key = m.hexdigest()
+        return key
+    m = hashlib.md5()
+    if isinstance(key, str): key = key.encode("utf-8") # turn str keys into bytes
+    m.update(key)
+    return m.hexdigest()
+
+def _getstore(path: str) -> sqlite3.Connection:
+    """
+    Returns this thread's connection to the store for path, opening it
+    and creating the store if necessary.
+    """
+    path = _sanitise_path(path)
+    # Connections cannot be shared with a forked child process
+    pid = os.getpid()
+    if getattr(connections, "pid", 0) != pid:
+        connections.pid = pid
+        connections.stores = {}
+    if path in connections.stores:
+        return connections.stores[path]
     if not os.path.exists(DISK_CACHE):
         os.mkdir(DISK_CACHE)
-    if path != "":
-        path = _sanitise_path(path)
-        path = os.path.join(DISK_CACHE, path)
-        if mkpath and not os.path.exists(path):
-            os.mkdir(path)
-    else:
-        path = DISK_CACHE
-    fname = os.path.join(path, key)
-    return fname
+    fname = os.path.join(DISK_CACHE, "%s.db" % (path or "cache"))
+    c = sqlite3.connect(fname, timeout=10, isolation_level=None)
+    c.execute("PRAGMA journal_mode=WAL")
+    c.execute("PRAGMA synchronous=NORMAL")
+    c.execute("PRAGMA mmap_size=%d" % (64 * 1024 * 1024))
+    c.execute("PRAGMA recursive_triggers=ON") # so that the rows INSERT OR REPLACE removes update cachesize
+    for s in SCHEMA:
+        c.execute(s)
+    connections.stores[path] = c
+    return c
+
+def _evict(c: sqlite3.Connection, now: float) -> None:
+    """
+    Removes expired entries, then the least recently used entries
+    until the store is back under its size limit.
+    Must be called inside a write transaction.
+    """
+    maxsize = DISK_CACHE_MAX_SIZE * 1024 * 1024
+    target = maxsize * EVICT_TO
+    c.execute("DELETE FROM cache WHERE Expires < ?", (now,))
+    total = c.execute("SELECT Total FROM cachesize").fetchone()[0]
+    while total > target:
+        keys = c.execute("SELECT Key FROM cache ORDER BY Accessed LIMIT 100").fetchall()
+        if len(keys) == 0: break
+        c.executemany("DELETE FROM cache WHERE Key=?", keys)
+        total = c.execute("SELECT Total FROM cachesize").fetchone()[0]
+
+def _write(c: sqlite3.Connection, key: str, value: Any, expires: float, now: float) -> None:
+    """
+    Stores a pickled value under key, evicting entries if the store
+    has grown past its size limit. Must be called inside a write transaction.
+    """
+    v = pickle.dumps(value)
+    c.execute("INSERT OR REPLACE INTO cache (Key, Expires, Accessed, Size, Value) VALUES (?, ?, ?, ?, ?)", 
+        (key, expires, now, len(v), v))
+    if DISK_CACHE_MAX_SIZE > 0:
+        total = c.execute("SELECT Total FROM cachesize").fetchone()[0]
+        if total > DISK_CACHE_MAX_SIZE * 1024 * 1024:
+            _evict(c, now)
 
 def delete(key: str, path: str) -> None:
     """
     Removes a value from our disk cache.
     """
     try:
-        fname = _getfilename(key, path)
-        os.unlink(fname)
+        c = _getstore(path)
+        c.execute("DELETE FROM cache WHERE Key=?", (_hashkey(key),))
     except Exception as err:
         asm3.al.error(str(err), "cachedisk.delete")
 
@@ -88,16 +141,30 @@ def exists(key: str, path: str) -> bool:
     """
     Returns True if a key exists in the cache (does not unpack and check expiry)
     """
-    fname = _getfilename(key, path)
-    return os.path.exists(fname)
+    c = _getstore(path)
+    return c.execute("SELECT 1 FROM cache WHERE Key=?", (_hashkey(key),)).fetchone() is not None
 
 def increment(key: str, path: str, ttl: int) -> int:
     """
-    Retrieves a value from our disk cache, increments it and returns the value
+    Retrieves a value from our disk cache, increments it and returns the value.
+    A missing or expired value is treated as 0.
     """
-    v = get(key, path, int)
-    v += 1
-    put(key, path, v, ttl)
+    c = _getstore(path)
+    key = _hashkey(key)
+    now = time.time()
+    c.execute("BEGIN IMMEDIATE")
+    try:
+        v = 0
+        row = c.execute("SELECT Expires, Value FROM cache WHERE Key=?", (key,)).fetchone()
+        if row is not None and row[0] >= now:
+            o = pickle.loads(row[1])
+            if isinstance(o, int): v = o
+        v += 1
+        _write(c, key, v, now + ttl, now)
+        c.execute("COMMIT")
+    except:
+        c.execute("ROLLBACK")
+        raise
     return v
 
 def get(key: str, path: str, expectedtype: Any = None) -> Any:
@@ -108,24 +175,31 @@ def get(key: str, path: str, expectedtype: Any = None) -> Any:
     config and caused all the database updates to be re-run.
     """
     try:
-        fname = _getfilename(key, path)
+        c = _getstore(path)
+        key = _hashkey(key)
+        now = time.time()
 
         # No cache entry found, bail
-        if not os.path.exists(fname): return None
-
-        # Pull the entry out
-        o = _lrunpickle(fname)
+        row = c.execute("SELECT Expires, Accessed, Value FROM cache WHERE Key=?", (key,)).fetchone()
+        if row is None: return None
 
         # Has the entry expired?
-        if o["expires"] < time.time():
-            delete(key, path)
+        expires, accessed, value = row
+        if expires < now:
+            c.execute("DELETE FROM cache WHERE Key=? AND Expires < ?", (key, now))
             return None
 
+        value = pickle.loads(value)
+
         # Is the value of the type we're expecting?
-        if expectedtype is not None and not isinstance(o["value"], expectedtype):
+        if expectedtype is not None and not isinstance(value, expectedtype):
             return None
 
-        return o["value"]
+        # Keep track of when the entry was last used for eviction
+        if accessed < now - ACCESS_RESOLUTION:
+            c.execute("UPDATE cache SET Accessed=? WHERE Key=?", (now, key))
+
+        return value
     except Exception as err:
         asm3.al.error("%s/%s: %s" % (path, key, err), "cachedisk.get")
 
@@ -135,15 +209,15 @@ def put(key: str, path: str, value: Any, ttl: int) -> None:
     will be removed if it is accessed past the ttl.
     """
     try:
-        fname = _getfilename(key, path, mkpath=True)
-
-        o = {
-            "expires": time.time() + ttl,
-            "value": value
-        }
-
-        # Write the entry
-        _lwpickle(fname, o)
+        c = _getstore(path)
+        now = time.time()
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            _write(c, _hashkey(key), value, now + ttl, now)
+            c.execute("COMMIT")
+        except:
+            c.execute("ROLLBACK")
+            raise
     except Exception as err:
         asm3.al.error("%s/%s: %s" % (path, key, err), "cachedisk.put")
 
@@ -154,48 +228,32 @@ def touch(key: str, path: str, newttl: int = 0) -> None:
     Returns None if the value is not found or has expired.
     """
     try:
-        fname = _getfilename(key, path)
+        c = _getstore(path)
+        key = _hashkey(key)
+        now = time.time()
 
         # No cache entry found, bail
-        if not os.path.exists(fname): return None
-
-        # Pull the entry out
-        o = _lrunpickle(fname)
+        row = c.execute("SELECT Expires, Value FROM cache WHERE Key=?", (key,)).fetchone()
+        if row is None: return None
 
         # Has the entry expired?
-        now = time.time()
-        if o["expires"] < now:
-            delete(key, path)
+        if row[0] < now:
+            c.execute("DELETE FROM cache WHERE Key=? AND Expires < ?", (key, now))
             return None
 
         # Reset the ttl
-        o["expires"] = now + newttl
-        _lwpickle(fname, o)
+        c.execute("UPDATE cache SET Expires=?, Accessed=? WHERE Key=?", (now + newttl, now, key))
 
-        return o["value"]
+        return pickle.loads(row[1])
     except Exception as err:
         asm3.al.error("%s/%s: %s" % (path, key, err), "cachedisk.touch")
 
 def remove_expired(path: str) -> None:
     """
-    Runs through the cache and deletes any files that have expired
-    for cache/path
+    Deletes any entries that have expired from the store for path
     """
     if DISK_CACHE == "": return
-    cache_path = os.path.join(DISK_CACHE, path)
-    checked = 0
-    removed = 0
-    for root, dummy, files in os.walk(cache_path):
-        for name in files:
-            if name.startswith("."): continue
-            checked += 1
-            try:
-                fpath = os.path.join(root, name)
-                o = _lrunpickle(fpath)
-                if o["expires"] < time.time():
-                    os.unlink(fpath)
-                    removed += 1
-            except:
-                # Move to the next entry if there are problems
-                pass
+    c = _getstore(path)
+    removed = c.execute("DELETE FROM cache WHERE Expires < ?", (time.time(),)).rowcount
+    checked = c.execute("SELECT COUNT(*) FROM cache").fetchone()[0] + removed
     asm3.al.debug("removed %s expired disk cache entries for '%s' (%s checked)" % (removed, path, checked), "cachedisk.remove_expired")
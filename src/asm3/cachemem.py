@@ -21,13 +21,13 @@ def put(key: str, value: Any, ttl: int) -> Any:
     if _memcache_available(): return _memcache_put(key, value, ttl)
     return _dict_put(key, value, ttl)
 
-def increment(key: str) -> int:
+def increment(key: str, delta: int = 1) -> int:
     """
-    Increments a cache value and returns it or
+    Increments a cache value by delta and returns it or
     None if the value doesn't exist.
     """
-    if _memcache_available(): return _memcache_increment(key)
-    return _dict_increment(key)
+    if _memcache_available(): return _memcache_increment(key, delta)
+    return _dict_increment(key, delta)
 
 def delete(key: str) -> Any:
     """
@@ -55,11 +55,11 @@ def _dict_put(key: str, value: Any, ttl: int) -> None:
     global dict_client
     dict_client[key] = [time.time() + ttl, value]
 
-def _dict_increment(key: str) -> int:
+def _dict_increment(key: str, delta: int = 1) -> int:
     global dict_client
     if key not in dict_client: return None
     v = dict_client[key]
-    v[1] += 1
+    v[1] += delta
     return v[1]
 
 def _dict_delete(key: str) -> None:
@@ -97,10 +97,10 @@ def _memcache_put(key: str, value: str, ttl: int) -> Any:
     if not rv: asm3.al.error("failed writing value to memcache (ttl=%s,key=%s,val=%s)" % (ttl, key, value), "cachemem.memcache_put")
     return rv
 
-def _memcache_increment(key: str) -> int:
+def _memcache_increment(key: str, delta: int = 1) -> int:
     global memcache_client
     if memcache_client is None: memcache_client = _get_mc()
-    return memcache_client.incr(key)
+    return memcache_client.incr(key, delta)
 
 def _memcache_delete(key: str) -> Any:
     global memcache_client
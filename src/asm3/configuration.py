@@ -5,6 +5,8 @@ import asm3.geo
 import asm3.i18n
 
 import os
+import time
+import uuid
 
 from asm3.sitedefs import LOCALE, TIMEZONE, WATERMARK_FONT_BASEDIRECTORY
 from asm3.typehints import Any, Database, Dict, List, PostedData, Tuple
@@ -561,19 +563,54 @@ def csave(dbo: Database, username: str, post: PostedData) -> None:
     asm3.audit.edit(dbo, username, "configuration", 0, "", str(post))
     invalidate_config_cache(dbo)
 
+# Process local copies of each database's config map, held in front of the
+# disk cache so that most lookups do not need to unpickle the whole map.
+# Each copy is tagged with the version stamp from the disk cache it was read
+# under. invalidate_config_cache changes the stamp, and every process drops
+# its copy the next time it checks the stamp.
+# { dbname: { "version": str, "checked": float, "loaded": float, "map": dict } }
+config_maps = {}
+
+CONFIG_TTL = 3600 # one hour cache means direct database updates show up eventually
+CONFIG_VERSION_CHECK = 1 # seconds a process can use its copy before checking the version stamp again
+
 def get_map(dbo: Database) -> Dict[str, str]:
-    """ Returns a map of the config items, using a read-through cache to save database calls """
-    cmap = asm3.cachedisk.get("config", dbo.name(), expectedtype=dict)
+    """ Returns a map of the config items, using a process local copy in front 
+        of a read-through disk cache to save database calls """
+    name = dbo.name()
+    now = time.time()
+    l1 = config_maps.get(name)
+    if l1 is not None and now - l1["checked"] < CONFIG_VERSION_CHECK:
+        return l1["map"]
+    version = get_config_version(dbo)
+    if l1 is not None and l1["version"] == version and now - l1["loaded"] < CONFIG_TTL:
+        l1["checked"] = now
+        return l1["map"]
+    # The disk cache entry is keyed on the version, so a process that read the
+    # database before an invalidation cannot put a stale map back under the new one
+    cmap = asm3.cachedisk.get("config%s" % version, name, expectedtype=dict)
     if cmap is None:
         rows = dbo.query("SELECT ItemName, ItemValue FROM configuration ORDER BY ItemName")
         cmap = DEFAULTS.copy()
         for r in rows:
             cmap[r.itemname] = r.itemvalue
-        asm3.cachedisk.put("config", dbo.name(), cmap, 3600) # one hour cache means direct database updates show up eventually
+        asm3.cachedisk.put("config%s" % version, name, cmap, CONFIG_TTL) 
+    config_maps[name] = { "version": version, "checked": now, "loaded": now, "map": cmap }
     return cmap
 
+def get_config_version(dbo: Database) -> str:
+    """ Returns the current version stamp for the config in the disk cache, creating one if there isn't one """
+    version = asm3.cachedisk.get("configversion", dbo.name(), expectedtype=str)
+    if version is None:
+        version = uuid.uuid4().hex
+        asm3.cachedisk.put("configversion", dbo.name(), version, CONFIG_TTL * 24)
+    return version
+
 def invalidate_config_cache(dbo: Database) -> None:
-    asm3.cachedisk.delete("config", dbo.name())
+    """ Changes the config version stamp so that all processes reload the config """
+    asm3.cachedisk.delete("config%s" % get_config_version(dbo), dbo.name())
+    asm3.cachedisk.put("configversion", dbo.name(), uuid.uuid4().hex, CONFIG_TTL * 24)
+    config_maps.pop(dbo.name(), None)
 
 def address_change_log(dbo: Database) -> bool:
     return cboolean(dbo, "AddressChangeLog", DEFAULTS["AddressChangeLog"] == "Yes")
@@ -1741,6 +1778,19 @@ def unit_extra_get(dbo: Database, locationid: int, unit: str) -> Tuple[str, str]
             return (v[2], v[3])
     return ("", "")
 
+def unit_extra_map(dbo: Database) -> Dict[Tuple[int, str], Tuple[str, str]]:
+    """
+    Returns all of the unit extra data as a dictionary of (locationid, unit) to
+    (sponsor, reserved), for looking up many units without parsing it each time.
+    Where a unit appears more than once, the first one wins as with unit_extra_get.
+    """
+    m = {}
+    for ux in unit_extra(dbo).split("&&"):
+        if ux.count("|") < 6: continue
+        v = ux.split("||")
+        m.setdefault((asm3.utils.cint(v[0]), v[1]), (v[2], v[3]))
+    return m
+
 def update_animal_test_fields(dbo: Database) -> bool:
     return cboolean(dbo, "UpdateAnimalTestFields", DEFAULTS["UpdateAnimalTestFields"] == "Yes")
 
@@ -14,12 +14,20 @@ import asm3.movement
 import asm3.person
 import asm3.utils
 
-from asm3.sitedefs import SERVICE_URL
-from asm3.typehints import Any, Database, Dict, List
+from asm3.sitedefs import CSV_IMPORT_BATCH_SIZE, CSV_IMPORT_FETCH_PER_HOST, CSV_IMPORT_FETCH_WORKERS, SERVICE_URL
+from asm3.typehints import Any, Database, Dict, List, ResultRow
 
+import collections
+import concurrent.futures
 from datetime import datetime
+import os
 import re
+import shutil
 import sys
+import tempfile
+import threading
+import time
+import urllib.parse
 
 VALID_FIELDS = [
     "ANIMALCODE", "ANIMALNAME", "ANIMALSEX", "ANIMALTYPE", "ANIMALCOLOR", "ANIMALBREED1", "ANIMALBREED2", "ANIMALDOB", 
@@ -160,38 +168,88 @@ def gkynu(m: Dict, f: str) -> str:
     if m[f].find("12") !=-1: return "12" # Good with kids over 12
     return "2"
 
-def gkbr(dbo: Database, m: Dict, f: str, speciesid: int, create: bool) -> str:
+class Lookups(object):
+    """
+    Remembers the ID for each name in the lookup tables used by an import so
+    that matching a lookup value does not query the database for every field
+    of every row. Each table is read in full the first time it is used.
+    """
+    tables = None # (table, namefield): { lowercase name: id }
+
+    def __init__(self, dbo: Database) -> None:
+        self.dbo = dbo
+        self.tables = {}
+
+    def _table(self, table: str, namefield: str) -> Dict[str, int]:
+        key = (table, namefield)
+        if key not in self.tables:
+            names = {}
+            for r in self.dbo.query("SELECT ID, %s AS Name FROM %s ORDER BY ID" % (namefield, table)):
+                # The lowest ID wins where names are duplicated
+                if r.NAME is not None: names.setdefault(r.NAME.lower(), r.ID)
+            self.tables[key] = names
+        return self.tables[key]
+
+    def add(self, table: str, namefield: str, name: str, lid: int) -> None:
+        """
+        Records the ID of a row that has just been created in table
+        """
+        self._table(table, namefield)[name.strip().lower().replace("'", "`")] = lid
+
+    def clear(self) -> None:
+        """
+        Forgets everything read so far, eg: after rows that were added have been rolled back
+        """
+        self.tables = {}
+
+    def find(self, table: str, namefield: str, name: str) -> int:
+        """
+        Returns the ID of the row in table whose namefield matches name, or 0
+        """
+        return self._table(table, namefield).get(name.strip().lower().replace("'", "`"), 0)
+
+def gkbr(dbo: Database, m: Dict, f: str, speciesid: int, create: bool, lookups: "Lookups" = None) -> str:
     """ reads lookup field f from map m, returning a str(int) that
         corresponds to a lookup match for BreedName in breed.
         if create is True, adds a row to the table if it doesn't
         find a match and then returns str(newid)
         speciesid is the linked species for any newly created breed
+        lookups: a Lookups cache to match against instead of querying the table
         returns "0" if key not present, or if no match was found and create is off """
     if f not in m: return "0"
     lv = m[f]
-    matchid = dbo.query_int("SELECT ID FROM breed WHERE LOWER(BreedName) = ?", [ lv.strip().lower().replace("'", "`")] )
+    if lookups is not None:
+        matchid = lookups.find("breed", "BreedName", lv)
+    else:
+        matchid = dbo.query_int("SELECT ID FROM breed WHERE LOWER(BreedName) = ?", [ lv.strip().lower().replace("'", "`")] )
     if matchid == 0 and create and lv.strip() != "":
         nextid = dbo.get_id("breed")
         sql = "INSERT INTO breed (ID, SpeciesID, BreedName) VALUES (?,?,?)"
         dbo.execute(sql, (nextid, speciesid, lv.replace("'", "`")))
+        if lookups is not None: lookups.add("breed", "BreedName", lv, nextid)
         return str(nextid)
     return str(matchid)
 
-def gkl(dbo: Database, m: Dict, f: str, table: str, namefield: str, create: bool) -> str:
+def gkl(dbo: Database, m: Dict, f: str, table: str, namefield: str, create: bool, lookups: "Lookups" = None) -> str:
     """ reads lookup field f from map m, returning a str(int) that
         corresponds to a lookup match for namefield in table.
         if create is True, adds a row to the table if it doesn't
         find a match then returns str(newid)
+        lookups: a Lookups cache to match against instead of querying the table
         returns "0" if key not present, or if no match was found and create is off,
         or the value was an empty string """
     if f not in m: return "0" # column not present
     lv = m[f]
     if lv.strip() == "": return "0" # value is empty string
-    matchid = dbo.query_int("SELECT ID FROM %s WHERE LOWER(%s) = ?" % (table, namefield), [ lv.strip().lower().replace("'", "`") ])
+    if lookups is not None:
+        matchid = lookups.find(table, namefield, lv)
+    else:
+        matchid = dbo.query_int("SELECT ID FROM %s WHERE LOWER(%s) = ?" % (table, namefield), [ lv.strip().lower().replace("'", "`") ])
     if matchid == 0 and create and lv.strip() != "":
         nextid = dbo.insert(table, {
             namefield:  lv
         }, setRecordVersion=False, setCreated=False, writeAudit=False)
+        if lookups is not None: lookups.add(table, namefield, lv, nextid)
         return str(nextid)
     return str(matchid)
 
@@ -207,6 +265,217 @@ def gksx(m: Dict, f: str) -> str:
     elif x.startswith("a"): return "-1"
     else: return ""
 
+class PersonIndex(object):
+    """
+    Finds existing people that are similar to a person being imported with the
+    same rules as person.get_person_similar (a matching email address or mobile
+    number with the same first name, or matching names and first word of the address),
+    but from an in memory index of the person table instead of running queries for every row.
+    The person table is read the first time the index is used.
+    """
+    emails = None
+    mobiles = None
+    surnames = None
+
+    def __init__(self, dbo: Database) -> None:
+        self.dbo = dbo
+        self.emails = None
+
+    def _load(self) -> None:
+        self.emails = {}
+        self.mobiles = {}
+        self.surnames = {}
+        for r in self.dbo.query(self._sql() + " ORDER BY o.ID"):
+            self._index(r)
+
+    def _sql(self) -> str:
+        return "SELECT o.ID, o.OwnerForeNames, o.OwnerSurname, o.OwnerAddress, o.EmailAddress, o.MobileTelephone FROM owner o"
+
+    def _index(self, r: ResultRow) -> None:
+        if r.EMAILADDRESS: self.emails.setdefault(r.EMAILADDRESS.lower(), []).append(r)
+        if r.MOBILETELEPHONE: self.mobiles.setdefault(asm3.utils.digits_only(r.MOBILETELEPHONE), []).append(r)
+        if r.OWNERSURNAME: self.surnames.setdefault(r.OWNERSURNAME.lower(), []).append(r)
+
+    def add(self, personid: int) -> None:
+        """
+        Adds a person that has just been created to the index
+        """
+        if self.emails is None: return
+        r = self.dbo.first_row(self.dbo.query(self._sql() + " WHERE o.ID=?", [personid]))
+        if r is not None: self._index(r)
+
+    def clear(self) -> None:
+        """
+        Forgets the index so that it is read again on next use, eg: after people that were added have been rolled back
+        """
+        self.emails = None
+
+    def find(self, email: str = "", mobile: str = "", surname: str = "", forenames: str = "", address: str = "") -> List[ResultRow]:
+        """
+        Returns people similar to the details given, in the same order as person.get_person_similar
+        """
+        if self.emails is None: self._load()
+        # Normalise the values in the same way as get_person_similar
+        if address.find(" ") != -1: address = address[0:address.find(" ")]
+        if address.find("\n") != -1: address = address[0:address.find("\n")]
+        if address.find(",") != -1: address = address[0:address.find(",")]
+        address = address.replace("'", "`").lower().strip()
+        if asm3.utils.is_numeric(address): address += " "
+        forenames = forenames.replace("'", "`").lower().strip()
+        # A single forename matches the start of the forenames, the first of several must match them exactly
+        forenamesprefix = forenames.find(" ") == -1
+        if not forenamesprefix: forenames = forenames[0:forenames.find(" ")]
+        surname = surname.replace("'", "`").lower().strip()
+        email = email.replace("'", "`").lower().strip()
+        def forenamesmatch(r: ResultRow) -> bool:
+            f = (r.OWNERFORENAMES or "").lower()
+            return f.startswith(forenames) if forenamesprefix else f == forenames
+        matches = []
+        if email != "" and email.find("@") != -1 and email.find(".") != -1 and len(email) > 6:
+            matches += [ r for r in self.emails.get(email, []) if forenamesmatch(r) ]
+        if mobile != "" and asm3.utils.atoi(mobile) > 9999:
+            matches += [ r for r in self.mobiles.get(asm3.utils.digits_only(mobile), []) if forenamesmatch(r) ]
+        if surname != "" and address != "":
+            matches += [ r for r in self.surnames.get(surname, []) if forenamesmatch(r) and (r.OWNERADDRESS or "").lower().startswith(address) ]
+        return matches
+
+# How long to wait for a remote server when fetching media for an import (seconds)
+FETCH_TIMEOUT = 5
+
+# How many times to retry fetching media that failed with a connection or server error
+FETCH_RETRIES = 2
+
+# How many rows ahead of the row being imported to fetch media for
+FETCH_AHEAD = 50
+
+class MediaPrefetch(object):
+    """
+    Fetches the remote media (image, PDF and HTML document URLs) for the rows
+    of an import in a pool of threads, working ahead of the row being imported
+    so that one slow server does not hold up the others. Fetched files are held
+    in a temporary spool directory until their rows are imported.
+    No more than perhost fetches run at once for each server, the rest wait in
+    a queue for their server and are only given to the pool when one of its
+    fetches finishes, so workers are never left waiting on a busy server.
+    If workers is 0, each URL is fetched when it is asked for.
+    """
+    active = None # host: number of fetches given to the pool
+    futures = None # url: Future
+    lock = None
+    pending = None # host: deque of (url, Future) waiting for a free slot
+    pool = None
+    refs = None # url: number of rows still to use it
+    spool = ""
+
+    def __init__(self, rowurls: List[List[str]], workers: int = CSV_IMPORT_FETCH_WORKERS, perhost: int = CSV_IMPORT_FETCH_PER_HOST,
+                 ahead: int = FETCH_AHEAD, timeout: float = FETCH_TIMEOUT, retries: int = FETCH_RETRIES, retrywait: float = 1) -> None:
+        """
+        rowurls: The URLs to fetch for each row of the import
+        retrywait: Seconds to wait before a retry, multiplied by the number of the retry
+        """
+        self.rowurls = rowurls
+        self.perhost = max(perhost, 1)
+        self.ahead = ahead
+        self.timeout = timeout
+        self.retries = retries
+        self.retrywait = retrywait
+        self.active = collections.Counter()
+        self.futures = {}
+        self.lock = threading.Lock()
+        self.pending = collections.defaultdict(collections.deque)
+        self.refs = collections.Counter(url for urls in rowurls for url in urls)
+        self.started = 0 # the number of rows that have had their fetches started
+        if workers > 0 and len(self.refs) > 0:
+            self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="csvimportfetch")
+            self.spool = tempfile.mkdtemp(prefix="asm3csvimport")
+
+    def _fetch(self, url: str) -> Dict:
+        """
+        Fetches url, retrying connection and server errors. Returns the
+        response from get_url_bytes, with the content moved to a file
+        in the spool (path) if it was successful.
+        """
+        for attempt in range(self.retries + 1):
+            if attempt > 0: time.sleep(self.retrywait * attempt)
+            r = asm3.utils.get_url_bytes(url, timeout=self.timeout, exceptions=False)
+            if r["status"] < 500: break
+        if r["status"] != 200: return r
+        fd, path = tempfile.mkstemp(dir=self.spool)
+        with os.fdopen(fd, "wb") as f:
+            f.write(r["response"])
+        return { "status": 200, "path": path }
+
+    def _run(self, host: str, url: str, f: concurrent.futures.Future) -> None:
+        """
+        Runs in the pool. Fetches url into f, then hands the slot for host
+        to the next fetch waiting for it.
+        """
+        try:
+            f.set_result(self._fetch(url))
+        except Exception as err:
+            f.set_exception(err)
+        with self.lock:
+            if self.pool is None: return
+            if len(self.pending[host]) > 0:
+                nexturl, nextf = self.pending[host].popleft()
+                self.pool.submit(self._run, host, nexturl, nextf)
+            else:
+                self.active[host] -= 1
+
+    def _start(self, url: str) -> None:
+        """
+        Gives the fetch for url to the pool if its server has a free slot,
+        or queues it for the server if not.
+        """
+        host = urllib.parse.urlparse(url).netloc
+        f = concurrent.futures.Future()
+        self.futures[url] = f
+        with self.lock:
+            if self.active[host] < self.perhost:
+                self.active[host] += 1
+                self.pool.submit(self._run, host, url, f)
+            else:
+                self.pending[host].append((url, f))
+
+    def close(self) -> None:
+        """
+        Abandons any fetches that have not finished and removes the spool
+        """
+        with self.lock:
+            if self.pool is None: return
+            pool = self.pool
+            self.pool = None
+        pool.shutdown(wait=False, cancel_futures=True)
+        shutil.rmtree(self.spool, ignore_errors=True)
+
+    def get(self, rowno: int, url: str) -> Dict:
+        """
+        Returns the result of fetching url for row number rowno (the first is 1)
+        as a dictionary of status and response, like asm3.utils.get_url_bytes
+        """
+        if self.pool is None: return asm3.utils.get_url_bytes(url, timeout=self.timeout, exceptions=False)
+        # Start the fetches for the rows up to FETCH_AHEAD past this one
+        while self.started < min(rowno + self.ahead, len(self.rowurls)):
+            for u in self.rowurls[self.started]:
+                if u not in self.futures: self._start(u)
+            self.started += 1
+        # A URL we have already used up is fetched again, eg: for rows imported again after a rollback
+        if url not in self.futures:
+            self.refs[url] += 1
+            self._start(url)
+        try:
+            r = self.futures[url].result()
+        except Exception as err:
+            r = { "status": 599, "response": str(err) }
+        self.refs[url] -= 1
+        done = self.refs[url] <= 0
+        if done: del self.futures[url]
+        if "path" not in r: return r
+        with open(r["path"], "rb") as f:
+            data = f.read()
+        if done: os.unlink(r["path"])
+        return { "status": 200, "response": data }
+
 def create_additional_fields(dbo: Database, row: Dict, errors: List, rowno: int, csvkey: str = "ANIMALADDITIONAL", linktype: str = "animal", linkid: int = 0) -> None:
     """ Identifies and create any additional fields that may have been specified in
         the csv file with csvkey<fieldname> 
@@ -377,16 +646,13 @@ def csvimport(dbo: Database, csvdata: bytes, encoding: str = "utf-8-sig", user:
     # Now that we've read them in, go through all the rows
     # and start importing.
     errors = []
-    rowno = 1
     animalcodes = {}
-    asm3.asynctask.set_progress_max(dbo, len(rows))
-    for row in rows:
-
-        asm3.al.debug("import csv: row %d of %d" % (rowno, len(rows)), "csvimport.csvimport", dbo)
-        asm3.asynctask.increment_progress_value(dbo)
+    counted = 0
+    lookups = Lookups(dbo)
+    people = PersonIndex(dbo)
 
-        # Should we stop?
-        if asm3.asynctask.get_cancel(dbo): break
+    def import_row(row: Dict, rowno: int) -> None:
+        """ Imports one row of the file """
 
         # Do we have animal data to read?
         animalid = 0
@@ -414,41 +680,41 @@ def csvimport(dbo: Database, csvdata: bytes, encoding: str = "utf-8-sig", user:
                 a["sex"] = "2" # Default unknown if not set
             else:
                 a["sex"] = gksx(row, "ANIMALSEX")
-            a["basecolour"] = gkl(dbo, row, "ANIMALCOLOR", "basecolour", "BaseColour", createmissinglookups)
+            a["basecolour"] = gkl(dbo, row, "ANIMALCOLOR", "basecolour", "BaseColour", createmissinglookups, lookups)
             if a["basecolour"] == "0":
                 a["basecolour"] = str(asm3.configuration.default_colour(dbo))
-            a["species"] = gkl(dbo, row, "ANIMALSPECIES", "species", "SpeciesName", createmissinglookups)
+            a["species"] = gkl(dbo, row, "ANIMALSPECIES", "species", "SpeciesName", createmissinglookups, lookups)
             if a["species"] == "0":
                 a["species"] = str(asm3.configuration.default_species(dbo))
-            a["animaltype"] = gkl(dbo, row, "ANIMALTYPE", "animaltype", "AnimalType", createmissinglookups)
+            a["animaltype"] = gkl(dbo, row, "ANIMALTYPE", "animaltype", "AnimalType", createmissinglookups, lookups)
             if a["animaltype"] == "0":
                 a["animaltype"] = str(asm3.configuration.default_type(dbo))
-            a["breed1"] = gkbr(dbo, row, "ANIMALBREED1", a["species"], createmissinglookups)
+            a["breed1"] = gkbr(dbo, row, "ANIMALBREED1", a["species"], createmissinglookups, lookups)
             if a["breed1"] == "0":
                 a["breed1"] = str(asm3.configuration.default_breed(dbo))
-            a["breed2"] = gkbr(dbo, row, "ANIMALBREED2", a["species"], createmissinglookups)
+            a["breed2"] = gkbr(dbo, row, "ANIMALBREED2", a["species"], createmissinglookups, lookups)
             if a["breed2"] != "0" and a["breed2"] != a["breed1"]:
                 a["crossbreed"] = "on"
-            a["size"] = gkl(dbo, row, "ANIMALSIZE", "lksize", "Size", False)
+            a["size"] = gkl(dbo, row, "ANIMALSIZE", "lksize", "Size", False, lookups)
             if gks(row, "ANIMALSIZE") == "": 
                 a["size"] = str(asm3.configuration.default_size(dbo))
             a["weight"] = gks(row, "ANIMALWEIGHT")
-            a["internallocation"] = gkl(dbo, row, "ANIMALLOCATION", "internallocation", "LocationName", createmissinglookups)
+            a["internallocation"] = gkl(dbo, row, "ANIMALLOCATION", "internallocation", "LocationName", createmissinglookups, lookups)
             if a["internallocation"] == "0":
                 a["internallocation"] = str(asm3.configuration.default_location(dbo))
-            a["jurisdiction"] = gkl(dbo, row, "ANIMALJURISDICTION", "jurisdiction", "JurisdictionName", createmissinglookups)
+            a["jurisdiction"] = gkl(dbo, row, "ANIMALJURISDICTION", "jurisdiction", "JurisdictionName", createmissinglookups, lookups)
             if a["jurisdiction"] == "0":
                 a["jurisdiction"] = str(asm3.configuration.default_jurisdiction(dbo))
-            a["pickuplocation"] = gkl(dbo, row, "ANIMALPICKUPLOCATION", "pickuplocation", "LocationName", createmissinglookups)
+            a["pickuplocation"] = gkl(dbo, row, "ANIMALPICKUPLOCATION", "pickuplocation", "LocationName", createmissinglookups, lookups)
             if a["pickuplocation"] != "0":
                 a["pickedup"] = "on"
             a["pickupaddress"] = gks(row, "ANIMALPICKUPADDRESS")
             if a["pickupaddress"] != "":
                 a["pickedup"] = "on"
-            a["entrytype"] = gkl(dbo, row, "ANIMALENTRYTYPE", "lksentrytype", "EntryTypeName", False)
+            a["entrytype"] = gkl(dbo, row, "ANIMALENTRYTYPE", "lksentrytype", "EntryTypeName", False, lookups)
             if a["entrytype"] == "0":
                 a["entrytype"] = str(asm3.configuration.default_entry_type(dbo))
-            a["entryreason"] = gkl(dbo, row, "ANIMALENTRYCATEGORY", "entryreason", "ReasonName", createmissinglookups)
+            a["entryreason"] = gkl(dbo, row, "ANIMALENTRYCATEGORY", "entryreason", "ReasonName", createmissinglookups, lookups)
             if a["entryreason"] == "0":
                 a["entryreason"] = str(asm3.configuration.default_entry_reason(dbo))
             a["unit"] = gks(row, "ANIMALUNIT")
@@ -482,7 +748,7 @@ def csvimport(dbo: Database, csvdata: bytes, encoding: str = "utf-8-sig", user:
             a["deceaseddate"] = gkd(dbo, row, "ANIMALDECEASEDDATE")
             a["ptsreason"] = gks(row, "ANIMALDECEASEDNOTES")
             a["puttosleep"] = gkbc(row, "ANIMALEUTHANIZED")
-            a["deathcategory"] = gkl(dbo, row, "ANIMALDECEASEDREASON", "deathreason", "ReasonName", createmissinglookups)
+            a["deathcategory"] = gkl(dbo, row, "ANIMALDECEASEDREASON", "deathreason", "ReasonName", createmissinglookups, lookups)
             if a["deathcategory"] == "0":
                 a["deathcategory"] = str(asm3.configuration.default_death_reason(dbo))
             a["neutered"] = gkbc(row, "ANIMALNEUTERED")
@@ -497,19 +763,19 @@ def csvimport(dbo: Database, csvdata: bytes, encoding: str = "utf-8-sig", user:
             a["flags"] = gks(row, "ANIMALFLAGS")
             a["declawed"] = gkbc(row, "ANIMALDECLAWED")
             a["specialneeds"] = gkbc(row, "ANIMALHASSPECIALNEEDS")
-            a["coattype"] = gkl(dbo, row, "ANIMALCOATTYPE", "lkcoattype", "CoatType", createmissinglookups)
+            a["coattype"] = gkl(dbo, row, "ANIMALCOATTYPE", "lkcoattype", "CoatType", createmissinglookups, lookups)
             # image data if any was supplied
             imagedata = gks(row, "ANIMALIMAGE")
             if imagedata != "":
                 if imagedata.startswith("http"):
                     # It's a URL, get the image from the remote server
-                    r = asm3.utils.get_url_bytes(imagedata, timeout=5000, exceptions=False)
+                    r = fetcher.get(rowno, imagedata)
                     if r["status"] == 200:
                         asm3.al.debug("retrieved image from %s (%s bytes)" % (imagedata, len(r["response"])), "csvimport.csvimport", dbo)
                         imagedata = "data:image/jpeg;base64,%s" % asm3.utils.base64encode(r["response"])
                     else:
                         row_error(errors, "animal", rowno, row, "error reading image from '%s': %s" % (imagedata, r), dbo, sys.exc_info())
-                        continue
+                        return
                 elif imagedata.startswith("data:image"):
                     # It's a base64 encoded data URI - do nothing as attach_file requires it
                     pass
@@ -523,13 +789,13 @@ def csvimport(dbo: Database, csvdata: bytes, encoding: str = "utf-8-sig", user:
             if pdfdata != "":
                 if pdfdata.startswith("http"):
                     # It's a URL, get the PDF from the remote server
-                    r = asm3.utils.get_url_bytes(pdfdata, timeout=5000, exceptions=False)
+                    r = fetcher.get(rowno, pdfdata)
                     if r["status"] == 200:
                         asm3.al.debug("retrieved PDF from %s (%s bytes)" % (pdfdata, len(r["response"])), "csvimport.csvimport", dbo)
                         pdfdata = "data:application/pdf;base64,%s" % asm3.utils.base64encode(r["response"])
                     else:
                         row_error(errors, "animal", rowno, row, "error reading pdf from '%s': %s" % (pdfdata, r), dbo, sys.exc_info())
-                        continue
+                        return
                 elif pdfdata.startswith("data:"):
                     # It's a base64 encoded data URI - do nothing as attach_file requires it
                     pass
@@ -539,7 +805,7 @@ def csvimport(dbo: Database, csvdata: bytes, encoding: str = "utf-8-sig", user:
                     pdfdata = ""
                 if pdfdata != "" and pdfname == "":
                     row_error(errors, "animal", rowno, row, "ANIMALPDFNAME must be set for data", dbo, sys.exc_info())
-                    continue
+                    return
 
             # media data if any was supplied
             htmldata = gks(row, "ANIMALHTMLDATA")
@@ -547,13 +813,13 @@ def csvimport(dbo: Database, csvdata: bytes, encoding: str = "utf-8-sig", user:
             if htmldata != "":
                 if htmldata.startswith("http"):
                     # It's a URL, get the PDF from the remote server
-                    r = asm3.utils.get_url_bytes(htmldata, timeout=5000, exceptions=False)
+                    r = fetcher.get(rowno, htmldata)
                     if r["status"] == 200:
                         asm3.al.debug("retrieved HTML document from %s (%s bytes)" % (htmldata, len(r["response"])), "csvimport.csvimport", dbo)
                         htmldata = "data:text/html;base64,%s" % asm3.utils.base64encode(r["response"])
                     else:
                         row_error(errors, "animal", rowno, row, "error reading html data from '%s': %s" % (htmldata, r), dbo, sys.exc_info())
-                        continue
+                        return
                 elif htmldata.startswith("data:"):
                     # It's a base64 encoded data URI - do nothing as attach_file requires it
                     pass
@@ -563,7 +829,7 @@ def csvimport(dbo: Database, csvdata: bytes, encoding: str = "utf-8-sig", user:
                     htmldata = ""
                 if htmldata != "" and htmlname == "":
                     row_error(errors, "animal", rowno, row, "ANIMALHTMLNAME must be set for data", dbo, sys.exc_info())
-                    continue
+                    return
 
             # If an original owner is specified, create a person record
             # for them and attach it to the animal as original owner
@@ -577,7 +843,7 @@ def csvimport(dbo: Database, csvdata: bytes, encoding: str = "utf-8-sig", user:
                 p["town"] = gks(row, "ORIGINALOWNERCITY")
                 p["county"] = gks(row, "ORIGINALOWNERSTATE")
                 p["postcode"] = gks(row, "ORIGINALOWNERZIPCODE")
-                p["jurisdiction"] = gkl(dbo, row, "ORIGINALOWNERJURISDICTION", "jurisdiction", "JurisdictionName", createmissinglookups)
+                p["jurisdiction"] = gkl(dbo, row, "ORIGINALOWNERJURISDICTION", "jurisdiction", "JurisdictionName", createmissinglookups, lookups)
                 if p["jurisdiction"] == "0":
                     p["jurisdiction"] = str(asm3.configuration.default_jurisdiction(dbo))
                 p["hometelephone"] = gks(row, "ORIGINALOWNERHOMEPHONE")
@@ -589,11 +855,12 @@ def csvimport(dbo: Database, csvdata: bytes, encoding: str = "utf-8-sig", user:
                 try:
                     originalownerid = 0
                     if checkduplicates:
-                        dups = asm3.person.get_person_similar(dbo, p["emailaddress"], p["mobiletelephone"], p["surname"], p["forenames"], p["address"])
+                        dups = people.find(p["emailaddress"], p["mobiletelephone"], p["surname"], p["forenames"], p["address"])
                         if len(dups) > 0:
                             originalownerid = dups[0]["ID"]
                     if originalownerid == 0:
                         originalownerid = asm3.person.insert_person_from_form(dbo, asm3.utils.PostedData(p, dbo.locale), user, geocode=False)
+                        people.add(originalownerid)
                     # Identify any ORIGINALOWNERADDITIONAL additional fields and create/merge them
                     if originalownerid > 0: 
                         create_additional_fields(dbo, row, errors, rowno, "ORIGINALOWNERADDITIONAL", "person", originalownerid)
@@ -617,7 +884,7 @@ def csvimport(dbo: Database, csvdata: bytes, encoding: str = "utf-8-sig", user:
                 p["town"] = gks(row, "CURRENTVETCITY")
                 p["county"] = gks(row, "CURRENTVETSTATE")
                 p["postcode"] = gks(row, "CURRENTVETZIPCODE")
-                p["jurisdiction"] = gkl(dbo, row, "CURRENTVETJURISDICTION", "jurisdiction", "JurisdictionName", createmissinglookups)
+                p["jurisdiction"] = gkl(dbo, row, "CURRENTVETJURISDICTION", "jurisdiction", "JurisdictionName", createmissinglookups, lookups)
                 if p["jurisdiction"] == "0":
                     p["jurisdiction"] = str(asm3.configuration.default_jurisdiction(dbo))
                 p["hometelephone"] = gks(row, "CURRENTVETHOMEPHONE")
@@ -628,12 +895,13 @@ def csvimport(dbo: Database, csvdata: bytes, encoding: str = "utf-8-sig", user:
                 try:
                     cvid = 0
                     if checkduplicates:
-                        dups = asm3.person.get_person_similar(dbo, p["emailaddress"], p["mobiletelephone"], p["surname"], p["forenames"], p["address"])
+                        dups = people.find(p["emailaddress"], p["mobiletelephone"], p["surname"], p["forenames"], p["address"])
                         if len(dups) > 0:
                             cvid = dups[0]["ID"]
                             a["currentvet"] = str(cvid)
                     if "currentvet" not in a:
                         cvid = asm3.person.insert_person_from_form(dbo, asm3.utils.PostedData(p, dbo.locale), user, geocode=False)
+                        people.add(cvid)
                         a["currentvet"] = str(cvid)
                     # If both a current vet and neutering date has been given, set the neutering vet
                     if "currentvet" in a and a["neutereddate"] in a and a["neutereddate"] != "":
@@ -718,7 +986,7 @@ def csvimport(dbo: Database, csvdata: bytes, encoding: str = "utf-8-sig", user:
             p["town"] = gks(row, "PERSONCITY")
             p["county"] = gks(row, "PERSONSTATE")
             p["postcode"] = gks(row, "PERSONZIPCODE")
-            p["jurisdiction"] = gkl(dbo, row, "PERSONJURISDICTION", "jurisdiction", "JurisdictionName", createmissinglookups)
+            p["jurisdiction"] = gkl(dbo, row, "PERSONJURISDICTION", "jurisdiction", "JurisdictionName", createmissinglookups, lookups)
             if p["jurisdiction"] == "0":
                 p["jurisdiction"] = str(asm3.configuration.default_jurisdiction(dbo))
             p["hometelephone"] = gks(row, "PERSONHOMEPHONE")
@@ -745,14 +1013,14 @@ def csvimport(dbo: Database, csvdata: bytes, encoding: str = "utf-8-sig", user:
                 if "PERSONMATCHADDED" in cols: p["matchadded"] = gkd(dbo, row, "PERSONMATCHADDED")
                 if "PERSONMATCHEXPIRES" in cols: p["matchexpires"] = gkd(dbo, row, "PERSONMATCHEXPIRES")
                 if "PERSONMATCHSEX" in cols: p["matchsex"] = gksx(row, "PERSONMATCHSEX")
-                if "PERSONMATCHSIZE" in cols: p["matchsize"] = gkl(dbo, row, "PERSONMATCHSIZE", "lksize", "Size", False)
-                if "PERSONMATCHCOLOR" in cols: p["matchcolour"] = gkl(dbo, row, "PERSONMATCHCOLOR", "basecolour", "BaseColour", createmissinglookups)
+                if "PERSONMATCHSIZE" in cols: p["matchsize"] = gkl(dbo, row, "PERSONMATCHSIZE", "lksize", "Size", False, lookups)
+                if "PERSONMATCHCOLOR" in cols: p["matchcolour"] = gkl(dbo, row, "PERSONMATCHCOLOR", "basecolour", "BaseColour", createmissinglookups, lookups)
                 if "PERSONMATCHAGEFROM" in cols: p["agedfrom"] = gks(row, "PERSONMATCHAGEFROM")
                 if "PERSONMATCHAGETO" in cols: p["agedto"] = gks(row, "PERSONMATCHAGETO")
-                if "PERSONMATCHTYPE" in cols: p["matchanimaltype"] = gkl(dbo, row, "PERSONMATCHTYPE", "animaltype", "AnimalType", createmissinglookups)
-                if "PERSONMATCHSPECIES" in cols: p["matchspecies"] = gkl(dbo, row, "PERSONMATCHSPECIES", "species", "SpeciesName", createmissinglookups)
-                if "PERSONMATCHBREED1" in cols: p["matchbreed"] = gkbr(dbo, row, "PERSONMATCHBREED1", p["matchspecies"], createmissinglookups)
-                if "PERSONMATCHBREED2" in cols: p["matchbreed2"] = gkbr(dbo, row, "PERSONMATCHBREED2", p["matchspecies"], createmissinglookups)
+                if "PERSONMATCHTYPE" in cols: p["matchanimaltype"] = gkl(dbo, row, "PERSONMATCHTYPE", "animaltype", "AnimalType", createmissinglookups, lookups)
+                if "PERSONMATCHSPECIES" in cols: p["matchspecies"] = gkl(dbo, row, "PERSONMATCHSPECIES", "species", "SpeciesName", createmissinglookups, lookups)
+                if "PERSONMATCHBREED1" in cols: p["matchbreed"] = gkbr(dbo, row, "PERSONMATCHBREED1", p["matchspecies"], createmissinglookups, lookups)
+                if "PERSONMATCHBREED2" in cols: p["matchbreed2"] = gkbr(dbo, row, "PERSONMATCHBREED2", p["matchspecies"], createmissinglookups, lookups)
                 if "PERSONMATCHGOODWITHCATS" in cols: p["matchgoodwithcats"] = gkynu(row, "PERSONMATCHGOODWITHCATS")
                 if "PERSONMATCHGOODWITHDOGS" in cols: p["matchgoodwithdogs"] = gkynu(row, "PERSONMATCHGOODWITHDOGS")
                 if "PERSONMATCHGOODWITHCHILDREN" in cols: p["matchgoodwithchildren"] = gkynu(row, "PERSONMATCHGOODWITHCHILDREN")
@@ -763,13 +1031,13 @@ def csvimport(dbo: Database, csvdata: bytes, encoding: str = "utf-8-sig", user:
             if imagedata != "":
                 if imagedata.startswith("http"):
                     # It's a URL, get the image from the remote server
-                    r = asm3.utils.get_url_bytes(imagedata, timeout=5000, exceptions=False)
+                    r = fetcher.get(rowno, imagedata)
                     if r["status"] == 200:
                         asm3.al.debug("retrieved image from %s (%s bytes)" % (imagedata, len(r["response"])), "csvimport.csvimport", dbo)
                         imagedata = "data:image/jpeg;base64,%s" % asm3.utils.base64encode(r["response"])
                     else:
                         row_error(errors, "person", rowno, row, "error reading image from '%s': %s" % (imagedata, r), dbo, sys.exc_info())
-                        continue
+                        return
                 elif imagedata.startswith("data:image"):
                     # It's a base64 encoded data URI - do nothing as attach_file requires it
                     pass
@@ -783,13 +1051,13 @@ def csvimport(dbo: Database, csvdata: bytes, encoding: str = "utf-8-sig", user:
             if pdfdata != "":
                 if pdfdata.startswith("http"):
                     # It's a URL, get the PDF from the remote server
-                    r = asm3.utils.get_url_bytes(pdfdata, timeout=5000, exceptions=False)
+                    r = fetcher.get(rowno, pdfdata)
                     if r["status"] == 200:
                         asm3.al.debug("retrieved PDF from %s (%s bytes)" % (pdfdata, len(r["response"])), "csvimport.csvimport", dbo)
                         pdfdata = "data:application/pdf;base64,%s" % asm3.utils.base64encode(r["response"])
                     else:
                         row_error(errors, "person", rowno, row, "error reading pdf from '%s': %s" % (pdfdata, r), dbo, sys.exc_info())
-                        continue
+                        return
                 elif pdfdata.startswith("data:"):
                     # It's a base64 encoded data URI - do nothing as attach_file requires it
                     pass
@@ -799,11 +1067,11 @@ def csvimport(dbo: Database, csvdata: bytes, encoding: str = "utf-8-sig", user:
                     pdfdata = ""
                 if pdfdata != "" and pdfname == "":
                     row_error(errors, "person", rowno, row, "PERSONPDFNAME must be set for data", dbo, sys.exc_info())
-                    continue
+                    return
 
             try:
                 if checkduplicates:
-                    dups = asm3.person.get_person_similar(dbo, p["emailaddress"], p["mobiletelephone"], p["surname"], p["forenames"], p["address"])
+                    dups = people.find(p["emailaddress"], p["mobiletelephone"], p["surname"], p["forenames"], p["address"])
                     if len(dups) > 0:
                         personid = dups[0].ID
                         # Merge flags and any extra details
@@ -816,6 +1084,7 @@ def csvimport(dbo: Database, csvdata: bytes, encoding: str = "utf-8-sig", user:
                         asm3.person.merge_person_details(dbo, user, personid, p, force=dups[0].EMAILADDRESS == p["emailaddress"])
                 if personid == 0:
                     personid = asm3.person.insert_person_from_form(dbo, asm3.utils.PostedData(p, dbo.locale), user, geocode=False)
+                    people.add(personid)
                 # Identify any PERSONADDITIONAL additional fields and create/merge them
                 create_additional_fields(dbo, row, errors, rowno, "PERSONADDITIONAL", "person", personid)
                 # If we have some image data, add it to the person
@@ -862,11 +1131,11 @@ def csvimport(dbo: Database, csvdata: bytes, encoding: str = "utf-8-sig", user:
             d["comments"] = gks(row, "DONATIONCOMMENTS")
             d["received"] = gkd(dbo, row, "DONATIONDATE", True)
             d["chequenumber"] = gks(row, "DONATIONCHECKNUMBER")
-            d["type"] = gkl(dbo, row, "DONATIONTYPE", "donationtype", "DonationName", createmissinglookups)
+            d["type"] = gkl(dbo, row, "DONATIONTYPE", "donationtype", "DonationName", createmissinglookups, lookups)
             if d["type"] == "0":
                 d["type"] = str(asm3.configuration.default_donation_type(dbo))
             d["giftaid"] = gkbc(row, "DONATIONGIFTAID")
-            d["payment"] = gkl(dbo, row, "DONATIONPAYMENT", "donationpayment", "PaymentName", createmissinglookups)
+            d["payment"] = gkl(dbo, row, "DONATIONPAYMENT", "donationpayment", "PaymentName", createmissinglookups, lookups)
             if d["payment"] == "0":
                 d["payment"] = "1"
             try:
@@ -881,7 +1150,7 @@ def csvimport(dbo: Database, csvdata: bytes, encoding: str = "utf-8-sig", user:
             d = {}
             d["incidentdate"] = gkd(dbo, row, "INCIDENTDATE", True)
             d["incidenttime"] = gks(row, "INCIDENTTIME")
-            d["incidenttype"] = gkl(dbo, row, "INCIDENTTYPE", "incidenttype", "IncidentName", createmissinglookups)
+            d["incidenttype"] = gkl(dbo, row, "INCIDENTTYPE", "incidenttype", "IncidentName", createmissinglookups, lookups)
             if d["incidenttype"] == "0":
                 d["incidenttype"] = str(asm3.configuration.default_incident(dbo))
             d["calldate"] = d["incidentdate"]
@@ -891,7 +1160,7 @@ def csvimport(dbo: Database, csvdata: bytes, encoding: str = "utf-8-sig", user:
             d["dispatchtown"] = gks(row, "DISPATCHCITY")
             d["dispatchcounty"] = gks(row, "DISPATCHSTATE")
             d["dispatchpostcode"] = gks(row, "DISPATCHZIPCODE")
-            d["species"] = gkl(dbo, row, "INCIDENTANIMALSPECIES", "species", "SpeciesName", createmissinglookups)
+            d["species"] = gkl(dbo, row, "INCIDENTANIMALSPECIES", "species", "SpeciesName", createmissinglookups, lookups)
             d["sex"] = gksx(row, "INCIDENTANIMALSEX")
             d["dispatchedaco"] = gks(row, "DISPATCHACO")
             d["dispatchdate"] = gkd(dbo, row, "DISPATCHDATE")
@@ -900,7 +1169,7 @@ def csvimport(dbo: Database, csvdata: bytes, encoding: str = "utf-8-sig", user:
             d["followupdate"] = gkd(dbo, row, "INCIDENTFOLLOWUPDATE")
             d["completeddate"] = gkd(dbo, row, "INCIDENTCOMPLETEDDATE")
             d["completedtime"] = gks(row, "INCIDENTCOMPLETEDTIME")
-            d["completedtype"] = gkl(dbo, row, "INCIDENTCOMPLETEDTYPE", "incidentcompleted", "CompletedName", True)
+            d["completedtype"] = gkl(dbo, row, "INCIDENTCOMPLETEDTYPE", "incidentcompleted", "CompletedName", True, lookups)
             try:
                 incidentid = asm3.animalcontrol.insert_animalcontrol_from_form(dbo, asm3.utils.PostedData(d, dbo.locale), user, geocode=False)
             except Exception as e:
@@ -925,7 +1194,7 @@ def csvimport(dbo: Database, csvdata: bytes, encoding: str = "utf-8-sig", user:
         if hasvacc and animalid != 0 and gks(row, "VACCINATIONDUEDATE") != "":
             v = {}
             v["animal"] = str(animalid)
-            v["type"] = gkl(dbo, row, "VACCINATIONTYPE", "vaccinationtype", "VaccinationType", createmissinglookups)
+            v["type"] = gkl(dbo, row, "VACCINATIONTYPE", "vaccinationtype", "VaccinationType", createmissinglookups, lookups)
             if v["type"] == "0":
                 v["type"] = str(asm3.configuration.default_vaccination_type(dbo))
             v["required"] = gkd(dbo, row, "VACCINATIONDUEDATE", True)
@@ -944,8 +1213,8 @@ def csvimport(dbo: Database, csvdata: bytes, encoding: str = "utf-8-sig", user:
         if hastest and animalid != 0 and gks(row, "TESTDUEDATE") != "":
             v = {}
             v["animal"] = str(animalid)
-            v["type"] = gkl(dbo, row, "TESTTYPE", "testtype", "TestName", createmissinglookups)
-            v["result"] = gkl(dbo, row, "TESTRESULT", "testresult", "ResultName", createmissinglookups)
+            v["type"] = gkl(dbo, row, "TESTTYPE", "testtype", "TestName", createmissinglookups, lookups)
+            v["result"] = gkl(dbo, row, "TESTRESULT", "testresult", "ResultName", createmissinglookups, lookups)
             v["required"] = gkd(dbo, row, "TESTDUEDATE", True)
             v["given"] = gkd(dbo, row, "TESTPERFORMEDDATE")
             v["comments"] = gks(row, "TESTCOMMENTS")
@@ -973,7 +1242,7 @@ def csvimport(dbo: Database, csvdata: bytes, encoding: str = "utf-8-sig", user:
         if hascost and animalid != 0 and gkc(row, "COSTAMOUNT") > 0:
             c = {}
             c["animalid"] = str(animalid)
-            c["type"] = gkl(dbo, row, "COSTTYPE", "costtype", "CostTypeName", createmissinglookups)
+            c["type"] = gkl(dbo, row, "COSTTYPE", "costtype", "CostTypeName", createmissinglookups, lookups)
             c["costdate"] = gkd(dbo, row, "COSTDATE", True)
             c["cost"] = str(gkc(row, "COSTAMOUNT"))
             c["description"] = gks(row, "COSTDESCRIPTION")
@@ -985,7 +1254,7 @@ def csvimport(dbo: Database, csvdata: bytes, encoding: str = "utf-8-sig", user:
         # Logs
         if haslog and animalid != 0 and gks(row, "LOGCOMMENTS") != "":
             l = {}
-            l["type"] = gkl(dbo, row, "LOGTYPE", "logtype", "LogTypeName", createmissinglookups)
+            l["type"] = gkl(dbo, row, "LOGTYPE", "logtype", "LogTypeName", createmissinglookups, lookups)
             l["logdate"] = gkd(dbo, row, "LOGDATE", True)
             l["logtime"] = gks(row, "LOGTIME")
             l["entry"] = gks(row, "LOGCOMMENTS")
@@ -999,7 +1268,7 @@ def csvimport(dbo: Database, csvdata: bytes, encoding: str = "utf-8-sig", user:
             l = {}
             l["person"] = str(personid)
             l["animal"] = str(animalid)
-            l["type"] = gkl(dbo, row, "LICENSETYPE", "licencetype", "LicenceTypeName", createmissinglookups)
+            l["type"] = gkl(dbo, row, "LICENSETYPE", "licencetype", "LicenceTypeName", createmissinglookups, lookups)
             if l["type"] == "0": l["type"] = 1
             l["number"] = gks(row, "LICENSENUMBER")
             l["fee"] = str(gkc(row, "LICENSEFEE"))
@@ -1016,7 +1285,7 @@ def csvimport(dbo: Database, csvdata: bytes, encoding: str = "utf-8-sig", user:
             l = {}
             l["person"] = str(originalownerid)
             l["animal"] = str(animalid)
-            l["type"] = gkl(dbo, row, "LICENSETYPE", "licencetype", "LicenceTypeName", createmissinglookups)
+            l["type"] = gkl(dbo, row, "LICENSETYPE", "licencetype", "LicenceTypeName", createmissinglookups, lookups)
             if l["type"] == "0": l["type"] = 1
             l["number"] = gks(row, "LICENSENUMBER")
             l["fee"] = str(gkc(row, "LICENSEFEE"))
@@ -1028,8 +1297,59 @@ def csvimport(dbo: Database, csvdata: bytes, encoding: str = "utf-8-sig", user:
             except Exception as e:
                 row_error(errors, "license", rowno, row, e, dbo, sys.exc_info())
 
-        rowno += 1
-    
+    def import_rows(start: int, batch: List[Dict]) -> bool:
+        """ Imports a list of rows, the first being row number start.
+            Returns False if the import was cancelled. """
+        nonlocal counted
+        for rowno, row in enumerate(batch, start):
+            # Rows imported again after a rollback have already been counted
+            if rowno > counted:
+                counted = rowno
+                asm3.al.debug("import csv: row %d of %d" % (rowno, len(rows)), "csvimport.csvimport", dbo)
+                asm3.asynctask.increment_progress_value(dbo)
+            # Should we stop?
+            if asm3.asynctask.get_cancel(dbo): return False
+            import_row(row, rowno)
+            # If a statement failed, the batch has been rolled back so there is no point going on with it
+            uow = dbo.transaction_state()
+            if uow is not None and uow.failed: 
+                raise asm3.utils.ASMError("row %d failed" % rowno)
+        return True
+
+    # Start fetching any remote media for the rows that will use it
+    def row_urls(row: Dict) -> List[str]:
+        urls = []
+        if hasanimal and gks(row, "ANIMALNAME") != "":
+            urls += [ gks(row, "ANIMALIMAGE"), gks(row, "ANIMALPDFDATA"), gks(row, "ANIMALHTMLDATA") ]
+        if hasperson and (gks(row, "PERSONLASTNAME") != "" or gks(row, "PERSONNAME") != ""):
+            urls += [ gks(row, "PERSONIMAGE"), gks(row, "PERSONPDFDATA") ]
+        return [ x for x in urls if x.startswith("http") ]
+    fetcher = MediaPrefetch([ row_urls(row) for row in rows ])
+
+    try:
+        asm3.asynctask.set_progress_max(dbo, len(rows))
+        if CSV_IMPORT_BATCH_SIZE <= 1:
+            import_rows(1, rows)
+        else:
+            # Commit the rows in batches rather than after every statement
+            for i in range(0, len(rows), CSV_IMPORT_BATCH_SIZE):
+                batch = rows[i:i+CSV_IMPORT_BATCH_SIZE]
+                errorcount = len(errors)
+                try:
+                    with dbo.transaction():
+                        finished = import_rows(i + 1, batch)
+                except Exception as err:
+                    # The batch was rolled back. Forget anything we remembered from it and import
+                    # its rows again one at a time so that only the rows that fail are lost.
+                    asm3.al.warn("rows %d-%d rolled back (%s), importing them again one at a time" % (i + 1, i + len(batch), err), "csvimport.csvimport", dbo)
+                    del errors[errorcount:]
+                    lookups.clear()
+                    people.clear()
+                    finished = import_rows(i + 1, batch)
+                if not finished: break
+    finally:
+        fetcher.close()
+
     if htmlresults:
         h = [ "<p>%d success, %d errors</p><table>" % (len(rows) - len(errors), len(errors)) ]
         for rowno, row, err in errors:
@@ -1362,6 +1682,14 @@ def csvexport_animals(dbo: Database, dataset: str, animalids: str = "", where: s
         "VACCINATIONTYPE", "VACCINATIONDUEDATE", "VACCINATIONGIVENDATE", "VACCINATIONEXPIRESDATE", "VACCINATIONRABIESTAG",
         "VACCINATIONMANUFACTURER", "VACCINATIONBATCHNUMBER", "VACCINATIONCOMMENTS", 
         "MEDICALNAME", "MEDICALDOSAGE", "MEDICALGIVENDATE", "MEDICALCOMMENTS" ]
+
+    # Additional fields are output as ANIMALADDITIONAL<fieldname> so that they
+    # can be imported again, with the values for all animals loaded up front
+    addfields = [ f for f in asm3.additional.get_field_definitions_cached(dbo, "animal") if f.FIELDNAME.upper().find("&") == -1 ]
+    keys += [ "ANIMALADDITIONAL%s" % f.FIELDNAME.upper() for f in addfields ]
+    addvalues = {}
+    if len(addfields) > 0:
+        addvalues = asm3.additional.get_additional_values_ids(dbo, [ x.ID for x in ids ], "animal")
     
     def tocsv(row: Dict) -> str:
         r = []
@@ -1481,6 +1809,9 @@ def csvexport_animals(dbo: Database, dataset: str, animalids: str = "", where: s
             # dummy, mdata = asm3.media.get_image_file_data(dbo, "animal", a["ID"])
             # row["ANIMALIMAGE"] = "data:image/jpg;base64,%s" % asm3.utils.base64encode(mdata)
             row["ANIMALIMAGE"] = "%s?account=%s&method=animal_image&animalid=%s" % (SERVICE_URL, dbo.name(), a["ID"])
+        av = addvalues.get(aid.ID, {})
+        for f in addfields:
+            if av.get(f.ID) is not None: row["ANIMALADDITIONAL%s" % f.FIELDNAME.upper()] = av[f.ID]
         out.write(tocsv(row))
 
         if includemedia == "photos":
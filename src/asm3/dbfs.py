@@ -371,7 +371,9 @@ def put_file(dbo: Database, name: str, path: str, filepath: str) -> int:
         "Path": path
     })
     o = DBFSStorage(dbo)
-    o.put(dbfsid, name, s)
+    url = o.put(dbfsid, name, s)
+    # If the new row is rolled back, remove its file from storage too
+    dbo.on_rollback(lambda: o.delete(url))
     return dbfsid
 
 def put_string(dbo: Database, name: str, path: str, contents: bytes) -> int:
@@ -383,13 +385,17 @@ def put_string(dbo: Database, name: str, path: str, contents: bytes) -> int:
     name = name.replace("'", "")
     path = path.replace("'", "")
     dbfsid = dbo.query_int("SELECT ID FROM dbfs WHERE Path = ? AND Name = ?", (path, name))
+    o = DBFSStorage(dbo)
     if dbfsid == 0:
         dbfsid = dbo.insert("dbfs", {
             "Name": name, 
             "Path": path
         })
-    o = DBFSStorage(dbo)
-    o.put(dbfsid, name, contents)
+        url = o.put(dbfsid, name, contents)
+        # If the new row is rolled back, remove its file from storage too
+        dbo.on_rollback(lambda: o.delete(url))
+    else:
+        o.put(dbfsid, name, contents)
     return dbfsid
 
 def put_string_id(dbo: Database, dbfsid: int, name: str, contents: bytes) -> int:
@@ -6,12 +6,16 @@ import asm3.cachedisk
 import asm3.i18n
 import asm3.utils
 
+import collections.abc
+import contextlib
 import datetime
 import sys
+import threading
 import time
 
 from asm3.sitedefs import DB_TYPE, DB_HOST, DB_PORT, DB_USERNAME, DB_PASSWORD, DB_NAME, DB_EXEC_LOG, DB_EXPLAIN_QUERIES, DB_TIME_QUERIES, DB_TIME_LOG_OVER, DB_TIMEOUT, CACHE_COMMON_QUERIES
-from asm3.typehints import Any, Dict, Generator, List, Tuple
+from asm3.sitedefs import DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_POOL_IDLE_TIMEOUT, DB_POOL_CHECK_AFTER, DB_POOL_WAIT_TIMEOUT, DB_STREAM_BATCH_SIZE
+from asm3.typehints import Any, Callable, Dict, Generator, List, Tuple
 
 class ResultRow(dict):
     """
@@ -40,6 +44,271 @@ class ResultRow(dict):
     def __repr__(self) -> str:
         return '<ResultRow ' + dict.__repr__(self) + '>'
 
+DELETED = object() # marks a column removed from a ResultRowView
+
+class ResultRowView(collections.abc.MutableMapping):
+    """
+    A lightweight row returned by Database.query_view. It behaves like a
+    ResultRow, but keeps the driver's row tuple and a column index shared by
+    every row in the resultset instead of building a dict per row. Values
+    are only decoded when read and anything set on the row is kept in an
+    overlay dict that is not created until the first write.
+    """
+    __slots__ = ("_cols", "_row", "_decode", "_overlay")
+
+    def __init__(self, cols: Dict[str, int], row: Tuple, decode: Callable) -> None:
+        object.__setattr__(self, "_cols", cols)
+        object.__setattr__(self, "_row", row)
+        object.__setattr__(self, "_decode", decode)
+        object.__setattr__(self, "_overlay", None)
+
+    def __getitem__(self, key: str) -> Any:
+        if self._overlay is not None and key in self._overlay:
+            v = self._overlay[key]
+            if v is DELETED: raise KeyError(key)
+            return v
+        return self._decode(self._row[self._cols[key]])
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        if self._overlay is None:
+            object.__setattr__(self, "_overlay", {})
+        self._overlay[key] = value
+
+    def __delitem__(self, key: str) -> None:
+        if key not in self: raise KeyError(key)
+        if key in self._cols:
+            self[key] = DELETED
+        else:
+            del self._overlay[key]
+
+    def __contains__(self, key: Any) -> bool:
+        if self._overlay is not None and key in self._overlay:
+            return self._overlay[key] is not DELETED
+        return key in self._cols
+
+    def __iter__(self) -> Generator[str, None, None]:
+        o = self._overlay
+        for k in self._cols:
+            if o is None or o.get(k) is not DELETED:
+                yield k
+        if o is not None:
+            for k, v in o.items():
+                if k not in self._cols and v is not DELETED:
+                    yield k
+
+    def __len__(self) -> int:
+        if self._overlay is None: return len(self._cols)
+        return sum(1 for dummy in self)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self) -> List[str]:
+        return list(self)
+
+    def values(self) -> List[Any]:
+        return [ self[k] for k in self ]
+
+    def items(self) -> List[Tuple[str, Any]]:
+        return [ (k, self[k]) for k in self ]
+
+    def copy(self) -> ResultRow:
+        return ResultRow(self.items())
+
+    def todict(self) -> ResultRow:
+        """ Materialises this row as a regular ResultRow """
+        return ResultRow(self.items())
+
+    def __getattr__(self, key: str) -> Any:
+        try:
+            return self[key.upper()]
+        except KeyError as k:
+            raise AttributeError(k)
+
+    def __setattr__(self, key: str, value: Any) -> None:
+        self[key.upper()] = value
+
+    def __delattr__(self, key: str) -> None:
+        try:
+            del self[key.upper()]
+        except KeyError as k:
+            raise AttributeError(k)
+
+    def __reduce__(self) -> Tuple:
+        # Pickles and copies as a plain ResultRow
+        return (ResultRow, (self.items(),))
+
+    def __repr__(self) -> str:
+        return '<ResultRowView ' + dict.__repr__(dict(self.items())) + '>'
+
+class ConnectionPool(object):
+    """
+    A thread-safe pool of open connections to a single database.
+    
+    get() hands out an idle connection (most recently used first) or opens
+    a new one if there are fewer than maxsize open. If the pool is full, it
+    waits up to waittimeout seconds for a connection to be released and returns
+    None if one was not. Connections that have been idle for longer than
+    checkafter seconds are tested before being handed out and connections
+    idle for longer than idletimeout are closed, keeping at least minsize open.
+    
+    release() rolls back anything left uncommitted and returns the connection
+    to the pool. Connections that did not come from the pool are closed.
+    """
+    def __init__(self, connectfn: Callable, minsize: int = 0, maxsize: int = 10, idletimeout: int = 300, 
+                 checkafter: int = 30, waittimeout: int = 5) -> None:
+        self.connectfn = connectfn
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self.idletimeout = idletimeout
+        self.checkafter = checkafter
+        self.waittimeout = waittimeout
+        self.size = 0 # number of open connections owned by the pool (idle + in use)
+        self.idle = [] # [ connection, lastused ]
+        self.inuse = set() # id() of connections currently checked out
+        self.cond = threading.Condition()
+
+    def get(self) -> Any:
+        """ Returns an open connection from the pool, or None if the pool is exhausted """
+        deadline = time.time() + self.waittimeout
+        while True:
+            c = None
+            lastused = 0
+            with self.cond:
+                self._evict_idle()
+                while len(self.idle) == 0 and self.size >= self.maxsize:
+                    remaining = deadline - time.time()
+                    if remaining <= 0: return None
+                    self.cond.wait(remaining)
+                if len(self.idle) > 0:
+                    c, lastused = self.idle.pop()
+                else:
+                    self.size += 1 # reserve a slot, the connection is opened outside the lock
+            if c is None:
+                try:
+                    c = self.connectfn()
+                except:
+                    self._forget(None)
+                    raise
+            elif time.time() - lastused >= self.checkafter and not self._healthy(c):
+                self._forget(c)
+                continue
+            with self.cond:
+                self.inuse.add(id(c))
+            return c
+
+    def release(self, c: Any, discard: bool = False) -> None:
+        """ Returns connection c to the pool. If discard is True or the 
+            connection is no longer usable, it is closed instead. """
+        with self.cond:
+            if id(c) not in self.inuse:
+                # Not one of ours (or already released), just close it if it isn't idle
+                if not any(x[0] is c for x in self.idle): self._close(c)
+                return
+            self.inuse.discard(id(c))
+        if not discard:
+            try:
+                c.rollback()
+            except:
+                discard = True
+        if discard:
+            self._forget(c, inuse=False)
+            return
+        with self.cond:
+            self.idle.append([c, time.time()])
+            self.cond.notify()
+
+    def prefill(self) -> None:
+        """ Opens connections until there are at least minsize in the pool """
+        while True:
+            with self.cond:
+                if self.size >= self.minsize or self.size >= self.maxsize: return
+                self.size += 1
+            try:
+                c = self.connectfn()
+            except:
+                self._forget(None)
+                raise
+            with self.cond:
+                self.idle.insert(0, [c, time.time()])
+                self.cond.notify()
+
+    def close_all(self) -> None:
+        """ Closes all idle connections. Connections in use are closed when released. """
+        with self.cond:
+            for c, lastused in self.idle:
+                self._close(c)
+            self.size -= len(self.idle)
+            self.idle = []
+
+    def _close(self, c: Any) -> None:
+        try:
+            c.close()
+        except:
+            pass
+
+    def _evict_idle(self) -> None:
+        """ Closes connections that have been idle for longer than idletimeout. 
+            Must be called while holding the lock. The idle list is in order of 
+            last use, so the oldest are at the front. """
+        cutoff = time.time() - self.idletimeout
+        while len(self.idle) > 0 and self.size > self.minsize and self.idle[0][1] < cutoff:
+            c, lastused = self.idle.pop(0)
+            self._close(c)
+            self.size -= 1
+
+    def _forget(self, c: Any, inuse: bool = True) -> None:
+        """ Closes connection c (if given) and frees its slot in the pool """
+        if c is not None: self._close(c)
+        with self.cond:
+            if inuse and c is not None: self.inuse.discard(id(c))
+            self.size -= 1
+            self.cond.notify()
+
+    def _healthy(self, c: Any) -> bool:
+        """ Returns True if connection c can still run a query """
+        try:
+            s = c.cursor()
+            s.execute("SELECT 1")
+            s.fetchall()
+            s.close()
+            c.rollback()
+            return True
+        except:
+            return False
+
+connection_pools = {}
+connection_pools_lock = threading.Lock()
+
+class UnitOfWork(object):
+    """
+    State for an open Database.transaction() block. 
+    Kept per thread (see unit_of_work) rather than on the dbo so that
+    dbo objects shared between requests or pickled into a session are
+    unaffected.
+    """
+    def __init__(self, connection: Any, owned: bool) -> None:
+        self.connection = connection
+        self.owned = owned # True if the connection was opened for this unit of work
+        self.depth = 0
+        self.failed = False # A statement failed and the work has already been rolled back
+        self.rollback_actions = [] # Functions to call if the work is rolled back (see Database.on_rollback)
+
+    def rolled_back(self) -> None:
+        """ Calls the rollback actions once the work has been rolled back """
+        actions = self.rollback_actions
+        self.rollback_actions = []
+        for fn in actions:
+            try:
+                fn()
+            except Exception as err:
+                asm3.al.error("rollback action failed: %s" % err, "UnitOfWork.rolled_back")
+
+unit_of_work = threading.local()
+
 class QueryBuilder(object):
     """
     Build a query from component parts, keeping track of params eg:
@@ -124,6 +393,7 @@ class Database(object):
     is_large_db = False
     timeout = DB_TIMEOUT
     connection = None
+    pooling = True # Whether this backend can share connections through a ConnectionPool
 
     type_shorttext = "VARCHAR(1024)"
     type_longtext = "TEXT"
@@ -136,33 +406,179 @@ class Database(object):
         """ Virtual: Connect to the database and return the connection """
         raise NotImplementedError()
     
+    def connection_pool(self) -> ConnectionPool:
+        """ Returns the shared connection pool for this database, creating
+            it if necessary. Pools are per process and keyed by connection info
+            so that every dbo object for the same database (including aliases 
+            in MULTIPLE_DATABASES_MAP and sheltermanager.com) shares one.
+        """
+        key = "%s:%s:%s:%s:%s" % (self.dbtype, self.host, self.port, self.username, self.database)
+        with connection_pools_lock:
+            pool = connection_pools.get(key)
+            if pool is None:
+                pool = ConnectionPool(self.connect, minsize=DB_POOL_MIN_SIZE, maxsize=DB_POOL_MAX_SIZE, 
+                    idletimeout=DB_POOL_IDLE_TIMEOUT, checkafter=DB_POOL_CHECK_AFTER, waittimeout=DB_POOL_WAIT_TIMEOUT)
+                connection_pools[key] = pool
+                created = True
+            else:
+                created = False
+        if created:
+            try:
+                pool.prefill()
+            except Exception as err:
+                asm3.al.error("failed opening connections for pool: %s" % err, "Database.connection_pool", self)
+        return pool
+
+    def connection_pooled(self) -> bool:
+        """ Returns True if connections for this dbo come from a ConnectionPool """
+        return self.connection is None and self.pooling and DB_POOL_MAX_SIZE > 0
+
+    def connection_open(self) -> Any:
+        """ Returns a new connection, from the pool if pooling is on """
+        if self.connection_pooled():
+            c = self.connection_pool().get()
+            if c is not None: return c
+            asm3.al.warn("connection pool exhausted (%s), opening unpooled connection" % DB_POOL_MAX_SIZE, "Database.connection_open", self)
+        return self.connect()
+
+    def connection_close(self, c: Any, discard: bool = False) -> None:
+        """ Closes a connection from connection_open, returning it to the pool if pooling is on """
+        if self.connection_pooled():
+            if not discard:
+                try:
+                    self.connection_reset(c)
+                except:
+                    discard = True
+            self.connection_pool().release(c, discard=discard)
+            return
+        try:
+            c.close()
+        except:
+            pass
+
+    def connection_reset(self, c: Any) -> None:
+        """ Virtual: Undoes any session settings made on connection c before 
+            it is returned to the pool for another dbo to use """
+        pass
+
     def cursor_open(self) -> Tuple[Any, Any]:
         """ Returns a tuple containing an open connection and cursor.
-            If the dbo object contains an active connection, we'll just use
-            that to get a cursor to save time.
+            If we are inside a unit of work, or the dbo object contains an 
+            active connection, we'll just use that to get a cursor to save time. 
+            If pooling is on, the connection comes from the pool for this database.
         """
-        if self.connection is not None:
+        uow = self.transaction_state()
+        if uow is not None:
+            c = uow.connection
+            s = c.cursor()
+        elif self.connection is not None:
             c = self.connection
             s = self.connection.cursor()
         else:
-            c = self.connect()
-            s = c.cursor()
+            c = self.connection_open()
+            try:
+                s = c.cursor()
+            except:
+                self.connection_close(c, discard=True)
+                raise
         return c, s
 
+    def cursor_stream(self, c: Any) -> Any:
+        """ Returns a cursor on connection c that streams results from the server
+            instead of reading the whole resultset into memory when the query is run.
+            DBMS implementations should override this where the driver supports it. 
+        """
+        return c.cursor()
+
     def cursor_close(self, c: Any, s: Any) -> None:
         """ Closes a connection and cursor pair. If self.connection exists, then
             c must be it, so don't close it. Connection caching in this object
-            is done by processes called via cron.py as they do not use pooling.
+            is done by processes called via cron.py as they hold one connection
+            for the whole run. The connection for a unit of work is also kept
+            open until the end of the transaction block. 
+            Pooled connections are returned to the pool.
         """
         try:
             s.close()
         except:
             pass
-        if self.connection is None:
+        if self.connection is None and self.transaction_state() is None:
+            self.connection_close(c)
+
+    def commit(self, c: Any) -> None:
+        """ Commits connection c, unless we are inside a unit of work, where
+            the commit is deferred until the transaction block exits """
+        if self.transaction_state() is None: 
+            c.commit()
+
+    def rollback(self, c: Any = None) -> None:
+        """ Rolls back connection c after a failed statement. Inside a unit of 
+            work this discards all the work so far, so it is marked as failed
+            and c can be omitted. """
+        uow = self.transaction_state()
+        if uow is not None: 
+            uow.failed = True
+            c = uow.connection
+        if c is None: return
+        try:
+            c.rollback()
+        except:
+            pass
+        if uow is not None: uow.rolled_back()
+
+    def on_rollback(self, fn: Callable) -> None:
+        """ Calls fn if the open unit of work is rolled back, so that things done
+            outside the database (eg: files written by dbfs) can be undone.
+            Does nothing outside a unit of work as statements are committed as they run. """
+        uow = self.transaction_state()
+        if uow is not None: uow.rollback_actions.append(fn)
+
+    @contextlib.contextmanager
+    def transaction(self) -> Generator[None, None, None]:
+        """ Unit of work. All statements run with this dbo by the current thread
+            inside the block share one connection and are committed together
+            when the block exits. If the block raises, everything is rolled back. 
+            Nested blocks join the outermost one.
+            
+            with dbo.transaction():
+                dbo.update("animal", 1, { "AnimalName": "Bob" }, "user")
+                dbo.insert("log", { ... }, "user")
+        """
+        uows = unit_of_work.__dict__.setdefault("uows", {})
+        uow = uows.get(id(self))
+        if uow is not None:
+            uow.depth += 1
+            try:
+                yield
+            finally:
+                uow.depth -= 1
+            return
+        if self.connection is not None:
+            uow = UnitOfWork(self.connection, False)
+        else:
+            uow = UnitOfWork(self.connection_open(), True)
+        uows[id(self)] = uow
+        try:
+            yield
+            if uow.failed:
+                raise asm3.utils.ASMError("transaction was rolled back after an earlier statement failed")
+            uow.connection.commit()
+        except:
             try:
-                c.close()
+                uow.connection.rollback()
             except:
                 pass
+            uow.rolled_back()
+            raise
+        finally:
+            del uows[id(self)]
+            if uow.owned: self.connection_close(uow.connection)
+
+    def transaction_state(self) -> UnitOfWork:
+        """ Returns the open unit of work for this dbo in the current thread, or None """
+        uows = unit_of_work.__dict__.get("uows")
+        if uows is None: return None
+        return uows.get(id(self))
 
     def name(self) -> str:
         """ Returns the database name """
@@ -245,6 +661,7 @@ class Database(object):
         def transform(s):
             """ Transforms values coming out of the database """
             if s is None: return ""
+            if s.find("`") == -1 and s.find("&bt;") == -1: return s # nothing to do, avoid copying
             s = s.replace("`", "'") # Backticks become apostrophes again
             s = s.replace("&bt;", "`") # Encoded backticks become proper backticks
             return s
@@ -292,8 +709,7 @@ class Database(object):
             else:
                 s.execute(sql)
             rv = s.rowcount
-            c.commit()
-            self.cursor_close(c, s)
+            self.commit(c)
             self._log_sql(sql, params)
             return rv
         except Exception as err:
@@ -302,7 +718,7 @@ class Database(object):
             try:
                 # An error can leave a connection in unusable state, 
                 # rollback any attempted changes.
-                c.rollback()
+                self.rollback(c)
             except:
                 pass
             raise err
@@ -343,8 +759,7 @@ class Database(object):
             sql = self.switch_param_placeholder(sql)
             s.executemany(sql, params)
             rv = s.rowcount
-            c.commit()
-            self.cursor_close(c, s)
+            self.commit(c)
             return rv
         except Exception as err:
             asm3.al.error(str(err), "Database.execute_many", self, sys.exc_info())
@@ -352,7 +767,49 @@ class Database(object):
             try:
                 # An error can leave a connection in unusable state, 
                 # rollback any attempted changes.
-                c.rollback()
+                self.rollback(c)
+            except:
+                pass
+            raise err
+        finally:
+            try:
+                self.cursor_close(c, s)
+            except:
+                pass
+
+    def execute_returning(self, sql: str, params: List = None, override_lock: bool = False) -> List[ResultRow]:
+        """
+            Runs an action query with a RETURNING clause (or any other that 
+            produces rows) and returns the rows as a list of ResultRow objects.
+            override_lock: as for execute
+        """
+        if not override_lock and self.locked: return []
+        if sql is None or sql.strip() == "": return []
+        try:
+            c, s = self.cursor_open()
+            if params:
+                sql = self.switch_param_placeholder(sql)
+                s.execute(sql, params)
+            else:
+                s.execute(sql)
+            d = s.fetchall() # all rows must be read before commit
+            cols = [ x[0].upper() for x in s.description ]
+            self.commit(c)
+            self._log_sql(sql, params)
+            l = []
+            for row in d:
+                rowmap = ResultRow()
+                for i in range(0, len(row)):
+                    rowmap[cols[i]] = self.encode_str_after_read(row[i])
+                l.append(rowmap)
+            return l
+        except Exception as err:
+            asm3.al.error(str(err), "Database.execute_returning", self, sys.exc_info())
+            asm3.al.error("failing sql: %s %s" % (sql, params), "Database.execute_returning", self)
+            try:
+                # An error can leave a connection in unusable state, 
+                # rollback any attempted changes.
+                self.rollback(c)
             except:
                 pass
             raise err
@@ -482,16 +939,57 @@ class Database(object):
         if asm3.utils.is_numeric(where):
             iid = asm3.utils.cint(where)
             where = "ID=%s" % where
-        sql = "UPDATE %s SET %s WHERE %s" % ( table, ",".join( ["%s=?" % x for x in values.keys()] ), where )
-        if iid > 0: 
-            preaudit = self.query_row(table, iid)
-        rows_affected = self.execute(sql, list(values.values()), override_lock=setOverrideDBLock)
-        if iid > 0:
-            postaudit = self.query_row(table, iid)
-        if user != "" and iid > 0 and rows_affected > 0 and writeAudit:
-            asm3.audit.edit(self, user, table, iid, asm3.audit.get_parent_links(values, table), asm3.audit.map_diff(preaudit, postaudit, asm3.audit.get_readable_fields_for_table(table)))
+        if user == "" or iid == 0 or not writeAudit:
+            sql = "UPDATE %s SET %s WHERE %s" % ( table, ",".join( ["%s=?" % x for x in values.keys()] ), where )
+            return self.execute(sql, list(values.values()), override_lock=setOverrideDBLock)
+        readable = asm3.audit.get_readable_fields_for_table(table)
+        rows_affected, preaudit, postaudit = self.update_audit_values(table, iid, values, readable, override_lock=setOverrideDBLock)
+        if rows_affected > 0:
+            asm3.audit.edit(self, user, table, iid, asm3.audit.get_parent_links(values, table), asm3.audit.map_diff(preaudit, postaudit, readable))
         return rows_affected
 
+    def update_audit_values(self, table: str, iid: int, values: Dict, readable: List[str] = [], override_lock: bool = False) -> Tuple[int, ResultRow, ResultRow]:
+        """ Updates row ID=iid in table with values (already encoded for writing) 
+            and returns a tuple of the rows affected and the before and after values 
+            needed to audit the change. Only the ID, the readable fields and the 
+            columns being changed are read back.
+            This fallback version reads the old values with a single locked
+            SELECT and works out the new values from what was written, backends
+            that support it override this to use UPDATE ... RETURNING.
+        """
+        if not override_lock and self.locked: return (0, None, None)
+        cols = self._audit_columns(values, readable)
+        # Both statements share one unit of work so that the row stays locked until it has been updated
+        with self.transaction():
+            preaudit = self.first_row(self.query("SELECT %s FROM %s WHERE ID=%d %s" % (",".join(cols), table, iid, self.sql_for_update())))
+            if preaudit is None: return (0, None, None)
+            sql = "UPDATE %s SET %s WHERE ID=%d" % ( table, ",".join( ["%s=?" % x for x in values.keys()] ), iid )
+            rows_affected = self.execute(sql, list(values.values()), override_lock=override_lock)
+        postaudit = preaudit.copy()
+        for k, v in values.items():
+            postaudit[k.upper()] = self._value_as_read(preaudit.get(k.upper()), v)
+        return (rows_affected, preaudit, postaudit)
+
+    def _audit_columns(self, values: Dict, readable: List[str]) -> List[str]:
+        """ Returns the uppercased list of columns to read for auditing an update of values """
+        cols = [ "ID" ]
+        for k in readable + list(values.keys()):
+            if k.upper() not in cols: cols.append(k.upper())
+        return cols
+
+    def _value_as_read(self, old: Any, new: Any) -> Any:
+        """ Given a value that has just been written to a column, returns it as 
+            it would come back from a query so that it can be compared with 
+            the old value for auditing without reading the row again. 
+        """
+        if new is None: return None
+        if asm3.utils.is_str(new): return self.encode_str_after_read(new)
+        if isinstance(new, bool): return int(new)
+        if isinstance(old, float) and isinstance(new, int): return float(new)
+        if isinstance(old, datetime.datetime) and not isinstance(new, datetime.datetime) and isinstance(new, datetime.date):
+            return datetime.datetime(new.year, new.month, new.day)
+        return new
+
     def delete(self, table: str, where: str, user: str = "", writeAudit: bool = True, writeDeletion: bool = True) -> int:
         """ Deletes row ID=iid from table 
             table: The table to delete from
@@ -503,10 +1001,13 @@ class Database(object):
         """
         if asm3.utils.is_numeric(where):
             where = "ID=%s" % asm3.utils.cint(where)
-        if writeAudit and user != "":
-            asm3.audit.delete_rows(self, user, table, where)
-        if writeDeletion and user != "":
-            asm3.audit.insert_deletions(self, user, table, where)
+        if user != "" and (writeAudit or writeDeletion):
+            # Read the rows once for both the audit trail and deletion log
+            rows = self.query("SELECT * FROM %s WHERE %s" % (table, where))
+            if writeAudit:
+                asm3.audit.delete_rows(self, user, table, where, rows)
+            if writeDeletion:
+                asm3.audit.insert_deletions(self, user, table, where, rows)
         return self.execute("DELETE FROM %s WHERE %s" % (table, where))
 
     def install_stored_procedures(self) -> None:
@@ -595,6 +1096,31 @@ class Database(object):
                         This is faster than doing DISTINCT on the full row at the database level
                         (the only thing all RDBMS are guaranteed to support)
         """
+        cols, d = self.query_fetchall(sql, params, limit, "Database.query")
+        l = []
+        seendistinct = set()
+        for row in d:
+            rowmap = ResultRow()
+            for i in range(0, len(row)):
+                v = self.encode_str_after_read(row[i])
+                rowmap[cols[i]] = v
+            # If a distinct on value has been set, check for duplicates
+            # before adding this row to the resultset
+            if distincton != "" and distincton in rowmap:
+                distinctval = rowmap[distincton]
+                if distinctval not in seendistinct:
+                    seendistinct.add(distinctval)
+                    l.append(rowmap)
+            else:
+                l.append(rowmap)
+        return l
+
+    def query_fetchall(self, sql: str, params: List = None, limit: int = 0, caller: str = "Database.query_fetchall") -> Tuple[List[str], List[Tuple]]:
+        """ Runs the query given and returns a tuple of the uppercased column names
+            and the rows as tuples from the driver, without decoding any values.
+            This is the execution path shared by query() and query_view().
+            caller: The name of the calling function for logging
+        """
         try:
             c, s = self.cursor_open()
             # Add limit clause if set
@@ -603,8 +1129,8 @@ class Database(object):
             # Explain the query if the option is on
             if DB_EXPLAIN_QUERIES:
                 esql = "EXPLAIN %s" % sql
-                asm3.al.debug(esql, "Database.query", self)
-                asm3.al.debug(self.query_explain(esql), "Database.query", self)
+                asm3.al.debug(esql, caller, self)
+                asm3.al.debug(self.query_explain(esql), caller, self)
             # Record start time
             start = time.time()
             # Run the query and retrieve all rows
@@ -613,37 +1139,19 @@ class Database(object):
                 s.execute(sql, params)
             else:
                 s.execute(sql)
-            c.commit()
+            self.commit(c)
             d = s.fetchall()
-            l = []
-            cols = []
             # Get the list of column names
-            for i in s.description:
-                cols.append(i[0].upper())
-            seendistinct = set()
-            for row in d:
-                rowmap = ResultRow()
-                for i in range(0, len(row)):
-                    v = self.encode_str_after_read(row[i])
-                    rowmap[cols[i]] = v
-                # If a distinct on value has been set, check for duplicates
-                # before adding this row to the resultset
-                if distincton != "" and distincton in rowmap:
-                    distinctval = rowmap[distincton]
-                    if distinctval not in seendistinct:
-                        seendistinct.add(distinctval)
-                        l.append(rowmap)
-                else:
-                    l.append(rowmap)
-            self.cursor_close(c, s)
+            cols = [ x[0].upper() for x in s.description ]
             if DB_TIME_QUERIES:
                 tt = time.time() - start
                 if tt > DB_TIME_LOG_OVER:
-                    asm3.al.debug("(%0.2f sec) %s" % (tt, sql), "Database.query", self)
-            return l
+                    asm3.al.debug("(%0.2f sec) %s" % (tt, sql), caller, self)
+            return cols, d
         except Exception as err:
-            asm3.al.error(str(err), "Database.query", self, sys.exc_info())
-            asm3.al.error("failing sql: %s %s" % (sql, params), "Database.query", self)
+            asm3.al.error(str(err), caller, self, sys.exc_info())
+            asm3.al.error("failing sql: %s %s" % (sql, params), caller, self)
+            self.rollback() # fails any unit of work in progress
             raise err
         finally:
             try:
@@ -682,16 +1190,16 @@ class Database(object):
                 s.execute(sql, params)
             else:
                 s.execute(sql)
-            c.commit()
+            self.commit(c)
             # Build a list of the column names
             cn = []
             for col in s.description:
                 cn.append(col[0].upper())
-            self.cursor_close(c, s)
             return cn
         except Exception as err:
             asm3.al.error(str(err), "Database.query_columns", self, sys.exc_info())
             asm3.al.error("failing sql: %s %s" % (sql, params), "Database.query_columns", self)
+            self.rollback() # fails any unit of work in progress
             raise err
         finally:
             try:
@@ -711,41 +1219,79 @@ class Database(object):
             o.append(r[0])
         return "\n".join(o)
 
-    def query_generator(self, sql: str, params: List = None) -> Generator[ResultRow, None, None]:
-        """ Runs the query given and returns the resultset as a list of dictionaries. 
+    def query_view(self, sql: str, params: List = None, limit: int = 0, distincton: str = "") -> List[ResultRowView]:
+        """ Runs the query given and returns the resultset as a list of ResultRowView objects.
+            Behaves the same as query(), but rows share a single column index and keep
+            the tuple from the driver, decoding values as they are read. This uses far
+            less memory than query() for large resultsets with many columns.
+        """
+        names, d = self.query_fetchall(sql, params, limit, "Database.query_view")
+        # Map uppercased column names to their position, where names
+        # are duplicated the last one wins, the same as query()
+        cols = {}
+        for i, col in enumerate(names):
+            cols[col] = i
+        decode = self.encode_str_after_read
+        if distincton != "" and distincton in cols:
+            di = cols[distincton]
+            seendistinct = set()
+            l = []
+            for row in d:
+                distinctval = decode(row[di])
+                if distinctval not in seendistinct:
+                    seendistinct.add(distinctval)
+                    l.append(ResultRowView(cols, row, decode))
+        else:
+            l = [ ResultRowView(cols, row, decode) for row in d ]
+        return l
+
+    def query_generator(self, sql: str, params: List = None) -> Generator[ResultRowView, None, None]:
+        """ Runs the query given and yields the resultset a row at a time as ResultRowView objects. 
             All fieldnames are uppercased when returned. 
-            generator function version that uses a forward cursor.
+            Outside of a unit of work this uses a connection of its own and a server side 
+            cursor where the database supports it, so only DB_STREAM_BATCH_SIZE rows are
+            held in memory at a time. This includes when a connection is held on the dbo 
+            (cron), as the caller may run other queries on that connection while reading 
+            the rows, which a server side cursor does not allow.
         """
+        streaming = self.transaction_state() is None
         try:
-            c, s = self.cursor_open()
-            # Run the query and retrieve all rows
+            if streaming:
+                c = self.connection_open()
+                s = self.cursor_stream(c)
+            else:
+                c, s = self.cursor_open()
+            # Run the query
             if params:
                 sql = self.switch_param_placeholder(sql)
                 s.execute(sql, params)
             else:
                 s.execute(sql)
-            c.commit()
-            cols = []
-            # Get the list of column names
-            for i in s.description:
-                cols.append(i[0].upper())
-            row = s.fetchone()
-            while row:
-                # Intialise a map for each row
-                rowmap = {}
-                for i in range(0, len(row)):
-                    v = self.encode_str_after_read(row[i])
-                    rowmap[cols[i]] = v
-                yield rowmap
-                row = s.fetchone()
-            self.cursor_close(c, s)
+            # Some drivers do not describe the columns of a server side cursor until 
+            # the first fetch, so read the first batch before looking at them
+            rows = s.fetchmany(DB_STREAM_BATCH_SIZE)
+            cols = {}
+            for i, col in enumerate(s.description):
+                cols[col[0].upper()] = i
+            decode = self.encode_str_after_read
+            while rows:
+                for row in rows:
+                    yield ResultRowView(cols, row, decode)
+                rows = s.fetchmany(DB_STREAM_BATCH_SIZE)
+            # Server side cursors only live as long as the transaction they were declared in
+            self.commit(c)
         except Exception as err:
             asm3.al.error(str(err), "Database.query_generator", self, sys.exc_info())
             asm3.al.error("failing sql: %s %s" % (sql, params), "Database.query_generator", self)
+            if not streaming: self.rollback() # fails any unit of work in progress
             raise err
         finally:
             try:
-                self.cursor_close(c, s)
+                if streaming:
+                    s.close()
+                    self.connection_close(c)
+                else:
+                    self.cursor_close(c, s)
             except:
                 pass
 
@@ -788,12 +1334,12 @@ class Database(object):
             else:
                 s.execute(sql)
             d = s.fetchall()
-            c.commit()
-            self.cursor_close(c, s)
+            self.commit(c)
             return d
         except Exception as err:
             asm3.al.error(str(err), "Database.query_tuple", self, sys.exc_info())
             asm3.al.error("failing sql: %s %s" % (sql, params), "Database.query_tuple", self)
+            self.rollback() # fails any unit of work in progress
             raise err
         finally:
             try:
@@ -817,16 +1363,16 @@ class Database(object):
             else:
                 s.execute(sql)
             d = s.fetchall()
-            c.commit()
+            self.commit(c)
             # Build a list of the column names
             cn = []
             for col in s.description:
                 cn.append(col[0].upper())
-            self.cursor_close(c, s)
             return (d, cn)
         except Exception as err:
             asm3.al.error(str(err), "Database.query_tuple_columns", self, sys.exc_info())
             asm3.al.error("failing sql: %s %s" % (sql, params), "Database.query_tuple_columns", self)
+            self.rollback() # fails any unit of work in progress
             raise err
         finally:
             try:
@@ -994,6 +1540,11 @@ class Database(object):
         """
         pass # no generic way to do this
     
+    def sql_for_update(self) -> str:
+        """ Writes a clause for the end of a SELECT that locks the rows read 
+            until the end of the transaction, if the backend supports it """
+        return ""
+
     def sql_greatest(self, items: List[str]) -> str:
         """ Writes greatest for a list of items """
         return "GREATEST(%s)" % ",".join(items)
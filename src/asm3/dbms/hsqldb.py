@@ -2,6 +2,7 @@
 from .base import Database
 
 class DatabaseHSQLDB(Database):
+    pooling = False # no connections are ever made
     type_shorttext = "VARCHAR(1024)"
     type_longtext = "VARCHAR(2000000)"
     type_clob = "VARCHAR(2000000)"
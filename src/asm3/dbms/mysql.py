@@ -5,6 +5,7 @@ from asm3.typehints import Any, List, Tuple
 
 try:
     import MySQLdb
+    import MySQLdb.cursors
 except:
     pass
 
@@ -29,6 +30,20 @@ class DatabaseMySQL(Database):
             s.execute("SET SESSION max_execution_time=%d" % self.timeout)
         return c, s
 
+    def connection_reset(self, c: Any) -> None:
+        """ Overridden to remove the session timeout set by cursor_open """
+        if self.timeout > 0:
+            s = c.cursor()
+            s.execute("SET SESSION max_execution_time=0")
+            s.close()
+
+    def cursor_stream(self, c: Any) -> Any:
+        """ Overridden to use an unbuffered cursor that reads rows from the server as they are fetched """
+        s = c.cursor(MySQLdb.cursors.SSCursor)
+        if self.timeout > 0: 
+            s.execute("SET SESSION max_execution_time=%d" % self.timeout)
+        return s
+
     def ddl_add_index(self, name: str, table: str, column: str, unique: bool = False, partial: bool = False) -> str:
         """ Overridden to allow partial index support """
         u = ""
@@ -121,6 +136,9 @@ class DatabaseMySQL(Database):
         """
         return f"DAYOFWEEK({dateexpr})"
     
+    def sql_for_update(self) -> str:
+        return "FOR UPDATE"
+
     def sql_interval(self, columnname: str, number: int, sign: str = "+", units: str = "months") -> str:
         """
         Used to add or a subtract a period to/from a date column 
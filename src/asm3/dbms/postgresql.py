@@ -1,7 +1,10 @@
 
 import asm3.al
-from .base import Database
-from asm3.typehints import Any, Tuple
+from .base import Database, ResultRow
+from asm3.sitedefs import DB_STREAM_BATCH_SIZE
+from asm3.typehints import Any, Dict, List, Tuple
+
+import uuid
 
 try:
     import psycopg2
@@ -24,11 +27,22 @@ class DatabasePostgreSQL(Database):
         return c
 
     def cursor_open(self) -> Tuple[Any, Any]:
-        """ Overridden to apply timeout """
+        """ Overridden to apply timeout. SET LOCAL only lasts until the end of the 
+            current transaction, so the timeout does not stay on a pooled connection """
         c, s = Database.cursor_open(self)
-        if self.timeout > 0: s.execute("SET statement_timeout=%d" % self.timeout)
+        if self.timeout > 0: s.execute("SET LOCAL statement_timeout=%d" % self.timeout)
         return c, s
 
+    def cursor_stream(self, c: Any) -> Any:
+        """ Overridden to use a named cursor, which psycopg2 declares on the server """
+        if self.timeout > 0: 
+            t = c.cursor()
+            t.execute("SET LOCAL statement_timeout=%d" % self.timeout)
+            t.close()
+        s = c.cursor(name="asm3_%s" % uuid.uuid4().hex)
+        s.itersize = DB_STREAM_BATCH_SIZE
+        return s
+
     def ddl_add_index(self, name: str, table: str, column: str, unique: bool = False, partial: bool = False) -> str:
         u = ""
         if unique: u = "UNIQUE "
@@ -160,6 +174,9 @@ class DatabasePostgreSQL(Database):
         """
         return f"TO_CHAR({dateexpr}::timestamp, 'DAY')"
 
+    def sql_for_update(self) -> str:
+        return "FOR UPDATE"
+
     def sql_ilike(self, expr1: str, expr2: str = "?") -> str:
         return "%s ILIKE %s" % (expr1, expr2)
     
@@ -192,6 +209,26 @@ class DatabasePostgreSQL(Database):
         """ Writes a function that zero pads an expression with zeroes to digits """
         return "TO_CHAR(%s, 'FM%s')" % (fieldexpr, "0"*digits)
 
+    def update_audit_values(self, table: str, iid: int, values: Dict, readable: List[str] = [], override_lock: bool = False) -> Tuple[int, ResultRow, ResultRow]:
+        """ Overridden to lock and read the old values, update the row and return 
+            the new values in a single statement with UPDATE ... FROM ... RETURNING """
+        if not override_lock and self.locked: return (0, None, None)
+        cols = self._audit_columns(values, readable)
+        sql = "UPDATE %s SET %s FROM (SELECT %s FROM %s WHERE ID=%d FOR UPDATE) pre WHERE %s.ID=pre.ID RETURNING %s, %s" % ( 
+            table, 
+            ",".join( ["%s=?" % x for x in values.keys()] ),
+            ",".join(cols), table, iid, table, 
+            ",".join( ["pre.%s AS pre_%s" % (x, x) for x in cols] ),
+            ",".join( ["%s.%s AS post_%s" % (table, x, x) for x in cols] ))
+        rows = self.execute_returning(sql, list(values.values()), override_lock=override_lock)
+        if len(rows) == 0: return (0, None, None)
+        preaudit = ResultRow()
+        postaudit = ResultRow()
+        for x in cols:
+            preaudit[x] = rows[0]["PRE_%s" % x]
+            postaudit[x] = rows[0]["POST_%s" % x]
+        return (len(rows), preaudit, postaudit)
+
     def vacuum(self, tablename: str = "") -> None:
         self.execute("VACUUM %s" % tablename)
 
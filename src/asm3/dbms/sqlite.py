@@ -1,6 +1,6 @@
 
-from .base import Database
-from asm3.typehints import Any, List
+from .base import Database, ResultRow
+from asm3.typehints import Any, Dict, List, Tuple
 
 try:
     import sqlite3
@@ -8,6 +8,7 @@ except:
     pass
 
 class DatabaseSQLite3(Database):
+    pooling = False # sqlite3 connections are cheap to open and cannot be shared between threads
     type_shorttext = "VARCHAR(1024)"
     type_longtext = "TEXT"
     type_clob = "TEXT"
@@ -118,6 +119,20 @@ class DatabaseSQLite3(Database):
     def switch_param_placeholder(self, sql: str) -> str:
         return sql # SQLite3 driver wants ? placeholders rather than usual %s so leave as is
 
+    def update_audit_values(self, table: str, iid: int, values: Dict, readable: List[str] = [], override_lock: bool = False) -> Tuple[int, ResultRow, ResultRow]:
+        """ Overridden to get the new values back with UPDATE ... RETURNING (SQLite 3.35+) """
+        if sqlite3.sqlite_version_info < (3, 35, 0): 
+            return Database.update_audit_values(self, table, iid, values, readable, override_lock)
+        if not override_lock and self.locked: return (0, None, None)
+        cols = self._audit_columns(values, readable)
+        preaudit = self.first_row(self.query("SELECT %s FROM %s WHERE ID=%d" % (",".join(cols), table, iid)))
+        if preaudit is None: return (0, None, None)
+        sql = "UPDATE %s SET %s WHERE ID=%d RETURNING %s" % ( table, ",".join( ["%s=?" % x for x in values.keys()] ), iid, ",".join(cols) )
+        rows = self.execute_returning(sql, list(values.values()), override_lock=override_lock)
+        if len(rows) == 0: return (0, None, None)
+        postaudit = ResultRow(rows[0])
+        return (len(rows), preaudit, postaudit)
+
     def vacuum(self, tablename: str = "") -> None:
         self.execute("VACUUM") # sqlite3 vacuum does the whole file and cannot accept a table argument
 
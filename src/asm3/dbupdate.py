@@ -2959,8 +2959,7 @@ def dump_dbfs_base64(dbo: Database) -> Generator[str, None, None]:
     This can be used to get an old style dbfs from newer storage mechanisms for export.
     """
     yield "DELETE FROM dbfs;\n"
-    rows = dbo.query("SELECT ID, Name, Path FROM dbfs ORDER BY ID")
-    for r in rows:
+    for r in dbo.query_generator("SELECT ID, Name, Path FROM dbfs ORDER BY ID"):
         content = ""
         url = ""
         # Only try and read the dbfs file if it has an extension and is actually a file
@@ -2987,8 +2986,7 @@ def dump_dbfs_files(dbo: Database) -> Generator[str, None, None]:
     post insert if necessary.
     """
     yield "DELETE FROM dbfs;\n"
-    rows = dbo.query("SELECT ID, Name, Path FROM dbfs ORDER BY ID")
-    for r in rows:
+    for r in dbo.query_generator("SELECT ID, Name, Path FROM dbfs ORDER BY ID"):
         name = r.NAME
         content = ""
         url = ""
@@ -3056,10 +3054,8 @@ def dump_merge(dbo: Database, deleteViewSeq: bool = True) -> Generator[str, None
     deleteViewSeq: if True, deletes the view/seq version from the configuration table after.
     """
     ID_OFFSET = 100000
-    def fix_and_dump(table: str, fields: List[str]) -> str:
-        rows = dbo.query("SELECT * FROM %s" % table)
-        s = []
-        for r in rows:
+    def fix_and_dump(table: str, fields: List[str]) -> Generator[str, None, None]:
+        for r in dbo.query_generator("SELECT * FROM %s" % table):
             # Add ID_OFFSET to all ID fields in the rows
             for f in fields:
                 f = f.upper()
@@ -3081,61 +3077,60 @@ def dump_merge(dbo: Database, deleteViewSeq: bool = True) -> Generator[str, None
             # Make any lookup values we copy over inactive
             if "ISRETIRED" in r: 
                 r.ISRETIRED = 1 
-            s.append(dbo.row_to_insert_sql(table, r, escapeCR = ""))
-        return "\n".join(s)
-
-    yield fix_and_dump("additional", [ "AdditionalFieldID", "LinkID" ])
-    yield fix_and_dump("additionalfield", [ "ID" ])
-    yield fix_and_dump("adoption", [ "ID", "AnimalID", "AdoptionNumber", "OwnerID", "RetailerID", "OriginalRetailerMovementID" ])
-    yield fix_and_dump("animal", [ "ID", "AnimalTypeID", "BreedID", "Breed2ID", "SpeciesID", "ShelterLocation", "ShelterCode", "BondedAnimalID", "BondedAnimal2ID", "PickupLocationID", "JurisdictionID", "OwnersVetID", "CurrentVetID", "OriginalOwnerID", "BroughtInByOwnerID", "ActiveMovementID" ])
-    yield fix_and_dump("animalcontrol", [ "ID", "CallerID", "VictimID", "PickupLocationID", "JurisdictionID", "OwnerID", "Owner2ID", "Owner3ID" ])
-    yield fix_and_dump("animalcontrolanimal", [ "AnimalID", "AnimalControlID" ])
-    yield fix_and_dump("animalcost", [ "ID", "AnimalID", "CostTypeID" ])
-    yield fix_and_dump("breed", [ "ID" ])
-    yield fix_and_dump("costtype", [ "ID" ])
-    yield fix_and_dump("animaldiet", [ "ID", "AnimalID" ])
-    yield fix_and_dump("animalfound", [ "ID", "OwnerID", "AnimalTypeID", "BreedID" ])
-    yield fix_and_dump("animallitter", [ "ID", "ParentAnimalID" ])
-    yield fix_and_dump("animallost", [ "ID", "OwnerID", "AnimalTypeID", "BreedID" ])
-    yield fix_and_dump("animalmedical", [ "ID", "AnimalID", "MedicalProfileID" ])
-    yield fix_and_dump("animalmedicaltreatment", [ "ID", "AnimalID", "AnimalMedicalID" ])
-    yield fix_and_dump("animalpublished", [ "AnimalID" ])
-    yield fix_and_dump("animaltest", [ "ID", "AnimalID", "TestTypeID", "TestResultID" ])
-    yield fix_and_dump("animaltype", [ "ID", ])
-    yield fix_and_dump("animaltransport", [ "ID", "AnimalID", "DriverOwnerID", "PickupOwnerID", "DropoffOwnerID" ])
-    yield fix_and_dump("animalvaccination", [ "ID", "AnimalID", "VaccinationID" ])
-    yield fix_and_dump("animalwaitinglist", [ "ID", "OwnerID" ])
-    yield fix_and_dump("diary", [ "ID", "LinkID" ])
-    yield fix_and_dump("internallocation", [ "ID", ])
-    yield fix_and_dump("jurisdiction", [ "ID", ])
-    yield fix_and_dump("lkanimalflags", [ "ID", ])
-    yield fix_and_dump("lkownerflags", [ "ID", ])
-    yield fix_and_dump("lkworktype", [ "ID", ])
-    yield fix_and_dump("log", [ "ID", "LinkID" ])
-    yield fix_and_dump("media", [ "ID", "DBFSID", "LinkID" ])
-    yield fix_and_dump("medicalprofile", [ "ID" ])
-    yield fix_and_dump("owner", [ "ID", "HomeCheckedBy", "JurisdictionID" ])
-    yield fix_and_dump("ownercitation", [ "ID", "OwnerID", "AnimalControlID" ])
-    yield fix_and_dump("ownerdonation", [ "ID", "AnimalID", "OwnerID", "MovementID", "DonationTypeID" ])
-    yield fix_and_dump("donationtype", [ "ID", ])
-    yield fix_and_dump("ownerinvestigation", [ "ID", "OwnerID" ])
-    yield fix_and_dump("ownerlicence", [ "ID", "OwnerID", "AnimalID", "LicenceTypeID" ])
-    yield fix_and_dump("licencetype", [ "ID", ])
-    yield fix_and_dump("ownerrota", [ "ID", "OwnerID" ])
-    yield fix_and_dump("ownertraploan", [ "ID", "OwnerID" ])
-    yield fix_and_dump("ownervoucher", [ "ID", "OwnerID", "VoucherID" ])
-    yield fix_and_dump("pickuplocation", [ "ID" ])
-    yield fix_and_dump("species", [ "ID" ])
-    yield fix_and_dump("stocklevel", [ "ID", "StockLocationID" ])
-    yield fix_and_dump("stocklocation", [ "ID", ])
-    yield fix_and_dump("stockusage", [ "ID", "StockLevelID" ])
-    yield fix_and_dump("templatedocument", [ "ID", ])
-    yield fix_and_dump("templatehtml", [ "ID", ])
-    yield fix_and_dump("testtype", [ "ID", ])
-    yield fix_and_dump("testresult", [ "ID", ])
-    yield fix_and_dump("vaccinationtype", [ "ID", ])
-    yield fix_and_dump("voucher", [ "ID", ])
-    yield fix_and_dump("dbfs", [ "ID", "URL" ])
+            yield dbo.row_to_insert_sql(table, r, escapeCR = "")
+
+    yield from fix_and_dump("additional", [ "AdditionalFieldID", "LinkID" ])
+    yield from fix_and_dump("additionalfield", [ "ID" ])
+    yield from fix_and_dump("adoption", [ "ID", "AnimalID", "AdoptionNumber", "OwnerID", "RetailerID", "OriginalRetailerMovementID" ])
+    yield from fix_and_dump("animal", [ "ID", "AnimalTypeID", "BreedID", "Breed2ID", "SpeciesID", "ShelterLocation", "ShelterCode", "BondedAnimalID", "BondedAnimal2ID", "PickupLocationID", "JurisdictionID", "OwnersVetID", "CurrentVetID", "OriginalOwnerID", "BroughtInByOwnerID", "ActiveMovementID" ])
+    yield from fix_and_dump("animalcontrol", [ "ID", "CallerID", "VictimID", "PickupLocationID", "JurisdictionID", "OwnerID", "Owner2ID", "Owner3ID" ])
+    yield from fix_and_dump("animalcontrolanimal", [ "AnimalID", "AnimalControlID" ])
+    yield from fix_and_dump("animalcost", [ "ID", "AnimalID", "CostTypeID" ])
+    yield from fix_and_dump("breed", [ "ID" ])
+    yield from fix_and_dump("costtype", [ "ID" ])
+    yield from fix_and_dump("animaldiet", [ "ID", "AnimalID" ])
+    yield from fix_and_dump("animalfound", [ "ID", "OwnerID", "AnimalTypeID", "BreedID" ])
+    yield from fix_and_dump("animallitter", [ "ID", "ParentAnimalID" ])
+    yield from fix_and_dump("animallost", [ "ID", "OwnerID", "AnimalTypeID", "BreedID" ])
+    yield from fix_and_dump("animalmedical", [ "ID", "AnimalID", "MedicalProfileID" ])
+    yield from fix_and_dump("animalmedicaltreatment", [ "ID", "AnimalID", "AnimalMedicalID" ])
+    yield from fix_and_dump("animalpublished", [ "AnimalID" ])
+    yield from fix_and_dump("animaltest", [ "ID", "AnimalID", "TestTypeID", "TestResultID" ])
+    yield from fix_and_dump("animaltype", [ "ID", ])
+    yield from fix_and_dump("animaltransport", [ "ID", "AnimalID", "DriverOwnerID", "PickupOwnerID", "DropoffOwnerID" ])
+    yield from fix_and_dump("animalvaccination", [ "ID", "AnimalID", "VaccinationID" ])
+    yield from fix_and_dump("animalwaitinglist", [ "ID", "OwnerID" ])
+    yield from fix_and_dump("diary", [ "ID", "LinkID" ])
+    yield from fix_and_dump("internallocation", [ "ID", ])
+    yield from fix_and_dump("jurisdiction", [ "ID", ])
+    yield from fix_and_dump("lkanimalflags", [ "ID", ])
+    yield from fix_and_dump("lkownerflags", [ "ID", ])
+    yield from fix_and_dump("lkworktype", [ "ID", ])
+    yield from fix_and_dump("log", [ "ID", "LinkID" ])
+    yield from fix_and_dump("media", [ "ID", "DBFSID", "LinkID" ])
+    yield from fix_and_dump("medicalprofile", [ "ID" ])
+    yield from fix_and_dump("owner", [ "ID", "HomeCheckedBy", "JurisdictionID" ])
+    yield from fix_and_dump("ownercitation", [ "ID", "OwnerID", "AnimalControlID" ])
+    yield from fix_and_dump("ownerdonation", [ "ID", "AnimalID", "OwnerID", "MovementID", "DonationTypeID" ])
+    yield from fix_and_dump("donationtype", [ "ID", ])
+    yield from fix_and_dump("ownerinvestigation", [ "ID", "OwnerID" ])
+    yield from fix_and_dump("ownerlicence", [ "ID", "OwnerID", "AnimalID", "LicenceTypeID" ])
+    yield from fix_and_dump("licencetype", [ "ID", ])
+    yield from fix_and_dump("ownerrota", [ "ID", "OwnerID" ])
+    yield from fix_and_dump("ownertraploan", [ "ID", "OwnerID" ])
+    yield from fix_and_dump("ownervoucher", [ "ID", "OwnerID", "VoucherID" ])
+    yield from fix_and_dump("pickuplocation", [ "ID" ])
+    yield from fix_and_dump("species", [ "ID" ])
+    yield from fix_and_dump("stocklevel", [ "ID", "StockLocationID" ])
+    yield from fix_and_dump("stocklocation", [ "ID", ])
+    yield from fix_and_dump("stockusage", [ "ID", "StockLevelID" ])
+    yield from fix_and_dump("templatedocument", [ "ID", ])
+    yield from fix_and_dump("templatehtml", [ "ID", ])
+    yield from fix_and_dump("testtype", [ "ID", ])
+    yield from fix_and_dump("testresult", [ "ID", ])
+    yield from fix_and_dump("vaccinationtype", [ "ID", ])
+    yield from fix_and_dump("voucher", [ "ID", ])
+    yield from fix_and_dump("dbfs", [ "ID", "URL" ])
     if deleteViewSeq: yield "DELETE FROM configuration WHERE ItemName LIKE 'DBViewSeqVersion';\n"
 
 def diagnostic(dbo: Database) -> Dict[str, int]:
@@ -60,7 +60,7 @@ def email_uncompleted_upto_today(dbo: Database) -> None:
             if totalforuser > 0:
                 asm3.al.debug("got %d notes for user %s" % (totalforuser, u.username), "diary.email_uncompleted_upto_today", dbo)
                 subject = asm3.i18n._("Diary notes for: {0}", l).format(asm3.i18n.python2display(l, dbo.now()))
-                asm3.utils.send_email(dbo, "", u.emailaddress, "", "", subject, s, exceptions=False, bulk=True, retries=3)
+                asm3.utils.send_email(dbo, "", u.emailaddress, "", "", subject, s, exceptions=False, bulk=True, retries=3, queue=True)
                 if asm3.configuration.audit_on_send_email(dbo): 
                     asm3.audit.email(dbo, "system", asm3.configuration.email(dbo), u.emailaddress, "", "", subject, s)
 
@@ -85,7 +85,7 @@ def email_note_on_change(dbo: Database, n: ResultRow, username: str) -> None:
             or (n.diaryforname in u.roles.split("|")):
                 # Yes, send it to them
                 subject = asm3.i18n._("Diary update: {0}", l).format(n.subject)
-                asm3.utils.send_email(dbo, "", u.emailaddress, "", "", subject, s, exceptions=False, bulk=True)
+                asm3.utils.send_email(dbo, "", u.emailaddress, "", "", subject, s, exceptions=False, bulk=True, queue=True)
                 if asm3.configuration.audit_on_send_email(dbo): 
                     asm3.audit.email(dbo, username, asm3.configuration.email(dbo), u.emailaddress, "", "", subject, s)
 
@@ -108,7 +108,7 @@ def email_note_on_complete(dbo: Database, n: ResultRow, username: str) -> None:
             if (n.createdby == u.username):
                 # Yes, send it to them
                 subject = asm3.i18n._("Diary complete: {0}", l).format(n.subject)
-                asm3.utils.send_email(dbo, "", u.emailaddress, "", "", subject, s, exceptions=False, bulk=True)
+                asm3.utils.send_email(dbo, "", u.emailaddress, "", "", subject, s, exceptions=False, bulk=True, queue=True)
                 if asm3.configuration.audit_on_send_email(dbo): 
                     asm3.audit.email(dbo, username, asm3.configuration.email(dbo), u.emailaddress, "", "", subject, s)
 
@@ -455,13 +455,14 @@ def execute_diary_task(dbo: Database, username: str, tasktype: int, taskid: int,
     rollingdate = dbo.today()
     dtd = dbo.query("SELECT * FROM diarytaskdetail WHERE DiaryTaskHeadID = ? ORDER BY OrderIndex", [taskid])
     tags = {}
+    tokens = asm3.wordprocessor.get_tokens("".join([ "%s %s" % (d.SUBJECT, d.NOTE) for d in dtd ]))
     linktype = ANIMAL
     if tasktype == "ANIMAL": 
         linktype = ANIMAL
-        tags = asm3.wordprocessor.animal_tags(dbo, asm3.animal.get_animal(dbo, linkid))
+        tags = asm3.wordprocessor.animal_tags(dbo, asm3.animal.get_animal(dbo, linkid), tokens=tokens)
     elif tasktype == "PERSON": 
         linktype = PERSON
-        tags = asm3.wordprocessor.person_tags(dbo, asm3.person.get_person(dbo, linkid))
+        tags = asm3.wordprocessor.person_tags(dbo, asm3.person.get_person(dbo, linkid), tokens=tokens)
     for d in dtd:
         if d.DAYPIVOT == 9999: 
             rollingdate = selecteddate
@@ -0,0 +1,206 @@
+"""
+Stores scaled copies (derivatives) of dbfs images on disk.
+
+Derivatives are addressed by a hash of the source image content and the
+resize spec, so each one is only generated once and is shared by every
+record and database that has the same image. The hash of each dbfs item's
+content is remembered in the disk cache so that finding a derivative does
+not need the source image. Callers that have a media record pass its date
+as the version so that the hash is looked up again when the content is
+changed (rotating and watermarking images update the date). Anything that
+changes content without a version should call forget().
+Only scaled copies are stored, the original image is always read from dbfs.
+Unused derivatives are removed by remove_expired() after DERIVATIVE_TTL.
+"""
+
+import asm3.al
+import asm3.cachedisk
+import asm3.dbfs
+import asm3.media
+
+from asm3.sitedefs import DISK_CACHE, IMAGE_DERIVATIVE_WORKERS
+from asm3.typehints import Any, Database, Dict, List, Tuple
+
+import concurrent.futures
+import hashlib
+import os
+import re
+import tempfile
+import threading
+import time
+
+DERIVATIVE_DIR = os.path.join(DISK_CACHE, "derivatives")
+
+# How long to remember the content hash for a dbfs item (seconds)
+HASH_TTL = 86400 * 7
+
+# Derivatives that have not been used for this long are removed (seconds)
+DERIVATIVE_TTL = 86400 * 30
+
+# Only record that a derivative was used if it was last recorded longer ago than this
+TOUCH_RESOLUTION = 86400
+
+# The process pool used by generate(), created on first use and shared
+# by every call so that publishing does not start a pool for each animal
+pool = None
+pool_lock = threading.Lock()
+
+def _hash(data: bytes) -> str:
+    return hashlib.sha1(data).hexdigest()
+
+def _path(h: str, spec: str) -> str:
+    """
+    Returns the file path for the derivative of the content with hash h
+    """
+    spec = re.sub(r"[^0-9x]", "", spec)
+    return os.path.join(DERIVATIVE_DIR, h[0:2], "%s_%s.jpg" % (h, spec))
+
+def _write(path: str, data: bytes) -> None:
+    """
+    Writes a derivative file. The data goes to a temporary file that is
+    renamed over the target so that readers never see a partial file.
+    """
+    d = os.path.dirname(path)
+    os.makedirs(d, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=d, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except:
+        if os.path.exists(tmp): os.unlink(tmp)
+        raise
+
+def _touch(path: str) -> None:
+    """
+    Updates the modified time of path if it is older than TOUCH_RESOLUTION
+    so that it is not removed by remove_expired while it is still in use.
+    """
+    now = time.time()
+    try:
+        if os.path.getmtime(path) < now - TOUCH_RESOLUTION:
+            os.utime(path, (now, now))
+    except OSError:
+        pass
+
+def _scale(data: bytes, spec: str) -> bytes:
+    """
+    Produces the derivative data for spec from the source data
+    """
+    return asm3.media.scale_image(data, spec)
+
+def _hashcachekey(dbfsid: int, version: Any) -> str:
+    return "imagehash%d:%s" % (dbfsid, version)
+
+def get_source_hash(dbo: Database, dbfsid: int, version: Any = "") -> Tuple[str, bytes]:
+    """
+    Returns the content hash for a dbfs item. If the hash was not known and
+    the item had to be read, its content is returned too (otherwise None)
+    """
+    key = _hashcachekey(dbfsid, version)
+    h = asm3.cachedisk.get(key, dbo.name(), str)
+    if h is not None: return (h, None)
+    data = asm3.dbfs.get_string_id(dbo, dbfsid)
+    h = _hash(data)
+    asm3.cachedisk.put(key, dbo.name(), h, HASH_TTL)
+    return (h, data)
+
+def forget(dbo: Database, dbfsid: int, version: Any = "") -> None:
+    """
+    Forgets the content hash for a dbfs item. Must be called when the
+    content of an image is changed without changing its version.
+    """
+    asm3.cachedisk.delete(_hashcachekey(dbfsid, version), dbo.name())
+
+def _get_pool() -> concurrent.futures.ProcessPoolExecutor:
+    """
+    Returns the shared process pool, creating it if necessary
+    """
+    global pool
+    with pool_lock:
+        if pool is None:
+            pool = concurrent.futures.ProcessPoolExecutor(max_workers=IMAGE_DERIVATIVE_WORKERS)
+        return pool
+
+def get_path(dbo: Database, dbfsid: int, spec: str, version: Any = "") -> str:
+    """
+    Returns the path to the derivative of dbfsid for the resize spec given
+    (WxH), generating it if it does not exist yet.
+    version: the date of the media record pointing to dbfsid if available
+    """
+    h, data = get_source_hash(dbo, dbfsid, version)
+    path = _path(h, spec)
+    if os.path.exists(path):
+        _touch(path)
+        return path
+    if data is None:
+        data = asm3.dbfs.get_string_id(dbo, dbfsid)
+        # The hash we remembered is out of date if the content has changed
+        if _hash(data) != h:
+            h = _hash(data)
+            asm3.cachedisk.put(_hashcachekey(dbfsid, version), dbo.name(), h, HASH_TTL)
+            path = _path(h, spec)
+            if os.path.exists(path): return path
+    _write(path, _scale(data, spec))
+    return path
+
+def get(dbo: Database, dbfsid: int, spec: str, version: Any = "") -> bytes:
+    """
+    Returns the data for the derivative of dbfsid for the resize spec given
+    """
+    with open(get_path(dbo, dbfsid, spec, version), "rb") as f:
+        return f.read()
+
+def generate(dbo: Database, dbfsids: List[Tuple[int, Any]], spec: str) -> Dict[int, str]:
+    """
+    Makes sure the derivatives for spec exist for all of dbfsids, a list
+    of (dbfsid, version) tuples. Missing
+    derivatives are scaled in the shared pool of IMAGE_DERIVATIVE_WORKERS
+    processes (or in this process if it is 0 or there is only one to do).
+    Returns a dictionary of dbfsid to derivative path. Items that could not
+    be read are left out.
+    """
+    paths = {}
+    todo = [] # (dbfsid, path, data)
+    for dbfsid, version in dbfsids:
+        try:
+            h, data = get_source_hash(dbo, dbfsid, version)
+            path = _path(h, spec)
+            paths[dbfsid] = path
+            if os.path.exists(path):
+                _touch(path)
+                continue
+            if data is None: data = asm3.dbfs.get_string_id(dbo, dbfsid)
+            todo.append((dbfsid, path, data))
+        except Exception as err:
+            asm3.al.error("failed reading dbfsid %s: %s" % (dbfsid, err), "imagecache.generate", dbo)
+            paths.pop(dbfsid, None)
+    if len(todo) == 0: return paths
+    if IMAGE_DERIVATIVE_WORKERS > 0 and len(todo) > 1:
+        results = list(_get_pool().map(_scale, [ x[2] for x in todo ], [ spec ] * len(todo)))
+    else:
+        results = [ _scale(x[2], spec) for x in todo ]
+    for (dbfsid, path, data), scaled in zip(todo, results):
+        _write(path, scaled)
+    asm3.al.debug("generated %d derivatives for %s (%d existed)" % (len(todo), spec, len(paths) - len(todo)), "imagecache.generate", dbo)
+    return paths
+
+def remove_expired() -> int:
+    """
+    Removes derivatives that have not been used for DERIVATIVE_TTL.
+    Returns the number of files removed.
+    """
+    if not os.path.exists(DERIVATIVE_DIR): return 0
+    cutoff = time.time() - DERIVATIVE_TTL
+    removed = 0
+    for d in os.scandir(DERIVATIVE_DIR):
+        if not d.is_dir(): continue
+        for f in os.scandir(d.path):
+            try:
+                if f.stat().st_mtime < cutoff:
+                    os.unlink(f.path)
+                    removed += 1
+            except OSError:
+                pass
+    asm3.al.debug("removed %d unused image derivatives" % removed, "imagecache.remove_expired")
+    return removed
@@ -13,7 +13,7 @@ import asm3.reports
 import asm3.utils
 import asm3.waitinglist
 from asm3.i18n import _, date_diff_days, now, subtract_years, python2display
-from asm3.typehints import Database, Dict, List, PostedData, ResultRow, Results
+from asm3.typehints import Database, Dict, List, PostedData, ResultRow, Results, Tuple
 
 class LostFoundMatch:
     dbo = None
@@ -335,22 +335,91 @@ def send_email_from_form(dbo: Database, username: str, post: PostedData) -> bool
         asm3.log.add_log_email(dbo, username, post["lfmode"] == "lost" and asm3.log.LOSTANIMAL or asm3.log.FOUNDANIMAL, post.integer("lfid"), logtype, emailto, subject, body)
     return rv
 
+def tokenise(s: str) -> Tuple[List[str], set]:
+    """
+    Splits a string into the lowercased words compared by words().
+    Returns the words as a list and as a set for fast lookups, so that
+    each record only needs tokenising once when matching.
+    """
+    if s is None: s = ""
+    w = s.replace(",", " ").replace("\n", " ").lower().strip().split(" ")
+    return (w, set(w))
+
+def words_tokenised(t1: Tuple[List[str], set], t2: Tuple[List[str], set], maxpoints: int) -> int:
+    """
+    As words(), but for two strings that have been through tokenise()
+    """
+    s2words = t2[1]
+    matches = 0
+    for w in t1[0]:
+        if w in s2words:
+            matches += 1
+    return int((float(matches) / float(len(t1[0]))) * float(maxpoints))
+
 def words(str1: str, str2: str, maxpoints: int):
     """
     Evalutes words in string 1 for appearances in string 2
     Returns the number of points for 1 to 2 as a percentage of maxpoints
     """
-    if str1 is None: str1 = ""
-    if str2 is None: str2 = ""
-    str1 = str1.replace(",", " ").replace("\n", " ").lower().strip()
-    str2 = str2.replace(",", " ").replace("\n", " ").lower().strip()
-    matches = 0
-    s1words = str1.split(" ")
-    s2words = str2.split(" ")
-    for w in s1words:
-        if w in s2words: 
-            matches += 1
-    return int((float(matches) / float(len(s1words))) * float(maxpoints))
+    return words_tokenised(tokenise(str1), tokenise(str2), maxpoints)
+
+class MatchCandidates(object):
+    """
+    Found or shelter animals to compare lost animals against, indexed
+    by species and microchip number. Candidates are tuples of the row
+    followed by any precalculated values, kept in their original order.
+    """
+    def __init__(self, speciesfield: str, chipfield: str) -> None:
+        self.speciesfield = speciesfield
+        self.chipfield = chipfield
+        self.all = []
+        self.byspecies = {}
+        self.bychip = {}
+
+    def add(self, c: Tuple) -> None:
+        self.all.append(c)
+        self.byspecies.setdefault(c[0][self.speciesfield], []).append(c)
+        self.bychip.setdefault(c[0][self.chipfield], []).append(c)
+
+    def get(self, species: int, chip: str, blockspecies: bool, chiponly: bool) -> List[Tuple]:
+        """
+        Returns the candidates for a lost animal.
+        blockspecies: Only candidates of the same species can match
+        chiponly:     Only candidates with the same microchip can match
+        """
+        if chiponly:
+            if chip == "": return []
+            c = self.bychip.get(chip, [])
+            if blockspecies: c = [ x for x in c if x[0][self.speciesfield] == species ]
+            return c
+        if blockspecies:
+            return self.byspecies.get(species, [])
+        return self.all
+
+def _lost_match(dbo: Database, la: ResultRow, matchpoints: int, matchmax: int) -> LostFoundMatch:
+    """
+    Returns a new LostFoundMatch with the lost animal fields filled in from la
+    """
+    m = LostFoundMatch(dbo)
+    m.lid = la["ID"]
+    m.lcontactname = la["OWNERNAME"]
+    m.lmicrochip = la["MICROCHIPNUMBER"]
+    m.lcontactnumber = la["HOMETELEPHONE"]
+    m.larealost = la["AREALOST"]
+    m.lareapostcode = la["AREAPOSTCODE"]
+    m.lagegroup = la["AGEGROUP"]
+    m.lsexid = la["SEX"]
+    m.lsexname = la["SEXNAME"]
+    m.lspeciesid = la["ANIMALTYPEID"]
+    m.lspeciesname = la["SPECIESNAME"]
+    m.lbreedid = la["BREEDID"]
+    m.lbreedname = la["BREEDNAME"]
+    m.ldistinguishingfeatures = la["DISTFEAT"]
+    m.lbasecolourid = la["BASECOLOURID"]
+    m.lbasecolourname = la["BASECOLOURNAME"]
+    m.ldatelost = la["DATELOST"]
+    m.matchpoints = int((float(matchpoints) / float(matchmax)) * 100.0)
+    return m
 
 def match(dbo: Database, lostanimalid: int = 0, foundanimalid: int = 0, animalid: int = 0, limit: int = 0) -> List[LostFoundMatch]:
     """
@@ -383,6 +452,20 @@ def match(dbo: Database, lostanimalid: int = 0, foundanimalid: int = 0, animalid
     # Ignore records older than 6 months to keep things useful
     giveup = dbo.today(offset=-182)
 
+    # The most points any pair can score, used to rule out pairs that can
+    # never reach the floor without scoring them
+    def best(*points): 
+        return sum(max(0, p) for p in points)
+    bestall = best(matchspecies, matchbreed, matchage, matchsex, matcharealost, matchfeatures, \
+        matchpostcode, matchcolour, matchmicrochip, matchdatewithin2weeks)
+    bestwords = best(matcharealost, matchfeatures)
+    bestshelterwords = best(matcharealost, matchfeatures, matchpostcode)
+    # A different species costs 9999 points, so those pairs can be skipped
+    blockspecies = bestall - 9999 < matchpointfloor
+    # If a pair cannot reach the floor without a microchip match, we only
+    # need to look at animals with the same microchip
+    chiponly = bestall - best(matchmicrochip) < matchpointfloor
+
     # Get our set of lost animals
     lostanimals = None
     if lostanimalid == 0:
@@ -397,24 +480,46 @@ def match(dbo: Database, lostanimalid: int = 0, foundanimalid: int = 0, animalid
         oldestdate = lostanimals[0].DATELOST
 
     # Get the set of found animals for comparison
-    foundanimals = None
-    if foundanimalid == 0:
-        foundanimals = dbo.query(get_foundanimal_query(dbo) + \
-            " WHERE a.ReturnToOwnerDate Is Null" \
-            " AND a.DateFound >= ? ", [oldestdate])
-    else:
-        foundanimals = dbo.query(get_foundanimal_query(dbo) + " WHERE a.ID = ?", [foundanimalid])
+    foundanimals = MatchCandidates("ANIMALTYPEID", "MICROCHIPNUMBER")
+    if animalid == 0:
+        if foundanimalid == 0:
+            rows = dbo.query(get_foundanimal_query(dbo) + \
+                " WHERE a.ReturnToOwnerDate Is Null" \
+                " AND a.DateFound >= ? ", [oldestdate])
+        else:
+            rows = dbo.query(get_foundanimal_query(dbo) + " WHERE a.ID = ?", [foundanimalid])
+        for fa in rows:
+            foundanimals.add((fa, tokenise(fa["AREAFOUND"]), tokenise(fa["DISTFEAT"])))
 
     # Get the set of shelter animals for comparison - anything brought in recently
     # that's 1. still on shelter or 2. was released to wild, transferred or escaped
-    shelteranimals = None
+    shelteranimals = MatchCandidates("SPECIESID", "IDENTICHIPNUMBER")
     if includeshelter:
         if animalid == 0:
-            shelteranimals = dbo.query(asm3.animal.get_animal_query(dbo) + " WHERE " + \
+            rows = dbo.query(asm3.animal.get_animal_query(dbo) + " WHERE " + \
                 "(a.Archived = 0 OR a.ActiveMovementType IN (3,4,7)) " \
                 "AND a.DateBroughtIn > ?", [oldestdate])
         else:
-            shelteranimals = dbo.query(asm3.animal.get_animal_query(dbo) + " WHERE a.ID = ?", [animalid])
+            rows = dbo.query(asm3.animal.get_animal_query(dbo) + " WHERE a.ID = ?", [animalid])
+        for a in rows:
+            # Work out which address we compare the area lost against
+            foundarea = ""
+            foundpostcode = ""
+            areawords = None
+            if a["ISPICKUP"] == 1:
+                foundarea = a["PICKUPADDRESS"]
+                areawords = tokenise(foundarea)
+            elif a["BROUGHTINBYOWNERADDRESS"] is not None:
+                foundarea = a["BROUGHTINBYOWNERADDRESS"]
+                foundpostcode = a["BROUGHTINBYOWNERPOSTCODE"]
+                areawords = tokenise(foundarea)
+            elif a["ORIGINALOWNERADDRESS"] is not None:
+                foundarea = a["ORIGINALOWNERADDRESS"]
+                foundpostcode = a["ORIGINALOWNERPOSTCODE"]
+                areawords = tokenise(foundarea)
+            # Postcodes are only compared for owner addresses
+            comparepostcode = a["ISPICKUP"] != 1 and areawords is not None
+            shelteranimals.add((a, tokenise(a["MARKINGS"]), foundarea, foundpostcode, areawords, comparepostcode))
 
     asm3.asynctask.set_progress_max(dbo, len(lostanimals))
     for la in lostanimals:
@@ -422,139 +527,96 @@ def match(dbo: Database, lostanimalid: int = 0, foundanimalid: int = 0, animalid
         # Stop if we've hit our limit
         if limit > 0 and len(matches) >= limit:
             break
+        lspecies = la["ANIMALTYPEID"]
+        lchip = la["MICROCHIPNUMBER"]
+        lareawords = tokenise(la["AREALOST"])
+        lfeatwords = tokenise(la["DISTFEAT"])
         # Found animals (if an animal id has been given don't
         # check found animals)
-        if animalid == 0:
-            for fa in foundanimals:
-                matchpoints = 0
-                if la["MICROCHIPNUMBER"] != "" and la["MICROCHIPNUMBER"] == fa["MICROCHIPNUMBER"]: matchpoints += matchmicrochip
-                if la["ANIMALTYPEID"] == fa["ANIMALTYPEID"]: matchpoints += matchspecies
-                if la["ANIMALTYPEID"] != fa["ANIMALTYPEID"]: matchpoints -= 9999 # if species is different, force no match
-                if la["BREEDID"] == fa["BREEDID"]: matchpoints += matchbreed
-                if la["AGEGROUP"] == fa["AGEGROUP"]: matchpoints += matchage
-                if la["SEX"] == fa["SEX"]: matchpoints += matchsex
-                matchpoints += words(la["AREALOST"], fa["AREAFOUND"], matcharealost)
-                matchpoints += words(la["DISTFEAT"], fa["DISTFEAT"], matchfeatures)
-                if la["AREAPOSTCODE"] == fa["AREAPOSTCODE"]: matchpoints += matchpostcode
-                if la["BASECOLOURID"] == fa["BASECOLOURID"]: matchpoints += matchcolour
-                if date_diff_days(la["DATELOST"], fa["DATEFOUND"]) <= 14: matchpoints += matchdatewithin2weeks
-                if matchpoints > matchmax: matchpoints = matchmax
-                if matchpoints >= matchpointfloor:
-                    m = LostFoundMatch(dbo)
-                    m.lid = la["ID"]
-                    m.lcontactname = la["OWNERNAME"]
-                    m.lmicrochip = la["MICROCHIPNUMBER"]
-                    m.lcontactnumber = la["HOMETELEPHONE"]
-                    m.larealost = la["AREALOST"]
-                    m.lareapostcode = la["AREAPOSTCODE"]
-                    m.lagegroup = la["AGEGROUP"]
-                    m.lsexid = la["SEX"]
-                    m.lsexname = la["SEXNAME"]
-                    m.lspeciesid = la["ANIMALTYPEID"]
-                    m.lspeciesname = la["SPECIESNAME"]
-                    m.lbreedid = la["BREEDID"]
-                    m.lbreedname = la["BREEDNAME"]
-                    m.ldistinguishingfeatures = la["DISTFEAT"]
-                    m.lbasecolourid = la["BASECOLOURID"]
-                    m.lbasecolourname = la["BASECOLOURNAME"]
-                    m.ldatelost = la["DATELOST"]
-                    m.fid = fa["ID"]
-                    m.fanimalid = 0
-                    m.fcontactname = fa["OWNERNAME"]
-                    m.fmicrochip = fa["MICROCHIPNUMBER"]
-                    m.fcontactnumber = fa["HOMETELEPHONE"]
-                    m.fareafound = fa["AREAFOUND"]
-                    m.fareapostcode = fa["AREAPOSTCODE"]
-                    m.fagegroup = fa["AGEGROUP"]
-                    m.fsexid = fa["SEX"]
-                    m.fsexname = fa["SEXNAME"]
-                    m.fspeciesid = fa["ANIMALTYPEID"]
-                    m.fspeciesname = fa["SPECIESNAME"]
-                    m.fbreedid = fa["BREEDID"]
-                    m.fbreedname = fa["BREEDNAME"]
-                    m.fdistinguishingfeatures = fa["DISTFEAT"]
-                    m.fbasecolourid = fa["BASECOLOURID"]
-                    m.fbasecolourname = fa["BASECOLOURNAME"]
-                    m.fdatefound = fa["DATEFOUND"]
-                    m.matchpoints = int((float(matchpoints) / float(matchmax)) * 100.0)
-                    matches.append(m)
-                    if fullmatch: 
-                        batch.append(m.toParams())
-                    if limit > 0 and len(matches) >= limit:
-                        break
+        for fa, fareawords, ffeatwords in foundanimals.get(lspecies, lchip, blockspecies, chiponly):
+            matchpoints = 0
+            if lchip != "" and lchip == fa["MICROCHIPNUMBER"]: matchpoints += matchmicrochip
+            if lspecies == fa["ANIMALTYPEID"]: matchpoints += matchspecies
+            if lspecies != fa["ANIMALTYPEID"]: matchpoints -= 9999 # if species is different, force no match
+            if la["BREEDID"] == fa["BREEDID"]: matchpoints += matchbreed
+            if la["AGEGROUP"] == fa["AGEGROUP"]: matchpoints += matchage
+            if la["SEX"] == fa["SEX"]: matchpoints += matchsex
+            if la["AREAPOSTCODE"] == fa["AREAPOSTCODE"]: matchpoints += matchpostcode
+            if la["BASECOLOURID"] == fa["BASECOLOURID"]: matchpoints += matchcolour
+            if date_diff_days(la["DATELOST"], fa["DATEFOUND"]) <= 14: matchpoints += matchdatewithin2weeks
+            # Don't bother comparing words if they can't get us to the floor
+            if matchpoints + bestwords < matchpointfloor: continue
+            matchpoints += words_tokenised(lareawords, fareawords, matcharealost)
+            matchpoints += words_tokenised(lfeatwords, ffeatwords, matchfeatures)
+            if matchpoints > matchmax: matchpoints = matchmax
+            if matchpoints >= matchpointfloor:
+                m = _lost_match(dbo, la, matchpoints, matchmax)
+                m.fid = fa["ID"]
+                m.fanimalid = 0
+                m.fcontactname = fa["OWNERNAME"]
+                m.fmicrochip = fa["MICROCHIPNUMBER"]
+                m.fcontactnumber = fa["HOMETELEPHONE"]
+                m.fareafound = fa["AREAFOUND"]
+                m.fareapostcode = fa["AREAPOSTCODE"]
+                m.fagegroup = fa["AGEGROUP"]
+                m.fsexid = fa["SEX"]
+                m.fsexname = fa["SEXNAME"]
+                m.fspeciesid = fa["ANIMALTYPEID"]
+                m.fspeciesname = fa["SPECIESNAME"]
+                m.fbreedid = fa["BREEDID"]
+                m.fbreedname = fa["BREEDNAME"]
+                m.fdistinguishingfeatures = fa["DISTFEAT"]
+                m.fbasecolourid = fa["BASECOLOURID"]
+                m.fbasecolourname = fa["BASECOLOURNAME"]
+                m.fdatefound = fa["DATEFOUND"]
+                matches.append(m)
+                if fullmatch: 
+                    batch.append(m.toParams())
+                if limit > 0 and len(matches) >= limit:
+                    break
 
         # Shelter animals
-        if includeshelter:
-            for a in shelteranimals:
-                matchpoints = 0
-                foundarea = ""
-                foundpostcode = ""
-                if la["MICROCHIPNUMBER"] != "" and la["MICROCHIPNUMBER"] == a["IDENTICHIPNUMBER"]: matchpoints += matchmicrochip
-                if la["ANIMALTYPEID"] == a["SPECIESID"]: matchpoints += matchspecies
-                if la["ANIMALTYPEID"] != a["SPECIESID"]: matchpoints -= 9999 # if species is different, force no match
-                if la["BREEDID"] == a["BREEDID"] or la["BREEDID"] == a["BREED2ID"]: matchpoints += matchbreed
-                if la["BASECOLOURID"] == a["BASECOLOURID"]: matchpoints += matchcolour
-                if la["AGEGROUP"] == a["AGEGROUP"]: matchpoints += matchage
-                if la["SEX"] == a["SEX"]: matchpoints += matchsex
-                matchpoints += words(la["DISTFEAT"], a["MARKINGS"], matchfeatures)
-                if a["ISPICKUP"] == 1:
-                    matchpoints += words(la["AREALOST"], a["PICKUPADDRESS"], matcharealost)
-                    foundarea = a["PICKUPADDRESS"]
-                elif a["BROUGHTINBYOWNERADDRESS"] is not None:
-                    matchpoints += words(la["AREALOST"], a["BROUGHTINBYOWNERADDRESS"], matcharealost)
-                    if asm3.utils.nulltostr(a["BROUGHTINBYOWNERPOSTCODE"]).find(la["AREAPOSTCODE"]) != -1: matchpoints += matchpostcode
-                    foundarea = a["BROUGHTINBYOWNERADDRESS"]
-                    foundpostcode = a["BROUGHTINBYOWNERPOSTCODE"]
-                elif a["ORIGINALOWNERADDRESS"] is not None:
-                    matchpoints += words(la["AREALOST"], a["ORIGINALOWNERADDRESS"], matcharealost)
-                    if asm3.utils.nulltostr(a["ORIGINALOWNERPOSTCODE"]).find(la["AREAPOSTCODE"]) != -1: matchpoints += matchpostcode
-                    foundarea = a["ORIGINALOWNERADDRESS"]
-                    foundpostcode = a["ORIGINALOWNERPOSTCODE"]
-                if date_diff_days(la["DATELOST"], a["DATEBROUGHTIN"]) <= 14: matchpoints += matchdatewithin2weeks
-                if matchpoints > matchmax: matchpoints = matchmax
-                if matchpoints >= matchpointfloor:
-                    m = LostFoundMatch(dbo)
-                    m.lid = la["ID"]
-                    m.lcontactname = la["OWNERNAME"]
-                    m.lmicrochip = la["MICROCHIPNUMBER"]
-                    m.lcontactnumber = la["HOMETELEPHONE"]
-                    m.larealost = la["AREALOST"]
-                    m.lareapostcode = la["AREAPOSTCODE"]
-                    m.lagegroup = la["AGEGROUP"]
-                    m.lsexid = la["SEX"]
-                    m.lsexname = la["SEXNAME"]
-                    m.lspeciesid = la["ANIMALTYPEID"]
-                    m.lspeciesname = la["SPECIESNAME"]
-                    m.lbreedid = la["BREEDID"]
-                    m.lbreedname = la["BREEDNAME"]
-                    m.ldistinguishingfeatures = la["DISTFEAT"]
-                    m.lbasecolourid = la["BASECOLOURID"]
-                    m.lbasecolourname = la["BASECOLOURNAME"]
-                    m.ldatelost = la["DATELOST"]
-                    m.fid = 0
-                    m.fanimalid = a["ID"]
-                    m.fcontactname = _("Shelter animal {0} '{1}'", l).format(a["CODE"], a["ANIMALNAME"])
-                    m.fmicrochip = a["IDENTICHIPNUMBER"]
-                    m.fcontactnumber = a["SPECIESNAME"]
-                    m.fareafound = foundarea
-                    m.fareapostcode = foundpostcode
-                    m.fagegroup = a["AGEGROUP"]
-                    m.fsexid = a["SEX"]
-                    m.fsexname = a["SEXNAME"]
-                    m.fspeciesid = a["SPECIESID"]
-                    m.fspeciesname = a["SPECIESNAME"]
-                    m.fbreedid = a["BREEDID"]
-                    m.fbreedname = a["BREEDNAME"]
-                    m.fdistinguishingfeatures = a["MARKINGS"]
-                    m.fbasecolourid = a["BASECOLOURID"]
-                    m.fbasecolourname = a["BASECOLOURNAME"]
-                    m.fdatefound = a["DATEBROUGHTIN"]
-                    m.matchpoints = int((float(matchpoints) / float(matchmax)) * 100.0)
-                    matches.append(m)
-                    if fullmatch:
-                        batch.append(m.toParams())
-                    if limit > 0 and len(matches) >= limit:
-                        break
+        for a, afeatwords, foundarea, foundpostcode, aareawords, comparepostcode in shelteranimals.get(lspecies, lchip, blockspecies, chiponly):
+            matchpoints = 0
+            if lchip != "" and lchip == a["IDENTICHIPNUMBER"]: matchpoints += matchmicrochip
+            if lspecies == a["SPECIESID"]: matchpoints += matchspecies
+            if lspecies != a["SPECIESID"]: matchpoints -= 9999 # if species is different, force no match
+            if la["BREEDID"] == a["BREEDID"] or la["BREEDID"] == a["BREED2ID"]: matchpoints += matchbreed
+            if la["BASECOLOURID"] == a["BASECOLOURID"]: matchpoints += matchcolour
+            if la["AGEGROUP"] == a["AGEGROUP"]: matchpoints += matchage
+            if la["SEX"] == a["SEX"]: matchpoints += matchsex
+            if date_diff_days(la["DATELOST"], a["DATEBROUGHTIN"]) <= 14: matchpoints += matchdatewithin2weeks
+            if matchpoints + bestshelterwords < matchpointfloor: continue
+            matchpoints += words_tokenised(lfeatwords, afeatwords, matchfeatures)
+            if aareawords is not None:
+                matchpoints += words_tokenised(lareawords, aareawords, matcharealost)
+            if comparepostcode and asm3.utils.nulltostr(foundpostcode).find(la["AREAPOSTCODE"]) != -1: matchpoints += matchpostcode
+            if matchpoints > matchmax: matchpoints = matchmax
+            if matchpoints >= matchpointfloor:
+                m = _lost_match(dbo, la, matchpoints, matchmax)
+                m.fid = 0
+                m.fanimalid = a["ID"]
+                m.fcontactname = _("Shelter animal {0} '{1}'", l).format(a["CODE"], a["ANIMALNAME"])
+                m.fmicrochip = a["IDENTICHIPNUMBER"]
+                m.fcontactnumber = a["SPECIESNAME"]
+                m.fareafound = foundarea
+                m.fareapostcode = foundpostcode
+                m.fagegroup = a["AGEGROUP"]
+                m.fsexid = a["SEX"]
+                m.fsexname = a["SEXNAME"]
+                m.fspeciesid = a["SPECIESID"]
+                m.fspeciesname = a["SPECIESNAME"]
+                m.fbreedid = a["BREEDID"]
+                m.fbreedname = a["BREEDNAME"]
+                m.fdistinguishingfeatures = a["MARKINGS"]
+                m.fbasecolourid = a["BASECOLOURID"]
+                m.fbasecolourname = a["BASECOLOURNAME"]
+                m.fdatefound = a["DATEBROUGHTIN"]
+                matches.append(m)
+                if fullmatch:
+                    batch.append(m.toParams())
+                if limit > 0 and len(matches) >= limit:
+                    break
 
     if fullmatch:
         dbo.execute("DELETE FROM animallostfoundmatch")
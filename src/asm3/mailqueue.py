@@ -0,0 +1,313 @@
+"""
+A durable queue for outgoing email.
+
+Messages are stored as files in the MAIL_QUEUE directory and sent by a
+worker thread in the process that queued them. The worker keeps an SMTP
+session open for each server so that a batch of messages does not open a
+new connection for each one, applies MAIL_QUEUE_RATE_LIMIT to each server
+and retries failed messages with backoff. Messages that still fail after
+the last retry are moved to the failed directory.
+
+Queue files are JSON, named for the time they are next due and the database
+that queued them so that the due messages can be found without reading them. A message is claimed by
+renaming it into the work directory, so several processes can share a
+queue without sending a message twice. Messages left in the queue by a
+process that exited (eg: cron) are sent by the next worker to start or
+by cron.py maint_mail_queue. Other cron tasks only send the messages
+queued for their own database before they exit.
+"""
+
+import asm3.al
+import asm3.utils
+
+from asm3.sitedefs import MAIL_QUEUE, MAIL_QUEUE_RATE_LIMIT
+from asm3.typehints import Any, Dict, List, Tuple
+
+import collections
+import json
+import math
+import os
+import re
+import smtplib
+import tempfile
+import threading
+import time
+import uuid
+
+# Seconds to wait before each retry of a failed message.
+# Messages are retried once for each unless they were queued with
+# a number of retries, the last wait is used for any extra retries.
+RETRY_BACKOFF = ( 60, 300, 1800, 7200 )
+
+# SMTP sessions that have not been used for this long are closed (seconds)
+SESSION_IDLE = 30
+
+# Messages claimed longer ago than this are assumed to belong to a
+# worker that died and are put back in the queue (seconds)
+STALE_CLAIM = 3600
+
+# How long the worker waits before looking at the queue again when
+# it has messages that are not due yet or are rate limited (seconds)
+POLL = 5
+
+lock = threading.Lock()
+worker = None
+
+def _dir(name: str) -> str:
+    """
+    Returns the path to a directory in the queue, creating it if necessary
+    """
+    d = os.path.join(MAIL_QUEUE, name)
+    os.makedirs(d, exist_ok=True)
+    return d
+
+def _due(filename: str) -> float:
+    return float(filename.split("_")[0])
+
+def _tag(dbname: str) -> str:
+    """
+    Returns the part of a queue file name that identifies the database
+    """
+    return re.sub(r"[^A-Za-z0-9]", "", dbname)
+
+def _write(name: str, due: float, item: Dict) -> str:
+    """
+    Writes a queue item to the directory name, due to be sent at due.
+    The item is written to a temporary file (only readable by us as it
+    can contain SMTP credentials) that is renamed into place,
+    so a worker never sees a partial item.
+    """
+    d = _dir(name)
+    fd, tmp = tempfile.mkstemp(dir=MAIL_QUEUE, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(item, f)
+        # Round down so that a message is never named as due after it is
+        path = os.path.join(d, "%015.3f_%s_%s.msg" % (math.floor(due * 1000) / 1000, uuid.uuid4().hex, _tag(item["dbname"])))
+        os.replace(tmp, path)
+    except:
+        if os.path.exists(tmp): os.unlink(tmp)
+        raise
+    return path
+
+def enqueue(msg: str, fromadd: str, tolist: List[str], transport: Dict, dbname: str = "", retries: int = None) -> str:
+    """
+    Adds a message to the queue. Returns the path to the queue file.
+    msg: The message as a string
+    fromadd: The envelope sender address
+    tolist: A list of recipient addresses
+    transport: The settings to send the message with (from utils.get_smtp_transport)
+    dbname: The name of the database the message came from for logging
+    retries: The number of times to retry the message if it fails (None for one per RETRY_BACKOFF)
+    """
+    if retries is None: retries = len(RETRY_BACKOFF)
+    item = { "msg": msg, "fromadd": fromadd, "tolist": tolist, "transport": transport, "dbname": dbname, "attempts": 0, "retries": retries }
+    return _write("new", time.time(), item)
+
+def pending() -> Tuple[int, int]:
+    """
+    Returns a tuple of the number of messages in the queue and how many of them are due.
+    """
+    if MAIL_QUEUE == "": return (0, 0)
+    now = time.time()
+    names = [ x for x in os.listdir(_dir("new")) if x.endswith(".msg") ]
+    return (len(names), len([ x for x in names if _due(x) <= now ]))
+
+class Sender(object):
+    """
+    Sends messages, keeping an SMTP session open for each server
+    """
+    sessions = None # (host, port, username, usetls): (smtp, lastused)
+    sent = None # host: deque of times messages were sent in the last minute
+
+    def __init__(self) -> None:
+        self.sessions = {}
+        self.sent = collections.defaultdict(collections.deque)
+
+    def _key(self, transport: Dict) -> Tuple:
+        return (transport["host"], transport["port"], transport["username"], transport["usetls"])
+
+    def _close(self, key: Tuple) -> None:
+        smtp, dummy = self.sessions.pop(key)
+        try:
+            smtp.quit()
+        except:
+            pass
+
+    def _session(self, transport: Dict) -> smtplib.SMTP:
+        """
+        Returns the open session for transport, connecting if there isn't one
+        """
+        key = self._key(transport)
+        if key not in self.sessions:
+            self.sessions[key] = (asm3.utils.smtp_connect(transport), time.time())
+        return self.sessions[key][0]
+
+    def close(self) -> None:
+        """
+        Closes all open SMTP sessions
+        """
+        for key in list(self.sessions.keys()):
+            self._close(key)
+
+    def close_idle(self) -> None:
+        """
+        Closes SMTP sessions that have not been used for SESSION_IDLE
+        """
+        cutoff = time.time() - SESSION_IDLE
+        for key, (dummy, lastused) in list(self.sessions.items()):
+            if lastused < cutoff: self._close(key)
+
+    def rate_limited(self, transport: Dict) -> bool:
+        """
+        Returns True if sending a message with transport now would
+        go over MAIL_QUEUE_RATE_LIMIT for its server
+        """
+        if MAIL_QUEUE_RATE_LIMIT <= 0 or transport["sendmail"]: return False
+        times = self.sent[transport["host"]]
+        cutoff = time.time() - 60
+        while len(times) > 0 and times[0] < cutoff:
+            times.popleft()
+        return len(times) >= MAIL_QUEUE_RATE_LIMIT
+
+    def send(self, item: Dict) -> None:
+        """
+        Sends a queue item, raises an exception if it fails
+        """
+        transport = item["transport"]
+        if transport["sendmail"]:
+            asm3.utils.sendmail(item["msg"])
+            return
+        self.close_idle()
+        key = self._key(transport)
+        try:
+            try:
+                smtp = self._session(transport)
+                smtp.sendmail(item["fromadd"], item["tolist"], item["msg"])
+            except smtplib.SMTPServerDisconnected:
+                # The server closed the session we kept open, send on a new one
+                self.sessions.pop(key, None)
+                smtp = self._session(transport)
+                smtp.sendmail(item["fromadd"], item["tolist"], item["msg"])
+        except:
+            # Start again with a new session for the next message
+            if key in self.sessions: self._close(key)
+            raise
+        self.sessions[key] = (smtp, time.time())
+        if MAIL_QUEUE_RATE_LIMIT > 0: self.sent[transport["host"]].append(time.time())
+
+def _failed(path: str, item: Dict, err: Any) -> None:
+    """
+    Deals with a claimed message that could not be sent, by putting it back
+    in the queue to be retried after the next backoff or moving it to the
+    failed directory if it has run out of retries
+    """
+    item["attempts"] += 1
+    item["error"] = str(err)
+    retries = item.get("retries", len(RETRY_BACKOFF))
+    if item["attempts"] > retries:
+        asm3.al.error("giving up on message to %s from %s after %d attempts: %s" % (item["tolist"], item["dbname"], item["attempts"], err), "mailqueue.process_queue")
+        _write("failed", time.time(), item)
+    else:
+        asm3.al.warn("failed sending message to %s from %s (attempt %d): %s" % (item["tolist"], item["dbname"], item["attempts"], err), "mailqueue.process_queue")
+        _write("new", time.time() + RETRY_BACKOFF[min(item["attempts"], len(RETRY_BACKOFF)) - 1], item)
+    os.unlink(path)
+
+def requeue_stale() -> int:
+    """
+    Puts messages that were claimed more than STALE_CLAIM ago back in
+    the queue. Returns the number of messages requeued.
+    """
+    cutoff = time.time() - STALE_CLAIM
+    work = _dir("work")
+    requeued = 0
+    for f in os.scandir(work):
+        try:
+            if f.stat().st_mtime < cutoff:
+                os.rename(f.path, os.path.join(_dir("new"), f.name))
+                requeued += 1
+        except OSError:
+            pass
+    if requeued > 0: asm3.al.warn("requeued %d stale messages" % requeued, "mailqueue.requeue_stale")
+    return requeued
+
+def process_queue(sender: Sender = None, dbname: str = None) -> int:
+    """
+    Sends all of the messages in the queue that are due.
+    sender: The Sender to use, if one is not given a new one is created
+            and closed when the queue has been processed.
+    dbname: If given, only sends the messages queued for this database.
+    Returns the number of messages sent.
+    """
+    if MAIL_QUEUE == "": return 0
+    ownsender = sender is None
+    if ownsender: sender = Sender()
+    sent = 0
+    try:
+        requeue_stale()
+        new = _dir("new")
+        work = _dir("work")
+        suffix = ".msg"
+        if dbname is not None: suffix = "_%s.msg" % _tag(dbname)
+        for name in sorted(os.listdir(new)):
+            if not name.endswith(suffix): continue
+            if _due(name) > time.time(): break
+            path = os.path.join(new, name)
+            claimed = os.path.join(work, name)
+            try:
+                os.rename(path, claimed)
+                os.utime(claimed)
+            except FileNotFoundError:
+                continue # another worker has claimed it
+            try:
+                with open(claimed, "r") as f:
+                    item = json.load(f)
+            except Exception as err:
+                asm3.al.error("could not read %s: %s" % (name, err), "mailqueue.process_queue")
+                os.rename(claimed, os.path.join(_dir("failed"), name))
+                continue
+            if sender.rate_limited(item["transport"]):
+                os.rename(claimed, path)
+                continue
+            try:
+                sender.send(item)
+                os.unlink(claimed)
+                sent += 1
+            except Exception as err:
+                _failed(claimed, item, err)
+    finally:
+        if ownsender: sender.close()
+    if sent > 0: asm3.al.debug("sent %d queued messages" % sent, "mailqueue.process_queue")
+    return sent
+
+def _run() -> None:
+    """
+    The worker thread. Sends messages until there are none left in the queue.
+    """
+    global worker
+    sender = Sender()
+    try:
+        while True:
+            process_queue(sender)
+            with lock:
+                if pending()[0] == 0:
+                    worker = None
+                    return
+            sender.close_idle()
+            time.sleep(POLL)
+    except Exception as err:
+        asm3.al.error("mail queue worker stopped: %s" % err, "mailqueue._run")
+        with lock:
+            worker = None
+    finally:
+        sender.close()
+
+def start_worker() -> None:
+    """
+    Starts the worker thread for this process if it is not running.
+    """
+    global worker
+    with lock:
+        if worker is not None: return
+        worker = threading.Thread(target=_run, name="mailqueue", daemon=True)
+        worker.start()
@@ -4,15 +4,19 @@ import asm3.animal
 import asm3.audit
 import asm3.configuration
 import asm3.dbfs
+import asm3.imagecache
 import asm3.log
 import asm3.utils
 from asm3.i18n import _
-from asm3.sitedefs import RESIZE_IMAGES_DURING_ATTACH, RESIZE_IMAGES_SPEC, SCALE_PDF_DURING_ATTACH, SCALE_PDF_CMD, SERVICE_URL, WATERMARK_FONT_BASEDIRECTORY
+from asm3.sitedefs import MEDIA_INDEX_TTL, RESIZE_IMAGES_DURING_ATTACH, RESIZE_IMAGES_SPEC, SCALE_PDF_DURING_ATTACH, SCALE_PDF_CMD, SERVICE_URL, WATERMARK_FONT_BASEDIRECTORY
 from asm3.typehints import Database, Dict, PostedData, ResultRow, Results, Tuple
 
+import collections
 from datetime import datetime
 import os
 import tempfile
+import threading
+import time
 import zipfile
 from PIL import Image, ImageFont, ImageDraw
 
@@ -40,6 +44,13 @@ MEDIATYPE_VIDEO_LINK = 2
 DEFAULT_RESIZE_SPEC = "1024x1024" # If no valid resize spec is configured, the default to use
 MAX_PDF_PAGES = 50 # Do not scale PDFs with more than this many pages
 
+MEDIA_INDEX_MAX = 10000 # The most links to hold in the media index for each database
+
+# In memory index of the image media for each link, see MEDIA_INDEX_TTL
+# { database name: OrderedDict({ (linktype, linkid): (time loaded, rows) }) }
+media_index = {}
+media_index_lock = threading.Lock()
+
 def mime_type(filename: str) -> str:
     """
     Returns the mime type for a file with the given name
@@ -78,6 +89,10 @@ def get_web_preferred_name(dbo: Database, linktype: int, linkid: int) -> str:
 
 def get_web_preferred(dbo: Database, linktype: int, linkid: int) -> ResultRow:
     """ Returns the media record for the web preferred (or None if there isn't one) """
+    if MEDIA_INDEX_TTL > 0:
+        for m in get_media_index(dbo, linktype, linkid):
+            if m.WEBSITEPHOTO == 1: return m
+        return None
     return dbo.first_row(dbo.query("SELECT * FROM media WHERE LinkTypeID = ? AND " \
         "LinkID = ? AND WebsitePhoto = 1", (linktype, linkid)))
 
@@ -86,16 +101,53 @@ def get_media_by_seq(dbo: Database, linktype: int, linkid: int, seq: int) -> Res
         Element 1 is always the preferred.
         None is returned if the item doesn't exist
     """
-    rows = dbo.query("SELECT * FROM media " \
-        "WHERE LinkTypeID = ? AND LinkID = ? " \
-        "AND MediaMimeType = 'image/jpeg' " \
-        "AND (ExcludeFromPublish = 0 OR ExcludeFromPublish Is Null) " \
-        "ORDER BY WebsitePhoto DESC, ID", (linktype, linkid))
+    if MEDIA_INDEX_TTL > 0:
+        rows = [ m for m in get_media_index(dbo, linktype, linkid) if m.MEDIAMIMETYPE == "image/jpeg" and 
+            (m.EXCLUDEFROMPUBLISH == 0 or m.EXCLUDEFROMPUBLISH is None) ]
+    else:
+        rows = dbo.query("SELECT * FROM media " \
+            "WHERE LinkTypeID = ? AND LinkID = ? " \
+            "AND MediaMimeType = 'image/jpeg' " \
+            "AND (ExcludeFromPublish = 0 OR ExcludeFromPublish Is Null) " \
+            "ORDER BY WebsitePhoto DESC, ID", (linktype, linkid))
     if len(rows) >= seq:
         return rows[seq-1]
     else:
         return None
 
+def get_media_index(dbo: Database, linktype: int, linkid: int) -> Results:
+    """
+    Returns the web preferred and publishable image media for a link from the 
+    media index, loading them if they are not there or older than MEDIA_INDEX_TTL. 
+    Rows are ordered preferred first, then by ID and must not be changed.
+    """
+    key = (linktype, linkid)
+    with media_index_lock:
+        links = media_index.setdefault(dbo.name(), collections.OrderedDict())
+        cached = links.get(key)
+        if cached is not None and time.time() - cached[0] < MEDIA_INDEX_TTL:
+            links.move_to_end(key)
+            return cached[1]
+    rows = dbo.query("SELECT * FROM media WHERE LinkTypeID = ? AND LinkID = ? " \
+        "AND (WebsitePhoto = 1 OR (MediaMimeType = 'image/jpeg' " \
+        "AND (ExcludeFromPublish = 0 OR ExcludeFromPublish Is Null))) " \
+        "ORDER BY WebsitePhoto DESC, ID", (linktype, linkid))
+    with media_index_lock:
+        # Don't store what we read if the index was cleared while we were reading
+        if media_index.get(dbo.name()) is links:
+            links[key] = (time.time(), rows)
+            links.move_to_end(key)
+            while len(links) > MEDIA_INDEX_MAX:
+                links.popitem(last=False)
+    return rows
+
+def invalidate_media_index(dbo: Database) -> None:
+    """
+    Clears the media index for this database after media has been changed
+    """
+    with media_index_lock:
+        media_index.pop(dbo.name(), None)
+
 def get_total_seq(dbo: Database, linktype: int, linkid: int) -> int:
     return dbo.query_int(dbo, "SELECT COUNT(ID) FROM media WHERE LinkTypeID = ? AND LinkID = ? " \
         "AND MediaMimeType = 'image/jpeg' " \
@@ -108,6 +160,7 @@ def set_video_preferred(dbo: Database, username: str, mid: int) -> None:
     link = dbo.first_row(dbo.query("SELECT LinkID, LinkTypeID FROM media WHERE ID = ?", [mid]))
     dbo.update("media", "LinkID=%d AND LinkTypeID=%d" % (link.LINKID, link.LINKTYPEID), { "WebsiteVideo": 0 })
     dbo.update("media", mid, { "WebsiteVideo": 1, "Date": dbo.now() }, username) 
+    invalidate_media_index(dbo)
 
 def set_web_preferred(dbo: Database, username: str, mid: int) -> None:
     """
@@ -116,6 +169,7 @@ def set_web_preferred(dbo: Database, username: str, mid: int) -> None:
     link = dbo.first_row(dbo.query("SELECT LinkID, LinkTypeID FROM media WHERE ID = ?", [mid]))
     dbo.update("media", "LinkID=%d AND LinkTypeID=%d" % (link.LINKID, link.LINKTYPEID), { "WebsitePhoto": 0 })
     dbo.update("media", mid, { "WebsitePhoto": 1, "ExcludeFromPublish": 0, "Date": dbo.now() }, username) 
+    invalidate_media_index(dbo)
 
 def set_doc_preferred(dbo: Database, username: str, mid: int) -> None:
     """
@@ -124,6 +178,7 @@ def set_doc_preferred(dbo: Database, username: str, mid: int) -> None:
     link = dbo.first_row(dbo.query("SELECT LinkID, LinkTypeID FROM media WHERE ID = ?", [mid]))
     dbo.update("media", "LinkID=%d AND LinkTypeID=%d" % (link.LINKID, link.LINKTYPEID), { "DocPhoto": 0 })
     dbo.update("media", mid, { "DocPhoto": 1, "Date": dbo.now() }, username) 
+    invalidate_media_index(dbo)
 
 def set_excluded(dbo: Database, username: str, mid: int, exclude: int = 1) -> None:
     """
@@ -135,6 +190,7 @@ def set_excluded(dbo: Database, username: str, mid: int, exclude: int = 1) -> No
         d["WebsitePhoto"] = 0
         d["DocPhoto"] = 0
     dbo.update("media", mid, d, username)
+    invalidate_media_index(dbo)
 
 def get_name_for_id(dbo: Database, mid: int) -> str:
     return dbo.query_string("SELECT MediaName FROM media WHERE ID = ?", [mid])
@@ -206,7 +262,7 @@ def get_image_file_data(dbo: Database, mode: str, iid: str = "", seq: int = 0, j
     def thumb_mrec(mm):
         if mm is None: return thumb_nopic()
         if justdate: return mm.DATE
-        return (mm.DATE, scale_image(asm3.dbfs.get_string_id(dbo, mm.DBFSID), asm3.configuration.thumbnail_size(dbo)))
+        return (mm.DATE, asm3.imagecache.get(dbo, mm.DBFSID, asm3.configuration.thumbnail_size(dbo), mm.DATE))
 
     sid = str(iid)
     iid = asm3.utils.cint(iid)
@@ -460,6 +516,7 @@ def attach_file_from_form(dbo: Database, username: str, linktype: int, linkid: i
     if ispicture and excludefrompublish == 0:
         check_default_web_doc_pic(dbo, mediaid, linkid, linktype)
 
+    invalidate_media_index(dbo)
     return mediaid
 
 def attach_link_from_form(dbo: Database, username: str, linktype: int, linkid: int, post: PostedData) -> int:
@@ -703,13 +760,12 @@ def embellish_photo_urls(dbo: Database, rows: Results, linktypeid: int = ANIMAL)
             "AND MediaMimeType = 'image/jpeg' " \
             "AND (ExcludeFromPublish = 0 OR ExcludeFromPublish Is Null) " \
             "ORDER BY WebsitePhoto DESC, LinkID, ID")
+    urls = {} # LinkID: [ urls ]
+    for m in mr:
+        ts = asm3.i18n.python2unix(m.DATE)
+        urls.setdefault(m.LINKID, []).append(f"{SERVICE_URL}?account={dbo.name()}&method=media_image&mediaid={m.ID}&ts={ts}")
     for r in rows:
-        r.PHOTOURLS = []
-        for m in mr:
-            if r.ID == m.LINKID: 
-                ts = asm3.i18n.python2unix(m.DATE)
-                url = f"{SERVICE_URL}?account={dbo.name()}&method=media_image&mediaid={m.ID}&ts={ts}"
-                r.PHOTOURLS.append(url)
+        r.PHOTOURLS = list(urls.get(r.ID, []))
     return rows
 
 def send_signature_request(dbo: Database, username: str, mid: int, post: PostedData) -> None:
@@ -816,7 +872,12 @@ def update_file_content(dbo: Database, username: str, mid: int, content: bytes)
     if m is None: raise IOError("media id %s does not exist" % mid)
     if m.DBFSID == 0: raise IOError("cannot update contents of DBFSID 0")
     asm3.dbfs.put_string_id(dbo, m.DBFSID, m.MEDIANAME, content)
+    # The new date could be the same as the old one if it changed within a second
+    for d in dbo.query_list("SELECT DISTINCT Date FROM media WHERE DBFSID=?", [m.DBFSID]):
+        asm3.imagecache.forget(dbo, m.DBFSID, d)
+    asm3.imagecache.forget(dbo, m.DBFSID)
     dbo.update("media", f"DBFSID={m.DBFSID}", { "Date": dbo.now(), "MediaSize": len(content) }, username)
+    invalidate_media_index(dbo)
 
 def update_media_from_form(dbo: Database, username: str, post: PostedData) -> None:
     mediaid = post.integer("mediaid")
@@ -828,12 +889,13 @@ def update_media_from_form(dbo: Database, username: str, post: PostedData) -> No
         # ASM2_COMPATIBILITY
         "UpdatedSinceLastPublish": 1
     }, username)
+    invalidate_media_index(dbo)
 
 def clone_media(dbo: Database, username: str, mediaid: int, linktypeid: int, linkid: int) -> None:
     """ Clones a media record with a new link """
     m = get_media_by_id(dbo, mediaid)
     nextid = dbo.get_id("media")
-    return dbo.insert("media", {
+    dbo.insert("media", {
         "ID":                   nextid,
         "DBFSID":               m.DBFSID,
         "MediaSize":            m.MEDIASIZE,
@@ -857,6 +919,8 @@ def clone_media(dbo: Database, username: str, mediaid: int, linktypeid: int, lin
         "CreatedDate":          dbo.now(),
         "RetainUntil":          m.RETAINUNTIL
     }, username, generateID=False)
+    invalidate_media_index(dbo)
+    return nextid
 
 def update_media_link(dbo: Database, username: str, mediaid: int, linktypeid: int, linkid: int) -> None:
     """ Updates the media with id to have a new link """
@@ -869,6 +933,7 @@ def update_media_link(dbo: Database, username: str, mediaid: int, linktypeid: in
         "LinkTypeID": linktypeid,
         "Date":     dbo.now()
     }, username)
+    invalidate_media_index(dbo)
     
 
 def delete_media(dbo: Database, username: str, mid: int) -> None:
@@ -890,6 +955,7 @@ def delete_media(dbo: Database, username: str, mid: int) -> None:
             "AND MediaMimeType = 'image/jpeg' AND ExcludeFromPublish = 0 " \
             "ORDER BY ID DESC", (mr.LINKID, mr.LINKTYPEID)))
         if ml: dbo.update("media", ml.ID, { "DocPhoto": 1 })
+    invalidate_media_index(dbo)
 
 def convert_media_jpg2pdf(dbo: Database, username: str, mid: int) -> int:
     """
@@ -1121,6 +1187,7 @@ def remove_expired_media(dbo: Database, years: int = None, username: str = "syst
     #for r in rows:
     #    asm3.dbfs.delete_id(dbo, r.dbfsid)
     dbo.execute("DELETE FROM media WHERE RetainUntil Is Not Null AND RetainUntil < ?", [ dbo.today() ])
+    invalidate_media_index(dbo)
     asm3.al.debug("removed %d expired media items (retain until)" % len(rows), "media.remove_expired_media", dbo)
     enabled = asm3.configuration.auto_remove_document_media(dbo)
     retainyears = asm3.configuration.auto_remove_document_media_years(dbo)
@@ -1154,6 +1221,7 @@ def remove_media_after_exit(dbo: Database, years: int = None, username: str = "s
         affected = 0
         if len(animals) > 0:
             affected = dbo.delete("media", "LinkType=0 AND LinkID IN (%s)" % ",".join(animals), username) 
+            invalidate_media_index(dbo)
         asm3.al.debug("removed %d expired animal media items (remove %s years after exit)" % (affected, years), "media.remove_media_after_exit", dbo)
         return "OK %s" % affected
     
@@ -1295,7 +1363,7 @@ def scale_all_animal_images(dbo: Database) -> None:
     Goes through all animal images in the database and scales
     them to the current incoming media scaling factor.
     """
-    mp = dbo.query("SELECT ID, DBFSID, MediaName FROM media WHERE MediaMimeType = 'image/jpeg' AND LinkTypeID = 0 ORDER BY ID")
+    mp = dbo.query("SELECT ID, DBFSID, MediaName, Date FROM media WHERE MediaMimeType = 'image/jpeg' AND LinkTypeID = 0 ORDER BY ID")
     for i, m in enumerate(mp):
         try:
             inputfile = tempfile.NamedTemporaryFile(suffix=".jpg", delete=False)
@@ -1313,6 +1381,7 @@ def scale_all_animal_images(dbo: Database) -> None:
             # Update the image file data
             asm3.dbfs.put_string_id(dbo, m.DBFSID, m.MEDIANAME, data)
             dbo.update("media", m.ID, { "MediaSize": len(data) })
+            asm3.imagecache.forget(dbo, m.DBFSID, m.DATE)
         except Exception as err:
             asm3.al.error("failed scaling image (ID=%s, DBFSID=%s): %s" % (m.ID, m.DBFSID, err), "media.scale_all_animal_images", dbo)
     asm3.al.debug("scaled %d images" % len(mp), "media.scale_all_animal_images", dbo)
@@ -16,8 +16,9 @@ import asm3.users
 import asm3.utils
 from asm3.i18n import _, add_days, date_diff_days, format_time, display2python, python2display, subtract_years, now
 from asm3.sitedefs import GEO_BATCH, GEO_LIMIT
-from asm3.typehints import Database, Dict, List, PostedData, ResultRow, Results, Session
+from asm3.typehints import Database, Dict, List, PostedData, ResultRow, Results, Session, Tuple
 
+import re
 from datetime import datetime
 
 ASCENDING = 0
@@ -1607,35 +1608,97 @@ def merge_person(dbo: Database, username: str, personid: int, mergepersonid: int
     dbo.delete("owner", mergepersonid, username)
     asm3.audit.move(dbo, username, "owner", personid, "", "Merged owner %d -> %d" % (mergepersonid, personid))
 
-def merge_duplicate_people(dbo: Database, username: str) -> None:
-    """
-    Runs through every person in the database and attempts to find other people
-    with the same first name, last name and address. If any are found, they are
-    merged into this person via a call to merge_person
+# Keys merge_duplicate_people can group people by. NAME is the exact
+# first name, last name and address, the others are fuzzier and combine
+# the first name with a normalised email, mobile number or address.
+DEDUP_NAME = "name"
+DEDUP_EMAIL = "email"
+DEDUP_MOBILE = "mobile"
+DEDUP_ADDRESS = "address"
+
+def _dedup_keys(p: ResultRow, keys: List[str]) -> List[Tuple]:
+    """
+    Returns the hashable keys for person row p that identify its duplicates
+    """
+    def norm(s):
+        return " ".join(re.split(r"[\W_]+", asm3.utils.nulltostr(s).lower())).strip()
+    forenames = norm(p.OWNERFORENAMES)
+    rv = []
+    for k in keys:
+        if k == DEDUP_NAME:
+            # NULLs never match, the same as in an SQL equality test
+            if p.OWNERFORENAMES is not None and p.OWNERSURNAME is not None and p.OWNERADDRESS is not None:
+                rv.append((k, p.OWNERFORENAMES, p.OWNERSURNAME, p.OWNERADDRESS))
+        elif k == DEDUP_EMAIL:
+            email = asm3.utils.nulltostr(p.EMAILADDRESS).lower().strip()
+            if forenames != "" and email.find("@") != -1 and email.find(".") != -1 and len(email) > 6:
+                rv.append((k, forenames, email))
+        elif k == DEDUP_MOBILE:
+            mobile = asm3.utils.digits_only(asm3.utils.nulltostr(p.MOBILETELEPHONE))
+            if forenames != "" and len(mobile) >= 5: # at least 5 digits to constitute a valid number
+                rv.append((k, forenames, mobile))
+        elif k == DEDUP_ADDRESS:
+            surname = norm(p.OWNERSURNAME)
+            address = norm(p.OWNERADDRESS)
+            if forenames != "" and surname != "" and address != "":
+                rv.append((k, forenames, surname, address, norm(p.OWNERPOSTCODE)))
+    return rv
+
+def get_duplicate_people(dbo: Database, keys: List[str] = [ DEDUP_NAME ]) -> List[List[int]]:
+    """
+    Finds groups of duplicate people in a single pass over the owner table.
+    People sharing any of the keys given are in the same group, including
+    people linked through a chain of different keys.
+    Returns a list of groups, each a list of person IDs in ascending order.
+    """
+    parent = {} # union find of person IDs, every group's root is its lowest ID
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    seen = {}
+    for p in dbo.query_generator("SELECT ID, OwnerForeNames, OwnerSurname, OwnerAddress, OwnerPostcode, " \
+        "EmailAddress, MobileTelephone FROM owner ORDER BY ID"):
+        parent[p.ID] = p.ID
+        for k in _dedup_keys(p, keys):
+            if k not in seen:
+                seen[k] = p.ID
+                continue
+            root = find(seen[k])
+            proot = find(p.ID)
+            if root != proot:
+                parent[max(root, proot)] = min(root, proot)
+    groups = {}
+    for i in parent:
+        r = find(i)
+        if r != i: groups.setdefault(r, [ r ]).append(i)
+    return [ groups[r] for r in sorted(groups) ]
+
+def merge_duplicate_people(dbo: Database, username: str, keys: List[str] = [ DEDUP_NAME ]) -> None:
+    """
+    Finds groups of people with the same first name, last name and address
+    (or the other keys given, see get_duplicate_people), and merges each
+    group into the person with the lowest ID via calls to merge_person.
+    Each group is merged in a single transaction.
     """
     merged = 0
-    removed = [] # track people we've already merged and removed so we can skip them
-    people = dbo.query("SELECT ID, OwnerForeNames, OwnerSurname, OwnerAddress FROM owner ORDER BY ID")
-
-    asm3.al.info("Checking for duplicate people (%d records)" % len(people), "person.merge_duplicate_people", dbo)
-
-    for i, p in enumerate(people):
-
-        if p.ID in removed: continue
+    groups = get_duplicate_people(dbo, keys)
 
-        rows = dbo.query("SELECT ID FROM owner WHERE ID > ? AND OwnerForeNames = ? AND OwnerSurname = ? AND OwnerAddress = ?",
-            (p.ID, p.OWNERFORENAMES, p.OWNERSURNAME, p.OWNERADDRESS))
+    asm3.al.info("Found %d groups of duplicate people (keys: %s)" % (len(groups), ", ".join(keys)), "person.merge_duplicate_people", dbo)
 
-        for mp in rows:
-
-            merged += 1
-
-            asm3.al.debug("found duplicate %s %s (%d of %d) id=%d, dupid=%d, merging" % \
-                (p.OWNERFORENAMES, p.OWNERSURNAME, i, len(people), p.ID, mp.ID), \
-                "person.merge_duplicate_people", dbo)
-
-            merge_person(dbo, username, p.ID, mp.ID)
-            removed.append(mp.ID)
+    asm3.asynctask.set_progress_max(dbo, len(groups))
+    for g in groups:
+        asm3.asynctask.increment_progress_value(dbo)
+        personid = g[0]
+        try:
+            with dbo.transaction():
+                for mergepersonid in g[1:]:
+                    asm3.al.debug("found duplicate id=%d, dupid=%d, merging" % (personid, mergepersonid), "person.merge_duplicate_people", dbo)
+                    merge_person(dbo, username, personid, mergepersonid)
+            merged += len(g) - 1
+        except Exception as err:
+            asm3.al.error("failed merging duplicates %s into %d: %s" % (g[1:], personid, err), "person.merge_duplicate_people", dbo)
 
     asm3.al.info("Merged %d duplicate people records" % merged, "person.merge_duplicate_people", dbo)
 
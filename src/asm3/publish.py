@@ -74,7 +74,8 @@ PUBLISHER_LIST["pr"] = {
     "label":    "Publish to PetRescue.com.au",
     "class":    asm3.publishers.petrescue.PetRescuePublisher,
     "locales":  "en_AU",
-    "sub24hour": True
+    "sub24hour": True,
+    "delta":    True
 }
 PUBLISHER_LIST["sac"] = {
     "label":    "Publish to shelteranimalscount.org",
@@ -86,7 +87,8 @@ PUBLISHER_LIST["sl"] = {
     "label":    "Publish to Savour-Life.com.au",
     "class":    asm3.publishers.savourlife.SavourLifePublisher,
     "locales":  "en_AU",
-    "sub24hour": True
+    "sub24hour": True,
+    "delta":    True
 }
 PUBLISHER_LIST["pcuk"] = {
     "label":    "Publish to PetsLocated.com",
@@ -177,8 +179,10 @@ def get_publish_log(dbo: Database, plid: int) -> str:
     """ Returns the log for a publish log ID """
     return dbo.query_string("SELECT LogData FROM publishlog WHERE ID = ?", [plid])
 
-def start_publisher(dbo: Database, code: str, user: str = "", newthread: bool = True) -> None:
-    """ Starts the publisher with code """
+def start_publisher(dbo: Database, code: str, user: str = "", newthread: bool = True, delta: bool = False) -> None:
+    """ Starts the publisher with code 
+        delta: Only send new and changed animals if the publisher supports it
+    """
     pc = PublishCriteria(asm3.configuration.publisher_presets(dbo))
     p = None
 
@@ -191,6 +195,7 @@ def start_publisher(dbo: Database, code: str, user: str = "", newthread: bool =
         return
 
     else:
+        pc.deltaOnly = delta and PUBLISHER_LIST[code].get("delta", False)
         p = PUBLISHER_LIST[code]["class"](dbo, pc)
 
     if newthread:
@@ -6,20 +6,25 @@ import asm3.asynctask
 import asm3.configuration
 import asm3.dbfs
 import asm3.i18n
+import asm3.imagecache
 import asm3.media
 import asm3.movement
 import asm3.utils
 import asm3.wordprocessor
-from asm3.sitedefs import SERVICE_URL, FTP_CONNECTION_TIMEOUT
-from asm3.typehints import Any, datetime, Database, Dict, List, ResultRow, Results
+from asm3.sitedefs import SERVICE_URL, FTP_CONNECTION_TIMEOUT, FTP_UPLOAD_SESSIONS
+from asm3.typehints import Any, datetime, Database, Dict, List, ResultRow, Results, Tuple
 
 import ftplib
 import glob
+import heapq
+import operator
 import os
+import queue
 import shutil
 import sys
 import tempfile
 import threading
+import time
 
 def quietcallback(x: Any) -> None:
     """ ftplib callback that does nothing instead of dumping messages to stdout """
@@ -71,6 +76,7 @@ class PublishCriteria(object):
     internalLocations = [] # List of either location IDs, or LIKE comparisons
     publishDirectory = None # None = use temp directory for publishing
     ignoreLock = False # Force the publisher to run even if another publisher is running
+    deltaOnly = False # Only send animals that have changed since they were last sent (publishers that support it)
 
     def get_int(self, s: str) -> int:
         """
@@ -199,29 +205,33 @@ def get_animal_data(dbo: Database, pc: PublishCriteria = None, animalid: int = 0
         pc = PublishCriteria(asm3.configuration.publisher_presets(dbo))
     
     sql = get_animal_data_query(dbo, pc, animalid, publisher_key=publisher_key)
-    rows = dbo.query(sql, distincton="ID")
+    rows = dbo.query_view(sql, distincton="ID")
     asm3.al.debug("get_animal_data_query returned %d rows" % len(rows), "publishers.base.get_animal_data", dbo)
 
+    # One pass to tidy up and filter the rows:
     # If the sheltercode format has a slash in it, convert it to prevent
     # creating images with broken paths.
-    if len(rows) > 0 and rows[0]["SHELTERCODE"].find("/") != -1:
-        asm3.al.debug("discovered forward slashes in code, repairing", "publishers.base.get_animal_data", dbo)
-        for r in rows:
-            r.SHORTCODE = r.SHORTCODE.replace("/", "-").replace(" ", "")
-            r.SHELTERCODE = r.SHELTERCODE.replace("/", "-").replace(" ", "")
-
     # If we're using animal comments, override the websitemedianotes field
     # with animalcomments for compatibility with service users and other
     # third parties who were used to the old way of doing things
-    if asm3.configuration.publisher_use_comments(dbo):
-        for r in rows:
-            r.WEBSITEMEDIANOTES = r.ANIMALCOMMENTS
-
     # If we aren't including animals with blank descriptions, remove them now
     # (but don't let it override the courtesy flag, which should always make animals appear)
+    repaircodes = len(rows) > 0 and rows[0]["SHELTERCODE"].find("/") != -1
+    if repaircodes:
+        asm3.al.debug("discovered forward slashes in code, repairing", "publishers.base.get_animal_data", dbo)
+    usecomments = asm3.configuration.publisher_use_comments(dbo)
+    oldcount = len(rows)
+    filtered = []
+    for r in rows:
+        if repaircodes:
+            r.SHORTCODE = r.SHORTCODE.replace("/", "-").replace(" ", "")
+            r.SHELTERCODE = r.SHELTERCODE.replace("/", "-").replace(" ", "")
+        if usecomments:
+            r.WEBSITEMEDIANOTES = r.ANIMALCOMMENTS
+        if pc.includeWithoutDescription or r.ISCOURTESY == 1 or asm3.utils.nulltostr(r.WEBSITEMEDIANOTES).strip() != "":
+            filtered.append(r)
+    rows = filtered
     if not pc.includeWithoutDescription:
-        oldcount = len(rows)
-        rows = [r for r in rows if r.ISCOURTESY == 1 or asm3.utils.nulltostr(r.WEBSITEMEDIANOTES).strip() != "" ]
         asm3.al.debug("removed %d rows without descriptions" % (oldcount - len(rows)), "publishers.base.get_animal_data", dbo)
 
     # Embellish additional fields if requested
@@ -241,33 +251,35 @@ def get_animal_data(dbo: Database, pc: PublishCriteria = None, animalid: int = 0
         asm3.animal.calc_age_group_rows(dbo, rows)
     
     # Generate the sponsor column
-    unitextra = asm3.configuration.unit_extra(dbo)
-    if unitextra.strip() != "":
+    if asm3.configuration.unit_extra(dbo).strip() != "":
+        unitextra = asm3.configuration.unit_extra_map(dbo)
         for r in rows:
             if r.ACTIVEMOVEMENTTYPE is not None and r.ACTIVEMOVEMENTTYPE > 0: continue # animal must be in the location
-            r.UNITSPONSOR = asm3.configuration.unit_extra_get(dbo, r.SHELTERLOCATION, r.SHELTERLOCATIONUNIT)[0]
+            r.UNITSPONSOR = unitextra.get((r.SHELTERLOCATION, r.SHELTERLOCATIONUNIT), ("", ""))[0]
+
+    # Index the rows by ID for finding bonded animals
+    byid = { r.ID: r for r in rows }
 
     # If bondedAsSingle is on, go through the the set of animals and merge
     # the bonded animals into a single record
     def merge_animal(a, aid):
         """
         Find the animal in rows with animalid, merge it into a and
-        then remove it from the set.
-        """
-        for r in rows:
-            if r.ID == aid:
-                # Add some useful values for publishers that can accept bonded animal info
-                a.BONDEDNAME1 = a.ANIMALNAME
-                a.BONDEDNAME2 = r.ANIMALNAME
-                a.BONDEDSEX = r.SEX
-                a.BONDEDMICROCHIPNUMBER = r.IDENTICHIPNUMBER
-                a.BONDEDBREEDNAME = r.BREEDNAME
-                a.BONDEDSIZE = r.SIZE
-                a.BONDEDDATEOFBIRTH = r.DATEOFBIRTH
-                a.ANIMALNAME = "%s / %s" % (a.ANIMALNAME, r.ANIMALNAME)
-                r.REMOVE = True # Flag this row for removal
-                asm3.al.debug("merged animal %d into %d" % (aid, a.ID), "publishers.base.get_animal_data", dbo)
-                break
+        then flag it for removal from the set.
+        """
+        r = byid.get(aid)
+        if r is None: return
+        # Add some useful values for publishers that can accept bonded animal info
+        a.BONDEDNAME1 = a.ANIMALNAME
+        a.BONDEDNAME2 = r.ANIMALNAME
+        a.BONDEDSEX = r.SEX
+        a.BONDEDMICROCHIPNUMBER = r.IDENTICHIPNUMBER
+        a.BONDEDBREEDNAME = r.BREEDNAME
+        a.BONDEDSIZE = r.SIZE
+        a.BONDEDDATEOFBIRTH = r.DATEOFBIRTH
+        a.ANIMALNAME = "%s / %s" % (a.ANIMALNAME, r.ANIMALNAME)
+        r.REMOVE = True # Flag this row for removal
+        asm3.al.debug("merged animal %d into %d" % (aid, a.ID), "publishers.base.get_animal_data", dbo)
     
     def check_bonding(r):
         """ Verifies if this row is bonded to another animal and handles 
@@ -292,23 +304,20 @@ def get_animal_data(dbo: Database, pc: PublishCriteria = None, animalid: int = 0
                 return [ r ]
         return []
 
-    # Ordering
-    if pc.order == 0:
-        rows = sorted(rows, key=lambda k: k.MOSTRECENTENTRYDATE)
-    elif pc.order == 1:
-        rows = list(reversed(sorted(rows, key=lambda k: k.MOSTRECENTENTRYDATE)))
-    elif pc.order == 2:
-        rows = sorted(rows, key=lambda k: k.ANIMALNAME)
-    else:
-        rows = sorted(rows, key=lambda k: k.MOSTRECENTENTRYDATE)
-
-    # If a limit was set, throw away extra rows
-    # (we do it here instead of a LIMIT clause as there's extra logic that throws
-    #  away rows above).
+    # Ordering. If a limit was set, only the top rows are picked out rather
+    # than sorting everything and throwing away the extra rows (we do it 
+    # here instead of a LIMIT clause as there's extra logic that throws
+    # away rows above). The keys match the stable sorts used without a limit.
+    if pc.order == 1:
+        # Most recent first, with tied rows in reverse order
+        if limit > 0 and len(rows) > limit:
+            return [ x[2] for x in heapq.nlargest(limit, ( (r.MOSTRECENTENTRYDATE, i, r) for i, r in enumerate(rows) ), key=lambda k: (k[0], k[1])) ]
+        return list(reversed(sorted(rows, key=lambda k: k.MOSTRECENTENTRYDATE)))
+    key = operator.attrgetter("MOSTRECENTENTRYDATE")
+    if pc.order == 2: key = operator.attrgetter("ANIMALNAME")
     if limit > 0 and len(rows) > limit:
-        rows = rows[0:limit]
-
-    return rows
+        return heapq.nsmallest(limit, rows, key=key)
+    return sorted(rows, key=key)
 
 def get_animal_data_query(dbo: Database, pc: PublishCriteria, animalid: int = 0, publisher_key: str = "") -> str:
     """
@@ -632,10 +641,12 @@ class AbstractPublisher(threading.Thread):
     locale = "en"
     lastError = ""
     logBuffer = []
+    logLock = None
 
     def __init__(self, dbo: Database, publishCriteria: PublishCriteria) -> None:
         threading.Thread.__init__(self)
         self.dbo = dbo
+        self.logLock = threading.Lock()
         self.locale = asm3.configuration.locale(dbo)
         self.pc = publishCriteria
         self.makePublishDirectory()
@@ -1000,6 +1011,40 @@ class AbstractPublisher(threading.Thread):
             { "lp": self.dbo.sql_value(lastpublished) })
         return len(changes) > 0
 
+    def getDeltaAnimals(self, animals: Results) -> Results:
+        """
+        Returns the animals from the matching set that need sending to the
+        current publisher if pc.deltaOnly is set, otherwise all of them.
+        An animal needs sending if it has never been sent, if its last send
+        recorded a failure or status (animalpublished.Extra), or if the animal,
+        its adoption movements or media have changed since it was sent.
+        If the configuration has changed since the earliest send, all are returned.
+        Listings that need removing are found from the full matching set as before.
+        """
+        if not self.pc.deltaOnly or len(animals) == 0: return animals
+        sent = {}
+        for r in self.dbo.query("SELECT AnimalID, SentDate, Extra FROM animalpublished WHERE PublishedTo = ?", [self.publisherKey]):
+            sent[r.ANIMALID] = r
+        since = min([ sent[a.ID].SENTDATE for a in animals if a.ID in sent and sent[a.ID].SENTDATE is not None ], default=None)
+        if since is None: return animals
+        if self.dbo.query_int("SELECT COUNT(*) FROM audittrail WHERE TableName='configuration' AND Action=1 AND AuditDate > ?", [since]) > 0:
+            self.log("Configuration changed since last publish, sending all animals.")
+            return animals
+        # The most recent change to each animal's adoptions and media since the earliest send
+        changed = {}
+        for r in self.dbo.query("SELECT AnimalID, LastChangedDate AS Changed FROM adoption WHERE LastChangedDate > ? " \
+                "UNION ALL SELECT LinkID AS AnimalID, Date AS Changed FROM media WHERE LinkTypeID = 0 AND Date > ?", [since, since]):
+            if r.ANIMALID not in changed or r.CHANGED > changed[r.ANIMALID]: changed[r.ANIMALID] = r.CHANGED
+        delta = []
+        for a in animals:
+            s = sent.get(a.ID)
+            if s is None or s.SENTDATE is None or (s.EXTRA is not None and s.EXTRA != ""):
+                delta.append(a)
+            elif (a.LASTCHANGEDDATE is not None and a.LASTCHANGEDDATE > s.SENTDATE) or (a.ID in changed and changed[a.ID] > s.SENTDATE):
+                delta.append(a)
+        self.log("Delta publish: %d of %d matching animals are new or changed." % (len(delta), len(animals)))
+        return delta
+
     def markAnimalPublished(self, animalid: int, datevalue: datetime = None, extra: str = "") -> None:
         """
         Marks an animal published at the current date/time for this publisher
@@ -1108,9 +1153,10 @@ class AbstractPublisher(threading.Thread):
 
     def log(self, msg: str) -> None:
         """
-        Logs a message
+        Logs a message. Safe to call from upload threads.
         """
-        self.logBuffer.append(msg)
+        with self.logLock:
+            self.logBuffer.append(msg)
 
     def logError(self, msg: str, ie: Any = None) -> None:
         """
@@ -1119,7 +1165,8 @@ class AbstractPublisher(threading.Thread):
         """
         self.log("ALERT: %s" % msg)
         asm3.al.error(msg, self.publisherName, self.dbo, ie)
-        self.alerts += 1
+        with self.logLock:
+            self.alerts += 1
 
     def logSearch(self, needle: str) -> str:
         """ Does a find on logBuffer """
@@ -1131,7 +1178,8 @@ class AbstractPublisher(threading.Thread):
         """
         self.log("SUCCESS: %s" % msg)
         asm3.al.info(msg, self.publisherName, self.dbo)
-        self.successes += 1
+        with self.logLock:
+            self.successes += 1
 
     def saveLog(self) -> None:
         """
@@ -1151,24 +1199,11 @@ class AbstractPublisher(threading.Thread):
         """
         return path.lower().endswith("jpg") or path.lower().endswith("jpeg")
 
-    def generateThumbnail(self, image: str, thumbnail: str) -> None:
-        """
-        Generates a thumbnail 
-        image: Path to the image to generate a thumbnail from
-        thumbnail: Path to the target thumbnail image
-        """
-        self.log("generating thumbnail %s -> %s" % ( image, thumbnail ))
-        try:
-            asm3.media.scale_image_file(image, thumbnail, self.pc.thumbnailSize)
-        except Exception as err:
-            self.logError("Failed scaling thumbnail: %s" % err, sys.exc_info())
-
-    def scaleImage(self, image: bytes, scalesize: str) -> None:
+    def scaleSpec(self, scalesize: str) -> str:
         """
-        Scales an image. scalesize is the scaleImage publish criteria and
-        can either be a resize spec, or it can be one of our old ASM2
-        fixed numbers.
-        image: The image file
+        Returns the resize spec for the scaleImages publish criteria, 
+        or an empty string for no scaling. scalesize can either be a 
+        resize spec, or it can be one of our old ASM2 fixed numbers.
         Empty string = No scaling
         1 = No scaling
         2 = 320x200
@@ -1178,20 +1213,16 @@ class AbstractPublisher(threading.Thread):
         6 = 300x300
         7 = 95x95
         """
-        sizespec = ""
-        if scalesize == "" or scalesize == "1": return image
-        elif scalesize == "2": sizespec = "320x200"
-        elif scalesize == "3": sizespec = "640x400"
-        elif scalesize == "4": sizespec = "800x600"
-        elif scalesize == "5": sizespec = "1024x768"
-        elif scalesize == "6": sizespec = "300x300"
-        elif scalesize == "7": sizespec = "95x95"
-        else: sizespec = scalesize
-        self.log("scaling %s to %s" % ( image, scalesize ))
-        try:
-            return asm3.media.scale_image_file(image, image, sizespec)
-        except Exception as err:
-            self.logError("Failed scaling image: %s" % err, sys.exc_info())
+        scalesize = str(scalesize)
+        if scalesize == "" or scalesize == "1": return ""
+        elif scalesize == "2": return "320x200"
+        elif scalesize == "3": return "640x400"
+        elif scalesize == "4": return "800x600"
+        elif scalesize == "5": return "1024x768"
+        elif scalesize == "6": return "300x300"
+        elif scalesize == "7": return "95x95"
+        elif scalesize.find("x") > -1: return scalesize
+        return ""
 
 class FTP_TLS_REUSE(ftplib.FTP_TLS):
     """A subclass of FTP_TLS that forces reuse of the socket that already did
@@ -1218,6 +1249,15 @@ class FTPPublisher(AbstractPublisher):
     currentDir = ""
     passive = True
     existingImageList = None
+    remoteDir = None
+    uploadQueue = None
+    uploadThreads = None
+    uploadLock = None
+    uploadsQueued = 0
+    uploadsDone = 0
+
+    # The number of times a queued upload is tried before giving up
+    UPLOAD_RETRIES = 3
 
     def __init__(self, dbo: Database, publishCriteria: PublishCriteria, 
                  ftphost: str, ftpuser: str, ftppassword: str, ftptls: bool = False, 
@@ -1255,15 +1295,8 @@ class FTPPublisher(AbstractPublisher):
         self.log("Connecting to %s as %s" % (self.ftphost, self.ftpuser))
         
         try:
-            # open it and login
-            if self.ftptls:
-                self.socket = FTP_TLS_REUSE(host=self.ftphost, timeout=FTP_CONNECTION_TIMEOUT)
-            else:
-                self.socket = ftplib.FTP(host=self.ftphost, timeout=FTP_CONNECTION_TIMEOUT)
-            self.socket.login(self.ftpuser, self.ftppassword)
-            if self.ftptls: 
-                self.socket.prot_p()
-            self.socket.set_pasv(self.passive)
+            self.socket = self.openFTPSession()
+            self.remoteDir = None
 
             if self.ftproot is not None and self.ftproot != "":
                 self.chdir(self.ftproot)
@@ -1273,6 +1306,20 @@ class FTPPublisher(AbstractPublisher):
             self.logError("Failed opening FTP socket (%s->%s): %s" % (self.dbo.name(), self.ftphost, err), sys.exc_info())
             return False
 
+    def openFTPSession(self) -> ftplib.FTP:
+        """
+        Opens and logs in a new FTP session to the server
+        """
+        if self.ftptls:
+            session = FTP_TLS_REUSE(host=self.ftphost, timeout=FTP_CONNECTION_TIMEOUT)
+        else:
+            session = ftplib.FTP(host=self.ftphost, timeout=FTP_CONNECTION_TIMEOUT)
+        session.login(self.ftpuser, self.ftppassword)
+        if self.ftptls: 
+            session.prot_p()
+        session.set_pasv(self.passive)
+        return session
+
     def closeFTPSocket(self) -> None:
         if not self.pc.uploadDirectly: return
         try:
@@ -1312,6 +1359,9 @@ class FTPPublisher(AbstractPublisher):
         if filename.find(os.sep) != -1: filename = filename[filename.rfind(os.sep) + 1:]
         if not self.pc.uploadDirectly: return
         if not os.path.exists(os.path.join(self.publishDir, filename)): return
+        # Anything queued earlier has to be on the server first, the
+        # third party may start an import when it sees our datafile
+        self.waitForUploads()
         self.log("Uploading: %s" % filename)
         try:
             if self.pc.checkSocket: self.checkFTPSocket()
@@ -1324,6 +1374,105 @@ class FTPPublisher(AbstractPublisher):
             self.log("reconnecting FTP socket to reset state")
             self.reconnectFTPSocket()
 
+    def queueUpload(self, filename: str) -> None:
+        """
+        Queues a file in the publish directory to be uploaded to the current
+        FTP directory by a pool of FTP_UPLOAD_SESSIONS sessions, so that
+        uploads run alongside preparing the next files. If the pool size
+        is 1, the file is uploaded straight away with upload().
+        """
+        if FTP_UPLOAD_SESSIONS <= 1:
+            self.upload(filename)
+            return
+        if filename.find(os.sep) != -1: filename = filename[filename.rfind(os.sep) + 1:]
+        if not self.pc.uploadDirectly: return
+        if not os.path.exists(os.path.join(self.publishDir, filename)): return
+        if self.remoteDir is None:
+            self.remoteDir = self.socket.pwd()
+        if self.uploadQueue is None:
+            self.uploadQueue = queue.Queue()
+            self.uploadLock = threading.Lock()
+            self.uploadThreads = []
+            for dummy in range(FTP_UPLOAD_SESSIONS):
+                t = threading.Thread(target=self.uploadWorker, daemon=True)
+                t.start()
+                self.uploadThreads.append(t)
+        self.log("Queued upload: %s" % filename)
+        self.uploadsQueued += 1
+        self.uploadQueue.put((self.remoteDir, filename))
+
+    def uploadWorker(self) -> None:
+        """
+        Runs in a thread with its own FTP session, uploading files from
+        uploadQueue until it receives None. Failed uploads are retried
+        on a new session up to UPLOAD_RETRIES times.
+        """
+        session = None
+        cwd = None
+        while True:
+            item = self.uploadQueue.get()
+            try:
+                if item is None: break
+                remotedir, filename = item
+                for attempt in range(1, self.UPLOAD_RETRIES + 1):
+                    try:
+                        if session is None:
+                            session = self.openFTPSession()
+                            cwd = None
+                        if cwd != remotedir:
+                            session.cwd(remotedir)
+                            cwd = remotedir
+                        with open(os.path.join(self.publishDir, filename), "rb") as f:
+                            session.storbinary("STOR %s" % filename, f, callback=quietcallback)
+                        self.log("Uploaded: %s" % filename)
+                        break
+                    except Exception as err:
+                        try:
+                            session.close()
+                        except:
+                            pass
+                        session = None
+                        if attempt == self.UPLOAD_RETRIES:
+                            self.logError("Failed uploading %s: %s" % (filename, err), sys.exc_info())
+                        else:
+                            self.log("Failed uploading %s (attempt %d): %s, retrying" % (filename, attempt, err))
+                with self.uploadLock:
+                    self.uploadsDone += 1
+            finally:
+                self.uploadQueue.task_done()
+        if session is not None:
+            try:
+                session.quit()
+            except:
+                pass
+
+    def waitForUploads(self, progress: bool = False) -> None:
+        """
+        Waits for any queued uploads to finish.
+        progress: Report how many have been uploaded with updatePublisherProgress while waiting
+        """
+        if self.uploadQueue is None or self.uploadsDone >= self.uploadsQueued: return
+        self.log("Waiting for %d queued uploads" % (self.uploadsQueued - self.uploadsDone))
+        if not progress:
+            self.uploadQueue.join()
+            return
+        while self.uploadsDone < self.uploadsQueued:
+            self.updatePublisherProgress(self.getProgress(self.uploadsDone, self.uploadsQueued))
+            time.sleep(1)
+
+    def stopUploads(self) -> None:
+        """
+        Waits for any queued uploads, then closes the upload sessions
+        """
+        if self.uploadQueue is None: return
+        self.waitForUploads(progress=True)
+        for dummy in self.uploadThreads:
+            self.uploadQueue.put(None)
+        for t in self.uploadThreads:
+            t.join()
+        self.uploadQueue = None
+        self.uploadThreads = None
+
     def lsdir(self) -> List[str]:
         if not self.pc.uploadDirectly: return []
         try:
@@ -1349,6 +1498,7 @@ class FTPPublisher(AbstractPublisher):
         if not self.pc.uploadDirectly: return True
         self.log("FTP chdir to %s" % newdir)
         try:
+            self.remoteDir = None
             self.socket.cwd(newdir)
             if fromroot != "": self.currentDir = fromroot
             return True
@@ -1411,6 +1561,7 @@ class FTPPublisher(AbstractPublisher):
         """
         Call when the publisher has completed to tidy up.
         """
+        self.stopUploads()
         self.closeFTPSocket()
         self.deletePublishDirectory()
         if save_log: self.saveLog()
@@ -1427,33 +1578,60 @@ class FTPPublisher(AbstractPublisher):
             # have any recently changed images
             if not self.pc.forceReupload and a.RECENTLYCHANGEDIMAGES == 0:
                 if self.existingImageList is None:
-                    self.existingImageList = self.lsdir()
-                elif imagename in self.existingImageList:
+                    self.existingImageList = set(self.lsdir() or [])
+                if imagename in self.existingImageList:
                     self.log("%s: skipping, already on server" % imagename)
                     return
-            dbfsid = self.dbo.query_int("SELECT DBFSID FROM media WHERE ID=?", [mediaid])
-            if dbfsid == 0:
+            m = self.dbo.first_row(self.dbo.query("SELECT DBFSID, Date FROM media WHERE ID=?", [mediaid]))
+            if m is None or m.DBFSID == 0:
                 self.log("%s: skipping, no DBFSID link for media id %s" % (imagename, mediaid))
                 return
             imagefile = os.path.join(self.publishDir, imagename)
             thumbnail = os.path.join(self.publishDir, "tn_" + imagename)
-            asm3.dbfs.get_file_id(self.dbo, dbfsid, imagefile)
-            self.log("Retrieved image: %d::%s::%s" % ( a["ID"], medianame, imagename ))
-            # If scaling is on, do it
-            if str(self.pc.scaleImages) in ( "2", "3", "4", "5", "6", "7" ) or str(self.pc.scaleImages).find("x") > -1:
-                self.scaleImage(imagefile, self.pc.scaleImages)
+            # The scaled image and thumbnail come from the derivative store, so
+            # images shared between animals or runs are only scaled once
+            sizespec = self.scaleSpec(self.pc.scaleImages)
+            if sizespec == "":
+                asm3.dbfs.get_file_id(self.dbo, m.DBFSID, imagefile)
+            else:
+                shutil.copyfile(asm3.imagecache.get_path(self.dbo, m.DBFSID, sizespec, m.DATE), imagefile)
+            self.log("Retrieved image: %d::%s::%s%s" % ( a["ID"], medianame, imagename, asm3.utils.iif(sizespec != "", " (%s)" % sizespec, "") ))
             # If thumbnails are on, do it
             if self.pc.thumbnails:
-                self.generateThumbnail(imagefile, thumbnail)
+                self.log("generating thumbnail %s -> %s" % ( imagefile, thumbnail ))
+                shutil.copyfile(asm3.imagecache.get_path(self.dbo, m.DBFSID, self.pc.thumbnailSize, m.DATE), thumbnail)
             # Upload
             if self.pc.uploadDirectly:
-                self.upload(imagefile)
+                self.queueUpload(imagefile)
                 if self.pc.thumbnails:
-                    self.upload(thumbnail)
+                    self.queueUpload(thumbnail)
         except Exception as err:
             self.logError("Failed uploading image %s: %s" % (medianame, err), sys.exc_info())
             return 0
 
+    def generateImages(self, a: ResultRow, uploads: List[Tuple[int, str, str]]) -> None:
+        """
+        Scales the images in uploads (a list of mediaid, medianame, imagename)
+        that uploadImage is going to upload, and their thumbnails, in one batch
+        with imagecache.generate. uploadImage then finds them in the derivative store.
+        """
+        specs = [ x for x in [ self.scaleSpec(self.pc.scaleImages), asm3.utils.iif(self.pc.thumbnails, self.pc.thumbnailSize, "") ] if x != "" ]
+        if len(specs) == 0: return
+        # Leave out images that uploadImage will skip as they are already on the server
+        if not self.pc.forceReupload and a.RECENTLYCHANGEDIMAGES == 0:
+            if self.existingImageList is None:
+                self.existingImageList = set(self.lsdir() or [])
+            uploads = [ x for x in uploads if x[2] not in self.existingImageList ]
+        mediaids = set(x[0] for x in uploads)
+        if len(mediaids) == 0: return
+        rows = self.dbo.query("SELECT DBFSID, Date FROM media WHERE ID IN (%s) AND DBFSID > 0" % ",".join(str(x) for x in mediaids))
+        try:
+            for spec in specs:
+                asm3.imagecache.generate(self.dbo, [ (r.DBFSID, r.DATE) for r in rows ], spec)
+        except Exception as err:
+            # uploadImage tries again for each image and logs any that fail
+            self.log("Failed scaling images: %s" % err)
+
     def uploadImages(self, a: ResultRow, copyWithMediaIDAsName: bool = False, limit: int = 0) -> None:
         """
         Uploads all the images for an animal as sheltercode-X.jpg if
@@ -1487,17 +1665,17 @@ class FTPPublisher(AbstractPublisher):
         # for this animal before doing anything.
         if self.pc.forceReupload or a.RECENTLYCHANGEDIMAGES > 0:
             if self.existingImageList is None:
-                self.existingImageList = self.lsdir()
-            for ei in self.existingImageList:
+                self.existingImageList = set(self.lsdir() or [])
+            for ei in sorted(self.existingImageList):
                 if ei.startswith(animalcode):
                     self.log("delete: %s" % ei)
                     self.delete(ei)
         # Save it to the publish directory
         totalimages = 1
-        self.uploadImage(a, animalwebid, animalweb, imagename)
+        uploads = [ (animalwebid, animalweb, imagename) ] # mediaid, medianame, imagename
         # If we're saving a copy with the media ID, do that too
         if copyWithMediaIDAsName:
-            self.uploadImage(a, animalwebid, animalweb, animalweb)
+            uploads.append((animalwebid, animalweb, animalweb))
         # If upload all is set, we need to grab the rest of
         # the animal's images upto the limit. If the limit is
         # zero, we upload everything.
@@ -1510,13 +1688,12 @@ class FTPPublisher(AbstractPublisher):
                     continue
                 # Have we hit our limit?
                 if totalimages == limit:
-                    return totalimages
+                    break
                 totalimages += 1
-                # Get the image
-                otherpic = m.MEDIANAME
-                otherpicid = m.ID
-                imagename = "%s-%d.jpg" % ( animalcode, totalimages )
-                self.uploadImage(a, otherpicid, otherpic, imagename)
+                uploads.append((m.ID, m.MEDIANAME, "%s-%d.jpg" % ( animalcode, totalimages )))
+        self.generateImages(a, uploads)
+        for mediaid, medianame, imagename in uploads:
+            self.uploadImage(a, mediaid, medianame, imagename)
         return totalimages
 
 
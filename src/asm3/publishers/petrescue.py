@@ -109,6 +109,10 @@ class PetRescuePublisher(AbstractPublisher):
         animals = self.getMatchingAnimals(includeAdditionalFields=True)
         processed = []
 
+        # In delta mode, only new and changed listings are sent, the full
+        # set of animals is still used to find listings to cancel
+        delta = self.getDeltaAnimals(animals)
+
         # Log that there were no animals, we still need to check
         # previously sent listings
         if len(animals) == 0:
@@ -117,11 +121,11 @@ class PetRescuePublisher(AbstractPublisher):
         headers = { "Authorization": "Token token=%s" % token, "Accept": "*/*" }
 
         anCount = 0
-        for an in animals:
+        for an in delta:
             try:
                 anCount += 1
-                self.log("Processing: %s: %s (%d of %d)" % ( an["SHELTERCODE"], an["ANIMALNAME"], anCount, len(animals)))
-                self.updatePublisherProgress(self.getProgress(anCount, len(animals)))
+                self.log("Processing: %s: %s (%d of %d)" % ( an["SHELTERCODE"], an["ANIMALNAME"], anCount, len(delta)))
+                self.updatePublisherProgress(self.getProgress(anCount, len(delta)))
 
                 # If the user cancelled, stop now
                 if self.shouldStopPublishing(): 
@@ -146,7 +150,7 @@ class PetRescuePublisher(AbstractPublisher):
                     self.markAnimalPublished(an.ID, extra = errormsg)
                 else:
                     self.log("HTTP %d, headers: %s, response: %s" % (r["status"], r["headers"], r["response"]))
-                    self.logSuccess("Processed: %s: %s (%d of %d)" % ( an["SHELTERCODE"], an["ANIMALNAME"], anCount, len(animals)))
+                    self.logSuccess("Processed: %s: %s (%d of %d)" % ( an["SHELTERCODE"], an["ANIMALNAME"], anCount, len(delta)))
                     processed.append(an)
 
             except Exception as err:
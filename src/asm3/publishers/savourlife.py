@@ -123,6 +123,10 @@ class SavourLifePublisher(AbstractPublisher):
         animals = [ x for x in preanimals if x.SPECIESID == 1 ] # We only want dogs
         processed = []
 
+        # In delta mode, only new and changed listings are sent, the full
+        # set of animals is still used to find listings to cancel
+        delta = self.getDeltaAnimals(animals)
+
         # Log that there were no animals, we still need to check
         # previously sent listings
         if len(animals) == 0:
@@ -153,11 +157,11 @@ class SavourLifePublisher(AbstractPublisher):
         """
 
         anCount = 0
-        for an in animals:
+        for an in delta:
             try:
                 anCount += 1
-                self.log("Processing: %s: %s (%d of %d)" % ( an["SHELTERCODE"], an["ANIMALNAME"], anCount, len(animals)))
-                self.updatePublisherProgress(self.getProgress(anCount, len(animals)))
+                self.log("Processing: %s: %s (%d of %d)" % ( an["SHELTERCODE"], an["ANIMALNAME"], anCount, len(delta)))
+                self.updatePublisherProgress(self.getProgress(anCount, len(delta)))
 
                 # If the user cancelled, stop now
                 if self.shouldStopPublishing(): 
@@ -180,7 +184,7 @@ class SavourLifePublisher(AbstractPublisher):
                     self.logError("HTTP %d, headers: %s, response: %s" % (r["status"], r["headers"], r["response"]))
                 else:
                     self.log("HTTP %d, headers: %s, response: %s" % (r["status"], r["headers"], r["response"]))
-                    self.logSuccess("Processed: %s: %s (%d of %d)" % ( an["SHELTERCODE"], an["ANIMALNAME"], anCount, len(animals)))
+                    self.logSuccess("Processed: %s: %s (%d of %d)" % ( an["SHELTERCODE"], an["ANIMALNAME"], anCount, len(delta)))
                     processed.append(an)
 
                     # If we didn't have a dogid, extract it from the response and store it
@@ -13,11 +13,22 @@ import asm3.template
 import asm3.users
 import asm3.utils
 from asm3.sitedefs import BASE_URL, SERVICE_URL, URL_REPORTS
-from asm3.typehints import Any, CriteriaParams, datetime, Database, List, MenuItems, PostedData, ReportParams, ResultRow, Results, Session, Tuple
+from asm3.typehints import Any, CriteriaParams, datetime, Database, Generator, List, MenuItems, PostedData, ReportParams, ResultRow, Results, Session, Tuple
+
+import itertools
 
 HEADER = 0
 FOOTER = 1
 
+# The minimum number of rows output at a time when streaming a report
+STREAM_WINDOW = 100
+
+# Stands in for rows in the footer calculations when streaming a report whose footer has no calculated fields
+NO_FIELDS = {}
+
+# Characters that denote a field token has ended
+VALID_TOKEN_END = (" ", "\n", "\r", ",", "<", ">", "&" , "[", "]", "{", "}", ".", "$", "*", ":", ";", "!", "%", "^", "(", ")", "@", "~", "/", "\\", "'", "\"", "|")
+
 RECOMMENDED_REPORTS = [
     "Active Donors", "Active Fosters", "Active Members", "Adoptions by Date with Addresses",
     "Animal Entry Reasons", "Animal Return Reasons", "Animals Inducted by Date and Species",
@@ -780,16 +791,30 @@ def execute(dbo: Database, customreportid: int, username: str = "system", params
     r.toolbar = toolbar
     return r.Execute(customreportid, username, params)
 
-def execute_query(dbo: Database, customreportid: int, username: str = "system", params: CriteriaParams = None) -> Tuple[Results, List[str]]:
+def execute_stream(dbo: Database, customreportid: int, username: str = "system", params: CriteriaParams = None, toolbar: bool = True) -> Generator[str, None, None]:
+    """
+    Executes a custom report by its ID in the same way as execute, but 
+    returns a generator that yields the HTML document in chunks as the
+    rows are read from the database instead of building it in memory.
+    Reports whose header or groups need the whole result are read in
+    full first.
+    """
+    r = Report(dbo)
+    r.toolbar = toolbar
+    return r.ExecuteStream(customreportid, username, params)
+
+def execute_query(dbo: Database, customreportid: int, username: str = "system", params: CriteriaParams = None, stream: bool = False) -> Tuple[Results, List[str]]:
     """
     Executes a custom report query by its ID. 'params' is a tuple of 
     parameters. username is the name of the user running the 
     report. See the Report._SubstituteSQLParameters function for
     more info. Return value is the list of rows from the query and
     a list of columns.
+    If stream is True, the rows are a generator that reads them from
+    the database as they are consumed.
     """
     r = Report(dbo)
-    return r.ExecuteQuery(customreportid, username, params)
+    return r.ExecuteQuery(customreportid, username, params, stream)
 
 def execute_sql(dbo: Database, title: str, sql: str, html: str, headerfooter: bool = True, username: str = "system") -> str:
     """
@@ -821,6 +846,99 @@ class GroupDescriptor:
     lastGroupStartPosition = 0
     lastGroupEndPosition = 0
 
+class FieldTemplate:
+    """
+    A block of report HTML with its $FIELD tokens located for a set of
+    columns, so that substituting a row is a single pass over the block.
+    The substitution gives the same output as calling Report._ReplaceFields
+    for every column. Where that cannot be guaranteed, legacy is set (for
+    the whole block) or render returns None (for a row) and the caller should
+    fall back to _ReplaceFields.
+    """
+    def __init__(self, html: str, columns: List[str]) -> None:
+        self.parts = [] # literal text, with a field token after each part but the last
+        self.fields = [] # the column for each field token
+        self.risky = set() # indexes into parts of literal $ that a substituted value could complete a token for
+        self.columns = [ c.lower() for c in columns ]
+        self.legacy = False
+        lc = html.lower()
+        # _ReplaceFields indexes the original with positions in the lower case copy
+        # and uses replace on the whole string, so these are only equivalent when
+        # the lengths match and no column name contains a $
+        if len(lc) != len(html) or any([ c.find("$") != -1 or len(c.lower()) != len(c) for c in columns ]):
+            self.legacy = True
+            return
+        maxlen = max([ len(c) for c in columns ], default=0)
+        # Bind each $ to the first column (in row order) that matches it
+        bound = {}
+        order = {}
+        for i, c in enumerate(self.columns): order.setdefault(c, i)
+        tok = lc.find("$")
+        while tok != -1:
+            for c in columns:
+                end = tok + 1 + len(c)
+                if lc.startswith(c.lower(), tok + 1) and lc[end:end+1] in VALID_TOKEN_END:
+                    bound[tok] = c
+                    break
+            tok = lc.find("$", tok + 1)
+        last = 0
+        positions = sorted(bound.keys())
+        for i, tok in enumerate(positions):
+            c = bound[tok]
+            end = tok + 1 + len(c)
+            # A token ended by a $ that an earlier column replaces is ended by that
+            # column's value instead, and the same token repeated straight after 
+            # overlaps itself in the replace
+            if end in bound and (bound[end] == c or order[bound[end].lower()] < order[c.lower()]):
+                self.legacy = True
+                return
+            # Another column that continues past this token into the value of 
+            # the next would match once that value has been substituted
+            if i + 1 < len(positions) and lc.find("$", tok + 1) == positions[i+1]:
+                lit = lc[tok+1:positions[i+1]]
+                if any([ x.startswith(lit) and len(x) > len(lit) for x in self.columns ]):
+                    self.legacy = True
+                    return
+            self.parts.append(html[last:tok])
+            self.fields.append(c)
+            last = end
+        self.parts.append(html[last:])
+        # Unbound $ that are close enough to a token for its value to complete
+        # another column name after substitution
+        for i, part in enumerate(self.parts[:-1]):
+            d = part.rfind("$")
+            if d != -1 and len(part) - d - 1 < maxlen:
+                self.risky.add(i)
+
+    def render(self, row: ResultRow, display: Any) -> str:
+        """
+        Substitutes the values from row into the block.
+        display is a function(k, v) that returns the display value for a field.
+        Returns None if the result might differ from _ReplaceFields for this row.
+        """
+        out = []
+        values = {}
+        riskat = [] # positions of risky $ in the output
+        pos = 0
+        for i, f in enumerate(self.fields):
+            if f not in values:
+                v = display(f, row[f])
+                if len(v.lower()) != len(v): return None
+                values[f] = v.replace("{", "&#123;").replace("}", "&#125;").replace("$", "&#36;")
+            part = self.parts[i]
+            if i in self.risky: riskat.append(pos + part.rfind("$"))
+            out.append(part)
+            out.append(values[f])
+            pos += len(part) + len(values[f])
+        out.append(self.parts[-1])
+        s = "".join(out)
+        if len(riskat) > 0:
+            lc = s.lower()
+            for r in riskat:
+                for c in self.columns:
+                    if lc.startswith(c, r + 1): return None
+        return s
+
 class Report:
     dbo = None
     user = ""
@@ -836,10 +954,27 @@ class Report:
     omitHeaderFooter = False
     isSubReport = False
     toolbar = False
-    output = ""
+    buffer = None
+    templates = None
     
     def __init__(self, dbo: Database):
         self.dbo = dbo
+        self.buffer = []
+        self.templates = {}
+
+    @property
+    def output(self) -> str:
+        """
+        The report output so far. Appended text is held in a list
+        and only joined when it is read.
+        """
+        if len(self.buffer) != 1:
+            self.buffer = [ "".join(self.buffer) ]
+        return self.buffer[0]
+
+    @output.setter
+    def output(self, s: str) -> None:
+        self.buffer = [ s ]
 
     def _ReadReport(self, reportId: int) -> bool:
         """
@@ -901,9 +1036,8 @@ class Report:
             s = self._SubstituteTemplateHeaderFooter(s)
             return s
 
-    def _Append(self, s: str) -> str:
-        self.output += str(s)
-        return self.output
+    def _Append(self, s: str) -> None:
+        self.buffer.append(str(s))
 
     def _p(self, s: str) -> str:
         self._Append("<p>%s</p>" % s)
@@ -918,13 +1052,11 @@ class Report:
         up the parser after substitution.
         s is the html string, k is the fieldname, v is the value
         """
-        # Characters that denote a field token has ended
-        validend = (" ", "\n", "\r", ",", "<", ">", "&" , "[", "]", "{", "}", ".", "$", "*", ":", ";", "!", "%", "^", "(", ")", "@", "~", "/", "\\", "'", "\"", "|")
         lc = s.lower()
         tok = lc.find("$")
         while tok != -1:
             aftertok = lc[tok+1+len(k):tok+1+len(k)+1]
-            if lc[tok+1:tok+1+len(k)] == k.lower() and aftertok in validend:
+            if lc[tok+1:tok+1+len(k)] == k.lower() and aftertok in VALID_TOKEN_END:
                 foundtok = s[tok+1:tok+1+len(k)]
                 v = v.replace("{", "&#123;").replace("}", "&#125;")
                 v = v.replace("$", "&#36;")
@@ -932,6 +1064,25 @@ class Report:
                 lc = s.lower()
             tok = lc.find("$", tok+1) 
         return s
+
+    def _ReplaceRowFields(self, s: str, row: ResultRow) -> str:
+        """
+        Replaces the field tokens in HTML s for all the fields in row. 
+        The block is compiled into a FieldTemplate the first time it is
+        seen with this set of columns.
+        """
+        columns = row.keys()
+        key = (s, tuple(columns))
+        t = self.templates.get(key)
+        if t is None:
+            t = FieldTemplate(s, columns)
+            self.templates[key] = t
+        if not t.legacy:
+            out = t.render(row, self._DisplayValue)
+            if out is not None: return out
+        for k, v in row.items():
+            s = self._ReplaceFields(s, k, self._DisplayValue(k, v))
+        return s
         
     def _DisplayValue(self, k: str, v: Any) -> str:
         """
@@ -972,8 +1123,7 @@ class Report:
 
         # Replace any fields in the block based on the last row
         # in the group
-        for k, v in rs[gd.lastGroupEndPosition].items():
-            out = self._ReplaceFields(out, k, self._DisplayValue(k, v))
+        out = self._ReplaceRowFields(out, rs[gd.lastGroupEndPosition])
 
         # Replace any of our special header/footer tokens
         out = self._SubstituteTemplateHeaderFooter(out)
@@ -1579,10 +1729,50 @@ class Report:
 
         return self.output
 
-    def ExecuteQuery(self, reportId: int = 0, username: str = "system", params: CriteriaParams = None) -> Tuple[Results, List[str]]:
+    def ExecuteStream(self, reportId: int = 0, username: str = "system", params: CriteriaParams = None) -> Generator[str, None, None]:
+        """
+        Executes a report in the same way as Execute, but returns a generator
+        that yields the HTML output in chunks as the rows are read. 
+        The report is read and validated before returning, so errors
+        are raised here rather than part way through the output.
+        """
+        self.user = username
+        self.params = params
+        self.output = ""
+
+        # Attempt to read our report if an ID was specified
+        if reportId != 0: 
+            if not self._ReadReport(reportId):
+                raise asm3.utils.ASMValidationError("Report %s does not exist." % reportId)
+
+        # Substitute our parameters in the SQL
+        self._SubstituteSQLParameters(params)
+
+        # Make sure the report query is valid
+        if not is_valid_query(self.sql):
+            raise asm3.utils.ASMValidationError("Reports must be based on a SELECT query.")
+
+        if self.html.upper().startswith("GRAPH"):
+            return iter([ self._GenerateGraph() ])
+        elif self.html.upper().startswith("MAP"):
+            return iter([ self._GenerateMap() ])
+        return self._StreamReport()
+
+    def _StreamReport(self) -> Generator[str, None, None]:
+        """
+        Yields the output of the report as it is generated
+        """
+        for dummy in self._GenerateReportChunks(stream=True):
+            if self.output != "": yield self.output
+            self.output = ""
+        if self.output != "": yield self.output
+        self.output = ""
+
+    def ExecuteQuery(self, reportId: int = 0, username: str = "system", params: CriteriaParams = None, stream: bool = False) -> Tuple[Results, List[str]]:
         """
         Executes the query portion of a report only and then returns
         the query results and column order.
+        If stream is True, the results are a generator from query_generator
         If the query fails to execute
         """
         self.user = username
@@ -1605,8 +1795,20 @@ class Report:
         rs = None
         cols = None
         try:
-            rs = self.dbo.query(self.sql)
-            cols = self.dbo.query_columns(self.sql)
+            if stream:
+                # Read the first row now so that a bad query fails here rather
+                # than part way through the response, and take the columns from it
+                rs = self.dbo.query_generator(self.sql)
+                first = next(rs, None)
+                if first is None:
+                    cols = self.dbo.query_columns(self.sql)
+                    rs = iter([])
+                else:
+                    cols = first.keys()
+                    rs = itertools.chain([ first ], rs)
+            else:
+                rs = self.dbo.query(self.sql)
+                cols = self.dbo.query_columns(self.sql)
         except Exception as e:
             self._p(e)
             raise asm3.utils.ASMError(str(e))
@@ -1835,6 +2037,15 @@ class Report:
         """
         Does the work of generating the report content, building self.output
         """
+        for dummy in self._GenerateReportChunks(): pass
+
+    def _GenerateReportChunks(self, stream: bool = False) -> Generator[None, None, None]:
+        """
+        Generates the report content into self.output.
+        If stream is True, the rows are read with query_generator and output
+        in windows, yielding after the header and each window so that the
+        caller can send and clear self.output.
+        """
 
         # String indexes within report html string to where 
         # tokens begin and end
@@ -1847,7 +2058,6 @@ class Report:
         groupstart = 0
         groupend = 0
 
-        tempbody = ""
         cheader = ""
         cbody = ""
         cfooter = ""
@@ -1965,15 +2175,20 @@ class Report:
         # run that process to make sure the data is upto date.
         self.UpdateTables()
 
-        # Run the query
+        # Run the query. When streaming, only the first row is read here
         rs = None
+        rows = None
         try:
-            rs = self.dbo.query(self.sql)
+            if stream:
+                rows = self.dbo.query_generator(self.sql)
+                first = next(rows, None)
+                rs = []
+                if first is not None: rs.append(first)
+            else:
+                rs = self.dbo.query_view(self.sql)
         except Exception as e:
             self._p(e)
 
-        first_record = True
-
         # If there are no records, show a message to say so
         # but only if it's not a subreport
         if rs is None or len(rs) == 0:
@@ -1987,8 +2202,111 @@ class Report:
                 self._Append(nodata)
             return
 
-        # Add the header to the report
+        footerfields = self._CalculatedFields(cfooter)
+        if rows is not None and not self._IsStreamable(cheader, footerfields, groups, rs[0]):
+            # The report header or a group needs the whole result, read it all
+            asm3.al.debug("report '%s' cannot be streamed, reading all rows" % self.title, "reports._GenerateReport", self.dbo)
+            rs.extend(rows)
+            rows = None
+
+        if rows is None:
+            # Add the header to the report
+            self._SubstituteHeaderFooter(HEADER, cheader, rs)
+
+            # Construct our report
+            if not self._OutputRows(rs, groups, cbody): return
+
+            # And the report footer
+            self._SubstituteHeaderFooter(FOOTER, cfooter, rs)
+
+            # HTML footer to finish 
+            self._Append(htmlfooter)
+            return
+
+        # Streaming, the header does not use any rows
         self._SubstituteHeaderFooter(HEADER, cheader, rs)
+        yield
+
+        # Output the rows in windows of at least STREAM_WINDOW rows, only breaking
+        # between groups. The footer only needs the first and last rows in full, 
+        # the others are cut down to the fields it calculates with.
+        window = []
+        footrows = []
+        for r in itertools.chain(rs, rows):
+            if len(window) >= STREAM_WINDOW and self._IsWindowBreak(groups, window[-1], r):
+                if not self._OutputRows(window, groups, cbody): return
+                yield
+                window = []
+            window.append(r)
+            if len(footrows) == 0:
+                footrows.append(r)
+            elif len(footerfields) == 0:
+                footrows.append(NO_FIELDS)
+            else:
+                footrows.append({ f: r[f] for f in footerfields if f in r })
+        if not self._OutputRows(window, groups, cbody): return
+        footrows[-1] = window[-1]
+        self._SubstituteHeaderFooter(FOOTER, cfooter, footrows)
+        self._Append(htmlfooter)
+
+    def _CalculatedFields(self, block: str) -> List[str]:
+        """
+        Returns the set of fields used by calculation keys in a header/footer 
+        block, eg: {SUM.FIELD}. Returns None if the keys cannot be known
+        before the block is output (they contain field tokens or SQL/subreport
+        keys whose output could contain further keys).
+        """
+        s = self._SubstituteTemplateHeaderFooter(block)
+        fields = set()
+        startkey = s.find("{")
+        while startkey != -1:
+            endkey = s.find("}", startkey)
+            if endkey == -1: endkey = len(s)-1
+            key = s[startkey+1:endkey].lower()
+            if key.find("$") != -1 or key.startswith("sql.") or key.startswith("subreport."): return None
+            fields.add(key.split(".")[1].upper() if key.find(".") != -1 else "")
+            startkey = s.find("{", startkey+1)
+        fields.discard("")
+        return list(fields)
+
+    def _IsStreamable(self, cheader: str, footerfields: List[str], groups: List[GroupDescriptor], first: ResultRow) -> bool:
+        """
+        Returns True if the report can be output as the rows are read.
+        The header is output before any rows, so it cannot contain field 
+        tokens or keys. The footer needs to know its calculated fields
+        and group blocks cannot use the total row count (PCTG).
+        """
+        if footerfields is None: return False
+        t = FieldTemplate(cheader, first.keys())
+        if t.legacy or len(t.fields) > 0: return False
+        if self._SubstituteTemplateHeaderFooter(cheader).find("{") != -1: return False
+        for gd in groups:
+            if (gd.header + gd.footer).lower().find("{pctg.") != -1: return False
+        return True
+
+    def _IsWindowBreak(self, groups: List[GroupDescriptor], prev: ResultRow, row: ResultRow) -> bool:
+        """
+        Returns True if a window of rows being streamed can end between prev 
+        and row. That is when the outer group changes and the end of 
+        every group found when outputting its header is no later than prev.
+        """
+        prevgroup = ""
+        for gd in groups:
+            if gd.fieldName not in row or (prevgroup != "" and prevgroup not in row): return True
+            if prevgroup == "":
+                if prev[gd.fieldName] == row[gd.fieldName]: return False
+            elif prev[gd.fieldName] == row[gd.fieldName] and (prev[prevgroup] == "" or prev[prevgroup] == row[prevgroup]):
+                return False
+            prevgroup = gd.fieldName
+        return True
+
+    def _OutputRows(self, rs: Results, groups: List[GroupDescriptor], cbody: str) -> bool:
+        """
+        Outputs the body block for each row in rs, with the group headers
+        and footers around them. Returns False if the report could not be 
+        constructed.
+        """
+        first_record = True
 
         # Construct our report
         for row in range(0, len(rs)):
@@ -2007,7 +2325,7 @@ class Report:
                     # Check the group field exists
                     if gd.fieldName not in rs[row]:
                         self._p("Cannot construct group, field '%s' does not exist" % gd.fieldName)
-                        return
+                        return False
                     if cascade or gd.lastFieldValue != rs[row][gd.fieldName]:
                         # Mark this one for update
                         gd.forceFinish = True
@@ -2033,7 +2351,7 @@ class Report:
                     # Check the group field exists
                     if gd.fieldName not in rs[row]:
                         self._p("Cannot construct group, field '%s' does not exist" % gd.fieldName)
-                        return
+                        return False
                     # Find the end position of the group so that calculations work in headers. 
                     # Also tracks the previous group changing to mark the end if this is a 2nd level group.
                     groupval = rs[row][gd.fieldName]
@@ -2055,9 +2373,7 @@ class Report:
 
             # Make a temp string to hold the body block 
             # while we substitute fields for tags
-            tempbody = cbody
-            for k, v in rs[row].items():
-                tempbody = self._ReplaceFields(tempbody, k, self._DisplayValue(k, v))
+            tempbody = self._ReplaceRowFields(cbody, rs[row])
 
             # Update the last value for each group
             for gd in groups:
@@ -2203,10 +2519,5 @@ class Report:
         for gd in reversed(groups):
             gd.lastGroupEndPosition = row
             self._OutputGroupBlock(gd, FOOTER, rs)
-
-        # And the report footer
-        self._SubstituteHeaderFooter(FOOTER, cfooter, rs)
-
-        # HTML footer to finish 
-        self._Append(htmlfooter)
+        return True
 
@@ -549,7 +549,8 @@ def handler(post: PostedData, path: str, remoteip: str, referer: str, useragent:
             return ("text/plain", 0, 0, "ERROR: Invalid animalid")
         else:
             dummy, data = asm3.media.get_image_file_data(dbo, "animal", asm3.utils.cint(animalid), seq)
-            if data == "NOPIC": dummy, data = asm3.media.get_image_file_data(dbo, "nopic", 0)
+            if data == b"NOPIC": dummy, data = asm3.media.get_image_file_data(dbo, "nopic", 0)
+            # Full size images are read from dbfs, so they are cached like media_image
             return set_cached_response(cache_key, account, "image/jpeg", 86400, 3600, data)
 
     elif method =="animal_thumbnail":
@@ -558,8 +559,9 @@ def handler(post: PostedData, path: str, remoteip: str, referer: str, useragent:
             return ("text/plain", 0, 0, "ERROR: Invalid animalid")
         else:
             dummy, data = asm3.media.get_image_file_data(dbo, "animalthumb", asm3.utils.cint(animalid), seq)
-            if data == "NOPIC": dummy, data = asm3.media.get_image_file_data(dbo, "nopic", 0)
-            return set_cached_response(cache_key, account, "image/jpeg", 86400, 3600, data)
+            if data == b"NOPIC": dummy, data = asm3.media.get_image_file_data(dbo, "nopic", 0)
+            # Not put in the response cache as thumbnails come from the derivative store
+            return ("image/jpeg", 86400, 3600, data)
 
     elif method == "animal_view":
         if asm3.utils.cint(animalid) == 0:
@@ -635,6 +637,8 @@ def handler(post: PostedData, path: str, remoteip: str, referer: str, useragent:
 
     elif method == "media_image":
         hotlink_protect("media_image", referer)
+        # Originals are not kept in the derivative store (see imagecache), so
+        # full size images are cached as responses like animal_image
         lastmodified, medianame, mimetype, filedata = asm3.media.get_media_file_data(dbo, mediaid)
         if medianame == "": return ("text/plain", 0, 0, "ERROR: Invalid mediaid")
         return set_cached_response(cache_key, account, mimetype, 86400, 86400, filedata)
@@ -861,17 +865,25 @@ def handler(post: PostedData, path: str, remoteip: str, referer: str, useragent:
         asm3.users.check_permission_map(l, user.SUPERUSER, securitymap, asm3.users.VIEW_REPORT)
         crid = asm3.reports.get_id(dbo, title)
         p = asm3.reports.get_criteria_params(dbo, crid, post)
-        rhtml = asm3.reports.execute(dbo, crid, username, p, toolbar=False)
-        rhtml = asm3.utils.fix_relative_document_uris(dbo, rhtml)
-        return set_cached_response(cache_key, account, "text/html", 600, 600, rhtml)
+        if CACHE_SERVICE_RESPONSES:
+            rhtml = asm3.reports.execute(dbo, crid, username, p, toolbar=False)
+            rhtml = asm3.utils.fix_relative_document_uris(dbo, rhtml)
+            return set_cached_response(cache_key, account, "text/html", 600, 600, rhtml)
+        # Without the server cache, output is streamed as it is generated
+        chunks = asm3.reports.execute_stream(dbo, crid, username, p, toolbar=False)
+        return ("text/html", 600, 600, ( asm3.utils.fix_relative_document_uris(dbo, x) for x in chunks ))
 
     elif method == "csv_mail" or method == "csv_report":
         asm3.users.check_permission_map(l, user.SUPERUSER, securitymap, asm3.users.VIEW_REPORT)
         crid = asm3.reports.get_id(dbo, title)
         p = asm3.reports.get_criteria_params(dbo, crid, post)
-        rows, cols = asm3.reports.execute_query(dbo, crid, username, p)
-        mcsv = asm3.utils.csv(l, rows, cols, True)
-        return set_cached_response(cache_key, account, "text/csv", 600, 600, mcsv)
+        if CACHE_SERVICE_RESPONSES:
+            rows, cols = asm3.reports.execute_query(dbo, crid, username, p)
+            mcsv = asm3.utils.csv(l, rows, cols, True)
+            return set_cached_response(cache_key, account, "text/csv", 600, 600, mcsv)
+        # Without the server cache, rows are streamed from the database
+        rows, cols = asm3.reports.execute_query(dbo, crid, username, p, stream=True)
+        return ("text/csv", 600, 600, asm3.utils.csv_generator(l, rows, cols, True))
 
     elif method == "json_report" or method == "json_mail":
         asm3.users.check_permission_map(l, user.SUPERUSER, securitymap, asm3.users.VIEW_REPORT)
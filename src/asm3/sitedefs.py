@@ -125,6 +125,19 @@ DB_TIME_LOG_OVER = get_integer("db_time_log_over", 0)
 # Time out queries that take longer than this (ms) to run
 DB_TIMEOUT = get_integer("db_timeout", 0)
 
+# Connection pooling. If DB_POOL_MAX_SIZE is more than zero, each process
+# keeps a pool of open connections for each database it talks to rather
+# than connecting for every query. 
+DB_POOL_MAX_SIZE = get_integer("db_pool_max_size", 0)      # Most connections to keep per database (0 disables pooling)
+DB_POOL_MIN_SIZE = get_integer("db_pool_min_size", 0)      # Connections to open when the pool is created and never evict
+DB_POOL_IDLE_TIMEOUT = get_integer("db_pool_idle_timeout", 300) # Close connections that have been unused for this many seconds
+DB_POOL_CHECK_AFTER = get_integer("db_pool_check_after", 30)    # Test connections unused for this many seconds before reuse
+DB_POOL_WAIT_TIMEOUT = get_integer("db_pool_wait_timeout", 5)   # Wait this many seconds for a connection when the pool is full
+
+# Number of rows at a time fetched by Database.query_generator, which
+# uses server side cursors on PostgreSQL and MySQL to stream large results
+DB_STREAM_BATCH_SIZE = get_integer("db_stream_batch_size", 1000)
+
 # URLs for ASM services
 URL_NEWS = get_string("url_news", "https://sheltermanager.com/repo/asm_news.html")
 URL_REPORTS = get_string("url_reports", "https://sheltermanager.com/repo/reports.txt")
@@ -192,6 +205,10 @@ DBFS_S3_BACKUP_ENDPOINT_URL = get_string("dbfs_s3_backup_endpoint_url", "")
 # as the application will not attempt to create it.
 DISK_CACHE = get_string("disk_cache", "/tmp/asm_disk_cache")
 
+# The most space (in MB) the disk cache for each database can use before the
+# least recently used entries are evicted (0 for no limit)
+DISK_CACHE_MAX_SIZE = get_integer("disk_cache_max_size", 256)
+
 # Allow some non-critical queries to be cached for short periods in the 
 # disk cache to help with performance. The majority of these are queries for
 # to populate the home page so that it can load quickly. 
@@ -201,6 +218,16 @@ CACHE_COMMON_QUERIES = get_boolean("cache_common_queries", False)
 # to their max-age headers in the disk cache
 CACHE_SERVICE_RESPONSES = get_boolean("cache_service_responses", False)
 
+# Keep an in memory index of the image media for each record so that
+# image and thumbnail requests do not query the database every time. 
+# Entries last this many seconds (0 to disable the index). Changes made
+# by other processes can take this long to show up.
+MEDIA_INDEX_TTL = get_integer("media_index_ttl", 0)
+
+# The number of processes to use when generating several scaled copies of
+# images at once for the derivative store (0 = scale in the calling process)
+IMAGE_DERIVATIVE_WORKERS = get_integer("image_derivative_workers", 0)
+
 # If EMAIL_ERRORS is set to True, all errors from the site
 # are emailed to ADMIN_EMAIL and the user is given a generic
 # error page. If set to False, debug information is output.
@@ -263,12 +290,39 @@ MULTIPLE_DATABASES_TYPE = get_string("multiple_databases_type", "map")
 # { "alias": { "dbtype": "MYSQL", "host": "localhost", "port": 3306, "username": "root", "password": "root", "database": "asm" } }
 MULTIPLE_DATABASES_MAP = get_dict("multiple_databases_map")
 
+# When cron.py runs a task for every database in the map, run it for this
+# many databases at once in separate processes (0 or 1 runs them one at a time).
+# A database's process is stopped if it takes longer than the timeout (seconds,
+# 0 for no limit) and databases that fail or time out are retried this many times.
+CRON_WORKERS = get_integer("cron_workers", 0)
+CRON_DATABASE_TIMEOUT = get_integer("cron_database_timeout", 0)
+CRON_RETRIES = get_integer("cron_retries", 0)
+
+# The number of tasks in the daily batch that can run at once for each
+# database. Tasks that do not share tables run side by side, each on its
+# own database connection (1 runs them one at a time, as does SQLite).
+CRON_DAILY_WORKERS = get_integer("cron_daily_workers", 1)
+
+# The number of rows of a CSV import to commit together in one transaction
+# (1 commits every statement as it runs)
+CSV_IMPORT_BATCH_SIZE = get_integer("csv_import_batch_size", 100)
+
+# The number of threads fetching remote image and document URLs ahead of the
+# rows of a CSV import (0 fetches each one when its row is imported) and
+# how many of them can fetch from the same server at once
+CSV_IMPORT_FETCH_WORKERS = get_integer("csv_import_fetch_workers", 4)
+CSV_IMPORT_FETCH_PER_HOST = get_integer("csv_import_fetch_per_host", 2)
+
 # Whether the old HTML/FTP publisher of static files is enabled
 HTMLFTP_PUBLISHER_ENABLED = get_boolean("htmlftp_publisher_enabled", True)
 
 # FTP connection timeout value in seconds
 FTP_CONNECTION_TIMEOUT = get_integer("ftp_connection_timeout", 60)
 
+# The number of FTP sessions publishers use to upload images at the
+# same time (1 uploads images one at a time on the main session)
+FTP_UPLOAD_SESSIONS = get_integer("ftp_upload_sessions", 1)
+
 # FTP hosts and URLs for third party publishing services
 ADOPTAPET_FTP_HOST = get_string("adoptapet_ftp_host", "autoupload.adoptapet.com")
 AKC_REUNITE_BASE_URL = get_string("akc_reunite_base_url", "")
@@ -349,6 +403,16 @@ SMTP_SERVER = get_dict("smtp_server", { "sendmail": True })
 # {alias} database alias
 FROM_ADDRESS = get_string("from_address", "you@yourdomain.com")
 
+# A directory to queue outgoing bulk, automated and diary emails in, so
+# they are sent by a background worker instead of the calling request or
+# task. The directory is created if it does not exist. "" sends them
+# immediately.
+MAIL_QUEUE = get_string("mail_queue", "")
+
+# The most messages per minute the mail queue worker will send to
+# each SMTP server (0 for no limit)
+MAIL_QUEUE_RATE_LIMIT = get_integer("mail_queue_rate_limit", 0)
+
 # URLs to access manuals and help documentation
 MANUAL_HTML_URL = get_string("manual_html_url", "static/pages/manual/index.html")
 MANUAL_FAQ_URL = get_string("manual_faq_url", "static/pages/manual/faq.html")
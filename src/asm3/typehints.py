@@ -34,6 +34,7 @@ Generator = typing.Generator
 List = typing.List
 Dict = typing.Dict
 Optional = typing.Optional
+Set = typing.Set
 Tuple = typing.Tuple
 Union = typing.Union
 
@@ -3,9 +3,10 @@ import asm3.al
 import asm3.cachemem
 import asm3.configuration
 import asm3.i18n
+import asm3.mailqueue
 import asm3.users
 
-from asm3.sitedefs import ADMIN_EMAIL, BASE_URL, DISK_CACHE, MULTIPLE_DATABASES, SERVICE_URL, SMTP_SERVER, FROM_ADDRESS, HTML_TO_PDF, URL_NEWS
+from asm3.sitedefs import ADMIN_EMAIL, BASE_URL, DISK_CACHE, MAIL_QUEUE, MULTIPLE_DATABASES, SERVICE_URL, SMTP_SERVER, FROM_ADDRESS, HTML_TO_PDF, URL_NEWS
 from asm3.typehints import bytes_or_str, Any, Callable, Database, Dict, Generator, List, Results, Tuple, Union
 
 import web062 as web
@@ -15,6 +16,7 @@ import datetime
 import decimal
 import hashlib
 import hmac
+import itertools
 import json as extjson
 import os
 import random
@@ -606,6 +608,8 @@ def json_handler(obj: Any) -> str:
     """
     if obj is None:
         return "null"
+    elif hasattr(obj, "todict"):
+        return obj.todict()
     elif hasattr(obj, "isoformat"):
         return obj.isoformat()
     elif isinstance(obj, datetime.timedelta):
@@ -1037,7 +1041,7 @@ def csv_generator(l: str, rows: Results, cols: List[str] = None, includeheader:
     The file is returned as unicode. It is upto the caller to encode data appropriately. 
     If this generator function is the return value from an endpoint, web.py will handle encoding as utf-8.
     l:  locale (used for formatting currencies and dates)
-    rows: list of dict result rows
+    rows: list of dict result rows, or a generator of them such as Database.query_generator
     cols: list of column headings, if None uses the result column names
     includeheader: if True writes the header row
     titlecaseheader: if True title cases the header row
@@ -1050,9 +1054,17 @@ def csv_generator(l: str, rows: Results, cols: List[str] = None, includeheader:
         for r in row:
             line.append("\"%s\"" % r)
         return ",".join(line) + "\n"
+    # rows can be a generator, so take the first one for the columns
+    # and put it back in front of the others
+    rows = iter(rows)
+    first = next(rows, None)
+    if first is not None:
+        rows = itertools.chain([ first ], rows)
+    elif cols is None:
+        return # no rows and no columns to write a header for
     if cols is None:
         cols = []
-        for k in rows[0].keys():
+        for k in first.keys():
             cols.append(k)
         cols = sorted(cols)
     if includeheader:
@@ -1878,7 +1890,7 @@ def send_email(dbo: Database, replyadd: str, toadd: str, ccadd: str = "", bccadd
                subject: str = "", body: str = "", contenttype: str = "plain", 
                attachments: List[Tuple[str, str, bytes]] = [], 
                exceptions: bool = True, bulk: bool = False, 
-               fromoverride: bool = True, retries: int = 1) -> bool:
+               fromoverride: bool = True, retries: int = 1, queue: bool = False) -> bool:
     """
     Sends an email.
     replyadd is a single email address and controls the Reply-To header
@@ -1898,6 +1910,9 @@ def send_email(dbo: Database, replyadd: str, toadd: str, ccadd: str = "", bccadd
           (useful if the reply address is going to be one you don't own)
     retries: If >1, the number of times to wait and retry if an 
           SMTP error occurs (incompatible with exceptions = True)
+    queue: If True, add the message to the mail queue (if the mail_queue
+          sitedef is set) so that the caller does not wait for it to be sent.
+          Failures are then retried and logged by the queue.
 
     returns True on success
 
@@ -2045,55 +2060,83 @@ def send_email(dbo: Database, replyadd: str, toadd: str, ccadd: str = "", bccadd
     asm3.al.debug("from: %s, reply-to: %s, to: %s, subject: %s, body: %s" % \
         (fromadd, replyadd, str(tolist), subject, body), "utils.send_email", dbo)
 
-    _send_email(msg, fromadd, tolist, dbo, exceptions=exceptions, retries=retries)
+    return _send_email(msg, fromadd, tolist, dbo, exceptions=exceptions, retries=retries, queue=queue)
+
+def get_smtp_transport(dbo: Database = None) -> Dict:
+    """
+    Returns the settings for sending email as a dictionary with sendmail, 
+    host, port, username, password and usetls keys. 
+    These come from the smtp_server sitedef unless dbo is given and has
+    an SMTP override configured.
+    """
+    t = { "sendmail": True, "host": "", "port": 25, "username": "", "password": "", "usetls": False }
+    if SMTP_SERVER is not None:
+        for k in t.keys():
+            if k in SMTP_SERVER: t[k] = SMTP_SERVER[k]
+    if dbo and asm3.configuration.smtp_override(dbo):
+        t["sendmail"] = False
+        t["host"] = asm3.configuration.smtp_server(dbo)
+        t["port"] = asm3.utils.cint(asm3.configuration.smtp_port(dbo))
+        t["usetls"] = asm3.configuration.smtp_use_tls(dbo)
+        t["username"] = asm3.configuration.smtp_username(dbo)
+        t["password"] = asm3.configuration.smtp_password(dbo)
+    return t
+
+def smtp_connect(transport: Dict) -> smtplib.SMTP:
+    """
+    Opens an SMTP session with the server in transport (from get_smtp_transport)
+    """
+    smtp = smtplib.SMTP(transport["host"], transport["port"])
+    if transport["usetls"]:
+        smtp.starttls()
+    if transport["password"].strip() != "":
+        smtp.login(transport["username"], transport["password"])
+    return smtp
+
+def sendmail(msg: str) -> None:
+    """
+    Sends the message string msg with the local sendmail binary.
+    Raises an exception if it fails.
+    """
+    p = subprocess.Popen(["/usr/sbin/sendmail", "-t", "-oi"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdoutdata, stderrdata = p.communicate(str2bytes(msg))
+    if p.returncode != 0: raise Exception("%s %s" % (stdoutdata, stderrdata))
 
 def _send_email(msg: MIMEMultipart, fromadd: str, tolist: List[str], dbo: Database = None, 
-                exceptions: bool = True, retries: int = 1) -> bool:
+                exceptions: bool = True, retries: int = 1, queue: bool = False) -> bool:
     """
     Internal function to handle the final transmission of an email message.
     msg: The python message object
     fromadd: The envelope sender address for the SMTP server (not used by sendmail)
     tolist: A list of recipient addresses [ "add1@test.com", "add2@test.com" ... ]
-    dbo can be None, is only used for logging
+    dbo can be None, is only used for logging and the SMTP override
     exceptions: If True throws exceptions on error, otherwise returns success boolean
     retries: If >1, waits RETRY_SECS seconds and retries this many times in the 
              event of an error (SMTP only, exceptions must be False)
              Since _send_email is synchronous/blocking, never set retries from UI calls
+    queue: If True and the mail_queue sitedef is set, adds the message to the
+           mail queue to be sent (and retried) in the background instead.
+           If retries is >1, the queue gives up after that many attempts. 
+           If the message cannot be queued, it is sent straight away.
     """
-    # Load the server config over default vars
     RETRY_SECS = 10
-    sendmail = True
-    host = ""
-    port = 25
-    username = ""
-    password = ""
-    usetls = False
-    if SMTP_SERVER is not None:
-        if "sendmail" in SMTP_SERVER: sendmail = SMTP_SERVER["sendmail"]
-        if "host" in SMTP_SERVER: host = SMTP_SERVER["host"]
-        if "port" in SMTP_SERVER: port = SMTP_SERVER["port"]
-        if "username" in SMTP_SERVER: username = SMTP_SERVER["username"]
-        if "password" in SMTP_SERVER: password = SMTP_SERVER["password"]
-        if "usetls" in SMTP_SERVER: usetls = SMTP_SERVER["usetls"]
-        if "headers" in SMTP_SERVER: 
-            for k, v in SMTP_SERVER["headers"].items():
-                msg[k] = Header(v)
-
-    # If we have a dbo and there's an smtp override in the database, use it
-    if dbo and asm3.configuration.smtp_override(dbo):
-        sendmail = False
-        host = asm3.configuration.smtp_server(dbo)
-        port = asm3.utils.cint(asm3.configuration.smtp_port(dbo))
-        usetls = asm3.configuration.smtp_use_tls(dbo)
-        username = asm3.configuration.smtp_username(dbo)
-        password = asm3.configuration.smtp_password(dbo)
+    transport = get_smtp_transport(dbo)
+    if SMTP_SERVER is not None and "headers" in SMTP_SERVER:
+        for k, v in SMTP_SERVER["headers"].items():
+            msg[k] = Header(v)
+
+    if queue and MAIL_QUEUE != "":
+        try:
+            asm3.mailqueue.enqueue(msg.as_string(), fromadd, tolist, transport, dbo and dbo.name() or "", iif(retries > 1, retries - 1, None))
+            asm3.mailqueue.start_worker()
+            return True
+        except Exception as err:
+            asm3.al.error("mailqueue: %s, sending directly" % str(err), "utils.send_email", dbo)
      
     # Use sendmail or SMTP for the transport depending on config
-    if sendmail:
+    if transport["sendmail"]:
         try:
-            p = subprocess.Popen(["/usr/sbin/sendmail", "-t", "-oi"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            stdoutdata, stderrdata = p.communicate(str2bytes(msg.as_string()))
-            if p.returncode != 0: raise Exception("%s %s" % (stdoutdata, stderrdata))
+            sendmail(msg.as_string())
             return True
         except Exception as err:
             asm3.al.error("sendmail: %s" % str(err), "utils.send_email", dbo)
@@ -2101,12 +2144,9 @@ def _send_email(msg: MIMEMultipart, fromadd: str, tolist: List[str], dbo: Databa
             return False
     else:
         try:
-            smtp = smtplib.SMTP(host, port)
-            if usetls:
-                smtp.starttls()
-            if password.strip() != "":
-                smtp.login(username, password)
+            smtp = smtp_connect(transport)
             smtp.sendmail(fromadd, tolist, msg.as_string())
+            smtp.quit()
             return True
         except Exception as err:
             asm3.al.error("smtp: %s" % str(err), "utils.send_email", dbo)
@@ -2114,7 +2154,7 @@ def _send_email(msg: MIMEMultipart, fromadd: str, tolist: List[str], dbo: Databa
             if retries == 1: return False # Last attempt, quit
             # Wait 10 seconds and try again until retries is exhausted
             time.sleep(RETRY_SECS)
-            _send_email(msg, fromadd, tolist, dbo=dbo, exceptions=exceptions, retries=retries-1)
+            return _send_email(msg, fromadd, tolist, dbo=dbo, exceptions=exceptions, retries=retries-1)
 
 def send_bulk_email(dbo: Database, replyadd: str, subject: str, body: str, rows: Results, contenttype: str, unsubscribe: bool) -> None:
     """
@@ -2139,12 +2179,12 @@ def send_bulk_email(dbo: Database, replyadd: str, subject: str, body: str, rows:
             toadd = r.EMAILADDRESS
             if toadd is None or toadd.strip() == "": continue
             asm3.al.debug("sending bulk email: to=%s, subject=%s" % (toadd, ssubject), "utils.send_bulk_email", dbo)
-            send_email(dbo, replyadd, toadd, "", "", ssubject, sbody, contenttype, exceptions=False, bulk=True)
+            send_email(dbo, replyadd, toadd, "", "", ssubject, sbody, contenttype, exceptions=False, bulk=True, queue=True)
             if "EMAILADDRESS2" in r: 
                 toadd = r.EMAILADDRESS2
                 if toadd is None or toadd.strip() == "": continue
                 asm3.al.debug("sending bulk email: to=%s, subject=%s" % (toadd, ssubject), "utils.send_bulk_email", dbo)
-                send_email(dbo, replyadd, toadd, "", "", ssubject, sbody, contenttype, exceptions=False, bulk=True)
+                send_email(dbo, replyadd, toadd, "", "", ssubject, sbody, contenttype, exceptions=False, bulk=True, queue=True)
     thread.start_new_thread(do_send, ())
 
 def send_error_email(errtype, errvalue, path, errmsg) -> None:
@@ -23,10 +23,74 @@ import asm3.waitinglist
 
 from asm3.i18n import _, date_diff_days, format_currency, format_currency_no_symbol, format_diff, format_diff_single, format_time, now, python2display, python2displaytime, yes_no
 from asm3.sitedefs import SERVICE_URL
-from asm3.typehints import bytes_or_str, Database, Dict, List, ResultRow, Results, Tags, Tuple
+from asm3.typehints import bytes_or_str, Database, Dict, List, ResultRow, Results, Set, Tags, Tuple
 
 import zipfile
 
+def get_tokens(s: str, opener: str = "&lt;&lt;", closer: str = "&gt;&gt;") -> Set[str]:
+    """
+    Returns the set of tag names that could be substituted in document s.
+    As well as the text between the opener and closer, this includes any
+    text between markup in it (ODT documents can have markup around
+    the tag name, which substitute_tags looks for with remove_unmatched=False)
+    """
+    tokens = set()
+    sp = s.find(opener)
+    while sp != -1:
+        ep = s.find(closer, sp + len(opener))
+        if ep == -1: break
+        tagstr = s[sp + len(opener):ep].upper()
+        tokens.add(tagstr)
+        for x in tagstr.split(">")[1:]:
+            tokens.add(x)
+            tokens.add(x.split("<")[0])
+        sp = s.find(opener, sp + len(opener))
+    return tokens
+
+def read_template(dbo: Database, templateid: int) -> Tuple[str, bytes, str]:
+    """
+    Reads document template templateid so that it can be passed to 
+    get_template_tokens and substitute_template.
+    Returns a tuple of the template name, its data and its text (the html, 
+    or content.xml for odt templates - None if it could not be read)
+    """
+    templatedata = asm3.template.get_document_template_content(dbo, templateid) # bytes
+    templatename = asm3.template.get_document_template_name(dbo, templateid)
+    content = None
+    if templatename.endswith(".odt"):
+        try:
+            zf = zipfile.ZipFile(asm3.utils.bytesio(templatedata), "r")
+            content = asm3.utils.bytes2str(zf.open("content.xml").read())
+            zf.close()
+        except Exception as err:
+            # substitute_template will report the problem
+            asm3.al.error("failed reading odt template %s: %s" % (templatename, err), "wordprocessor.read_template", dbo)
+    else:
+        content = asm3.utils.bytes2str(templatedata)
+    return (templatename, templatedata, content)
+
+def get_template_tokens(template: Tuple[str, bytes, str]) -> Set[str]:
+    """
+    Returns the set of tag names used by a document template from read_template.
+    Returns None if the template could not be read so that all tags are built.
+    """
+    templatename, templatedata, content = template
+    if content is None: return None
+    return get_tokens(content.replace("signature:user", "&lt;&lt;UserSignatureSrc&gt;&gt;"))
+
+def uses_tags(tokens: Set[str], prefixes: Tuple[str, ...]) -> bool:
+    """
+    Returns True if any of tokens (from get_tokens) starts with one of prefixes.
+    Tag generating functions use this to skip the queries for groups of
+    tags that are not used. A group can only be skipped if every tag it 
+    creates starts with one of its prefixes.
+    If tokens is None, all tags are wanted and this always returns True.
+    """
+    if tokens is None: return True
+    for t in tokens:
+        if t.startswith(prefixes): return True
+    return False
+
 def org_tags(dbo: Database, username: str) -> Tags:
     """
     Generates a list of tags from the organisation and user info
@@ -271,9 +335,11 @@ def animal_tags_publisher(dbo: Database, a: ResultRow, includeAdditional=True) -
 
 def animal_tags(dbo: Database, a: ResultRow, includeAdditional=True, includeCosts=True, includeDiary=True, 
         includeDiet=True, includeDonations=True, includeFutureOwner=True, includeIsVaccinated=True, 
-        includeLitterMates=True, includeLogs=True, includeLicence=True, includeMedical=True, includeTransport=True) -> Tags:
+        includeLitterMates=True, includeLogs=True, includeLicence=True, includeMedical=True, includeTransport=True, tokens: Set[str] = None) -> Tags:
     """
     Generates a list of tags from an animal result (the deep type from calling asm3.animal.get_animal)
+    tokens: The tags used by the document (see get_tokens), groups of tags that 
+            need extra queries are only generated if they are used.
     """
     l = dbo.locale
     
@@ -657,7 +723,8 @@ def animal_tags(dbo: Database, a: ResultRow, includeAdditional=True, includeCost
     # If the animal doesn't have a current owner, but does have an open
     # movement with a future date on it, look up the owner and use that 
     # instead so that we can still generate paperwork for future adoptions.
-    if includeFutureOwner and a["CURRENTOWNERID"] is None or a["CURRENTOWNERID"] == 0:
+    if uses_tags(tokens, ("CURRENTOWNER", "MOSTRECENTENTRYCATEGORY")) and \
+        (includeFutureOwner and a["CURRENTOWNERID"] is None or a["CURRENTOWNERID"] == 0):
         latest = asm3.movement.get_animal_movements(dbo, a["ID"])
         if len(latest) > 0:
             latest = latest[0]
@@ -687,27 +754,28 @@ def animal_tags(dbo: Database, a: ResultRow, includeAdditional=True, includeCost
     # Additional fields
     if includeAdditional:
         tags.update(additional_field_tags(dbo, asm3.additional.get_additional_fields(dbo, a["ID"], "animal")))
-        if a["ORIGINALOWNERID"] and a["ORIGINALOWNERID"] > 0:
+        if a["ORIGINALOWNERID"] and a["ORIGINALOWNERID"] > 0 and uses_tags(tokens, ("ORIGINALOWNER",)):
             tags.update(additional_field_tags(dbo, asm3.additional.get_additional_fields(dbo, a["ORIGINALOWNERID"], "person"), "ORIGINALOWNER"))
-        if a["BROUGHTINBYOWNERID"] and a["BROUGHTINBYOWNERID"] > 0:
+        if a["BROUGHTINBYOWNERID"] and a["BROUGHTINBYOWNERID"] > 0 and uses_tags(tokens, ("BROUGHTINBY",)):
             tags.update(additional_field_tags(dbo, asm3.additional.get_additional_fields(dbo, a["BROUGHTINBYOWNERID"], "person"), "BROUGHTINBY"))
-        if a["CURRENTOWNERID"] and a["CURRENTOWNERID"] > 0:
+        if a["CURRENTOWNERID"] and a["CURRENTOWNERID"] > 0 and uses_tags(tokens, ("CURRENTOWNER",)):
             tags.update(additional_field_tags(dbo, asm3.additional.get_additional_fields(dbo, a["CURRENTOWNERID"], "person"), "CURRENTOWNER"))
-        if a["CURRENTVETID"] and a["CURRENTVETID"] > 0:
+        if a["CURRENTVETID"] and a["CURRENTVETID"] > 0 and uses_tags(tokens, ("CURRENTVET",)):
             tags.update(additional_field_tags(dbo, asm3.additional.get_additional_fields(dbo, a["CURRENTVETID"], "person"), "CURRENTVET"))
 
     # Is vaccinated indicator
-    if includeIsVaccinated:    
+    if includeIsVaccinated and uses_tags(tokens, ("ANIMALISVACCINATED",)):
         tags["ANIMALISVACCINATED"] = asm3.utils.iif(asm3.medical.get_vaccinated(dbo, a["ID"]), _("Yes", l), _("No", l))
 
     # Last licence number
-    if includeLicence:
+    if includeLicence and uses_tags(tokens, ("LICENCENUMBER", "LICENSENUMBER")):
         licences = asm3.financial.get_animal_licences(dbo, a["ID"], asm3.financial.DESCENDING)
         if len(licences) > 0:
             tags["LICENCENUMBER"] = licences[0]["LICENCENUMBER"]
             tags["LICENSENUMBER"] = licences[0]["LICENCENUMBER"]
 
-    if includeMedical:
+    if includeMedical and uses_tags(tokens, ("VACCINATION", "GIVENANIMALVACCINATIONS", "DUEANIMALVACCINATIONS", "ANIMALVACCINATIONS", 
+        "TEST", "ANIMALTESTS", "MEDICAL", "ANIMALMEDICALS", "ACTIVEANIMALMEDICALS")):
         iic = asm3.configuration.include_incomplete_medical_doc(dbo)
         # Vaccinations
         d = {
@@ -843,7 +911,7 @@ def animal_tags(dbo: Database, a: ResultRow, includeAdditional=True, includeCost
         ))
 
     # Diary
-    if includeDiary:
+    if includeDiary and uses_tags(tokens, ("DIARY",)):
         d = {
             "DIARYDATE":                "d:DIARYDATETIME",
             "DIARYCOMPLETED":           "d:DATECOMPLETED",
@@ -855,7 +923,7 @@ def animal_tags(dbo: Database, a: ResultRow, includeAdditional=True, includeCost
         tags.update(table_tags(dbo, d, asm3.diary.get_diaries(dbo, asm3.diary.ANIMAL, a["ID"]), "DIARYFORNAME", "DIARYDATETIME", "DATECOMPLETED"))
 
     # Diet
-    if includeDiet:
+    if includeDiet and uses_tags(tokens, ("DIET",)):
         d = {
             "DIETNAME":                 "DIETNAME",
             "DIETDESCRIPTION":          "DIETDESCRIPTION",
@@ -865,7 +933,7 @@ def animal_tags(dbo: Database, a: ResultRow, includeAdditional=True, includeCost
         tags.update(table_tags(dbo, d, asm3.animal.get_diets(dbo, a["ID"]), "DIETNAME", "DATESTARTED", "DATESTARTED"))
 
     # Donations
-    if includeDonations:
+    if includeDonations and uses_tags(tokens, ("RECEIPTNUM", "DONATION", "PAYMENT")):
         d = {
             "RECEIPTNUM":               "RECEIPTNUMBER",
             "DONATIONTYPE":             "DONATIONNAME",
@@ -896,7 +964,7 @@ def animal_tags(dbo: Database, a: ResultRow, includeAdditional=True, includeCost
         tags.update(table_tags(dbo, d, dons, "DONATIONNAME", "DATEDUE", "DATE"))
 
     # Transport
-    if includeTransport:
+    if includeTransport and uses_tags(tokens, ("TRANSPORT",)):
         d = {
             "TRANSPORTTYPE":            "TRANSPORTTYPENAME",
             "TRANSPORTDRIVERNAME":      "DRIVEROWNERNAME", 
@@ -942,7 +1010,8 @@ def animal_tags(dbo: Database, a: ResultRow, includeAdditional=True, includeCost
         tags.update(table_tags(dbo, d, asm3.movement.get_animal_transports(dbo, a["ID"]), "TRANSPORTTYPENAME", "PICKUPDATETIME", "DROPOFFDATETIME"))
 
     # Costs
-    if includeCosts:
+    if includeCosts and uses_tags(tokens, ("COST", "TOTALVACCINATIONCOSTS", "TOTALTRANSPORTCOSTS", "TOTALTESTCOSTS", 
+        "TOTALMEDICALCOSTS", "TOTALLINECOSTS", "DAILYBOARDINGCOST", "CURRENTBOARDINGCOST", "TOTALCOSTS")):
         d = {
             "COSTTYPE":                 "COSTTYPENAME",
             "COSTDATE":                 "d:COSTDATE",
@@ -976,7 +1045,7 @@ def animal_tags(dbo: Database, a: ResultRow, includeAdditional=True, includeCost
         }
         tags = append_tags(tags, costtags)
 
-    if includeLitterMates and a["ACCEPTANCENUMBER"] is not None and len(a["ACCEPTANCENUMBER"]) > 2:
+    if includeLitterMates and uses_tags(tokens, ("LITTERMATES", "ACTIVELITTERMATES")) and a["ACCEPTANCENUMBER"] is not None and len(a["ACCEPTANCENUMBER"]) > 2:
         # Littermates
         lm = dbo.query("SELECT AnimalName, ShelterCode FROM animal " \
             "WHERE AcceptanceNumber = ? AND ID <> ? " \
@@ -993,7 +1062,7 @@ def animal_tags(dbo: Database, a: ResultRow, includeAdditional=True, includeCost
             ( "ANIMALNAME", _("Name", l))
         ))
 
-    if includeLogs:
+    if includeLogs and uses_tags(tokens, ("LOG", "ANIMALLOGS")):
         # Logs
         d = {
             "LOGNAME":                  "LOGTYPENAME",
@@ -1520,10 +1589,12 @@ def clinic_tags(dbo: Database, c: ResultRow) -> Tags:
     tags.update(table_tags(dbo, d, asm3.clinic.get_invoice_items(dbo, c.ID)))
     return tags
 
-def person_tags(dbo: Database, p: ResultRow, includeImg=False, includeDonations=False, includeVouchers=False) -> Tags:
+def person_tags(dbo: Database, p: ResultRow, includeImg=False, includeDonations=False, includeVouchers=False, tokens: Set[str] = None) -> Tags:
     """
     Generates a list of tags from a person result (the deep type from
     calling asm3.person.get_person)
+    tokens: The tags used by the document (see get_tokens), groups of tags that 
+            need extra queries are only generated if they are used.
     """
     l = dbo.locale
     tags = { 
@@ -1603,7 +1674,7 @@ def person_tags(dbo: Database, p: ResultRow, includeImg=False, includeDonations=
         "OWNERLOOKINGFOR"       : asm3.person.lookingfor_summary(dbo, p["ID"])
     }
 
-    if includeImg:
+    if includeImg and uses_tags(tokens, ("PERSONDOCUMENTIMG",)):
         tags["PERSONDOCUMENTIMGSRC"] = asm3.html.doc_img_src(dbo, p)
         tags["PERSONDOCUMENTIMGLINK"] = "<img height=\"200\" src=\"" + asm3.html.doc_img_src(dbo, p) + "\" >"
         tags["PERSONDOCUMENTIMGLINK200"] = "<img height=\"200\" src=\"" + asm3.html.doc_img_src(dbo, p) + "\" >"
@@ -1612,7 +1683,7 @@ def person_tags(dbo: Database, p: ResultRow, includeImg=False, includeDonations=
         tags["PERSONDOCUMENTIMGLINK500"] = "<img height=\"500\" src=\"" + asm3.html.doc_img_src(dbo, p) + "\" >"
 
     # Donations
-    if includeDonations:
+    if includeDonations and uses_tags(tokens, ("RECEIPTNUM", "DONATION", "PAYMENT")):
         d = {
             "RECEIPTNUM":               "RECEIPTNUMBER",
             "DONATIONTYPE":             "DONATIONNAME",
@@ -1643,7 +1714,7 @@ def person_tags(dbo: Database, p: ResultRow, includeImg=False, includeDonations=
         tags.update(table_tags(dbo, d, dons, "DONATIONNAME", "DATEDUE", "DATE"))
 
     # Vouchers
-    if includeVouchers:
+    if includeVouchers and uses_tags(tokens, ("VOUCHER",)):
         d = {
             "VOUCHERANIMALNAME":    "ANIMALNAME",
             "VOUCHERSHELTERCODE":   "SHELTERCODE",
@@ -1663,46 +1734,49 @@ def person_tags(dbo: Database, p: ResultRow, includeImg=False, includeDonations=
     tags.update(additional_field_tags(dbo, asm3.additional.get_additional_fields(dbo, p["ID"], "person")))
 
     # Citations
-    d = {
-        "CITATIONNAME":         "CITATIONNAME",
-        "CITATIONDATE":         "d:CITATIONDATE",
-        "CITATIONCOMMENTS":     "COMMENTS",
-        "FINEAMOUNT":           "c:FINEAMOUNT",
-        "FINEDUEDATE":          "d:FINEDUEDATE",
-        "FINEPAIDDATE":         "d:FINEPAIDDATE"
-    }
-    tags.update(table_tags(dbo, d, asm3.financial.get_person_citations(dbo, p["ID"]), "CITATIONNAME", "CITATIONDATE", "FINEPAIDDATE"))
+    if uses_tags(tokens, ("CITATION", "FINE")):
+        d = {
+            "CITATIONNAME":         "CITATIONNAME",
+            "CITATIONDATE":         "d:CITATIONDATE",
+            "CITATIONCOMMENTS":     "COMMENTS",
+            "FINEAMOUNT":           "c:FINEAMOUNT",
+            "FINEDUEDATE":          "d:FINEDUEDATE",
+            "FINEPAIDDATE":         "d:FINEPAIDDATE"
+        }
+        tags.update(table_tags(dbo, d, asm3.financial.get_person_citations(dbo, p["ID"]), "CITATIONNAME", "CITATIONDATE", "FINEPAIDDATE"))
 
     # Logs
-    d = {
-        "PERSONLOGNAME":            "LOGTYPENAME",
-        "PERSONLOGDATE":            "d:DATE",
-        "PERSONLOGTIME":            "t:DATE",
-        "PERSONLOGCOMMENTS":        "COMMENTS",
-        "PERSONLOGCREATEDBY":       "CREATEDBY"
-    }
-    tags.update(table_tags(dbo, d, asm3.log.get_logs(dbo, asm3.log.PERSON, p["ID"], 0, asm3.log.ASCENDING), "LOGTYPENAME", "DATE", "DATE"))
+    if uses_tags(tokens, ("PERSONLOG",)):
+        d = {
+            "PERSONLOGNAME":            "LOGTYPENAME",
+            "PERSONLOGDATE":            "d:DATE",
+            "PERSONLOGTIME":            "t:DATE",
+            "PERSONLOGCOMMENTS":        "COMMENTS",
+            "PERSONLOGCREATEDBY":       "CREATEDBY"
+        }
+        tags.update(table_tags(dbo, d, asm3.log.get_logs(dbo, asm3.log.PERSON, p["ID"], 0, asm3.log.ASCENDING), "LOGTYPENAME", "DATE", "DATE"))
 
     # Trap loans
-    d = {
-        "TRAPTYPENAME":             "TRAPTYPENAME",
-        "TRAPLOANDATE":             "d:LOANDATE",
-        "TRAPDEPOSITAMOUNT":        "c:DEPOSITAMOUNT",
-        "TRAPDEPOSITRETURNDATE":    "d:DEPOSITRETURNDATE",
-        "TRAPNUMBER":               "TRAPNUMBER",
-        "TRAPRETURNDUEDATE":        "d:RETURNDUEDATE",
-        "TRAPRETURNDATE":           "d:RETURNDATE",
-        "TRAPCOMMENTS":             "COMMENTS",
-        "EQUIPMENTTYPENAME":        "TRAPTYPENAME",
-        "EQUIPMENTLOANDATE":        "d:LOANDATE",
-        "EQUIPMENTDEPOSITAMOUNT":   "c:DEPOSITAMOUNT",
-        "EQUIPMENTDEPOSITRETURNDATE":"d:DEPOSITRETURNDATE",
-        "EQUIPMENTNUMBER":          "TRAPNUMBER",
-        "EQUIPMENTRETURNDUEDATE":   "d:RETURNDUEDATE",
-        "EQUIPMENTRETURNDATE":      "d:RETURNDATE",
-        "EQUIPMENTCOMMENTS":        "COMMENTS"
-    }
-    tags.update(table_tags(dbo, d, asm3.animalcontrol.get_person_traploans(dbo, p["ID"], asm3.animalcontrol.ASCENDING), "TRAPTYPENAME", "RETURNDUEDATE", "RETURNDATE"))
+    if uses_tags(tokens, ("TRAP", "EQUIPMENT")):
+        d = {
+            "TRAPTYPENAME":             "TRAPTYPENAME",
+            "TRAPLOANDATE":             "d:LOANDATE",
+            "TRAPDEPOSITAMOUNT":        "c:DEPOSITAMOUNT",
+            "TRAPDEPOSITRETURNDATE":    "d:DEPOSITRETURNDATE",
+            "TRAPNUMBER":               "TRAPNUMBER",
+            "TRAPRETURNDUEDATE":        "d:RETURNDUEDATE",
+            "TRAPRETURNDATE":           "d:RETURNDATE",
+            "TRAPCOMMENTS":             "COMMENTS",
+            "EQUIPMENTTYPENAME":        "TRAPTYPENAME",
+            "EQUIPMENTLOANDATE":        "d:LOANDATE",
+            "EQUIPMENTDEPOSITAMOUNT":   "c:DEPOSITAMOUNT",
+            "EQUIPMENTDEPOSITRETURNDATE":"d:DEPOSITRETURNDATE",
+            "EQUIPMENTNUMBER":          "TRAPNUMBER",
+            "EQUIPMENTRETURNDUEDATE":   "d:RETURNDUEDATE",
+            "EQUIPMENTRETURNDATE":      "d:RETURNDATE",
+            "EQUIPMENTCOMMENTS":        "COMMENTS"
+        }
+        tags.update(table_tags(dbo, d, asm3.animalcontrol.get_person_traploans(dbo, p["ID"], asm3.animalcontrol.ASCENDING), "TRAPTYPENAME", "RETURNDUEDATE", "RETURNDATE"))
 
     return tags
 
@@ -2027,26 +2101,26 @@ def substitute_tags(searchin: str, tags: Tags, escape_html: bool = True,
     """
     return asm3.utils.substitute_tags(searchin, tags, escape_html, opener, closer, cr_to_br, remove_unmatched)
 
-def substitute_template(dbo: Database, templateid: int, tags: Tags, imdata: bytes = None) -> bytes_or_str:
+def substitute_template(dbo: Database, template: Tuple[str, bytes, str], tags: Tags, imdata: bytes = None) -> bytes_or_str:
     """
-    Reads the template specified by id "template" and substitutes
-    according to the tags in "tags". Returns the built file.
+    Substitutes the template (from read_template) according to the
+    tags in "tags". Returns the built file.
     imdata is the preferred image for the record and since html uses
     URLs, only applies to ODT templates.
     Return value can be bytes (for ODT) or str (for HTML)
     """
-    templatedata = asm3.template.get_document_template_content(dbo, templateid) # bytes
-    templatename = asm3.template.get_document_template_name(dbo, templateid)
+    templatename, templatedata, content = template
     if templatename.endswith(".html"):
         # Translate any user signature placeholder
-        templatedata = asm3.utils.bytes2str(templatedata).replace("signature:user", "&lt;&lt;UserSignatureSrc&gt;&gt;")
-        return asm3.utils.substitute_tags(templatedata, tags)
+        content = content.replace("signature:user", "&lt;&lt;UserSignatureSrc&gt;&gt;")
+        return asm3.utils.substitute_tags(content, tags)
     elif templatename.endswith(".odt"):
         try:
             odt = asm3.utils.bytesio(templatedata)
             zf = zipfile.ZipFile(odt, "r")
-            # Load the content.xml file and substitute the tags
-            content = asm3.utils.bytes2str(zf.open("content.xml").read())
+            # Substitute the tags in the content.xml file (read again here if
+            # read_template failed so that the error is reported)
+            if content is None: content = asm3.utils.bytes2str(zf.open("content.xml").read())
             content = substitute_tags(content, tags, cr_to_br=False, remove_unmatched=False)
             # Write the replacement file
             zo = asm3.utils.bytesio()
@@ -2103,10 +2177,12 @@ def generate_animal_doc(dbo: Database, templateid: int, animalid: int, username:
         imdata = asm3.media.get_image_file_data(dbo, "animal", animalid)[1]
     except Exception as err:
         asm3.al.warn("could not load preferred image for animal %s: %s" % (animalid, err), "wordprocessor.generate_animal_doc", dbo)
+    template = read_template(dbo, templateid)
+    tokens = get_template_tokens(template)
     # We include donations here, so that we have RecentType, DueType, Last1, etc
     # But the call below to get_movement_donations will add the totals and allow
     # receipt/invoice type documents to work if there's an active movement
-    tags = animal_tags(dbo, a, includeDonations=True)
+    tags = animal_tags(dbo, a, includeDonations=True, tokens=tokens)
     # Use the person info from the latest open movement for the animal
     # This will pick up future dated adoptions instead of fosterers (which are still currentowner)
     # as get_animal_movements returns them in descending order of movement date
@@ -2114,7 +2190,7 @@ def generate_animal_doc(dbo: Database, templateid: int, animalid: int, username:
     for m in asm3.movement.get_animal_movements(dbo, animalid):
         if m["MOVEMENTDATE"] is not None and m["RETURNDATE"] is None and m["OWNERID"] is not None and m["OWNERID"] != 0:
             has_person_tags = True
-            tags = append_tags(tags, person_tags(dbo, asm3.person.get_person(dbo, m["OWNERID"])))
+            tags = append_tags(tags, person_tags(dbo, asm3.person.get_person(dbo, m["OWNERID"]), tokens=tokens))
             tags = append_tags(tags, movement_tags(dbo, m))
             md = asm3.financial.get_movement_donations(dbo, m["ID"])
             if len(md) > 0: 
@@ -2122,14 +2198,14 @@ def generate_animal_doc(dbo: Database, templateid: int, animalid: int, username:
             break
     # If we didn't have an open movement and there's a reserve, use that as the person
     if not has_person_tags and a["RESERVEDOWNERID"] is not None and a["RESERVEDOWNERID"] != 0:
-        tags = append_tags(tags, person_tags(dbo, asm3.person.get_person(dbo, a["RESERVEDOWNERID"])))
+        tags = append_tags(tags, person_tags(dbo, asm3.person.get_person(dbo, a["RESERVEDOWNERID"]), tokens=tokens))
         has_person_tags = True
     # If this is a non-shelter animal, use the owner
     if not has_person_tags and a["NONSHELTERANIMAL"] == 1 and a["ORIGINALOWNERID"] is not None and a["ORIGINALOWNERID"] != 0:
-        tags = append_tags(tags, person_tags(dbo, asm3.person.get_person(dbo, a["ORIGINALOWNERID"])))
+        tags = append_tags(tags, person_tags(dbo, asm3.person.get_person(dbo, a["ORIGINALOWNERID"]), tokens=tokens))
         has_person_tags = True
     tags = append_tags(tags, org_tags(dbo, username))
-    return substitute_template(dbo, templateid, tags, imdata)
+    return substitute_template(dbo, template, tags, imdata)
 
 def generate_animalcontrol_doc(dbo: Database, templateid: int, acid: int, username: str) -> bytes_or_str:
     """
@@ -2141,7 +2217,7 @@ def generate_animalcontrol_doc(dbo: Database, templateid: int, acid: int, userna
     if ac is None: raise asm3.utils.ASMValidationError("%d is not a valid incident ID" % acid)
     tags = animalcontrol_tags(dbo, ac)
     tags = append_tags(tags, org_tags(dbo, username))
-    return substitute_template(dbo, templateid, tags)
+    return substitute_template(dbo, read_template(dbo, templateid), tags)
 
 def generate_boarding_doc(dbo: Database, templateid: int, animalboardingid: int, username: str) -> bytes_or_str:
     """
@@ -2153,13 +2229,15 @@ def generate_boarding_doc(dbo: Database, templateid: int, animalboardingid: int,
     tags = {}
     if b is None:
         raise asm3.utils.ASMValidationError("%d is not a valid boarding record ID" % animalboardingid)
+    template = read_template(dbo, templateid)
+    tokens = get_template_tokens(template)
     if b.ANIMALID is not None and b.ANIMALID != 0:
-        tags = animal_tags(dbo, asm3.animal.get_animal(dbo, b.ANIMALID))
+        tags = animal_tags(dbo, asm3.animal.get_animal(dbo, b.ANIMALID), tokens=tokens)
     if b.OWNERID is not None and b.OWNERID != 0:
-        tags = append_tags(tags, person_tags(dbo, asm3.person.get_person(dbo, b.OWNERID)))
+        tags = append_tags(tags, person_tags(dbo, asm3.person.get_person(dbo, b.OWNERID), tokens=tokens))
     tags = append_tags(tags, boarding_tags(dbo, b))
     tags = append_tags(tags, org_tags(dbo, username))
-    return substitute_template(dbo, templateid, tags)
+    return substitute_template(dbo, template, tags)
 
 def generate_clinic_doc(dbo: Database, templateid: int, appointmentid: int, username: str) -> bytes_or_str:
     """
@@ -2169,16 +2247,18 @@ def generate_clinic_doc(dbo: Database, templateid: int, appointmentid: int, user
     """
     c = asm3.clinic.get_appointment(dbo, appointmentid)
     if c is None: raise asm3.utils.ASMValidationError("%d is not a valid clinic appointment ID" % appointmentid)
+    template = read_template(dbo, templateid)
+    tokens = get_template_tokens(template)
     tags = clinic_tags(dbo, c)
     tags = append_tags(tags, org_tags(dbo, username))
     a = asm3.animal.get_animal(dbo, c.ANIMALID)
     if a is not None:
         tags = append_tags(tags, animal_tags(dbo, a, includeAdditional=True, includeCosts=False, includeDiet=False, includeDonations=False, \
-            includeFutureOwner=False, includeIsVaccinated=True, includeLogs=False, includeMedical=True))
+            includeFutureOwner=False, includeIsVaccinated=True, includeLogs=False, includeMedical=True, tokens=tokens))
     p = asm3.person.get_person(dbo, c.OWNERID)
     if p is not None:
-        tags = append_tags(tags, person_tags(dbo, p))
-    return substitute_template(dbo, templateid, tags)
+        tags = append_tags(tags, person_tags(dbo, p, tokens=tokens))
+    return substitute_template(dbo, template, tags)
 
 def generate_person_doc(dbo: Database, templateid: int, personid: int, username: str) -> bytes_or_str:
     """
@@ -2189,14 +2269,16 @@ def generate_person_doc(dbo: Database, templateid: int, personid: int, username:
     p = asm3.person.get_person(dbo, personid)
     im = asm3.media.get_image_file_data(dbo, "person", personid)[1]
     if p is None: raise asm3.utils.ASMValidationError("%d is not a valid person ID" % personid)
-    tags = person_tags(dbo, p, includeImg=True, includeDonations=True, includeVouchers=True)
+    template = read_template(dbo, templateid)
+    tokens = get_template_tokens(template)
+    tags = person_tags(dbo, p, includeImg=True, includeDonations=True, includeVouchers=True, tokens=tokens)
     tags = append_tags(tags, org_tags(dbo, username))
     m = dbo.first_row(asm3.movement.get_person_movements(dbo, personid))
     if m is not None:
         tags = append_tags(tags, movement_tags(dbo, m))
         if m.ANIMALID is not None and m.ANIMALID != 0:
-            tags = append_tags(tags, animal_tags(dbo, asm3.animal.get_animal(dbo, m.ANIMALID)))
-    return substitute_template(dbo, templateid, tags, im)
+            tags = append_tags(tags, animal_tags(dbo, asm3.animal.get_animal(dbo, m.ANIMALID), tokens=tokens))
+    return substitute_template(dbo, template, tags, im)
 
 def generate_donation_doc(dbo: Database, templateid: int, donationids: List[int], username: str) -> bytes_or_str:
     """
@@ -2208,14 +2290,16 @@ def generate_donation_doc(dbo: Database, templateid: int, donationids: List[int]
     if len(dons) == 0: 
         raise asm3.utils.ASMValidationError("%s does not contain any valid donation IDs" % donationids)
     d = dons[0]
-    tags = person_tags(dbo, asm3.person.get_person(dbo, d.OWNERID))
+    template = read_template(dbo, templateid)
+    tokens = get_template_tokens(template)
+    tags = person_tags(dbo, asm3.person.get_person(dbo, d.OWNERID), tokens=tokens)
     if d.ANIMALID is not None and d.ANIMALID != 0:
-        tags = append_tags(tags, animal_tags(dbo, asm3.animal.get_animal(dbo, d["ANIMALID"]), includeDonations=False))
+        tags = append_tags(tags, animal_tags(dbo, asm3.animal.get_animal(dbo, d["ANIMALID"]), includeDonations=False, tokens=tokens))
     if d.MOVEMENTID is not None and d.MOVEMENTID != 0:
         tags = append_tags(tags, movement_tags(dbo, asm3.movement.get_movement(dbo, d.MOVEMENTID)))
     tags = append_tags(tags, donation_tags(dbo, dons))
     tags = append_tags(tags, org_tags(dbo, username))
-    return substitute_template(dbo, templateid, tags)
+    return substitute_template(dbo, template, tags)
 
 def generate_foundanimal_doc(dbo: Database, templateid: int, faid: int, username: str) -> bytes_or_str:
     """
@@ -2226,10 +2310,12 @@ def generate_foundanimal_doc(dbo: Database, templateid: int, faid: int, username
     a = asm3.lostfound.get_foundanimal(dbo, faid)
     if a is None:
         raise asm3.utils.ASMValidationError("%d is not a valid found animal ID" % faid)
-    tags = person_tags(dbo, asm3.person.get_person(dbo, a.OWNERID))
+    template = read_template(dbo, templateid)
+    tokens = get_template_tokens(template)
+    tags = person_tags(dbo, asm3.person.get_person(dbo, a.OWNERID), tokens=tokens)
     tags = append_tags(tags, foundanimal_tags(dbo, a))
     tags = append_tags(tags, org_tags(dbo, username))
-    return substitute_template(dbo, templateid, tags)
+    return substitute_template(dbo, template, tags)
 
 def generate_lostanimal_doc(dbo: Database, templateid: int, laid: int, username: str) -> bytes_or_str:
     """
@@ -2240,10 +2326,12 @@ def generate_lostanimal_doc(dbo: Database, templateid: int, laid: int, username:
     a = asm3.lostfound.get_lostanimal(dbo, laid)
     if a is None:
         raise asm3.utils.ASMValidationError("%d is not a valid lost animal ID" % laid)
-    tags = person_tags(dbo, asm3.person.get_person(dbo, a.OWNERID))
+    template = read_template(dbo, templateid)
+    tokens = get_template_tokens(template)
+    tags = person_tags(dbo, asm3.person.get_person(dbo, a.OWNERID), tokens=tokens)
     tags = append_tags(tags, lostanimal_tags(dbo, a))
     tags = append_tags(tags, org_tags(dbo, username))
-    return substitute_template(dbo, templateid, tags)
+    return substitute_template(dbo, template, tags)
 
 def generate_licence_doc(dbo: Database, templateid: int, licenceid: int, username: str) -> bytes_or_str:
     """
@@ -2254,12 +2342,14 @@ def generate_licence_doc(dbo: Database, templateid: int, licenceid: int, usernam
     l = asm3.financial.get_licence(dbo, licenceid)
     if l is None:
         raise asm3.utils.ASMValidationError("%d is not a valid licence ID" % licenceid)
-    tags = person_tags(dbo, asm3.person.get_person(dbo, l.OWNERID))
+    template = read_template(dbo, templateid)
+    tokens = get_template_tokens(template)
+    tags = person_tags(dbo, asm3.person.get_person(dbo, l.OWNERID), tokens=tokens)
     if l.ANIMALID is not None and l.ANIMALID != 0:
-        tags = append_tags(tags, animal_tags(dbo, asm3.animal.get_animal(dbo, l.ANIMALID), includeLicence=False))
+        tags = append_tags(tags, animal_tags(dbo, asm3.animal.get_animal(dbo, l.ANIMALID), includeLicence=False, tokens=tokens))
     tags = append_tags(tags, licence_tags(dbo, l))
     tags = append_tags(tags, org_tags(dbo, username))
-    return substitute_template(dbo, templateid, tags)
+    return substitute_template(dbo, template, tags)
 
 def generate_medical_doc(dbo: Database, templateid: int, medicalids: List[int], username: str) -> bytes_or_str:
     """
@@ -2271,12 +2361,14 @@ def generate_medical_doc(dbo: Database, templateid: int, medicalids: List[int],
     tags = {}
     if len(meds) == 0: 
         raise asm3.utils.ASMValidationError("%s does not contain any valid medical IDs" % medicalids)
+    template = read_template(dbo, templateid)
+    tokens = get_template_tokens(template)
     m = meds[0]
     if m.ANIMALID is not None and m.ANIMALID != 0:
-        tags = append_tags(tags, animal_tags(dbo, asm3.animal.get_animal(dbo, m.ANIMALID), includeMedical=False))
+        tags = append_tags(tags, animal_tags(dbo, asm3.animal.get_animal(dbo, m.ANIMALID), includeMedical=False, tokens=tokens))
     tags = append_tags(tags, medical_tags(dbo, meds))
     tags = append_tags(tags, org_tags(dbo, username))
-    return substitute_template(dbo, templateid, tags)
+    return substitute_template(dbo, template, tags)
 
 def generate_movement_doc(dbo: Database, templateid: int, movementid: int, username: str) -> bytes_or_str:
     """
@@ -2288,14 +2380,16 @@ def generate_movement_doc(dbo: Database, templateid: int, movementid: int, usern
     tags = {}
     if m is None:
         raise asm3.utils.ASMValidationError("%d is not a valid movement ID" % movementid)
+    template = read_template(dbo, templateid)
+    tokens = get_template_tokens(template)
     if m.ANIMALID is not None and m.ANIMALID != 0:
-        tags = animal_tags(dbo, asm3.animal.get_animal(dbo, m.ANIMALID))
+        tags = animal_tags(dbo, asm3.animal.get_animal(dbo, m.ANIMALID), tokens=tokens)
     if m.OWNERID is not None and m.OWNERID != 0:
-        tags = append_tags(tags, person_tags(dbo, asm3.person.get_person(dbo, m.OWNERID)))
+        tags = append_tags(tags, person_tags(dbo, asm3.person.get_person(dbo, m.OWNERID), tokens=tokens))
     tags = append_tags(tags, movement_tags(dbo, m))
     tags = append_tags(tags, donation_tags(dbo, asm3.financial.get_movement_donations(dbo, movementid)))
     tags = append_tags(tags, org_tags(dbo, username))
-    return substitute_template(dbo, templateid, tags)
+    return substitute_template(dbo, template, tags)
 
 def generate_transport_doc(dbo: Database, templateid: int, transportids: int, username: str) -> bytes_or_str:
     """
@@ -2308,7 +2402,7 @@ def generate_transport_doc(dbo: Database, templateid: int, transportids: int, us
         raise asm3.utils.ASMValidationError("%s does not contain any valid transport IDs" % transportids)
     tags = transport_tags(dbo, tt)
     tags = append_tags(tags, org_tags(dbo, username))
-    return substitute_template(dbo, templateid, tags)
+    return substitute_template(dbo, read_template(dbo, templateid), tags)
 
 def generate_voucher_doc(dbo: Database, templateid: int, voucherid: int, username: str) -> bytes_or_str:
     """
@@ -2319,12 +2413,14 @@ def generate_voucher_doc(dbo: Database, templateid: int, voucherid: int, usernam
     v = asm3.financial.get_voucher(dbo, voucherid)
     if v is None:
         raise asm3.utils.ASMValidationError("%d is not a valid voucher ID" % voucherid)
-    tags = person_tags(dbo, asm3.person.get_person(dbo, v.OWNERID))
+    template = read_template(dbo, templateid)
+    tokens = get_template_tokens(template)
+    tags = person_tags(dbo, asm3.person.get_person(dbo, v.OWNERID), tokens=tokens)
     if v.ANIMALID is not None and v.ANIMALID != 0:
-        tags = append_tags(tags, animal_tags(dbo, asm3.animal.get_animal(dbo, v.ANIMALID)))
+        tags = append_tags(tags, animal_tags(dbo, asm3.animal.get_animal(dbo, v.ANIMALID), tokens=tokens))
     tags = append_tags(tags, voucher_tags(dbo, v))
     tags = append_tags(tags, org_tags(dbo, username))
-    return substitute_template(dbo, templateid, tags)
+    return substitute_template(dbo, template, tags)
 
 def generate_waitinglist_doc(dbo: Database, templateid: int, wlid: int, username: str) -> bytes_or_str:
     """
@@ -2335,8 +2431,10 @@ def generate_waitinglist_doc(dbo: Database, templateid: int, wlid: int, username
     a = asm3.waitinglist.get_waitinglist_by_id(dbo, wlid)
     if a is None:
         raise asm3.utils.ASMValidationError("%d is not a valid waiting list ID" % wlid)
-    tags = person_tags(dbo, asm3.person.get_person(dbo, a.OWNERID))
+    template = read_template(dbo, templateid)
+    tokens = get_template_tokens(template)
+    tags = person_tags(dbo, asm3.person.get_person(dbo, a.OWNERID), tokens=tokens)
     tags = append_tags(tags, waitinglist_tags(dbo, a))
     tags = append_tags(tags, org_tags(dbo, username))
-    return substitute_template(dbo, templateid, tags)
+    return substitute_template(dbo, template, tags)
 
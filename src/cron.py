@@ -19,7 +19,9 @@ from asm3 import dbfs
 from asm3 import dbupdate
 from asm3 import diary
 from asm3 import financial
+from asm3 import imagecache
 from asm3 import lostfound
+from asm3 import mailqueue
 from asm3 import media
 from asm3 import medical
 from asm3 import movement
@@ -30,20 +32,212 @@ from asm3 import reports as extreports
 from asm3 import utils
 from asm3 import waitinglist
 from asm3.sitedefs import LOCALE, TIMEZONE, MULTIPLE_DATABASES, MULTIPLE_DATABASES_TYPE, MULTIPLE_DATABASES_MAP
+from asm3.sitedefs import CRON_WORKERS, CRON_DATABASE_TIMEOUT, CRON_RETRIES, CRON_DAILY_WORKERS
 from asm3.sitedefs import HTMLFTP_PUBLISHER_ENABLED
-from asm3.typehints import Callable, Database
+from asm3.typehints import Any, Callable, Database, Dict, List, Tuple
 
+import concurrent.futures
+import copy
+import multiprocessing
 import time
 
-def ttask(fn: Callable, dbo: Database) -> None:
-    """ Runs a function and times how long it takes """
+# Set by fail() when a mode has an uncaught error, run() returns it as the exit status
+status = 0
+
+def fail(msg: str, location: str, dbo: Database, ei: Any = None) -> None:
+    """ Logs an uncaught error from a mode and sets the status returned by run() """
+    global status
+    status = 1
+    al.error(msg, location, dbo, ei)
+
+def ttask(fn: Callable, dbo: Database, transaction: bool = False) -> float:
+    """ Runs a function and times how long it takes 
+        transaction: Run fn as a single unit of work that is committed at the end
+        Returns the time taken in seconds
+    """
     x = time.time()
-    fn(dbo)
+    if transaction:
+        with dbo.transaction():
+            fn(dbo)
+    else:
+        fn(dbo)
     elapsed = time.time() - x
     if elapsed > 10:
         al.warn("complete in %0.2f sec" % elapsed, fn.__name__, dbo)
     else:
         al.debug("complete in %0.2f sec" % elapsed, fn.__name__, dbo)
+    return elapsed
+
+class Task(object):
+    """
+    A task in a batch run by run_tasks.
+    fn: The function to run, it is passed the dbo. The task is named after it.
+    reads: The tables the task reads. "*" means it could read any table.
+    writes: The tables the task changes. "*" means it could change any table.
+    after: The names of other tasks that must have finished before this one starts
+    transaction: Run fn as a single unit of work
+    """
+    def __init__(self, fn: Callable, reads: List[str] = [], writes: List[str] = [], after: List[str] = [], transaction: bool = False) -> None:
+        self.fn = fn
+        self.name = fn.__name__
+        self.reads = set(reads)
+        self.writes = set(writes)
+        self.after = set(after)
+        self.transaction = transaction
+
+    def conflicts(self, t: "Task") -> bool:
+        """ Returns True if this task and t cannot run at the same time because one writes tables the other uses """
+        def writes_used_by(a, b):
+            if len(a.writes) == 0: return False
+            # Any task can add to the audit trail
+            return "*" in a.writes or "*" in b.reads or "audittrail" in a.writes or len(a.writes & (b.reads | b.writes)) > 0
+        return writes_used_by(self, t) or writes_used_by(t, self)
+
+# The tasks run by daily() in the order they would run one at a time.
+# Table lists come from the queries each task (and the functions it calls) 
+# makes. They leave out the lookup and configuration tables, which no task 
+# changes, and the audit trail and deletion tables, which many tasks add to. 
+# A task that declares audittrail in writes (audit.clean) or that could 
+# write anything ("*") conflicts with every task.
+STATUS_READS = [ "animal", "adoption", "animalboarding", "media", "owner" ]
+DAILY_TASKS = [
+    Task(utils.get_asm_news),
+    Task(extreports.update_smcom_reports, reads=["customreport"], writes=["customreport", "customreportrole"]),
+    # Update on shelter and foster animal location fields
+    Task(animal.update_on_shelter_animal_statuses, reads=STATUS_READS, writes=["animal", "diary"], transaction=True),
+    Task(animal.update_foster_animal_statuses, reads=STATUS_READS, writes=["animal", "diary"], transaction=True),
+    Task(animal.update_boarding_animal_statuses, reads=STATUS_READS, writes=["animal", "diary"], transaction=True),
+    # Update on shelter, foster and young animal variable data (age, time on shelter, etc)
+    Task(animal.update_on_shelter_variable_animal_data, reads=["animal", "adoption"], writes=["animal"], transaction=True),
+    Task(animal.update_foster_variable_animal_data, reads=["animal", "adoption"], writes=["animal"], transaction=True),
+    Task(animal.update_offshelter_young_variable_animal_data, reads=["animal", "adoption"], writes=["animal"], transaction=True),
+    # Update locations of arriving boarders
+    Task(financial.update_location_boarding_today, reads=["animal", "animalboarding"], writes=["animal"]),
+    # Update animal figures for reports
+    Task(animal.update_animal_figures, reads=["animal", "adoption", "animalmedical", "animalmedicaltreatment", "animalvaccination", "animaltest"], writes=["animalfigures"]),
+    Task(animal.update_animal_figures_annual, reads=["animal", "adoption", "animalvaccination"], writes=["animalfiguresannual"]),
+    # Update waiting list urgencies and auto remove
+    Task(waitinglist.auto_remove_waitinglist, reads=["animalwaitinglist"], writes=["animalwaitinglist"]),
+    Task(waitinglist.auto_update_urgencies, reads=["animalwaitinglist"], writes=["animalwaitinglist"]),
+    # Email diary notes to users
+    Task(diary.email_uncompleted_upto_today, reads=["diary", "users", "userrole", "role"]),
+    # Update animal litter counts
+    Task(animal.update_active_litters, reads=["animal", "animallitter"], writes=["animallitter"], transaction=True),
+    # Find any missing person geocodes
+    Task(person.update_missing_geocodes, reads=["owner"], writes=["owner"]),
+    # Clear out any old audit logs
+    Task(audit.clean, writes=["audittrail", "deletion"]),
+    # Remove old publisher logs
+    Task(publish.delete_old_publish_logs, reads=["publishlog"], writes=["publishlog"]),
+    # auto cancel any reservations
+    Task(movement.auto_cancel_reservations, reads=["adoption"], writes=["adoption"]),
+    # auto cancel animal holds
+    Task(animal.auto_cancel_holds, reads=["animal"], writes=["animal"]),
+    # auto remove online forms
+    Task(onlineform.auto_remove_old_incoming_forms, reads=["onlineformincoming"], writes=["onlineformincoming"]),
+    # auto anonymise expired personal data
+    Task(person.update_anonymise_personal_data, 
+        reads=["owner", "adoption", "animal", "animalboarding", "animalcontrol", "animalcost", "clinicappointment", "log", "ownerdonation", "ownerlicence", "ownervoucher"], 
+        writes=["owner", "log"]),
+    # auto remove people who only have a cancelled reserve
+    Task(person.remove_people_only_cancelled_reserve, 
+        reads=["owner", "adoption", "animal", "animalboarding", "animalcontrol", "animalfound", "animallost", "animaltransport", "animalwaitinglist", 
+            "clinicappointment", "ownercitation", "ownerdonation", "ownerinvestigation", "ownerlicence", "ownertraploan", "ownervoucher"],
+        writes=["owner", "adoption", "additional", "clinicappointment", "diary", "log", "media", "ownercitation", "ownerdonation", 
+            "ownerinvestigation", "ownerlicence", "ownerrota", "ownertraploan", "ownervoucher"]),
+    # auto remove expired media items
+    Task(media.remove_expired_media, reads=["media"], writes=["media"]),
+    Task(media.remove_media_after_exit, reads=["animal", "media"], writes=["media"]),
+    # auto update clinic statuses
+    Task(clinic.auto_update_statuses, reads=["clinicappointment"], writes=["clinicappointment"]),
+    # Update the generated looking for report
+    Task(person.update_lookingfor_report, reads=["owner", "animal", "adoption", "animalmedical", "animalmedicaltreatment", "animalvaccination", "media"]),
+    # Update the generated lost/found match report
+    Task(lostfound.update_match_report, reads=["animallost", "animalfound", "animal", "adoption", "animalmedical", "animalmedicaltreatment", "animalvaccination", "media", "owner"], 
+        writes=["animallostfoundmatch"]),
+    # Email any reports set to run with batch, their SQL can do anything
+    Task(extreports.email_daily_reports, reads=["*"], writes=["*"]),
+    # Send automated person emails
+    Task(automail.send_all, reads=["*"], writes=["log"])
+]
+
+# Task names to run or skip from the --only and --skip command line options
+task_only = []
+task_skip = []
+
+def select_tasks(tasks: List[Task], only: List[str] = [], skip: List[str] = []) -> List[Task]:
+    """ Returns the tasks named in only (or all of them if it's empty), less those in skip """
+    names = set(t.name for t in tasks)
+    for n in list(only) + list(skip):
+        if n not in names: raise ValueError("'%s' is not a task, tasks are: %s" % (n, ", ".join(t.name for t in tasks)))
+    return [ t for t in tasks if (len(only) == 0 or t.name in only) and t.name not in skip ]
+
+def run_task(dbo: Database, t: Task, connect: bool = False) -> float:
+    """ Runs task t, returns the time taken. 
+        connect: Run the task on its own database connection 
+    """
+    if connect:
+        dbo = copy.copy(dbo)
+        dbo.connection = dbo.connect()
+    try:
+        return ttask(t.fn, dbo, t.transaction)
+    finally:
+        if connect: dbo.connection.close()
+
+def run_tasks(dbo: Database, tasks: List[Task], workers: int = 1) -> Dict[str, float]:
+    """
+    Runs tasks, up to workers of them at once. A task starts when the tasks
+    it runs after have finished and no task before it in the list that it
+    conflicts with (see Task.conflicts) is waiting or running, so every task
+    sees the data it would if they ran one at a time in order. 
+    Tasks that run at the same time as others use their own connection.
+    A task that fails, or is skipped because a task it runs after failed, 
+    is logged with fail() so the mode returns a failure status.
+    Returns a dictionary of task name to time taken in seconds (None for 
+    tasks that failed or were skipped).
+    """
+    x = time.time()
+    names = set(t.name for t in tasks)
+    waitfor = {}
+    for i, t in enumerate(tasks):
+        waitfor[t.name] = set(n for n in t.after if n in names) | set(p.name for p in tasks[:i] if t.conflicts(p))
+    results = {}
+    def finished(t: Task, f: Callable) -> None:
+        try:
+            results[t.name] = f()
+        except:
+            em = str(sys.exc_info()[1])
+            fail("FAIL: running batch task %s: %s" % (t.name, em), "cron.run_tasks", dbo, sys.exc_info())
+            results[t.name] = None
+    todo = list(tasks)
+    running = {} # future: task
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+        while len(todo) > 0:
+            for t in list(todo):
+                if len(running) >= max(workers, 1): break
+                if not waitfor[t.name] <= set(results.keys()): continue
+                todo.remove(t)
+                failed = [ n for n in t.after if n in results and results[n] is None ]
+                if len(failed) > 0:
+                    fail("FAIL: skipped %s as %s did not complete" % (t.name, failed), "cron.run_tasks", dbo)
+                    results[t.name] = None
+                elif workers > 1:
+                    running[pool.submit(run_task, dbo, t, True)] = t
+                else:
+                    finished(t, lambda: run_task(dbo, t))
+            if len(running) == 0: 
+                if len(todo) > 0 and not any(waitfor[t.name] <= set(results.keys()) for t in todo):
+                    raise Exception("tasks cannot start, check the after lists for loops: %s" % [ t.name for t in todo ])
+                continue
+            done, dummy = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for f in done:
+                finished(running.pop(f), f.result)
+        for f in concurrent.futures.as_completed(list(running.keys())):
+            finished(running.pop(f), f.result)
+    timed = sorted([ (v, k) for k, v in results.items() if v is not None ], reverse=True)
+    al.info("ran %d tasks in %0.2f secs with %d workers (%d failed), longest: %s" % (len(results), time.time() - x, workers, 
+        len(results) - len(timed), ", ".join("%s %0.2f" % (k, v) for v, k in timed[:5])), "cron.run_tasks", dbo)
+    return results
 
 def daily(dbo: Database):
     """
@@ -64,85 +258,14 @@ def daily(dbo: Database):
             ttask(dbupdate.install_db_sequences, dbo)
             ttask(dbupdate.install_db_stored_procedures, dbo)
 
-        # Update news file
-        ttask(utils.get_asm_news, dbo)
-
-        # Update any reports that have newer versions available
-        ttask(extreports.update_smcom_reports, dbo)
-
-        # Update on shelter and foster animal location fields
-        ttask(animal.update_on_shelter_animal_statuses, dbo)
-        ttask(animal.update_foster_animal_statuses, dbo)
-        ttask(animal.update_boarding_animal_statuses, dbo)
-
-        # Update on shelter, foster and young animal variable data (age, time on shelter, etc)
-        ttask(animal.update_on_shelter_variable_animal_data, dbo)
-        ttask(animal.update_foster_variable_animal_data, dbo)
-        ttask(animal.update_offshelter_young_variable_animal_data, dbo)
-
-        # Update locations of arriving boarders
-        ttask(financial.update_location_boarding_today, dbo)
-
-        # Update animal figures for reports
-        ttask(animal.update_animal_figures, dbo)
-        ttask(animal.update_animal_figures_annual, dbo)
-
-        # Update waiting list urgencies and auto remove
-        ttask(waitinglist.auto_remove_waitinglist, dbo)
-        ttask(waitinglist.auto_update_urgencies, dbo)
-
-        # Email diary notes to users
-        ttask(diary.email_uncompleted_upto_today, dbo)
-
-        # Update animal litter counts
-        ttask(animal.update_active_litters, dbo)
-
-        # Find any missing person geocodes
-        ttask(person.update_missing_geocodes, dbo)
-
-        # Clear out any old audit logs
-        ttask(audit.clean, dbo)
-
-        # Remove old publisher logs
-        ttask(publish.delete_old_publish_logs, dbo)
-
-        # auto cancel any reservations
-        ttask(movement.auto_cancel_reservations, dbo)
-
-        # auto cancel animal holds
-        ttask(animal.auto_cancel_holds, dbo)
-
-        # auto remove online forms
-        ttask(onlineform.auto_remove_old_incoming_forms, dbo)
-
-        # auto anonymise expired personal data
-        ttask(person.update_anonymise_personal_data, dbo)
-
-        # auto remove people who only have a cancelled reserve
-        ttask(person.remove_people_only_cancelled_reserve, dbo)
-
-        # auto remove expired media items
-        ttask(media.remove_expired_media, dbo)
-        ttask(media.remove_media_after_exit, dbo)
-
-        # auto update clinic statuses
-        ttask(clinic.auto_update_statuses, dbo)
-
-        # Update the generated looking for report
-        ttask(person.update_lookingfor_report, dbo)
-
-        # Update the generated lost/found match report
-        ttask(lostfound.update_match_report, dbo)
-
-        # Email any reports set to run with batch
-        ttask(extreports.email_daily_reports, dbo)
-
-        # Send automated person emails
-        ttask(automail.send_all, dbo)
+        # SQLite only allows one writer, tasks on their own connections would lock each other out
+        workers = CRON_DAILY_WORKERS
+        if dbo.dbtype == "SQLITE": workers = 1
+        run_tasks(dbo, select_tasks(DAILY_TASKS, task_only, task_skip), workers)
 
     except:
         em = str(sys.exc_info()[0])
-        al.error("FAIL: running batch tasks: %s" % em, "cron.daily", dbo, sys.exc_info())
+        fail("FAIL: running batch tasks: %s" % em, "cron.daily", dbo, sys.exc_info())
 
 def reports_email(dbo: Database):
     """
@@ -153,7 +276,7 @@ def reports_email(dbo: Database):
         extreports.email_daily_reports(dbo, dbo.now())
     except:
         em = str(sys.exc_info()[0])
-        al.error("FAIL: running daily email of reports_email: %s" % em, "cron.reports_email", dbo, sys.exc_info())
+        fail("FAIL: running daily email of reports_email: %s" % em, "cron.reports_email", dbo, sys.exc_info())
 
 def publish_3pty(dbo: Database):
     try:
@@ -169,10 +292,10 @@ def publish_3pty(dbo: Database):
                 publish.start_publisher(dbo, p, user="system", newthread=False)
             except: 
                 em = str(sys.exc_info()[0])
-                al.error("FAIL: uncaught error running publisher '%s': %s" % (p, em), "cron.publish_3pty", dbo, sys.exc_info())
+                fail("FAIL: uncaught error running publisher '%s': %s" % (p, em), "cron.publish_3pty", dbo, sys.exc_info())
     except:
         em = str(sys.exc_info()[0])
-        al.error("FAIL: uncaught error running third party publishers: %s" % em, "cron.publish_3pty", dbo, sys.exc_info())
+        fail("FAIL: uncaught error running third party publishers: %s" % em, "cron.publish_3pty", dbo, sys.exc_info())
 
 def publish_3pty_sub24(dbo: Database):
     try:
@@ -186,12 +309,15 @@ def publish_3pty_sub24(dbo: Database):
         elif freq == 6 and hournow not in [3,9,13,19]: return
         elif freq == 8 and hournow not in [1,9,17]: return
         elif freq == 12 and hournow not in [0,12]: return
+        # The first run of the day sends everything, later runs only send
+        # the changes for publishers that support it
+        delta = hournow >= freq
         for p in publishers.split(" "):
             if p in publish.PUBLISHER_LIST and publish.PUBLISHER_LIST[p]["sub24hour"]:
-                publish.start_publisher(dbo, p, user="system", newthread=False)
+                publish.start_publisher(dbo, p, user="system", newthread=False, delta=delta)
     except:
         em = str(sys.exc_info()[0])
-        al.error("FAIL: uncaught error running sub24 third party publishers: %s" % em, "cron.publish_3pty_sub24", dbo, sys.exc_info())
+        fail("FAIL: uncaught error running sub24 third party publishers: %s" % em, "cron.publish_3pty_sub24", dbo, sys.exc_info())
 
 def publish_html(dbo: Database):
     try :
@@ -199,7 +325,7 @@ def publish_html(dbo: Database):
             publish.start_publisher(dbo, "html", user="system", newthread=False)
     except:
         em = str(sys.exc_info()[0])
-        al.error("FAIL: uncaught error running html publisher: %s" % em, "cron.publish_html", dbo, sys.exc_info())
+        fail("FAIL: uncaught error running html publisher: %s" % em, "cron.publish_html", dbo, sys.exc_info())
 
 def maint_import_report(dbo: Database):
     try:
@@ -208,28 +334,31 @@ def maint_import_report(dbo: Database):
     except:
         em = str(sys.exc_info()[0])
         print(em) # This one is designed to be run from the command line rather than cron
-        al.error("FAIL: uncaught error running import report: %s" % em, "cron.maint_import_report", dbo, sys.exc_info())
+        fail("FAIL: uncaught error running import report: %s" % em, "cron.maint_import_report", dbo, sys.exc_info())
 
 def maint_recode_all(dbo: Database):
     try:
-        animal.maintenance_reassign_all_codes(dbo)
+        with dbo.transaction():
+            animal.maintenance_reassign_all_codes(dbo)
     except:
         em = str(sys.exc_info()[0])
-        al.error("FAIL: uncaught error running maint_recode_all: %s" % em, "cron.maint_recode_all", dbo, sys.exc_info())
+        fail("FAIL: uncaught error running maint_recode_all: %s" % em, "cron.maint_recode_all", dbo, sys.exc_info())
 
 def maint_variable_data(dbo: Database):
     try:
-        animal.update_all_variable_animal_data(dbo)
+        with dbo.transaction():
+            animal.update_all_variable_animal_data(dbo)
     except:
         em = str(sys.exc_info()[0])
-        al.error("FAIL: uncaught error running maint_variable_data: %s" % em, "cron.maint_variable_data", dbo, sys.exc_info())
+        fail("FAIL: uncaught error running maint_variable_data: %s" % em, "cron.maint_variable_data", dbo, sys.exc_info())
 
 def maint_recode_shelter(dbo: Database):
     try:
-        animal.maintenance_reassign_shelter_codes(dbo)
+        with dbo.transaction():
+            animal.maintenance_reassign_shelter_codes(dbo)
     except:
         em = str(sys.exc_info()[0])
-        al.error("FAIL: uncaught error running maint_recode_shelter: %s" % em, "cron.maint_recode_shelter", dbo, sys.exc_info())
+        fail("FAIL: uncaught error running maint_recode_shelter: %s" % em, "cron.maint_recode_shelter", dbo, sys.exc_info())
 
 def maint_animal_figures(dbo: Database):
     try:
@@ -238,14 +367,14 @@ def maint_animal_figures(dbo: Database):
         animal.maintenance_animal_figures(dbo, includeMonths = True, includeAnnual = True)
     except:
         em = str(sys.exc_info()[0])
-        al.error("FAIL: uncaught error running maint_animal_figures: %s" % em, "cron.maint_animal_figures", dbo, sys.exc_info())
+        fail("FAIL: uncaught error running maint_animal_figures: %s" % em, "cron.maint_animal_figures", dbo, sys.exc_info())
 
 def maint_animal_figures_annual(dbo: Database):
     try:
         animal.maintenance_animal_figures(dbo, includeMonths = False, includeAnnual = True)
     except:
         em = str(sys.exc_info()[0])
-        al.error("FAIL: uncaught error running maint_animal_figures_annual: %s" % em, "cron.maint_animal_figures_annual", dbo, sys.exc_info())
+        fail("FAIL: uncaught error running maint_animal_figures_annual: %s" % em, "cron.maint_animal_figures_annual", dbo, sys.exc_info())
 
 def maint_db_diagnostic(dbo: Database):
     try:
@@ -254,7 +383,7 @@ def maint_db_diagnostic(dbo: Database):
             print("%s: %s" % (k, v))
     except:
         em = str(sys.exc_info()[0])
-        al.error("FAIL: uncaught error running maint_db_diagnostic: %s" % em, "cron.maint_db_diagnostic", dbo, sys.exc_info())
+        fail("FAIL: uncaught error running maint_db_diagnostic: %s" % em, "cron.maint_db_diagnostic", dbo, sys.exc_info())
 
 def maint_db_fix_preferred_photos(dbo: Database):
     try:
@@ -262,77 +391,77 @@ def maint_db_fix_preferred_photos(dbo: Database):
         print("Fixed %d" % d)
     except:
         em = str(sys.exc_info()[0])
-        al.error("FAIL: uncaught error running maint_db_fix_preferred_photos: %s" % em, "cron.maint_db_fix_preferred_photos", dbo, sys.exc_info())
+        fail("FAIL: uncaught error running maint_db_fix_preferred_photos: %s" % em, "cron.maint_db_fix_preferred_photos", dbo, sys.exc_info())
 
 def maint_db_dump(dbo: Database):
     try:
         for x in dbupdate.dump(dbo):
-            print(x)
+            print(x, end="")
     except:
         em = str(sys.exc_info()[0])
-        al.error("FAIL: uncaught error running maint_db_dump: %s" % em, "cron.maint_db_dump", dbo, sys.exc_info())
+        fail("FAIL: uncaught error running maint_db_dump: %s" % em, "cron.maint_db_dump", dbo, sys.exc_info())
 
 def maint_db_dump_hsqldb(dbo: Database):
     try:
         for x in dbupdate.dump_hsqldb(dbo):
-            print(x)
+            print(x, end="")
     except:
         em = str(sys.exc_info()[0])
-        al.error("FAIL: uncaught error running maint_db_dump_hsqldb: %s" % em, "cron.maint_db_dump_hsqldb", dbo, sys.exc_info())
+        fail("FAIL: uncaught error running maint_db_dump_hsqldb: %s" % em, "cron.maint_db_dump_hsqldb", dbo, sys.exc_info())
 
 def maint_db_dump_dbfs_base64(dbo: Database):
     try:
         for x in dbupdate.dump_dbfs_base64(dbo):
-            print(x)
+            print(x, end="")
     except:
         em = str(sys.exc_info()[0])
-        al.error("FAIL: uncaught error running maint_db_dump_dbfs_base64: %s" % em, "cron.maint_db_dump_dbfs_base64", dbo, sys.exc_info())
+        fail("FAIL: uncaught error running maint_db_dump_dbfs_base64: %s" % em, "cron.maint_db_dump_dbfs_base64", dbo, sys.exc_info())
 
 def maint_db_dump_dbfs_files(dbo: Database):
     try:
         for x in dbupdate.dump_dbfs_files(dbo):
-            print(x)
+            print(x, end="")
     except:
         em = str(sys.exc_info()[0])
-        al.error("FAIL: uncaught error running maint_db_dump_dbfs_files: %s" % em, "cron.maint_db_dump_dbfs_files", dbo, sys.exc_info())
+        fail("FAIL: uncaught error running maint_db_dump_dbfs_files: %s" % em, "cron.maint_db_dump_dbfs_files", dbo, sys.exc_info())
 
 def maint_db_dump_lookups(dbo: Database):
     try:
         for x in dbupdate.dump_lookups(dbo):
-            print(x)
+            print(x, end="")
     except:
         em = str(sys.exc_info()[0])
-        al.error("FAIL: uncaught error running maint_db_dump_lookups: %s" % em, "cron.maint_db_dump_lookups", dbo, sys.exc_info())
+        fail("FAIL: uncaught error running maint_db_dump_lookups: %s" % em, "cron.maint_db_dump_lookups", dbo, sys.exc_info())
 
 def maint_db_dump_merge(dbo: Database):
     try:
         for x in dbupdate.dump_merge(dbo):
-            print(x)
+            print(x, end="")
     except:
         em = str(sys.exc_info()[0])
-        al.error("FAIL: uncaught error running maint_db_dump_merge: %s" % em, "cron.maint_db_dump_merge", dbo, sys.exc_info())
+        fail("FAIL: uncaught error running maint_db_dump_merge: %s" % em, "cron.maint_db_dump_merge", dbo, sys.exc_info())
 
 def maint_db_dump_smcom(dbo: Database):
     try:
         for x in dbupdate.dump_smcom(dbo):
-            print(x)
+            print(x, end="")
     except:
         em = str(sys.exc_info()[0])
-        al.error("FAIL: uncaught error running maint_db_dump_smcom: %s" % em, "cron.maint_db_dump_smcom", dbo, sys.exc_info())
+        fail("FAIL: uncaught error running maint_db_dump_smcom: %s" % em, "cron.maint_db_dump_smcom", dbo, sys.exc_info())
 
 def maint_db_dump_animalcsv(dbo: Database):
     try:
         print(utils.bytes2str(utils.csv(dbo.locale, animal.get_animal_find_advanced(dbo, { "logicallocation" : "all", "includedeceased": "true", "includenonshelter": "true" }))))
     except:
         em = str(sys.exc_info()[0])
-        al.error("FAIL: uncaught error running maint_db_dump_animalcsv: %s" % em, "cron.maint_db_dump_animalcsv", dbo, sys.exc_info())
+        fail("FAIL: uncaught error running maint_db_dump_animalcsv: %s" % em, "cron.maint_db_dump_animalcsv", dbo, sys.exc_info())
 
 def maint_db_dump_personcsv(dbo: Database):
     try:
         print(utils.bytes2str(utils.csv(dbo.locale, person.get_person_find_simple(dbo, "", "system", classfilter="all", includeStaff=True, includeVolunteers=True, limit=0))))
     except:
         em = str(sys.exc_info()[0])
-        al.error("FAIL: uncaught error running maint_db_dump_personcsv: %s" % em, "cron.maint_db_dump_personcsv", dbo, sys.exc_info())
+        fail("FAIL: uncaught error running maint_db_dump_personcsv: %s" % em, "cron.maint_db_dump_personcsv", dbo, sys.exc_info())
 
 def maint_db_dump_zip(dbo: Database):
     try:
@@ -368,41 +497,41 @@ def maint_db_dump_zip(dbo: Database):
         print(f"All data files exported to /tmp/{dbname}.zip")
     except:
         em = str(sys.exc_info()[0])
-        al.error("FAIL: uncaught error running maint_db_dump_zip: %s" % em, "cron.maint_db_dump_zip", dbo, sys.exc_info())
+        fail("FAIL: uncaught error running maint_db_dump_zip: %s" % em, "cron.maint_db_dump_zip", dbo, sys.exc_info())
 
 def maint_db_install(dbo: Database):
     try:
         dbupdate.install(dbo)
     except:
         em = str(sys.exc_info()[0])
-        al.error("FAIL: uncaught error running maint_db_install: %s" % em, "cron.maint_db_install", dbo, sys.exc_info())
+        fail("FAIL: uncaught error running maint_db_install: %s" % em, "cron.maint_db_install", dbo, sys.exc_info())
 
 def maint_db_reinstall(dbo: Database):
     try:
         dbupdate.reinstall_default_data(dbo)
     except:
         em = str(sys.exc_info()[0])
-        al.error("FAIL: uncaught error running maint_db_reinstall: %s" % em, "cron.maint_db_reinstall", dbo, sys.exc_info())
+        fail("FAIL: uncaught error running maint_db_reinstall: %s" % em, "cron.maint_db_reinstall", dbo, sys.exc_info())
 
 def maint_db_reinstall_default_templates(dbo: Database):
     try:
         dbupdate.install_default_templates(dbo, True)
     except:
         em = str(sys.exc_info()[0])
-        al.error("FAIL: uncaught error running maint_db_reinstall_default_templates: %s" % em, "cron.maint_db_reinstall_default_templates", dbo, sys.exc_info())
+        fail("FAIL: uncaught error running maint_db_reinstall_default_templates: %s" % em, "cron.maint_db_reinstall_default_templates", dbo, sys.exc_info())
 
 def maint_db_reinstall_default_onlineforms(dbo: Database):
     try:
         dbupdate.install_default_onlineforms(dbo, True)
     except:
         em = str(sys.exc_info()[0])
-        al.error("FAIL: uncaught error running maint_db_reinstall_default_onlineforms: %s" % em, "cron.maint_db_reinstall_default_onlineforms", dbo, sys.exc_info())
+        fail("FAIL: uncaught error running maint_db_reinstall_default_onlineforms: %s" % em, "cron.maint_db_reinstall_default_onlineforms", dbo, sys.exc_info())
 
 def maint_db_replace_doc_image(dbo: Database):
     try:
         if "FINDSTR" not in os.environ or "REPLACESTR" not in os.environ:
             msg = "FAIL: FINDSTR and REPLACESTR environment variables are needed by replace_doc_image"
-            al.error(msg)
+            fail(msg, "cron.maint_db_replace_doc_image", dbo)
             print(msg)
             return
         findstr = os.environ["FINDSTR"]
@@ -410,28 +539,28 @@ def maint_db_replace_doc_image(dbo: Database):
         media.replace_doc_image(dbo, findstr, replacestr)
     except:
         em = str(sys.exc_info()[0])
-        al.error("FAIL: uncaught error running maint_db_replace_doc_image: %s" % em, "cron.maint_db_replace_doc_image", dbo, sys.exc_info())
+        fail("FAIL: uncaught error running maint_db_replace_doc_image: %s" % em, "cron.maint_db_replace_doc_image", dbo, sys.exc_info())
 
 def maint_db_replace_html_entities(dbo: Database):
     try:
         dbupdate.replace_html_entities(dbo)
     except:
         em = str(sys.exc_info()[0])
-        al.error("FAIL: uncaught error running maint_db_replace_html_entities: %s" % em, "cron.maint_db_replace_html_entities", dbo, sys.exc_info())
+        fail("FAIL: uncaught error running maint_db_replace_html_entities: %s" % em, "cron.maint_db_replace_html_entities", dbo, sys.exc_info())
 
 def maint_db_reset(dbo: Database):
     try:
         dbupdate.reset_db(dbo)
     except:
         em = str(sys.exc_info()[0])
-        al.error("FAIL: uncaught error running maint_db_reset: %s" % em, "cron.maint_db_reset", dbo, sys.exc_info())
+        fail("FAIL: uncaught error running maint_db_reset: %s" % em, "cron.maint_db_reset", dbo, sys.exc_info())
 
 def maint_db_delete_orphaned_media(dbo: Database):
     try:
         dbfs.delete_orphaned_media(dbo)
     except:
         em = str(sys.exc_info()[0])
-        al.error("FAIL: uncaught error running maint_db_delete_orphaned_media: %s" % em, "cron.maint_db_delete_orphaned_media", dbo, sys.exc_info())
+        fail("FAIL: uncaught error running maint_db_delete_orphaned_media: %s" % em, "cron.maint_db_delete_orphaned_media", dbo, sys.exc_info())
 
 def maint_db_update(dbo: Database):
     """
@@ -454,7 +583,7 @@ def maint_db_update(dbo: Database):
 
     except:
         em = str(sys.exc_info()[0])
-        al.error("FAIL: running db updates: %s" % em, "cron.maint_db_update", dbo, sys.exc_info())
+        fail("FAIL: running db updates: %s" % em, "cron.maint_db_update", dbo, sys.exc_info())
 
 def maint_db_update_stdout(dbo: Database):
     """
@@ -467,44 +596,70 @@ def maint_deduplicate_people(dbo: Database):
         person.merge_duplicate_people(dbo, "cron")
     except:
         em = str(sys.exc_info()[0])
-        al.error("FAIL: uncaught error running maint_deduplicate_people: %s" % em, "cron.maint_deduplicate_people", dbo, sys.exc_info())
+        fail("FAIL: uncaught error running maint_deduplicate_people: %s" % em, "cron.maint_deduplicate_people", dbo, sys.exc_info())
+
+def maint_deduplicate_people_fuzzy(dbo: Database):
+    try:
+        person.merge_duplicate_people(dbo, "cron", [ person.DEDUP_NAME, person.DEDUP_EMAIL, person.DEDUP_MOBILE, person.DEDUP_ADDRESS ])
+    except:
+        em = str(sys.exc_info()[0])
+        fail("FAIL: uncaught error running maint_deduplicate_people_fuzzy: %s" % em, "cron.maint_deduplicate_people_fuzzy", dbo, sys.exc_info())
 
 def maint_disk_cache(dbo: Database):
     try:
         cachedisk.remove_expired(dbo.name())
+        imagecache.remove_expired()
     except:
         em = str(sys.exc_info()[0])
-        al.error("FAIL: uncaught error running remove_expired: %s" % em, "cron.maint_disk_cache", dbo, sys.exc_info())
+        fail("FAIL: uncaught error running remove_expired: %s" % em, "cron.maint_disk_cache", dbo, sys.exc_info())
+
+def maint_mail_queue(dbo: Database):
+    try:
+        mailqueue.process_queue()
+    except:
+        em = str(sys.exc_info()[0])
+        fail("FAIL: uncaught error running maint_mail_queue: %s" % em, "cron.maint_mail_queue", dbo, sys.exc_info())
+
+def send_queued_mail(dbo: Database):
+    try:
+        mailqueue.process_queue(dbname=dbo.name())
+    except:
+        em = str(sys.exc_info()[0])
+        # Not a failure of the mode, the messages are still in the queue for maint_mail_queue
+        al.error("FAIL: uncaught error running send_queued_mail: %s" % em, "cron.send_queued_mail", dbo, sys.exc_info())
 
 def maint_scale_animal_images(dbo: Database):
     try:
         media.scale_all_animal_images(dbo)
     except:
         em = str(sys.exc_info()[0])
-        al.error("FAIL: uncaught error running maint_scale_animal_images: %s" % em, "cron.maint_scale_animal_images", dbo, sys.exc_info())
+        fail("FAIL: uncaught error running maint_scale_animal_images: %s" % em, "cron.maint_scale_animal_images", dbo, sys.exc_info())
 
 def maint_scale_odts(dbo: Database):
     try:
         media.scale_all_odt(dbo)
     except:
         em = str(sys.exc_info()[0])
-        al.error("FAIL: uncaught error running maint_scale_odts: %s" % em, "cron.maint_scale_odts", dbo, sys.exc_info())
+        fail("FAIL: uncaught error running maint_scale_odts: %s" % em, "cron.maint_scale_odts", dbo, sys.exc_info())
 
 def maint_scale_pdfs(dbo: Database):
     try:
         media.scale_all_pdf(dbo)
     except:
         em = str(sys.exc_info()[0])
-        al.error("FAIL: uncaught error running maint_scale_pdfs: %s" % em, "cron.maint_scale_pdfs", dbo, sys.exc_info())
+        fail("FAIL: uncaught error running maint_scale_pdfs: %s" % em, "cron.maint_scale_pdfs", dbo, sys.exc_info())
 
 def maint_switch_dbfs_storage(dbo: Database):
     try:
         dbfs.switch_storage(dbo)
     except:
         em = str(sys.exc_info()[0])
-        al.error("FAIL: uncaught error running maint_dbfs_switch_storage: %s" % em, "cron.maint_switch_dbfs_storage", dbo, sys.exc_info())
+        fail("FAIL: uncaught error running maint_dbfs_switch_storage: %s" % em, "cron.maint_switch_dbfs_storage", dbo, sys.exc_info())
 
-def run(dbo: Database, mode: str) -> None:
+def run(dbo: Database, mode: str) -> int:
+    """ Runs mode for dbo, returns 0 for success or 1 if it had an uncaught error """
+    global status
+    status = 0
     # If the task is maint_db_install, then there won't be a 
     # locale or timezone to read
     x = time.time()
@@ -600,18 +755,89 @@ def run(dbo: Database, mode: str) -> None:
         maint_db_delete_orphaned_media(dbo)
     elif mode == "maint_deduplicate_people":
         maint_deduplicate_people(dbo)
+    elif mode == "maint_deduplicate_people_fuzzy":
+        maint_deduplicate_people_fuzzy(dbo)
     elif mode == "maint_disk_cache":
         maint_disk_cache(dbo)
+    elif mode == "maint_mail_queue":
+        maint_mail_queue(dbo)
+
+    # Send any messages this task queued for the database before the
+    # process exits, the rest of the queue is left to maint_mail_queue
+    if mode != "maint_mail_queue":
+        send_queued_mail(dbo)
 
     elapsed = time.time() - x
-    al.info("end %s: elapsed %0.2f secs" % (mode, elapsed), "cron.run", dbo)
+    al.info("end %s: elapsed %0.2f secs (status %d)" % (mode, elapsed, status), "cron.run", dbo)
+    return status
+
+def run_map_database(mode: str, alias: str) -> int:
+    dbo = db.get_database(alias)
+    dbo.timeout = 0
+    dbo.connection = dbo.connect()
+    return run(dbo, mode)
+
+def run_map_database_process(mode: str, alias: str) -> None:
+    """ Target for the processes started by run_parallel, exits with the status from run """
+    try:
+        rv = run_map_database(mode, alias)
+    except:
+        em = str(sys.exc_info()[1])
+        al.error("FAIL: uncaught error running %s for %s: %s" % (mode, alias, em), "cron.run_map_database_process", None, sys.exc_info())
+        rv = 1
+    sys.exit(rv)
 
 def run_all_map_databases(mode: str) -> None:
+    if CRON_WORKERS > 1:
+        run_parallel(mode, list(MULTIPLE_DATABASES_MAP.keys()), CRON_WORKERS, CRON_DATABASE_TIMEOUT, CRON_RETRIES)
+        return
     for alias in MULTIPLE_DATABASES_MAP.keys():
-        dbo = db.get_database(alias)
-        dbo.timeout = 0
-        dbo.connection = dbo.connect()
-        run(dbo, mode)
+        run_map_database(mode, alias)
+
+def run_parallel(mode: str, aliases: List[str], workers: int, timeout: int = 0, retries: int = 0, 
+                 target: Callable = run_map_database_process) -> Dict[str, Tuple[str, float, int]]:
+    """
+    Runs mode for each of the map database aliases given, with up to workers
+    of them running at once. Each database runs in its own process (so it
+    has its own database connection) and is stopped if it takes longer than
+    timeout seconds (0 for no limit). Databases that fail (exit with a non-zero
+    status) or are stopped are retried up to retries times.
+    target: The function run in each process with (mode, alias)
+    Returns a dictionary of alias: (result, elapsed secs, attempts)
+    """
+    x = time.time()
+    todo = [ (alias, 1) for alias in aliases ]
+    running = {} # alias: (process, started, attempt)
+    results = {}
+    while len(todo) > 0 or len(running) > 0:
+        while len(todo) > 0 and len(running) < workers:
+            alias, attempt = todo.pop(0)
+            p = multiprocessing.Process(target=target, args=(mode, alias), name="cron-%s" % alias)
+            p.start()
+            running[alias] = (p, time.time(), attempt)
+        time.sleep(0.5)
+        for alias, (p, started, attempt) in list(running.items()):
+            elapsed = time.time() - started
+            if p.is_alive():
+                if timeout == 0 or elapsed < timeout: continue
+                p.terminate()
+                p.join()
+                result = "timed out"
+            else:
+                p.join()
+                result = p.exitcode == 0 and "ok" or "failed (exit code %s)" % p.exitcode
+            del running[alias]
+            results[alias] = (result, elapsed, attempt)
+            if result == "ok":
+                al.info("%s %s: ok in %0.2f secs (attempt %d)" % (mode, alias, elapsed, attempt), "cron.run_parallel")
+            elif attempt <= retries:
+                al.warn("%s %s: %s after %0.2f secs (attempt %d), retrying" % (mode, alias, result, elapsed, attempt), "cron.run_parallel")
+                todo.append((alias, attempt + 1))
+            else:
+                al.error("%s %s: %s after %0.2f secs (attempt %d)" % (mode, alias, result, elapsed, attempt), "cron.run_parallel")
+    failed = [ k for k, v in results.items() if v[0] != "ok" ]
+    al.info("%s: %d databases ok, %d failed %s in %0.2f secs with %d workers" % (mode, len(results) - len(failed), len(failed), failed, time.time() - x, workers), "cron.run_parallel")
+    return results
 
 def run_default_database(mode: str) -> None:
     dbo = db.get_database()
@@ -643,7 +869,10 @@ def run_override_database(mode: str, dbtype: str, host: str, port: int, username
     run(dbo, mode)
 
 def print_usage() -> None:
-    print("Usage: cron.py mode [alias]")
+    print("Usage: cron.py [--only=task,task] [--skip=task,task] mode [alias]")
+    print("")
+    print("           --only and --skip choose which tasks the daily mode runs by name:")
+    print("           %s" % ", ".join(t.name for t in DAILY_TASKS))
     print("")
     print("           alias is a database alias to find info from. If none is given")
     print("           in multi database/map mode, the task is run for all databases")
@@ -679,7 +908,9 @@ def print_usage() -> None:
     print("       maint_db_delete_orphaned_media - delete all entries from the dbfs not in media")
     print("       maint_db_update - run any outstanding database updates")
     print("       maint_deduplicate_people - automatically merge duplicate people records")
+    print("       maint_deduplicate_people_fuzzy - as above, also matching on first name with email, mobile or normalised address")
     print("       maint_disk_cache - remove expired entries from the disk cache")
+    print("       maint_mail_queue - send any messages that are due in the mail queue")
     print("       maint_import_report - import report txt set file in ASM3_REPORT env")
     print("       maint_recode_all - regenerate all animal codes")
     print("       maint_recode_shelter - regenerate animals codes for all shelter animals")
@@ -690,6 +921,19 @@ def print_usage() -> None:
     print("       maint_variable_data - recalculate all variable data for all animals")
 
 if __name__ == "__main__": 
+    # Take out the options for choosing daily tasks
+    for a in [ x for x in sys.argv if x.startswith("--") ]:
+        sys.argv.remove(a)
+        if a.startswith("--only="): task_only = a[7:].split(",")
+        elif a.startswith("--skip="): task_skip = a[7:].split(",")
+        else:
+            print_usage()
+            sys.exit(1)
+    try:
+        select_tasks(DAILY_TASKS, task_only, task_skip)
+    except ValueError as err:
+        print(err)
+        sys.exit(1)
     if len(sys.argv) == 2 and not MULTIPLE_DATABASES:
         # mode argument given and we have a single database
         run_default_database(sys.argv[1])
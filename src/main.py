@@ -270,6 +270,7 @@ class ASMEndpoint(object):
     login_url = "login"    # The url to go to if not logged in
     data = None            # Request data posted to this endpoint as bytes or str if data_encoding is set
     data_encoding = None   # codec to use for decoding of posted data to str (None to not decode)
+    post_transaction = False # Run POST handlers as a single unit of work that commits once at the end (dbo.transaction)
 
     def _params(self) -> None:
         l = session.locale
@@ -474,6 +475,13 @@ class ASMEndpoint(object):
             self.check_locked_db()
         self.check(self.post_permissions)
         o = self._params()
+        if self.post_transaction and o.dbo is not None:
+            with o.dbo.transaction():
+                return self.post_dispatch(o)
+        return self.post_dispatch(o)
+
+    def post_dispatch(self, o) -> str:
+        """ Calls post_all or the post_mode handler for the mode posted """
         mode = o.post["mode"]
         if mode == "": 
             return self.post_all(o)
@@ -631,21 +639,8 @@ class image(ASMEndpoint):
 
     def content(self, o):
         try:
-            # Use a read through disk cache for thumbnails.
-            # This saves on database calls and thumbnail scaling for busier sites.
-            # We only cache if a date parameter is specified so that changing the date can invalidate the cache.
-            cache_indicator = ""
-            if o.post["date"] != "" and o.post["mode"].endswith("thumb"):
-                cache_key = "%s:id=%s:seq=%s:date=%s" % ( o.post["mode"], o.post["id"], o.post.integer("seq"), o.post["date"])
-                cache_path = o.dbo.name()
-                imagedata = asm3.cachedisk.get(cache_key, cache_path)
-                cache_indicator = asm3.utils.iif(imagedata is None, "", " from cache")
-                if imagedata is None:
-                    lastmod, imagedata = asm3.media.get_image_file_data(o.dbo, o.post["mode"], o.post["id"], o.post.integer("seq"), False)
-                    if len(imagedata) > 50: # Never cache empty/broken thumbnails
-                        asm3.cachedisk.put(cache_key, cache_path, imagedata, CACHE_ONE_WEEK)
-            else:
-                lastmod, imagedata = asm3.media.get_image_file_data(o.dbo, o.post["mode"], o.post["id"], o.post.integer("seq"), False)
+            # Thumbnails are served from the derivative store (see imagecache)
+            lastmod, imagedata = asm3.media.get_image_file_data(o.dbo, o.post["mode"], o.post["id"], o.post.integer("seq"), False)
         except Exception as err:
             # The call to get_image_file_data can produce a lot of errors when people try to access 
             # images via unsubstituted tokens in documents, etc. 
@@ -663,7 +658,7 @@ class image(ASMEndpoint):
             else:
                 # otherwise cache for an hour in CDNs and just for the day locally
                 self.cache_control(CACHE_ONE_DAY, CACHE_ONE_HOUR)
-            asm3.al.debug("mode=%s id=%s seq=%s (%s bytes%s)" % (o.post["mode"], o.post["id"], o.post["seq"], len(imagedata), cache_indicator), "image.content", o.dbo)
+            asm3.al.debug("mode=%s id=%s seq=%s (%s bytes)" % (o.post["mode"], o.post["id"], o.post["seq"], len(imagedata)), "image.content", o.dbo)
             return imagedata
         else:
             # If a parameter of nopic=404 is passed, we return a 404 instead of redirecting to nopic
@@ -1824,6 +1819,7 @@ class additional(JSONEndpoint):
 class animal(JSONEndpoint):
     url = "animal"
     get_permissions = asm3.users.VIEW_ANIMAL
+    post_transaction = True
 
     def controller(self, o):
         dbo = o.dbo
@@ -2342,6 +2338,7 @@ class animal_movements(JSONEndpoint):
 class animal_new(JSONEndpoint):
     url = "animal_new"
     get_permissions = asm3.users.ADD_ANIMAL
+    post_transaction = True
 
     def controller(self, o):
         dbo = o.dbo
@@ -6097,6 +6094,7 @@ class pp_square(ASMEndpoint):
 class person(JSONEndpoint):
     url = "person"
     get_permissions = asm3.users.VIEW_PERSON
+    post_transaction = True
 
     def controller(self, o):
         dbo = o.dbo
@@ -6748,7 +6746,7 @@ class publish_options(JSONEndpoint):
         userid, userpwd = asm3.publishers.vetenvoy.VetEnvoyUSMicrochipPublisher.signup(o.dbo, o.post)
         return "%s,%s" % (userid, userpwd)
 
-class report(ASMEndpoint):
+class report(GeneratorEndpoint):
     url = "report"
     get_permissions = asm3.users.VIEW_REPORT
 
@@ -6768,8 +6766,8 @@ class report(ASMEndpoint):
         p = asm3.reports.get_criteria_params(dbo, crid, post)
         if asm3.configuration.audit_on_view_report(dbo):
             asm3.audit.view_report(dbo, o.user, crid, title, str(post.data))
-        s = asm3.reports.execute(dbo, crid, o.user, p)
-        return s
+        # The report is sent as it is generated rather than built in memory first
+        yield from asm3.reports.execute_stream(dbo, crid, o.user, p)
 
 class report_criteria(JSONEndpoint):
     url = "report_criteria"
@@ -7,10 +7,15 @@ import test_additional
 import test_animalcontrol
 import test_animalname
 import test_animal
+import test_asynctask
 import test_automail
+import test_cachedisk
 import test_checkmicrochip
 import test_clinic
+import test_configuration
+import test_cron
 import test_csvimport
+import test_db
 import test_dbfs
 import test_dbupdate
 import test_diary
@@ -18,8 +23,10 @@ import test_event
 import test_financial
 import test_geo
 import test_html
+import test_imagecache
 import test_log
 import test_lookups
+import test_mailqueue
 import test_lostfound
 import test_media
 import test_medical
@@ -45,10 +52,15 @@ fullsuite = [
     lt(test_animalcontrol),
     lt(test_animalname),
     lt(test_animal),
+    lt(test_asynctask),
     lt(test_automail),
+    lt(test_cachedisk),
     lt(test_checkmicrochip),
     lt(test_clinic),
+    lt(test_configuration),
+    lt(test_cron),
     lt(test_csvimport),
+    lt(test_db),
     lt(test_dbfs),
     lt(test_dbupdate),
     lt(test_diary),
@@ -56,8 +68,10 @@ fullsuite = [
     lt(test_financial),
     lt(test_geo),
     lt(test_html),
+    lt(test_imagecache),
     lt(test_log),
     lt(test_lookups),
+    lt(test_mailqueue),
     lt(test_lostfound),
     lt(test_media),
     lt(test_medical),
@@ -3,6 +3,7 @@ import unittest
 import base
 
 import asm3.additional
+import asm3.dbms.base
 import asm3.utils
 
 class TestAdditional(unittest.TestCase):
@@ -35,6 +36,24 @@ class TestAdditional(unittest.TestCase):
     def test_get_additional_fields_ids(self):
         asm3.additional.get_additional_fields_ids(base.get_dbo(), [], "animal")
 
+    def test_append_to_results(self):
+        dbo = base.get_dbo()
+        asm3.additional.insert_additional(dbo, asm3.additional.ANIMAL, 99998, self.nid, "1")
+        rows = [ asm3.dbms.base.ResultRow(ID=99998), asm3.dbms.base.ResultRow(ID=99999, ADDNAME="clash") ]
+        chunksize = asm3.additional.CHUNK_SIZE
+        asm3.additional.CHUNK_SIZE = 1
+        try:
+            asm3.additional.append_to_results(dbo, rows, "animal")
+        finally:
+            asm3.additional.CHUNK_SIZE = chunksize
+        self.assertEqual("1", rows[0].ADDNAME)
+        self.assertEqual("clash", rows[1].ADDNAME)
+        self.assertIsNone(rows[1].ADDADDNAME)
+        for af in asm3.additional.get_additional_fields(dbo, 99998, "animal"):
+            self.assertEqual(af.VALUE, rows[0][af.FIELDNAME.upper()])
+        self.assertEqual(1, len(asm3.additional.get_additional_fields_ids(dbo, rows, "animal")))
+        dbo.delete("additional", "LinkID=99998")
+
     def test_get_field_definitions(self):
         self.assertNotEqual( len(asm3.additional.get_field_definitions(base.get_dbo(), "animal")), 0 )
 
@@ -1,5 +1,5 @@
 
-import unittest
+import datetime, unittest
 import base
 import asm3.animal
 import asm3.utils
@@ -359,6 +359,33 @@ class TestAnimal(unittest.TestCase):
         asm3.animal.get_number_litters_on_shelter(base.get_dbo(), base.today())
         asm3.animal.get_number_animals_on_foster(base.get_dbo(), base.today(), 1)
 
+    def test_figures_inventory(self):
+        dbo = base.get_dbo()
+        post = asm3.utils.PostedData({ "animalname": "Testio", "estimatedage": "1", "animaltype": "2", "entryreason": "1", "species": "2" }, "en")
+        aid, code = asm3.animal.insert_animal_from_form(dbo, post, "test")
+        dbo.update("animal", self.nid, { "DateBroughtIn": datetime.datetime(2020, 3, 3, 12, 0), "DateOfBirth": datetime.datetime(2019, 9, 1, 12, 0) })
+        dbo.update("animal", aid, { "DateBroughtIn": datetime.datetime(2020, 2, 20, 12, 0), "DeceasedDate": datetime.datetime(2020, 3, 12, 12, 0) })
+        mids = [
+            dbo.insert("adoption", { "AnimalID": self.nid, "OwnerID": 0, "AdoptionNumber": "T1", "MovementType": 2, "ReturnedReasonID": 0,
+                "MovementDate": datetime.datetime(2020, 3, 10, 12, 0), "ReturnDate": datetime.datetime(2020, 3, 15, 12, 0) }, "test"),
+            dbo.insert("adoption", { "AnimalID": self.nid, "OwnerID": 0, "AdoptionNumber": "T2", "MovementType": 1, "ReturnedReasonID": 0,
+                "MovementDate": datetime.datetime(2020, 3, 20, 12, 0) }, "test") ]
+        lid = dbo.insert("animallitter", { "SpeciesID": 1, "ParentAnimalID": 0, "AcceptanceNumber": "T", "Date": datetime.datetime(2020, 3, 4, 12, 0), 
+            "InvalidDate": datetime.datetime(2020, 3, 25, 12, 0), "NumberInLitter": 1, "CachedAnimalsLeft": 1 })
+        inv = asm3.animal.FiguresInventory(dbo, datetime.datetime(2020, 3, 1), 31)
+        for i in range(0, 31):
+            d = datetime.datetime(2020, 3, i + 1)
+            for sp in (1, 2):
+                self.assertEqual(asm3.animal.get_number_animals_on_shelter(dbo, d, sp), inv.on_shelter("SPECIESID").get(sp, [0] * 31)[i])
+                self.assertEqual(asm3.animal.get_number_animals_on_shelter(dbo, d, sp, ageselection=1), inv.on_shelter("SPECIESID", 1).get(sp, [0] * 31)[i])
+                self.assertEqual(asm3.animal.get_number_animals_on_shelter(dbo, d, 0, sp), inv.on_shelter("ANIMALTYPEID").get(sp, [0] * 31)[i])
+                self.assertEqual(asm3.animal.get_number_animals_on_foster(dbo, d, sp), inv.on_foster("SPECIESID").get(sp, [0] * 31)[i])
+                self.assertEqual(asm3.animal.get_number_litters_on_shelter(dbo, d, sp), inv.litters_on_shelter().get(sp, [0] * 31)[i])
+        self.assertEqual(1, inv.on_foster()[1][11])
+        for mid in mids: dbo.delete("adoption", mid)
+        dbo.delete("animallitter", lid)
+        asm3.animal.delete_animal(dbo, "test", aid)
+
     def test_animal_figures(self):
         asm3.animal.update_animal_figures(base.get_dbo())
         asm3.animal.update_animal_figures_annual(base.get_dbo())
@@ -0,0 +1,51 @@
+
+import time, unittest
+import base
+
+import asm3.asynctask
+
+class TestAsyncTask(unittest.TestCase):
+
+    def setUp(self):
+        asm3.asynctask.reset(base.get_dbo())
+
+    def tearDown(self):
+        asm3.asynctask.reset(base.get_dbo())
+
+    def test_increment_progress_value(self):
+        dbo = base.get_dbo()
+        asm3.asynctask.set_progress_max(dbo, 1000)
+        asm3.asynctask.set_progress_value(dbo, 0)
+        for dummy in range(999):
+            asm3.asynctask.increment_progress_value(dbo)
+        # The shared value is only written every FLUSH_INTERVAL
+        self.assertLess(asm3.asynctask.get_progress_value(dbo), 999)
+        self.assertEqual(999, asm3.asynctask.channels[dbo.name()].value)
+        # and always when the max is reached
+        asm3.asynctask.increment_progress_value(dbo)
+        self.assertEqual(1000, asm3.asynctask.get_progress_value(dbo))
+        self.assertEqual(100, asm3.asynctask.get_progress_percent(dbo))
+
+    def test_cancel(self):
+        dbo = base.get_dbo()
+        asm3.asynctask.set_progress_value(dbo, 0)
+        self.assertFalse(asm3.asynctask.get_cancel(dbo))
+        asm3.asynctask.set_cancel(dbo, True)
+        self.assertTrue(asm3.asynctask.get_cancel(dbo))
+        # A change made by another process is seen after FLUSH_INTERVAL
+        asm3.asynctask.put(dbo, "taskcancel", False)
+        time.sleep(asm3.asynctask.FLUSH_INTERVAL)
+        self.assertFalse(asm3.asynctask.get_cancel(dbo))
+
+    def test_function_task(self):
+        dbo = base.get_dbo()
+        def fn():
+            asm3.asynctask.set_progress_max(dbo, 10)
+            for dummy in range(10):
+                asm3.asynctask.increment_progress_value(dbo)
+            return "done"
+        asm3.asynctask.function_task(dbo, "test", fn)
+        for dummy in range(50):
+            if asm3.asynctask.get_return_value(dbo) == "done": break
+            time.sleep(0.1)
+        self.assertEqual("done", asm3.asynctask.get_return_value(dbo))
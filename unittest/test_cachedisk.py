@@ -0,0 +1,55 @@
+
+import threading, unittest
+import base
+
+import asm3.cachedisk
+
+PATH = "unittestcache"
+
+class TestCacheDisk(unittest.TestCase):
+
+    def setUp(self):
+        c = asm3.cachedisk._getstore(PATH)
+        c.execute("DELETE FROM cache")
+
+    def test_get_put(self):
+        asm3.cachedisk.put("key", PATH, { "a": 1 }, 60)
+        self.assertEqual({ "a": 1 }, asm3.cachedisk.get("key", PATH))
+        self.assertIsNone(asm3.cachedisk.get("key", PATH, str))
+        self.assertTrue(asm3.cachedisk.exists("key", PATH))
+        asm3.cachedisk.delete("key", PATH)
+        self.assertIsNone(asm3.cachedisk.get("key", PATH))
+
+    def test_expiry(self):
+        asm3.cachedisk.put("key", PATH, "value", -1)
+        self.assertIsNone(asm3.cachedisk.get("key", PATH))
+        asm3.cachedisk.put("key", PATH, "value", 60)
+        self.assertEqual("value", asm3.cachedisk.touch("key", PATH, -1))
+        self.assertIsNone(asm3.cachedisk.touch("key", PATH, 60))
+
+    def test_increment(self):
+        self.assertEqual(1, asm3.cachedisk.increment("count", PATH, 60))
+        self.assertEqual(2, asm3.cachedisk.increment("count", PATH, 60))
+
+    def test_increment_threads(self):
+        def worker():
+            for dummy in range(10):
+                asm3.cachedisk.increment("count", PATH, 60)
+        threads = [ threading.Thread(target=worker) for dummy in range(4) ]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        self.assertEqual(40, asm3.cachedisk.get("count", PATH))
+
+    def test_eviction(self):
+        oldmax = asm3.cachedisk.DISK_CACHE_MAX_SIZE
+        asm3.cachedisk.DISK_CACHE_MAX_SIZE = 1
+        try:
+            for i in range(10):
+                asm3.cachedisk.put("key%d" % i, PATH, "x" * 200000, 60)
+            self.assertIsNone(asm3.cachedisk.get("key0", PATH))
+            self.assertIsNotNone(asm3.cachedisk.get("key9", PATH))
+            total = asm3.cachedisk._getstore(PATH).execute("SELECT Total FROM cachesize").fetchone()[0]
+            self.assertLessEqual(total, 1024 * 1024)
+        finally:
+            asm3.cachedisk.DISK_CACHE_MAX_SIZE = oldmax
+
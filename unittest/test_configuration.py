@@ -0,0 +1,29 @@
+
+import unittest
+import base
+
+import asm3.configuration
+
+class TestConfiguration(unittest.TestCase):
+
+    def test_get_map(self):
+        dbo = base.get_dbo()
+        asm3.configuration.cset(dbo, "UnitTestSetting", "first")
+        self.assertEqual("first", asm3.configuration.cstring(dbo, "UnitTestSetting"))
+        self.assertIs(asm3.configuration.get_map(dbo), asm3.configuration.get_map(dbo))
+        asm3.configuration.cset(dbo, "UnitTestSetting", "second")
+        self.assertEqual("second", asm3.configuration.cstring(dbo, "UnitTestSetting"))
+
+    def test_invalidate_other_process(self):
+        dbo = base.get_dbo()
+        asm3.configuration.cset(dbo, "UnitTestSetting", "first")
+        asm3.configuration.get_map(dbo)
+        l1 = asm3.configuration.config_maps[dbo.name()]
+        # Simulate another process changing the config, the local copy should 
+        # be dropped as soon as the version stamp is next checked
+        dbo.execute("UPDATE configuration SET ItemValue='second' WHERE ItemName LIKE 'UnitTestSetting'")
+        asm3.configuration.invalidate_config_cache(dbo)
+        asm3.configuration.config_maps[dbo.name()] = l1
+        l1["checked"] = 0
+        self.assertEqual("second", asm3.configuration.cstring(dbo, "UnitTestSetting"))
+
@@ -0,0 +1,155 @@
+import os, shutil, sys, tempfile, time, unittest
+import base
+
+import cron
+
+def exit_status(mode, alias):
+    """ Process target that exits with the status in mode """
+    sys.exit(int(mode))
+
+def fail_first(mode, alias):
+    """ Process target that fails the first time it runs (alias is a marker file) """
+    if not os.path.exists(alias):
+        open(alias, "w").close()
+        sys.exit(1)
+    sys.exit(0)
+
+def sleep_forever(mode, alias):
+    time.sleep(60)
+
+def task(name, log, secs=0, error=False, **kwargs):
+    """ Returns a Task called name that records when it starts and ends in log """
+    def fn(dbo):
+        log.append(("start", name))
+        time.sleep(secs)
+        if error: raise Exception("failed")
+        log.append(("end", name))
+    fn.__name__ = name
+    return cron.Task(fn, **kwargs)
+
+class TestCron(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_run_status(self):
+        self.assertEqual(0, cron.run(base.get_dbo(), "maint_mail_queue"))
+        # maint_import_report fails without ASM3_REPORT set
+        report = os.environ.pop("ASM3_REPORT", None)
+        try:
+            self.assertEqual(1, cron.run(base.get_dbo(), "maint_import_report"))
+        finally:
+            if report is not None: os.environ["ASM3_REPORT"] = report
+
+    def test_run_parallel(self):
+        r = cron.run_parallel("0", [ "a", "b", "c" ], 2, target=exit_status)
+        self.assertEqual([ "a", "b", "c" ], sorted(r.keys()))
+        for result, elapsed, attempt in r.values():
+            self.assertEqual(("ok", 1), (result, attempt))
+
+    def test_run_parallel_failed(self):
+        r = cron.run_parallel("1", [ "a" ], 2, retries=1, target=exit_status)
+        self.assertEqual("failed (exit code 1)", r["a"][0])
+        self.assertEqual(2, r["a"][2])
+
+    def test_run_parallel_retry(self):
+        marker = os.path.join(self.tmpdir, "marker")
+        r = cron.run_parallel("0", [ marker ], 2, retries=1, target=fail_first)
+        self.assertEqual("ok", r[marker][0])
+        self.assertEqual(2, r[marker][2])
+
+    def test_run_parallel_timeout(self):
+        r = cron.run_parallel("0", [ "a" ], 1, timeout=1, retries=1, target=sleep_forever)
+        self.assertEqual("timed out", r["a"][0])
+        self.assertEqual(2, r["a"][2])
+        self.assertLess(r["a"][1], 30)
+
+    def test_task_conflicts(self):
+        log = []
+        a = task("a", log, writes=["animal"])
+        self.assertTrue(a.conflicts(task("b", log, reads=["animal"])))
+        self.assertTrue(task("b", log, reads=["animal"]).conflicts(a))
+        self.assertTrue(a.conflicts(task("b", log, reads=["*"])))
+        self.assertFalse(a.conflicts(task("b", log, reads=["owner"], writes=["owner"])))
+        self.assertFalse(task("a", log, reads=["animal"]).conflicts(task("b", log, reads=["animal"])))
+        # Tasks that change the audit trail conflict with every task
+        self.assertTrue(task("a", log, writes=["audittrail"]).conflicts(task("b", log)))
+        # So do tasks that could change any table
+        self.assertTrue(task("a", log, writes=["*"]).conflicts(task("b", log)))
+        self.assertTrue(task("b", log).conflicts(task("a", log, writes=["*"])))
+
+    def test_daily_tasks(self):
+        names = [ t.name for t in cron.DAILY_TASKS ]
+        self.assertEqual(len(names), len(set(names)))
+        for t in cron.DAILY_TASKS:
+            self.assertTrue(t.after <= set(names), t.name)
+        clean = [ t for t in cron.DAILY_TASKS if t.name == "clean" ][0]
+        self.assertIn("audittrail", clean.writes)
+        self.assertTrue(all(clean.conflicts(t) for t in cron.DAILY_TASKS if t is not clean))
+
+    def test_select_tasks(self):
+        log = []
+        tasks = [ task("a", log), task("b", log), task("c", log) ]
+        self.assertEqual([ "a", "b", "c" ], [ t.name for t in cron.select_tasks(tasks) ])
+        self.assertEqual([ "a", "c" ], [ t.name for t in cron.select_tasks(tasks, only=[ "c", "a" ]) ])
+        self.assertEqual([ "b" ], [ t.name for t in cron.select_tasks(tasks, skip=[ "a", "c" ]) ])
+        self.assertEqual([ "c" ], [ t.name for t in cron.select_tasks(tasks, only=[ "b", "c" ], skip=[ "b" ]) ])
+        self.assertRaises(ValueError, cron.select_tasks, tasks, [ "d" ])
+        self.assertRaises(ValueError, cron.select_tasks, tasks, [], [ "d" ])
+
+    def test_run_tasks_order(self):
+        log = []
+        tasks = [ task("a", log, 0.2, writes=["animal"]), 
+            task("b", log, writes=["animal"]), 
+            task("c", log, after=["a"]), 
+            task("d", log, reads=["owner"]) ]
+        results = cron.run_tasks(base.get_dbo(), tasks, 4)
+        self.assertEqual(set([ "a", "b", "c", "d" ]), set(results.keys()))
+        self.assertTrue(all(v is not None for v in results.values()))
+        # b conflicts with a and c runs after it, d does not wait for a
+        self.assertLess(log.index(("end", "a")), log.index(("start", "b")))
+        self.assertLess(log.index(("end", "a")), log.index(("start", "c")))
+        self.assertLess(log.index(("start", "d")), log.index(("end", "a")))
+
+    def test_run_tasks_serial(self):
+        log = []
+        tasks = [ task("a", log), task("b", log), task("c", log) ]
+        cron.run_tasks(base.get_dbo(), tasks, 1)
+        self.assertEqual([ ("start", "a"), ("end", "a"), ("start", "b"), ("end", "b"), ("start", "c"), ("end", "c") ], log)
+
+    def test_run_tasks_failed(self):
+        log = []
+        tasks = [ task("a", log, error=True), task("b", log, after=["a"]), task("c", log) ]
+        results = cron.run_tasks(base.get_dbo(), tasks, 2)
+        self.assertIsNone(results["a"])
+        self.assertIsNone(results["b"])
+        self.assertIsNotNone(results["c"])
+        self.assertNotIn(("start", "b"), log)
+
+    def test_daily_status(self):
+        log = []
+        oldtasks = cron.DAILY_TASKS
+        try:
+            cron.DAILY_TASKS = [ task("a", log), task("b", log) ]
+            self.assertEqual(0, cron.run(base.get_dbo(), "daily"))
+            # A failed task and the task skipped after it give a failure status
+            cron.DAILY_TASKS = [ task("a", log, error=True), task("b", log, after=["a"]) ]
+            self.assertEqual(1, cron.run(base.get_dbo(), "daily"))
+            cron.DAILY_TASKS = [ task("a", log), task("b", log, after=["c"]), task("c", log, error=True) ]
+            self.assertEqual(1, cron.run(base.get_dbo(), "daily"))
+        finally:
+            cron.DAILY_TASKS = oldtasks
+
+    def test_daily_sqlite_workers(self):
+        workers = []
+        oldrun, oldworkers = cron.run_tasks, cron.CRON_DAILY_WORKERS
+        try:
+            cron.run_tasks = lambda dbo, tasks, w: workers.append(w)
+            cron.CRON_DAILY_WORKERS = 4
+            cron.daily(base.get_dbo())
+        finally:
+            cron.run_tasks, cron.CRON_DAILY_WORKERS = oldrun, oldworkers
+        self.assertEqual([ 1 ], workers)
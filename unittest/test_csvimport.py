@@ -3,13 +3,58 @@ import unittest
 import base
 
 import asm3.csvimport
+import asm3.person
+import asm3.utils
+
+import http.server, os, threading, time
+
+class MediaHandler(http.server.BaseHTTPRequestHandler):
+    """ A stand in for a remote server holding media. /flaky fails the first time it is requested, /slow takes a second. """
+    active = 0
+    maxactive = 0
+    paths = []
+    lock = threading.Lock()
+
+    def do_GET(self):
+        with self.lock:
+            MediaHandler.active += 1
+            MediaHandler.maxactive = max(MediaHandler.active, MediaHandler.maxactive)
+            MediaHandler.paths.append(self.path)
+            status = 200
+            if self.path == "/missing" or (self.path == "/flaky" and MediaHandler.paths.count("/flaky") == 1): status = 404 if self.path == "/missing" else 500
+        time.sleep(self.path.startswith("/slow") and 1 or 0.05)
+        body = asm3.utils.read_binary_file(base.PATH + "../src/media/reports/nopic.jpg")
+        self.send_response(status)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        with self.lock:
+            MediaHandler.active -= 1
+
+    def log_message(self, *args):
+        pass
 
 class TestCSVImport(unittest.TestCase):
 
+    @classmethod
+    def setUpClass(cls):
+        cls.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), MediaHandler)
+        cls.url = "http://127.0.0.1:%d" % cls.server.server_address[1]
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
     def tearDown(self):
+        base.execute("DELETE FROM media WHERE LinkTypeID = 0 AND LinkID IN (SELECT ID FROM animal WHERE AnimalName = 'TestioCSV')")
         base.execute("DELETE FROM animal WHERE AnimalName = 'TestioCSV'")
         base.execute("DELETE FROM diary WHERE Subject = 'Test diary note from csv import'")
         base.execute("DELETE FROM owner WHERE OwnerName = 'Sir Bob Hoskins'")
+        base.execute("DELETE FROM owner WHERE OwnerSurname = 'Testcsv'")
+        base.execute("DELETE FROM basecolour WHERE BaseColour = 'Testcsvcolour'")
 
     def test_csvimport(self):
         csvdata = "ANIMALNAME,ANIMALSEX,ANIMALAGE,PERSONNAME,INCIDENTDATE,DIARYDATE,DIARYFOR,DIARYSUBJECT,DIARYNOTE\n" \
@@ -18,6 +63,91 @@ class TestCSVImport(unittest.TestCase):
             "\"\",\"\",\"\",\"Sir Bob Hoskins\",\"2001-09-11\",\"2020-01-20\",\"The Prince\",\"Test diary note from csv import\",\"This note was created as part of the CSV import unit test.\"\n"
         asm3.csvimport.csvimport(base.get_dbo(), csvdata)
 
+    def test_csvimport_batch(self):
+        dbo = base.get_dbo()
+        csvdata = "ANIMALNAME,ANIMALCOLOR,PERSONFIRSTNAME,PERSONLASTNAME,PERSONADDRESS,PERSONEMAIL\n" \
+            "\"TestioCSV\",\"Testcsvcolour\",\"Joe\",\"Testcsv\",\"12 Test Street\",\"joe@testcsv.com\"\n" \
+            "\"TestioCSV\",\"TESTCSVCOLOUR\",\"Joe\",\"Testcsv\",\"12 Test St\",\"\"\n" \
+            "\"TestioCSV\",\"Testcsvcolour\",\"Joe\",\"Testcsv\",\"\",\"JOE@testcsv.com\"\n"
+        asm3.csvimport.csvimport(dbo, csvdata, createmissinglookups=True)
+        self.assertEqual(1, dbo.query_int("SELECT COUNT(*) FROM basecolour WHERE BaseColour = 'Testcsvcolour'"))
+        self.assertEqual(1, dbo.query_int("SELECT COUNT(*) FROM owner WHERE OwnerSurname = 'Testcsv'"))
+
+    def test_person_index(self):
+        dbo = base.get_dbo()
+        p = { "forenames": "Joe", "surname": "Testcsv", "address": "12 Test Street", "emailaddress": "joe@testcsv.com", "mobiletelephone": "07700 900123" }
+        pid = asm3.person.insert_person_from_form(dbo, asm3.utils.PostedData(p, "en"), "test", geocode=False)
+        people = asm3.csvimport.PersonIndex(dbo)
+        for args in ( ( "joe@testcsv.com", "", "", "Joe", "" ), ( "", "07700-900123", "", "Joe", "" ), ( "", "", "testcsv", "Joe Bob", "12 Test" ),
+            ( "joe@testcsv.com", "", "", "Fred", "" ), ( "", "", "Testcsv", "Jo", "120 Test Street" ), ( "", "", "Testcsv", "Joe", "" ) ):
+            self.assertEqual([ x.ID for x in asm3.person.get_person_similar(dbo, *args) ], [ x.ID for x in people.find(*args) ])
+        self.assertEqual(pid, people.find("joe@testcsv.com", "", "", "Joe", "")[0].ID)
+
+    def test_lookups(self):
+        dbo = base.get_dbo()
+        lookups = asm3.csvimport.Lookups(dbo)
+        self.assertEqual(dbo.query_int("SELECT ID FROM species WHERE LOWER(SpeciesName) = 'cat'"), lookups.find("species", "SpeciesName", " CAT "))
+        self.assertEqual(0, lookups.find("basecolour", "BaseColour", "Testcsvcolour"))
+        row = { "ANIMALCOLOR": "Testcsvcolour" }
+        cid = asm3.csvimport.gkl(dbo, row, "ANIMALCOLOR", "basecolour", "BaseColour", True, lookups)
+        self.assertEqual(cid, asm3.csvimport.gkl(dbo, row, "ANIMALCOLOR", "basecolour", "BaseColour", True, lookups))
+        self.assertEqual(cid, asm3.csvimport.gkl(dbo, row, "ANIMALCOLOR", "basecolour", "BaseColour", False))
+
+    def test_csvimport_media_urls(self):
+        dbo = base.get_dbo()
+        csvdata = "ANIMALNAME,ANIMALAGE,ANIMALIMAGE\n" \
+            "\"TestioCSV\",\"2\",\"%s/image1\"\n" \
+            "\"TestioCSV\",\"2\",\"%s/missing\"\n" % (self.url, self.url)
+        results = asm3.csvimport.csvimport(dbo, csvdata, htmlresults=False)
+        self.assertIn("error reading image from '%s/missing'" % self.url, results)
+        self.assertEqual(1, dbo.query_int("SELECT COUNT(*) FROM media WHERE LinkTypeID = 0 AND LinkID IN (SELECT ID FROM animal WHERE AnimalName = 'TestioCSV')"))
+
+    def test_media_prefetch(self):
+        MediaHandler.maxactive = 0
+        MediaHandler.paths = []
+        rowurls = [ [ "%s/image%d" % (self.url, i) ] for i in range(8) ] + [ [ self.url + "/flaky", self.url + "/missing" ], [ self.url + "/image0" ] ]
+        fetcher = asm3.csvimport.MediaPrefetch(rowurls, workers=4, perhost=2, ahead=5, retrywait=0)
+        try:
+            data = asm3.utils.read_binary_file(base.PATH + "../src/media/reports/nopic.jpg")
+            for rowno, urls in enumerate(rowurls, 1):
+                for url in urls:
+                    r = fetcher.get(rowno, url)
+                    if url.endswith("missing"):
+                        self.assertEqual(404, r["status"])
+                    else:
+                        self.assertEqual(200, r["status"])
+                        self.assertEqual(data, r["response"])
+            # The file for a URL is kept until its last row has used it
+            self.assertEqual([], os.listdir(fetcher.spool))
+        finally:
+            fetcher.close()
+        self.assertFalse(os.path.exists(fetcher.spool))
+        self.assertLessEqual(MediaHandler.maxactive, 2)
+        self.assertEqual(2, MediaHandler.paths.count("/flaky")) # server errors are retried
+        self.assertEqual(1, MediaHandler.paths.count("/missing"))
+        self.assertEqual(1, MediaHandler.paths.count("/image0"))
+
+    def test_media_prefetch_hosts(self):
+        # The same server by another name counts as a different host
+        other = self.url.replace("127.0.0.1", "localhost")
+        rowurls = [ [ "%s/slow%d" % (self.url, i) ] for i in range(4) ] + [ [ other + "/image0" ] ]
+        fetcher = asm3.csvimport.MediaPrefetch(rowurls, workers=2, perhost=1, ahead=10, retrywait=0)
+        try:
+            start = time.time()
+            r = fetcher.get(5, other + "/image0")
+            # The slow host's other fetches wait in its queue instead of holding the second worker
+            self.assertEqual(200, r["status"])
+            self.assertLess(time.time() - start, 1)
+            host = self.url.replace("http://", "")
+            self.assertEqual(1, fetcher.active[host])
+            self.assertEqual(3, len(fetcher.pending[host]))
+        finally:
+            fetcher.close()
+            # Let the abandoned fetch finish so that it does not count towards other tests
+            for i in range(30):
+                if MediaHandler.active == 0: break
+                time.sleep(0.1)
+
     def test_csvexport_animals(self):
         asm3.csvimport.csvexport_animals(base.get_dbo(), "all")
 
@@ -0,0 +1,211 @@
+
+import pickle, sqlite3, threading, unittest
+import base
+
+import asm3.dbms.base
+import asm3.utils
+
+class TestDb(unittest.TestCase):
+
+    def connect(self):
+        return sqlite3.connect(base.get_dbo().database, check_same_thread=False)
+
+    def test_connection_pool_reuse(self):
+        p = asm3.dbms.base.ConnectionPool(self.connect, maxsize=2)
+        c = p.get()
+        p.release(c)
+        self.assertIs(c, p.get())
+        self.assertEqual(1, p.size)
+        p.release(c)
+        p.release(c) # releasing twice should not return it to the pool again
+        self.assertEqual(1, len(p.idle))
+        p.close_all()
+        self.assertEqual(0, p.size)
+
+    def test_connection_pool_exhausted(self):
+        p = asm3.dbms.base.ConnectionPool(self.connect, maxsize=1, waittimeout=0)
+        c = p.get()
+        self.assertIsNone(p.get())
+        p.release(c)
+        self.assertIsNotNone(p.get())
+
+    def test_connection_pool_health_check(self):
+        p = asm3.dbms.base.ConnectionPool(self.connect, maxsize=1, checkafter=0)
+        c = p.get()
+        p.release(c)
+        c.close() # broken connection should be discarded and replaced
+        c2 = p.get()
+        self.assertIsNot(c, c2)
+        self.assertEqual(1, p.size)
+
+    def test_connection_pool_idle_eviction(self):
+        p = asm3.dbms.base.ConnectionPool(self.connect, minsize=1, maxsize=3, idletimeout=0)
+        p.prefill()
+        c1 = p.get()
+        c2 = p.get()
+        p.release(c1)
+        p.release(c2)
+        p.release(p.get())
+        self.assertEqual(1, p.size)
+
+    def test_connection_pool_threads(self):
+        p = asm3.dbms.base.ConnectionPool(self.connect, maxsize=3)
+        def worker():
+            for dummy in range(20):
+                c = p.get()
+                s = c.cursor()
+                s.execute("SELECT COUNT(*) FROM animal")
+                s.close()
+                p.release(c)
+        threads = [ threading.Thread(target=worker) for dummy in range(6) ]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        self.assertLessEqual(p.size, 3)
+        self.assertEqual(0, len(p.inuse))
+
+    def test_transaction_commit(self):
+        dbo = base.get_dbo()
+        with dbo.transaction():
+            nid = dbo.insert("diet", { "DietName": "txtest", "DietDescription": "" })
+            with dbo.transaction():
+                dbo.update("diet", nid, { "DietDescription": "nested" })
+            self.assertEqual("nested", dbo.query_string("SELECT DietDescription FROM diet WHERE ID=?", [nid]))
+        self.assertEqual("nested", dbo.query_string("SELECT DietDescription FROM diet WHERE ID=?", [nid]))
+        dbo.delete("diet", nid)
+
+    def test_transaction_rollback(self):
+        dbo = base.get_dbo()
+        nid = 0
+        try:
+            with dbo.transaction():
+                nid = dbo.insert("diet", { "DietName": "txtest", "DietDescription": "" })
+                raise Exception("rollback")
+        except:
+            pass
+        self.assertIsNone(dbo.transaction_state())
+        self.assertEqual(0, dbo.query_int("SELECT COUNT(*) FROM diet WHERE ID=?", [nid]))
+
+    def test_transaction_on_rollback(self):
+        dbo = base.get_dbo()
+        called = []
+        # Outside a unit of work there is nothing to roll back
+        dbo.on_rollback(lambda: called.append("none"))
+        with dbo.transaction():
+            dbo.on_rollback(lambda: called.append("commit"))
+        try:
+            with dbo.transaction():
+                dbo.on_rollback(lambda: called.append("rollback"))
+                raise Exception("rollback")
+        except:
+            pass
+        # A failed statement rolls back straight away, actions only run once
+        try:
+            with dbo.transaction():
+                dbo.on_rollback(lambda: called.append("failed"))
+                try:
+                    dbo.execute("INSERT INTO nosuchtable VALUES (1)")
+                except:
+                    pass
+        except:
+            pass
+        self.assertEqual([ "rollback", "failed" ], called)
+
+    def test_update_audit(self):
+        dbo = base.get_dbo()
+        nid = dbo.insert("diet", { "DietName": "audittest", "DietDescription": "old", "IsRetired": 0 })
+        dbo.update("diet", nid, { "DietDescription": "it's new", "IsRetired": 1 }, "test", setLastChanged=False)
+        d = dbo.query_string("SELECT Description FROM audittrail WHERE TableName='diet' AND LinkID=? AND Action=1", [nid])
+        self.assertEqual("(ID %d) &gt;&gt;&gt; DIETDESCRIPTION: old ==&gt; it's new, ISRETIRED: 0 ==&gt; 1, " % nid, d)
+        dbo.delete("diet", nid, "test")
+        d = dbo.query_string("SELECT Description FROM audittrail WHERE TableName='diet' AND LinkID=? AND Action=2", [nid])
+        self.assertIn("audittest", d)
+
+    def test_update_audit_values_fallback(self):
+        dbo = base.get_dbo()
+        nid = dbo.insert("diet", { "DietName": "audittest", "DietDescription": "old" })
+        # The locked read and the update must run in the same unit of work
+        states = []
+        query = dbo.query
+        def checked_query(*args, **kwargs):
+            states.append(dbo.transaction_state())
+            return query(*args, **kwargs)
+        dbo.query = checked_query
+        try:
+            rows, pre, post = asm3.dbms.base.Database.update_audit_values(dbo, "diet", nid, { "DietDescription": "new" })
+        finally:
+            del dbo.query
+        self.assertIsNotNone(states[0])
+        self.assertEqual((1, "old", "new"), (rows, pre.DIETDESCRIPTION, post.DIETDESCRIPTION))
+        self.assertEqual("new", dbo.query_string("SELECT DietDescription FROM diet WHERE ID=?", [nid]))
+        dbo.delete("diet", nid)
+
+    def test_query_view(self):
+        dbo = base.get_dbo()
+        nid = dbo.insert("diet", { "DietName": "view'test", "DietDescription": "desc" })
+        rows = dbo.query_view("SELECT ID, DietName, DietDescription FROM diet WHERE ID=?", [nid])
+        r = rows[0]
+        self.assertEqual(r.DIETNAME, r["DIETNAME"])
+        self.assertEqual(dbo.query("SELECT ID, DietName, DietDescription FROM diet WHERE ID=?", [nid])[0], r.todict())
+        self.assertEqual([ "ID", "DIETNAME", "DIETDESCRIPTION" ], r.keys())
+        r.DIETDESCRIPTION = "changed"
+        r.EXTRA = 1
+        del r["ID"]
+        self.assertNotIn("ID", r)
+        self.assertEqual("changed", r.get("DIETDESCRIPTION"))
+        self.assertEqual([ "DIETNAME", "DIETDESCRIPTION", "EXTRA" ], r.keys())
+        self.assertEqual(3, len(r))
+        self.assertEqual('[{"DIETNAME": "view\'test", "DIETDESCRIPTION": "changed", "EXTRA": 1}]', asm3.utils.json(rows))
+        self.assertIsInstance(pickle.loads(pickle.dumps(r)), asm3.dbms.base.ResultRow)
+        dbo.delete("diet", nid)
+
+    def test_query_view_explain(self):
+        dbo = base.get_dbo()
+        explained = []
+        dbo.query_explain = lambda sql, params=None: explained.append(sql) or ""
+        explain = asm3.dbms.base.DB_EXPLAIN_QUERIES
+        asm3.dbms.base.DB_EXPLAIN_QUERIES = True
+        try:
+            dbo.query("SELECT ID FROM diet")
+            dbo.query_view("SELECT ID FROM diet")
+        finally:
+            asm3.dbms.base.DB_EXPLAIN_QUERIES = explain
+            del dbo.query_explain
+        self.assertEqual([ "EXPLAIN SELECT ID FROM diet" ] * 2, explained)
+
+    def test_query_view_distincton(self):
+        dbo = base.get_dbo()
+        sql = "SELECT a.ID FROM animal a LEFT OUTER JOIN media m ON m.LinkID = a.ID"
+        self.assertEqual(len(dbo.query(sql, distincton="ID")), len(dbo.query_view(sql, distincton="ID")))
+
+    def test_query_generator(self):
+        dbo = base.get_dbo()
+        sql = "SELECT ID, MovementType FROM lksmovementtype ORDER BY ID"
+        rows = list(dbo.query_generator(sql))
+        self.assertEqual(dbo.query(sql), [ r.todict() for r in rows ])
+        g = dbo.query_generator(sql)
+        self.assertEqual(rows[0].ID, next(g).ID)
+        g.close() # abandoning the generator part way through should release its connection
+
+    def test_query_generator_held_connection(self):
+        dbo = base.get_dbo()
+        sql = "SELECT ID, MovementType FROM lksmovementtype ORDER BY ID"
+        # Cron holds a connection on the dbo, rows should still be streamed
+        # on a connection of their own so the held one can be used meanwhile
+        streamed = []
+        cursor_stream = dbo.cursor_stream
+        def checked_cursor_stream(c):
+            streamed.append(c)
+            return cursor_stream(c)
+        dbo.cursor_stream = checked_cursor_stream
+        dbo.connection = dbo.connect()
+        try:
+            rows = []
+            for r in dbo.query_generator(sql):
+                rows.append(r.todict())
+                self.assertEqual(r.MOVEMENTTYPE, dbo.query_string("SELECT MovementType FROM lksmovementtype WHERE ID=?", [r.ID]))
+            self.assertEqual(dbo.query(sql), rows)
+        finally:
+            dbo.connection.close()
+            dbo.connection = None
+            del dbo.cursor_stream
+        self.assertEqual(1, len(streamed))
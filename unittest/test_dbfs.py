@@ -4,6 +4,8 @@ import base
 
 import asm3.dbfs
 
+import os, shutil, tempfile
+
 class TestDBFS(unittest.TestCase):
 
     def setUp(self):
@@ -54,4 +56,23 @@ class TestDBFS(unittest.TestCase):
     def test_switch_storage(self):
         asm3.dbfs.switch_storage(base.get_dbo())
 
-
+    def test_put_string_rollback(self):
+        dbo = base.get_dbo()
+        store, folder = asm3.dbfs.DBFS_STORE, asm3.dbfs.DBFS_FILESTORAGE_FOLDER
+        asm3.dbfs.DBFS_STORE = "file"
+        asm3.dbfs.DBFS_FILESTORAGE_FOLDER = tempfile.mkdtemp()
+        try:
+            dbfsid = 0
+            try:
+                with dbo.transaction():
+                    dbfsid = asm3.dbfs.put_string(dbo, "rollback.txt", "/reports", b"123test")
+                    self.assertEqual(1, len(os.listdir(os.path.join(asm3.dbfs.DBFS_FILESTORAGE_FOLDER, dbo.name()))))
+                    raise Exception("rollback")
+            except:
+                pass
+            # The row and its file are both gone
+            self.assertEqual(0, dbo.query_int("SELECT COUNT(*) FROM dbfs WHERE ID=?", [dbfsid]))
+            self.assertEqual(0, len(os.listdir(os.path.join(asm3.dbfs.DBFS_FILESTORAGE_FOLDER, dbo.name()))))
+        finally:
+            shutil.rmtree(asm3.dbfs.DBFS_FILESTORAGE_FOLDER)
+            asm3.dbfs.DBFS_STORE, asm3.dbfs.DBFS_FILESTORAGE_FOLDER = store, folder
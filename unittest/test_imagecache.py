@@ -0,0 +1,82 @@
+import unittest
+import base
+
+import asm3.animal, asm3.dbfs, asm3.imagecache, asm3.media
+import asm3.utils
+
+import os
+
+class TestImageCache(unittest.TestCase):
+
+    nid = 0
+    m1 = 0
+    m2 = 0
+
+    def setUp(self):
+        dbo = base.get_dbo()
+        post = asm3.utils.PostedData({ "animalname": "Testio", "estimatedage": "1", "animaltype": "1", "entryreason": "1", "species": "1" }, "en")
+        self.nid, dummy = asm3.animal.insert_animal_from_form(dbo, post, "test")
+        data = asm3.utils.read_binary_file(base.PATH + "../src/media/reports/nopic.jpg")
+        post = asm3.utils.PostedData({ "filename": "image.jpg", "filetype": "image/jpeg", "filedata": "data:image/jpeg;base64,%s" % asm3.utils.base64encode(data) }, "en")
+        self.m1 = asm3.media.attach_file_from_form(dbo, "test", asm3.media.ANIMAL, self.nid, asm3.media.MEDIASOURCE_ATTACHFILE, post)
+        self.m2 = asm3.media.attach_file_from_form(dbo, "test", asm3.media.ANIMAL, self.nid, asm3.media.MEDIASOURCE_ATTACHFILE, post)
+
+    def tearDown(self):
+        asm3.animal.delete_animal(base.get_dbo(), "test", self.nid)
+
+    def test_get_path(self):
+        dbo = base.get_dbo()
+        r1 = asm3.media.get_media_by_id(dbo, self.m1)
+        r2 = asm3.media.get_media_by_id(dbo, self.m2)
+        # The same content is stored once for both media records
+        p1 = asm3.imagecache.get_path(dbo, r1.DBFSID, "50x50", r1.DATE)
+        self.assertTrue(os.path.exists(p1))
+        self.assertEqual(p1, asm3.imagecache.get_path(dbo, r2.DBFSID, "50x50", r2.DATE))
+        self.assertNotEqual(p1, asm3.imagecache.get_path(dbo, r1.DBFSID, "60x60", r1.DATE))
+        paths = asm3.imagecache.generate(dbo, [ (r1.DBFSID, r1.DATE), (r2.DBFSID, r2.DATE) ], "40x40")
+        self.assertEqual(paths[r1.DBFSID], paths[r2.DBFSID])
+
+    def test_generate_pool(self):
+        dbo = base.get_dbo()
+        r1 = asm3.media.get_media_by_id(dbo, self.m1)
+        r2 = asm3.media.get_media_by_id(dbo, self.m2)
+        workers = asm3.imagecache.IMAGE_DERIVATIVE_WORKERS
+        try:
+            asm3.imagecache.IMAGE_DERIVATIVE_WORKERS = 2
+            # Content that has not been seen before so that there are derivatives to generate
+            for r in (r1, r2):
+                data = asm3.utils.read_binary_file(base.PATH + "../src/media/reports/nopic.jpg") + asm3.utils.str2bytes(asm3.utils.uuid_str())
+                asm3.dbfs.put_string_id(dbo, r.DBFSID, "image.jpg", data)
+                asm3.imagecache.forget(dbo, r.DBFSID, r.DATE)
+            paths = asm3.imagecache.generate(dbo, [ (r1.DBFSID, r1.DATE), (r2.DBFSID, r2.DATE) ], "35x35")
+            self.assertNotEqual(paths[r1.DBFSID], paths[r2.DBFSID])
+            self.assertTrue(os.path.exists(paths[r2.DBFSID]))
+            # The pool is kept for the next call
+            pool = asm3.imagecache.pool
+            self.assertIsNotNone(pool)
+            asm3.imagecache.generate(dbo, [ (r1.DBFSID, r1.DATE), (r2.DBFSID, r2.DATE) ], "36x36")
+            self.assertIs(pool, asm3.imagecache.pool)
+        finally:
+            asm3.imagecache.IMAGE_DERIVATIVE_WORKERS = workers
+
+    def test_original(self):
+        dbo = base.get_dbo()
+        r1 = asm3.media.get_media_by_id(dbo, self.m1)
+        # Originals come straight from dbfs
+        dummy, data = asm3.media.get_image_file_data(dbo, "media", self.m1)
+        self.assertEqual(asm3.dbfs.get_string_id(dbo, r1.DBFSID), data)
+
+    def test_update_file_content(self):
+        dbo = base.get_dbo()
+        dummy, before = asm3.media.get_image_file_data(dbo, "animalthumb", self.nid)
+        asm3.media.rotate_media(dbo, "test", self.m1, True)
+        dummy, after = asm3.media.get_image_file_data(dbo, "animalthumb", self.nid)
+        self.assertNotEqual(before, after)
+
+    def test_remove_expired(self):
+        dbo = base.get_dbo()
+        r1 = asm3.media.get_media_by_id(dbo, self.m1)
+        p = asm3.imagecache.get_path(dbo, r1.DBFSID, "30x30", r1.DATE)
+        os.utime(p, (0, 0))
+        self.assertGreaterEqual(asm3.imagecache.remove_expired(), 1)
+        self.assertFalse(os.path.exists(p))
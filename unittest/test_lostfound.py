@@ -74,6 +74,35 @@ class TestLostFound(unittest.TestCase):
     def test_get_foundanimal_satellite_counts(self):
         self.assertNotEqual(0, len(asm3.lostfound.get_foundanimal_satellite_counts(base.get_dbo(), self.faid)))
 
+    def test_words(self):
+        self.assertEqual(12, asm3.lostfound.words("Black cat, white paws", "white paws\nblack", 20)) # 3 of 5 words, the comma leaves an empty one
+        self.assertEqual(0, asm3.lostfound.words(None, "black", 20))
+
+    def test_match(self):
+        dbo = base.get_dbo()
+        data = {
+            "datefound": base.today_display(),
+            "datereported": base.today_display(),
+            "owner": "1",
+            "species": "2",
+            "sex": "1",
+            "breed": "1",
+            "colour": "1",
+            "markings": "Test",
+            "areafound": "Test",
+            "areapostcode": "Test"
+        }
+        post = asm3.utils.PostedData(data, "en")
+        otherid = asm3.lostfound.insert_foundanimal_from_form(dbo, post, "test")
+        matches = asm3.lostfound.match(dbo, lostanimalid=self.laid)
+        fids = [ m.fid for m in matches ]
+        self.assertIn(self.faid, fids)
+        self.assertNotIn(otherid, fids)
+        m = matches[fids.index(self.faid)]
+        self.assertEqual(self.laid, m.lid)
+        self.assertEqual(47, m.matchpoints) # everything but the microchip (45 of 95 points)
+        asm3.lostfound.delete_foundanimal(dbo, "test", otherid)
+
     def test_update_match_report(self):
         asm3.lostfound.update_match_report(base.get_dbo())
 
@@ -0,0 +1,134 @@
+
+import json, os, shutil, tempfile, time, unittest
+import base
+
+import asm3.mailqueue
+import asm3.utils
+
+from asm3.dbms.base import ResultRow
+
+class TestMailQueue(unittest.TestCase):
+
+    # An SMTP server that refuses connections
+    transport = { "sendmail": False, "host": "localhost", "port": 1, "username": "", "password": "", "usetls": False }
+
+    def setUp(self):
+        self.oldqueue = asm3.mailqueue.MAIL_QUEUE
+        self.oldbackoff = asm3.mailqueue.RETRY_BACKOFF
+        asm3.mailqueue.MAIL_QUEUE = tempfile.mkdtemp()
+        self.oldutilsqueue = asm3.utils.MAIL_QUEUE
+        self.oldstartworker = asm3.mailqueue.start_worker
+        self.oldenqueue = asm3.mailqueue.enqueue
+        self.oldtransport = asm3.utils.get_smtp_transport
+        self.oldconnect = asm3.utils.smtp_connect
+
+    def tearDown(self):
+        shutil.rmtree(asm3.mailqueue.MAIL_QUEUE)
+        asm3.mailqueue.MAIL_QUEUE = self.oldqueue
+        asm3.mailqueue.RETRY_BACKOFF = self.oldbackoff
+        asm3.utils.MAIL_QUEUE = self.oldutilsqueue
+        asm3.mailqueue.start_worker = self.oldstartworker
+        asm3.mailqueue.enqueue = self.oldenqueue
+        asm3.utils.get_smtp_transport = self.oldtransport
+        asm3.utils.smtp_connect = self.oldconnect
+
+    def test_enqueue(self):
+        path = asm3.mailqueue.enqueue("Subject: Test\n\nTest", "from@example.com", [ "to@example.com" ], self.transport, "test")
+        self.assertEqual(0o600, os.stat(path).st_mode & 0o777)
+        self.assertEqual((1, 1), asm3.mailqueue.pending())
+        with open(path, "r") as f:
+            self.assertEqual([ "to@example.com" ], json.load(f)["tolist"])
+
+    def test_retry(self):
+        asm3.mailqueue.RETRY_BACKOFF = ( 0, )
+        asm3.mailqueue.enqueue("Subject: Test\n\nTest", "from@example.com", [ "to@example.com" ], self.transport, "test")
+        # The first failure is retried, the second gives up on the message
+        self.assertEqual(0, asm3.mailqueue.process_queue())
+        self.assertEqual(1, asm3.mailqueue.pending()[0])
+        self.assertEqual(0, asm3.mailqueue.process_queue())
+        self.assertEqual((0, 0), asm3.mailqueue.pending())
+        failed = os.listdir(os.path.join(asm3.mailqueue.MAIL_QUEUE, "failed"))
+        self.assertEqual(1, len(failed))
+        with open(os.path.join(asm3.mailqueue.MAIL_QUEUE, "failed", failed[0]), "r") as f:
+            self.assertEqual(2, json.load(f)["attempts"])
+
+    def test_retries(self):
+        asm3.mailqueue.RETRY_BACKOFF = ( 0, )
+        asm3.mailqueue.enqueue("Subject: Test\n\nTest", "from@example.com", [ "to@example.com" ], self.transport, "test", retries=2)
+        # The message is retried twice, using the last backoff for the extra retry
+        for i in range(3):
+            self.assertEqual(0, asm3.mailqueue.process_queue())
+        self.assertEqual((0, 0), asm3.mailqueue.pending())
+        failed = os.listdir(os.path.join(asm3.mailqueue.MAIL_QUEUE, "failed"))
+        with open(os.path.join(asm3.mailqueue.MAIL_QUEUE, "failed", failed[0]), "r") as f:
+            self.assertEqual(3, json.load(f)["attempts"])
+
+    def test_send_email_retries(self):
+        # The retries given to send_email are kept in the queue
+        asm3.utils.MAIL_QUEUE = asm3.mailqueue.MAIL_QUEUE
+        asm3.mailqueue.start_worker = lambda: None
+        self.assertTrue(asm3.utils.send_email(base.get_dbo(), "from@example.com", "to@example.com", subject="Test", body="Test", retries=3, queue=True))
+        new = os.path.join(asm3.mailqueue.MAIL_QUEUE, "new")
+        with open(os.path.join(new, os.listdir(new)[0]), "r") as f:
+            self.assertEqual(2, json.load(f)["retries"])
+
+    def test_send_email_enqueue_failed(self):
+        # A message that cannot be queued is sent directly
+        def enqueue(*args):
+            raise OSError("queue is not writable")
+        connected = []
+        def smtp_connect(transport):
+            connected.append(transport)
+            raise OSError("refused")
+        asm3.utils.MAIL_QUEUE = asm3.mailqueue.MAIL_QUEUE
+        asm3.mailqueue.enqueue = enqueue
+        asm3.utils.get_smtp_transport = lambda dbo=None: self.transport
+        asm3.utils.smtp_connect = smtp_connect
+        self.assertFalse(asm3.utils.send_email(base.get_dbo(), "from@example.com", "to@example.com", subject="Test", body="Test", exceptions=False, queue=True))
+        self.assertEqual([ self.transport ], connected)
+
+    def test_due(self):
+        # Messages are never named as due later than they are
+        for i in range(100):
+            path = asm3.mailqueue.enqueue("Subject: Test\n\nTest", "from@example.com", [ "to@example.com" ], self.transport, "test")
+            self.assertLessEqual(asm3.mailqueue._due(os.path.basename(path)), time.time())
+
+    def test_dbname(self):
+        asm3.mailqueue.RETRY_BACKOFF = ( 0, )
+        asm3.mailqueue.enqueue("Subject: Test\n\nTest", "from@example.com", [ "to@example.com" ], self.transport, "test")
+        asm3.mailqueue.enqueue("Subject: Test\n\nTest", "from@example.com", [ "to@example.com" ], self.transport, "other")
+        # Only the message for the database given is tried
+        asm3.mailqueue.process_queue(dbname="test")
+        asm3.mailqueue.process_queue(dbname="test")
+        self.assertEqual(1, asm3.mailqueue.pending()[0])
+        self.assertEqual(1, len(os.listdir(os.path.join(asm3.mailqueue.MAIL_QUEUE, "failed"))))
+
+    def test_send_bulk_email(self):
+        # Bulk email is added to the queue by a background thread
+        asm3.utils.MAIL_QUEUE = asm3.mailqueue.MAIL_QUEUE
+        asm3.mailqueue.start_worker = lambda: None
+        rows = [ ResultRow({ "EMAILADDRESS": "one@example.com" }), ResultRow({ "EMAILADDRESS": "two@example.com" }) ]
+        asm3.utils.send_bulk_email(base.get_dbo(), "from@example.com", "Test", "Test", rows, "plain", False)
+        for i in range(50):
+            if asm3.mailqueue.pending()[0] == 2: break
+            time.sleep(0.1)
+        self.assertEqual(2, asm3.mailqueue.pending()[0])
+
+    def test_backoff(self):
+        asm3.mailqueue.enqueue("Subject: Test\n\nTest", "from@example.com", [ "to@example.com" ], self.transport, "test")
+        asm3.mailqueue.process_queue()
+        self.assertEqual((1, 0), asm3.mailqueue.pending())
+
+    def test_requeue_stale(self):
+        path = asm3.mailqueue.enqueue("Subject: Test\n\nTest", "from@example.com", [ "to@example.com" ], self.transport, "test")
+        claimed = os.path.join(asm3.mailqueue.MAIL_QUEUE, "work", os.path.basename(path))
+        os.makedirs(os.path.dirname(claimed), exist_ok=True)
+        os.rename(path, claimed)
+        self.assertEqual(0, asm3.mailqueue.requeue_stale())
+        os.utime(claimed, (0, 0))
+        self.assertEqual(1, asm3.mailqueue.requeue_stale())
+        self.assertTrue(os.path.exists(path))
+
+    def test_get_smtp_transport(self):
+        t = asm3.utils.get_smtp_transport()
+        self.assertEqual(set([ "sendmail", "host", "port", "username", "password", "usetls" ]), set(t.keys()))
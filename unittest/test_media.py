@@ -2,7 +2,7 @@
 import unittest
 import base, base64
 
-import asm3.animal, asm3.media
+import asm3.animal, asm3.dbms.base, asm3.media
 import asm3.utils
 
 class TestMedia(unittest.TestCase):
@@ -24,6 +24,31 @@ class TestMedia(unittest.TestCase):
         asm3.media.attach_file_from_form(base.get_dbo(), "test", asm3.media.ANIMAL, nid, asm3.media.MEDIASOURCE_ATTACHFILE, post)
         asm3.animal.delete_animal(base.get_dbo(), "test", nid)
  
+    def test_media_index(self):
+        dbo = base.get_dbo()
+        post = asm3.utils.PostedData({ "animalname": "Testio", "estimatedage": "1", "animaltype": "1", "entryreason": "1", "species": "1" }, "en")
+        nid, code = asm3.animal.insert_animal_from_form(dbo, post, "test")
+        data = asm3.utils.read_binary_file(base.PATH + "../src/media/reports/nopic.jpg")
+        post = asm3.utils.PostedData({ "filename": "image.jpg", "filetype": "image/jpeg", "filedata": "data:image/jpeg;base64,%s" % asm3.utils.base64encode(data) }, "en")
+        m1 = asm3.media.attach_file_from_form(dbo, "test", asm3.media.ANIMAL, nid, asm3.media.MEDIASOURCE_ATTACHFILE, post)
+        m2 = asm3.media.attach_file_from_form(dbo, "test", asm3.media.ANIMAL, nid, asm3.media.MEDIASOURCE_ATTACHFILE, post)
+        rows = asm3.media.embellish_photo_urls(dbo, [ asm3.animal.get_animal(dbo, nid), asm3.dbms.base.ResultRow(ID=0) ])
+        self.assertEqual(2, len(rows[0].PHOTOURLS))
+        self.assertIn("mediaid=%s&" % m1, rows[0].PHOTOURLS[0])
+        self.assertEqual([], rows[1].PHOTOURLS)
+        ttl = asm3.media.MEDIA_INDEX_TTL
+        asm3.media.MEDIA_INDEX_TTL = 60
+        try:
+            self.assertEqual(m1, asm3.media.get_web_preferred(dbo, asm3.media.ANIMAL, nid).ID)
+            self.assertEqual(m2, asm3.media.get_media_by_seq(dbo, asm3.media.ANIMAL, nid, 2).ID)
+            self.assertIsNone(asm3.media.get_media_by_seq(dbo, asm3.media.ANIMAL, nid, 3))
+            asm3.media.set_web_preferred(dbo, "test", m2)
+            self.assertEqual(m2, asm3.media.get_web_preferred(dbo, asm3.media.ANIMAL, nid).ID)
+            self.assertEqual(m2, asm3.media.get_media_by_seq(dbo, asm3.media.ANIMAL, nid, 1).ID)
+        finally:
+            asm3.media.MEDIA_INDEX_TTL = ttl
+        asm3.animal.delete_animal(dbo, "test", nid)
+
     def test_remove_expired_media(self):
         asm3.media.remove_expired_media(base.get_dbo(), years=1)
 
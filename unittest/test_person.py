@@ -144,6 +144,24 @@ class TestPerson(unittest.TestCase):
         mid = asm3.person.insert_person_from_form(base.get_dbo(), post, "test", geocode=False)
         asm3.person.merge_person(base.get_dbo(), "test", self.nid, mid)
 
+    def test_merge_duplicate_people(self):
+        dbo = base.get_dbo()
+        def add(forenames, surname, address, email=""):
+            data = { "title": "Mr", "forenames": forenames, "surname": surname, "ownertype": "1", "address": address, "emailaddress": email }
+            return asm3.person.insert_person_from_form(dbo, asm3.utils.PostedData(data, "en"), "test", geocode=False)
+        exact = add("Test", "Testing", "123 test street")
+        fuzzy = add("TEST", "testing", "123, Test  Street", "dupe@example.com")
+        email = add("Test", "Other", "9 other road", "dupe@example.com")
+        def group(keys):
+            return [ g for g in asm3.person.get_duplicate_people(dbo, keys) if self.nid in g ][0]
+        self.assertEqual([ self.nid, exact ], group([ asm3.person.DEDUP_NAME ]))
+        self.assertEqual([ self.nid, exact, fuzzy, email ], group([ asm3.person.DEDUP_NAME, asm3.person.DEDUP_ADDRESS, asm3.person.DEDUP_EMAIL ]))
+        asm3.person.merge_duplicate_people(dbo, "test")
+        self.assertEqual(0, dbo.query_int("SELECT COUNT(*) FROM owner WHERE ID=?", [exact]))
+        self.assertEqual(1, dbo.query_int("SELECT COUNT(*) FROM owner WHERE ID=?", [fuzzy]))
+        asm3.person.delete_person(dbo, "test", fuzzy)
+        asm3.person.delete_person(dbo, "test", email)
+
     def test_get_person_embedded(self):
         self.assertIsNotNone(asm3.person.get_person_embedded(base.get_dbo(), self.nid))
         self.assertIsNotNone(asm3.person.get_person_embedded_forbidden(base.get_dbo(), self.nid))
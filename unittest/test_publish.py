@@ -4,6 +4,7 @@ import base
 
 import asm3.animal
 import asm3.configuration
+import asm3.imagecache
 import asm3.publishers
 import asm3.publishers.html
 import asm3.publishers.adoptapet
@@ -27,6 +28,8 @@ import asm3.publishers.savourlife
 import asm3.publishers.smarttag
 import asm3.utils
 
+import datetime, os, shutil, tempfile
+
 class TestPublish(unittest.TestCase):
  
     def setUp(self):
@@ -109,6 +112,7 @@ class TestPublish(unittest.TestCase):
     def tearDown(self):
         for aid, sheltercode in self.animals:
             asm3.animal.delete_animal(base.get_dbo(), "test", aid)
+        base.get_dbo().execute("DELETE FROM animalpublished WHERE PublishedTo='deltatest'")
 
     # base
     def test_get_adoption_status(self):
@@ -118,6 +122,36 @@ class TestPublish(unittest.TestCase):
     def test_get_animal_data(self):
         self.assertNotEqual(0, len(asm3.publishers.base.get_animal_data(base.get_dbo())))
 
+    def test_get_animal_data_bonded_limit(self):
+        dbo = base.get_dbo()
+        post = asm3.utils.PostedData({ "animalname": "Bondio", "estimatedage": "1", "animaltype": "1", "entryreason": "1", "species": "1", 
+            "comments": "bio", "dateofbirth": "01/01/2022" }, "en")
+        bid, dummy = asm3.animal.insert_animal_from_form(dbo, post, "test")
+        self.animals.append((bid, dummy))
+        pc = asm3.publishers.base.PublishCriteria(asm3.configuration.publisher_presets(dbo))
+        pc.includeWithoutImage = True
+        for order in (0, 1, 2):
+            pc.order = order
+            rows = asm3.publishers.base.get_animal_data(dbo, pc)
+            self.assertEqual([ r.ID for r in rows[:1] ], [ r.ID for r in asm3.publishers.base.get_animal_data(dbo, pc, limit=1) ])
+        dbo.update("animal", self.nid, { "BondedAnimalID": bid })
+        pc.bondedAsSingle = True
+        rows = asm3.publishers.base.get_animal_data(dbo, pc)
+        ids = [ r.ID for r in rows ]
+        self.assertIn(self.nid, ids)
+        self.assertNotIn(bid, ids)
+        self.assertEqual("Testio / Bondio", [ r for r in rows if r.ID == self.nid ][0].ANIMALNAME)
+
+    def test_get_animal_data_unit_sponsor(self):
+        # Animals in a unit with no valid extra data still get an empty sponsor
+        dbo = base.get_dbo()
+        try:
+            asm3.configuration.unit_extra(dbo, "invalid")
+            rows = asm3.publishers.base.get_animal_data(dbo)
+            self.assertEqual([ "" ], list(set(r.UNITSPONSOR for r in rows if not r.ACTIVEMOVEMENTTYPE)))
+        finally:
+            asm3.configuration.unit_extra(dbo, "")
+
     def test_get_microchip_data(self):
         asm3.publishers.base.get_microchip_data(base.get_dbo(), [ "0", "1", "2", "3", "4", "5", "6", "7", "8", "9" ], "test")
 
@@ -148,6 +182,82 @@ class TestPublish(unittest.TestCase):
         self.assertNotEqual(0, len(asm3.publishers.html.get_animal_view_adoptable_js(base.get_dbo())))
 
     # adoptapet
+    def test_get_delta_animals(self):
+        dbo = base.get_dbo()
+        pc = asm3.publishers.base.PublishCriteria(asm3.configuration.publisher_presets(dbo))
+        pc.deltaOnly = True
+        p = asm3.publishers.base.AbstractPublisher(dbo, pc)
+        p.initLog("deltatest", "Delta Test")
+        animals = p.getMatchingAnimals()
+        self.assertNotEqual(0, len(animals))
+        self.assertEqual(len(animals), len(p.getDeltaAnimals(animals)))
+        p.markAnimalsPublished(animals)
+        self.assertEqual(0, len(p.getDeltaAnimals(animals)))
+        dbo.execute("UPDATE animal SET LastChangedDate=? WHERE ID=?", [ dbo.now() + datetime.timedelta(minutes=1), self.nid ])
+        p.markAnimalPublished(animals[-1].ID, extra="failed")
+        delta = p.getDeltaAnimals(p.getMatchingAnimals())
+        self.assertEqual(sorted(set([ self.nid, animals[-1].ID ])), sorted([ a.ID for a in delta ]))
+        p.markAnimalsPublished(animals)
+        dbo.execute("UPDATE animal SET LastChangedDate=? WHERE ID=?", [ dbo.now() - datetime.timedelta(minutes=1), self.nid ])
+        self.assertEqual(0, len(p.getDeltaAnimals(p.getMatchingAnimals())))
+        dbo.execute("UPDATE media SET Date=? WHERE LinkID=? AND LinkTypeID=0", [ dbo.now() + datetime.timedelta(minutes=1), self.nid ])
+        self.assertEqual([ self.nid ], [ a.ID for a in p.getDeltaAnimals(p.getMatchingAnimals()) ])
+
+    def test_ftp_upload_queue(self):
+        class FakeFTP(object):
+            stored = []
+            failures = 1
+            def pwd(self): return "/pub"
+            def cwd(self, d): self.dir = d
+            def close(self): pass
+            def quit(self): pass
+            def storbinary(self, cmd, f, callback=None):
+                if FakeFTP.failures > 0:
+                    FakeFTP.failures -= 1
+                    raise IOError("connection reset")
+                FakeFTP.stored.append(cmd)
+        pc = asm3.publishers.base.PublishCriteria("uploaddirectly")
+        p = asm3.publishers.base.FTPPublisher(base.get_dbo(), pc, "localhost", "user", "pass")
+        p.publishDir = tempfile.mkdtemp()
+        p.socket = FakeFTP()
+        p.openFTPSession = FakeFTP
+        sessions = asm3.publishers.base.FTP_UPLOAD_SESSIONS
+        asm3.publishers.base.FTP_UPLOAD_SESSIONS = 2
+        try:
+            for i in range(5):
+                asm3.utils.write_binary_file(os.path.join(p.publishDir, "%d.jpg" % i), b"image")
+                p.queueUpload("%d.jpg" % i)
+            p.stopUploads()
+        finally:
+            asm3.publishers.base.FTP_UPLOAD_SESSIONS = sessions
+            shutil.rmtree(p.publishDir)
+        self.assertEqual(sorted([ "STOR %d.jpg" % i for i in range(5) ]), sorted(FakeFTP.stored))
+        self.assertEqual(0, p.alerts)
+
+    def test_upload_images_generate(self):
+        # The main image and thumbnails are scaled in a batch through the derivative store
+        dbo = base.get_dbo()
+        pc = asm3.publishers.base.PublishCriteria("uploadall forcereupload thumbnails scaleimages=320x200 thumbnailsize=70x70")
+        p = asm3.publishers.base.FTPPublisher(dbo, pc, "localhost", "user", "pass")
+        p.publishDir = tempfile.mkdtemp()
+        p.existingImageList = set()
+        generated = []
+        oldgenerate = asm3.imagecache.generate
+        def generate(dbo, dbfsids, spec):
+            generated.append((spec, len(dbfsids)))
+            return oldgenerate(dbo, dbfsids, spec)
+        asm3.imagecache.generate = generate
+        try:
+            a = [ r for r in asm3.publishers.base.get_animal_data(dbo) if r.ID == self.nid ][0]
+            self.assertEqual(1, p.uploadImages(a))
+            files = sorted(os.listdir(p.publishDir))
+        finally:
+            asm3.imagecache.generate = oldgenerate
+            shutil.rmtree(p.publishDir)
+        self.assertEqual([ ("320x200", 1), ("70x70", 1) ], generated)
+        self.assertEqual([ "%s-1.jpg" % a.SHELTERCODE, "tn_%s-1.jpg" % a.SHELTERCODE ], files)
+        self.assertEqual(0, p.alerts)
+
     def test_adoptapet(self):
         pc = asm3.publishers.base.PublishCriteria()
         a = asm3.publishers.base.get_animal_data(base.get_dbo())[0]
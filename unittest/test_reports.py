@@ -3,6 +3,7 @@ import unittest
 import base
 import web062 as web
 
+import asm3.dbms.base
 import asm3.reports
 import asm3.utils
 
@@ -55,6 +56,48 @@ class TestReports(unittest.TestCase):
     def test_execute(self):
         asm3.reports.execute(base.get_dbo(), self.nid)
 
+    def test_execute_query(self):
+        rows, cols = asm3.reports.execute_query(base.get_dbo(), self.nid)
+        srows, scols = asm3.reports.execute_query(base.get_dbo(), self.nid, stream=True)
+        self.assertEqual(cols, scols)
+        self.assertEqual(len(rows), len(list(srows)))
+
+    def test_execute_stream(self):
+        dbo = base.get_dbo()
+        sql = "SELECT b.ID, b.BreedName, b.SpeciesID, s.SpeciesName, b.IsRetired FROM breed b INNER JOIN species s ON s.ID = b.SpeciesID ORDER BY s.SpeciesName, b.IsRetired, b.BreedName"
+        groups = "$$GROUP_SPECIESNAME $$HEAD <h2>$SPECIESNAME {COUNT.ID}</h2> $$FOOT <p>{SUM.ID.0}</p> GROUP$$ " \
+            "$$GROUP_ISRETIRED $$HEAD <h3>$ISRETIRED {FIRST.BREEDNAME}</h3> $$FOOT <p>{AVG.ID.1}</p> GROUP$$ "
+        footers = ( "$$FOOTER <p>{COUNT.ID} {MAX.SPECIESID} $BREEDNAME.</p> FOOTER$$", "$$FOOTER FOOTER$$" )
+        headers = ( "$$HEADER <h1>Breeds</h1> HEADER$$", "$$HEADER {SUM.ID} HEADER$$" ) # the second cannot stream
+        old = asm3.reports.STREAM_WINDOW
+        asm3.reports.STREAM_WINDOW = 2
+        try:
+            for header in headers:
+                for footer in footers:
+                    html = "%s %s $$BODY <p>$BREEDNAME {PCT.ISRETIRED.0}</p> BODY$$ %s" % (header, groups, footer)
+                    r = asm3.reports.Report(dbo)
+                    r.title = "Breeds"
+                    r.sql = sql
+                    r.html = html
+                    r.omitCriteria = True
+                    r.omitHeaderFooter = True
+                    chunks = list(r.ExecuteStream())
+                    self.assertEqual(header == headers[0], len(chunks) > 2)
+                    self.assertEqual(asm3.reports.execute_sql(dbo, "Breeds", sql, html, username="system"), "".join(chunks))
+        finally:
+            asm3.reports.STREAM_WINDOW = old
+
+    def test_replace_row_fields(self):
+        r = asm3.reports.Report(base.get_dbo())
+        row = asm3.dbms.base.ResultRow(ID=5, ANIMALNAME="Fi{do}", FEE="$10", A="", AB="x")
+        for html in ( "<p>$ID $AnimalName, $animalname.</p>", "$$FEE $fee", "$ID", "$A$AB $AB$A$A$A.", "$$ANIMALNAME", "$A$B " ):
+            legacy = html
+            for k, v in row.items():
+                legacy = r._ReplaceFields(legacy, k, r._DisplayValue(k, v))
+            self.assertEqual(legacy, r._ReplaceRowFields(html, row))
+            self.assertEqual(legacy, r._ReplaceRowFields(html, row)) # compiled template
+        self.assertEqual("5 Fi&#123;do&#125;.", r._ReplaceRowFields("$ID $ANIMALNAME.", row))
+
     def test_smcom_reports(self):
         asm3.reports.install_recommended_smcom_reports(base.get_dbo(), "test") # Calls get_reports to do the install
 
@@ -29,6 +29,12 @@ class TestUtils(unittest.TestCase):
         self.assertIsInstance(c, bytes)
         self.assertNotEqual(c.find(b"\"FIELD1"), -1)
 
+    def test_csv_generator(self):
+        data = [ { "FIELD1": "VAL1", "FIELD2": "Test" }, { "FIELD1": "MORE", "FIELD2": "OK" } ]
+        self.assertEqual("".join(asm3.utils.csv_generator("en", data)), "".join(asm3.utils.csv_generator("en", iter(data))))
+        self.assertEqual("\ufeff", "".join(asm3.utils.csv_generator("en", iter([]))))
+        self.assertEqual("\ufeff\"FIELD1\"\n", "".join(asm3.utils.csv_generator("en", [], cols=[ "FIELD1" ])))
+
     def test_csv_parse(self):
         data = u"FIELD1,FIELD2\n\"£,quoted\njunk\",field2"
         rows = asm3.utils.csv_parse(data)
@@ -476,3 +476,45 @@ class TestTemplate(unittest.TestCase):
         asm3.waitinglist.delete_waitinglist(base.get_dbo(), "test", wid)
         asm3.template.delete_document_template(base.get_dbo(), "test", tid)
 
+
+    def test_get_tokens(self):
+        s = "&lt;&lt;AnimalName&gt;&gt; &lt;&lt;<span>Vaccination</span>Name1&gt;&gt;"
+        tokens = asm3.wordprocessor.get_tokens(s)
+        self.assertIn("ANIMALNAME", tokens)
+        self.assertIn("VACCINATION", tokens)
+        self.assertTrue(asm3.wordprocessor.uses_tags(tokens, ("VACCINATION",)))
+        self.assertFalse(asm3.wordprocessor.uses_tags(tokens, ("DIET",)))
+        self.assertTrue(asm3.wordprocessor.uses_tags(None, ("DIET",)))
+
+    def test_lazy_tags(self):
+        dbo = base.get_dbo()
+        a = asm3.animal.get_animal(dbo, self.aid)
+        p = asm3.person.get_person(dbo, self.oid)
+        for eager, lazy in (
+            (asm3.wordprocessor.animal_tags(dbo, a), lambda t: asm3.wordprocessor.animal_tags(dbo, a, tokens=t)),
+            (asm3.wordprocessor.person_tags(dbo, p, includeImg=True, includeDonations=True, includeVouchers=True), 
+                lambda t: asm3.wordprocessor.person_tags(dbo, p, includeImg=True, includeDonations=True, includeVouchers=True, tokens=t))):
+            # Tags that are always generated must match
+            base_tags = lazy(set())
+            for k, v in base_tags.items():
+                self.assertEqual(eager[k], v, k)
+            # Asking for a tag that is skipped without tokens must generate it
+            skipped = sorted(set(eager.keys()) - set(base_tags.keys()))
+            self.assertNotEqual(0, len(skipped))
+            for k in skipped[::10]:
+                self.assertEqual(eager[k], lazy({ k })[k], k)
+
+    def test_read_template(self):
+        dbo = base.get_dbo()
+        tid = asm3.template.create_document_template(dbo, "test", "Test_Read", ".html", b"<p>&lt;&lt;AnimalName&gt;&gt; signature:user</p>")
+        try:
+            template = asm3.wordprocessor.read_template(dbo, tid)
+            tokens = asm3.wordprocessor.get_template_tokens(template)
+            self.assertIn("ANIMALNAME", tokens)
+            self.assertIn("USERSIGNATURESRC", tokens)
+            s = asm3.wordprocessor.substitute_template(dbo, template, { "ANIMALNAME": "Testio", "USERSIGNATURESRC": "sig" })
+            self.assertEqual("<p>Testio sig</p>", s)
+            # An unreadable odt template builds all tags
+            self.assertIsNone(asm3.wordprocessor.get_template_tokens(("bad.odt", b"notazip", None)))
+        finally:
+            asm3.template.delete_document_template(dbo, "test", tid)